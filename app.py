@@ -1,6 +1,19 @@
 from flask import Flask, request, render_template, session, redirect, url_for, jsonify, flash, send_from_directory, Response, stream_with_context, abort, template_rendered, send_file
-from config import SECRET_KEY, local_main, UPLOAD_FOLDER, TEST_GROUPS, local_complete, SO_GIO_TEST, TEAMS_WEBHOOK_URL_TRF, TEAMS_WEBHOOK_URL_RATE, TEMPLATE_MAP
-from excel_utils import get_item_code, get_col_idx, copy_row_with_style, write_tfr_to_excel, append_row_to_trf, export_expired_samples_to_excel
+from config import SECRET_KEY, local_main, UPLOAD_FOLDER, TEST_GROUPS, local_complete, SO_GIO_TEST, TEAMS_WEBHOOK_URL_TRF, TEAMS_WEBHOOK_URL_RATE, TEMPLATE_MAP, APPROVE_BATCH_FLUSH_EVERY, ETD_CALENDAR_FILE, IMAGE_ZIP_MAX_REPORTS
+from excel_utils import get_item_code, get_col_idx, copy_row_with_style, export_expired_samples_to_excel, commit_row_updates, build_tfr_row_updates
+from excel_utils import ExcelCommitBatch, queue_trf_row, is_report_in_open_batch, read_sheet_fast
+from report_db import get_report_view, flush_exports
+from report_alloc import reserve_report_no, commit_report_no, release_report_no, get_used_report_numbers
+import pending_store
+import image_manifest
+import image_derivs
+import image_seq
+import image_zip
+import blob_store
+from lock_utils import named_lock, lock_stats, reset_lock_stats
+from pdf_convert import converter_stats
+from job_queue import register_handler, create_job, get_job, list_jobs, job_events, iter_job_events, cancel_job, resume_job
+from archive_store import get_archive_store
 
 from image_utils import allowed_file, get_img_urls
 from auth import login, get_user_type
@@ -8,22 +21,24 @@ from test_logic import load_group_notes, get_group_test_status, is_drop_test, is
 from test_logic import IMPACT_ZONES, IMPACT_LABELS, ROT_LABELS, ROT_ZONES, RH_IMPACT_ZONES, RH_VIB_ZONES, RH_SECOND_IMPACT_ZONES, RH_STEP12_ZONES, update_group_note_file, get_group_note_value, F2057_TEST_TITLES
 from notify_utils import send_teams_message
 from counter_utils import update_counter, check_and_reset_counter, log_report_complete
-from docx_utils import approve_request_fill_docx_pdf, fill_cover_from_excel_generic, try_convert_to_pdf
+from docx_utils import approve_request_fill_docx_pdf, fill_cover_from_excel_generic, try_convert_to_pdf, warm_template_cache
+from docx_utils import render_request_docx, export_trf_pdf, get_docx_pool, reset_docx_pool, get_pdf_pool, load_report_rows
+from bulk_report import expand_report_spec, render_bulk, iter_bulk_zip
 from file_utils import (
     safe_write_json, safe_read_json, safe_save_excel, safe_load_excel,
-    safe_write_text, safe_read_text, safe_append_backup_json   # <— thêm hàm này
+    safe_write_text, safe_read_text, journal_append   # <— thêm hàm này
 )
-import re, os, pytz, json, openpyxl, random, subprocess, regex, traceback, calendar, time, tempfile, uuid, secrets, copy, glob, zipfile, io
-from contextlib import contextmanager
+import re, os, pytz, json, openpyxl, random, subprocess, regex, traceback, calendar, secrets, copy, glob, io
 from datetime import datetime, timedelta
 from waitress import serve
 from openpyxl import load_workbook, Workbook
 from openpyxl.styles import PatternFill
 from collections import defaultdict, OrderedDict
-from threading import Lock
-from contextlib import contextmanager
+from threading import Lock, Event
+from concurrent.futures import Future, CancelledError, wait as futures_wait
+from concurrent.futures.process import BrokenProcessPool
 from vfr3 import vfr3_bp
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
 from qr_print import qr_bp
 from testlab_dashboard import dashboard_bp
 from flask_session import Session
@@ -31,7 +46,6 @@ from collections import OrderedDict
 from markupsafe import Markup
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, date
-from uuid import uuid4
 from io import BytesIO
 
 app = Flask(__name__)
@@ -123,23 +137,18 @@ def _is_blank_cell(v):
 
 def row_is_filled_for_report(excel_path, report_no):
     """True nếu dòng có B == report_no ĐÃ có dữ liệu ở bất kỳ cột C..X; False nếu vẫn trống."""
-    wb = load_workbook(excel_path, data_only=True)
-    ws = wb.active
-    target_row = None
-    for r in range(2, ws.max_row + 1):
-        v = ws.cell(row=r, column=2).value  # cột B
-        if (str(v).strip() if v is not None else "") == str(report_no).strip():
-            target_row = r
-            break
+    # Đang nằm trong 1 đợt approve chưa flush ra Excel -> coi như đã dùng
+    if is_report_in_open_batch(report_no):
+        return True
+    idx = get_report_view(excel_path)
+    target_row = idx.find_row(report_no)
     if target_row is None:
-        wb.close()
         # Không thấy mã trong cột B (khác thiết kế) -> coi như đã dùng để tránh ghi bậy
         return True
-    for c in range(3, 25):  # C..X
-        if not _is_blank_cell(ws.cell(row=target_row, column=c).value):
-            wb.close()
+    values = idx.row_values(target_row) or ()
+    for v in values[2:24]:  # C..X
+        if not _is_blank_cell(v):
             return True   # ĐÃ có dữ liệu
-    wb.close()
     return False          # C..X đều trống => CHƯA dùng
 
 def format_excel_date_short(dt):
@@ -197,7 +206,7 @@ def calculate_default_etd(request_date: str, test_group: str, *, all_reqs=None)
 
     # Archive: dùng trực tiếp test_group nếu có, fallback map từ report_no
     try:
-        archive_list = safe_read_json(ARCHIVE_LOG) or []
+        archive_list = get_archive_store().records()
     except Exception:
         archive_list = []
 
@@ -298,55 +307,10 @@ def generate_unique_trq_id(existing_ids):
 ARCHIVE_LOG = "tfr_archive.json"
 TFR_LOG_FILE = "tfr_requests.json"
 
-@contextmanager
 def report_lock():
-    lock_dir = tempfile.gettempdir()              # Windows: C:\Users\<user>\AppData\Local\Temp
-    lock_path = os.path.join(lock_dir, "tfr_report.lock")
-    # Optional: timeout để không chờ vô hạn
-    timeout_s = 60
-    t0 = time.time()
-    fd = None
-    while True:
-        try:
-            # tạo mới, nếu đã có -> FileExistsError
-            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
-            # ghi chút info để debug stale lock
-            os.write(fd, f"pid={os.getpid()} run={uuid.uuid4()}".encode("utf-8"))
-            break
-        except FileExistsError:
-            # lock lâu quá coi như stale => cố gắng xoá
-            if time.time() - t0 > timeout_s:
-                _try_unlink_with_retry(lock_path)
-            else:
-                time.sleep(0.05 + random.random() * 0.15)
-    try:
-        yield
-    finally:
-        try:
-            if fd is not None:
-                os.close(fd)
-        except Exception:
-            pass
-        _try_unlink_with_retry(lock_path)
-
-def _try_unlink_with_retry(path, retries=8, delay=0.08):
-    # Windows có thể vướng PermissionError do AV; retry ngắn sẽ qua được
-    for i in range(retries):
-        try:
-            os.unlink(path)
-            return True
-        except FileNotFoundError:
-            return True
-        except PermissionError:
-            time.sleep(delay * (1.5 ** i))  # backoff
-        except Exception:
-            time.sleep(delay)
-    # fallback: đổi tên để không cản trở lần sau
-    try:
-        os.rename(path, path + ".stale")
-    except Exception:
-        pass
-    return False
+    # Khoá liên process cho cả phiên cấp số -> ghi Excel -> archive.
+    # flock/msvcrt (lock_utils): chờ blocking, OS tự nhả khi process chết, có thống kê wait/hold.
+    return named_lock("tfr_report")
 
 def bump_report_no(s):
     m = re.search(r'(\d+)$', str(s))
@@ -360,138 +324,86 @@ def bump_report_no(s):
 def report_no_exists(report_no, tfr_requests):
     """
     ĐÃ DÙNG khi:
-    - Dòng B==report_no trong Excel có dữ liệu C..X (không còn trống), HOẶC
+    - Số không còn free trong report_slots (đã có dữ liệu C..X / đang giữ chỗ), HOẶC
     - File đầu ra cho mã đó đã tồn tại (pdf/docx), HOẶC
     - Mã này đã nằm trong archive/log (đã approve).
     """
-    # 1) Excel: dòng đã có dữ liệu?
+    # Tra set trong UsedReportNumbers (load 1 lần từ 4 nguồn, cập nhật dần)
     try:
+        if get_used_report_numbers().contains(report_no):
+            return True
+    except Exception as e:
+        print("UsedReportNumbers lỗi, kiểm tra trực tiếp:", e)
         if row_is_filled_for_report(local_main, report_no):
             return True
-    except Exception:
-        pass
-
-    # 2) Trùng file đã sinh?
-    output_folder = os.path.join('static', 'TFR')
-    if os.path.exists(os.path.join(output_folder, f"{report_no}.pdf")):
-        return True
-    if os.path.exists(os.path.join(output_folder, f"{report_no}.docx")):
-        return True
+        output_folder = os.path.join('static', 'TFR')
+        for ext in ('.pdf', '.docx'):
+            if os.path.exists(os.path.join(output_folder, f"{report_no}{ext}")):
+                return True
+        if get_archive_store().find_by_report(report_no):
+            return True
 
-    # 3) Trùng trong log pending đang dùng?
+    # Danh sách pending caller đang cầm (có thể chưa ghi ra file)
     for r in tfr_requests:
         if str(r.get("report_no") or "").strip() == str(report_no):
             return True
 
-    # 4) Trùng trong archive (đã approve)?
-    try:
-        archive = safe_read_json(ARCHIVE_LOG)
-        for r in archive:
-            if str(r.get("report_no") or "").strip() == str(report_no):
-                return True
-    except Exception:
-        pass
-
     return False
 
-def allocate_unique_report_no(make_report_func, req, tfr_requests, max_try=2):
+def allocate_unique_report_no(make_report_func, req, tfr_requests):
     """
-    Cấp và cố định report_no đúng logic:
-    - Nếu req đã có report_no: kiểm tra dòng B==report_no còn trống (C..X). Nếu đã có dữ liệu -> báo lỗi.
-    - Nếu chưa có: để make_report_func chọn DÒNG TRỐNG (C..X trống) và trả về report_no tương ứng.
-    - Có retry nhẹ (bump số) nếu hi hữu bị chiếm chỗ giữa chừng.
+    Cấp và cố định report_no qua report_slots (report_alloc):
+    - Nếu req đã có report_no: giữ chỗ đúng số đó (đã có dữ liệu / đang giữ -> báo lỗi).
+    - Nếu chưa có: giữ chỗ số free nhỏ nhất (dòng C..X trống).
+    - make_report_func luôn chạy với số đã giữ; lỗi -> trả số lại (release).
+    Caller gọi commit_report_no() sau khi ghi Excel xong.
     """
-    tries = 0
+    preset = str(req.get("report_no", "") or "").strip()
+    report_no = reserve_report_no(owner=req.get("trq_id", ""), preset=preset or None)
 
-    # Case A: preset report_no trong req
     fixed_req = dict(req)
-    preset = str(fixed_req.get("report_no", "")).strip()
-    if preset:
-        if row_is_filled_for_report(local_main, preset):
-            raise RuntimeError(f"Mã report {preset} đã có dữ liệu, không thể ghi đè.")
+    fixed_req["report_no"] = report_no
+    try:
         pdf_path, report_no = make_report_func(fixed_req)  # docx_utils ưu tiên số đã set
-        return pdf_path, report_no
-
-    # Case B: chưa có -> để make_report_func chọn dòng C..X trống
-    while True:
-        pdf_path, report_no = make_report_func(req)
-
-        # Xác nhận lại: dòng vẫn còn trống?
-        if not row_is_filled_for_report(local_main, report_no):
-            return pdf_path, report_no
-
-        # Hi hữu: ai đó vừa điền vào dòng này giữa chừng -> thử lại (bump số + regenerate)
-        tries += 1
-        if tries >= max_try:
-            raise RuntimeError("Không tìm được dòng trống để cấp mã report.")
-
-        # Xoá file vừa sinh (đi nhầm dòng)
-        try:
-            outdir = os.path.join('static', 'TFR')
-            for ext in ('.pdf', '.docx'):
-                fp = os.path.join(outdir, f"{report_no}{ext}")
-                if os.path.exists(fp):
-                    os.remove(fp)
-        except Exception:
-            pass
-
-        # Bump số và tái tạo với số cố định
-        tries += 1
-        if tries >= max_try:
-            raise RuntimeError("Không cấp được report_no duy nhất sau nhiều lần thử")
-
-        bumped = bump_report_no(report_no)
-        fixed_req = dict(req)
-        fixed_req["report_no"] = bumped
-        pdf_path, report_no = make_report_func(fixed_req)
+    except Exception:
+        release_report_no(report_no)
+        raise
+    return pdf_path, report_no
 
 # ---- ARCHIVE REQUEST LOG ----
 def archive_request(short_data):
-    now = datetime.now()
-    archive = safe_read_json(ARCHIVE_LOG)
-    def get_dt(d):
-        if "-" in d: return datetime.strptime(d, "%Y-%m-%d")
-        else: return datetime.strptime(d, "%d/%m/%Y")
-    archive = [r for r in archive if (now - get_dt(r["request_date"])).days < 14]
-    archive.append(short_data)
-    safe_write_json(ARCHIVE_LOG, archive)
-    safe_append_backup_json(ARCHIVE_LOG, short_data) 
-
-# --- ADD NEW: cleanup archive file (>14 ngày) ---
-def cleanup_archive_json(days=14):
     """
-    Xóa các bản ghi archive quá 'days' ngày (xóa thật trong JSON).
-    Ưu tiên ARCHIVE_LOG / TFR_ARCHIVE_FILE nếu có; nếu không suy ra từ TFR_LOG_FILE.
+    Append 1 record vào archive segment (archive_store) thay vì đọc/ghi lại cả tfr_archive.json.
+    Record quá 14 ngày (request_date) tự ẩn khi đọc; segment cả tháng quá hạn thì xoá nguyên file.
     """
+    store = get_archive_store()
+    # chạy lại 1 bước approve (resume job) -> không archive trùng
+    if any(r.get("trq_id") == short_data.get("trq_id") for r in store.find_by_report(short_data.get("report_no"))):
+        return
+    _etd_approved_counts()   # nạp lịch ETD theo archive CŨ trước khi ghi (note_etd_approved +1 sau)
+    with named_lock("tfr_archive"):   # stamp trước/sau chỉ khác nhau đúng record này
+        stamp_before = store.stamp()
+        store.append(short_data)
+        stamp_after = store.stamp()
+    store.drop_expired()
+    journal_append(ARCHIVE_LOG, short_data)   # tfr_archive_backup.jsonl (append O(1))
     try:
-        archive_path = globals().get("ARCHIVE_LOG") or globals().get("TFR_ARCHIVE_FILE")
-        if not archive_path:
-            base, ext = os.path.splitext(TFR_LOG_FILE)
-            archive_path = f"{base}_archive.json"
-
-        data = safe_read_json(archive_path)
-        if not isinstance(data, list) or not data:
-            return
-        def _parse_date(s):
-            if not s:
-                return None
-            for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%Y/%m/%d", "%d-%m-%Y"):
-                try:
-                    return datetime.strptime(str(s), fmt).date()
-                except Exception:
-                    pass
-            return None
+        get_used_report_numbers().add(short_data.get("report_no"), "archive")
+    except Exception as e:
+        print("UsedReportNumbers update lỗi:", e)
+    try:
+        note_etd_approved(short_data.get("request_date"), short_data.get("test_group"), stamp_before, stamp_after)
+    except Exception as e:
+        print("Lịch ETD update lỗi:", e)
 
-        today = datetime.now(pytz.timezone("Asia/Ho_Chi_Minh")).date()
-        kept = []
-        for r in data:
-            d = None
-            if isinstance(r, dict):
-                d = _parse_date(r.get("approved_date")) or _parse_date(r.get("etd")) or _parse_date(r.get("request_date"))
-            if not d or (today - d).days <= days:
-                kept.append(r)
-        if len(kept) != len(data):
-            safe_write_json(archive_path, kept)
+# --- ADD NEW: cleanup archive (>14 ngày) ---
+def cleanup_archive_json(days=14):
+    """
+    Xoá các segment archive mà cả tháng đã quá 'days' ngày (xoá nguyên file, không ghi lại).
+    Record lẻ quá hạn trong segment còn lại đã được ẩn khi đọc.
+    """
+    try:
+        get_archive_store().drop_expired(days)
     except Exception as _e:
         print("cleanup_archive_json error:", _e)
 
@@ -533,15 +445,13 @@ def home():
     all_statuses = ['LATE', 'MUST', 'DUE', 'ACTIVE', 'COMPLETE', 'DONE']
     raw_status_set = set()
     try:
-        wb = load_workbook(local_main)
-        ws = wb.active
+        idx = get_report_view(local_main)
         def clean_col(s):
             s = str(s).lower().strip()
             s = re.sub(r'[^a-z0-9#]+', '', s)
             return s
         headers = {}
-        for col in range(2, ws.max_column + 1):
-            name = ws.cell(row=1, column=col).value
+        for col, name in enumerate(idx.headers[1:], start=2):
             if name:
                 clean = clean_col(name)
                 headers[clean] = col
@@ -554,14 +464,16 @@ def home():
         if None in (report_col, item_col, status_col, test_date_col):
             message = f"Missing columns in Excel file! Found: {headers}"
         else:
-            for row in range(2, ws.max_row + 1):
-                status_raw = ws.cell(row=row, column=status_col).value
+            def _v(values, col):
+                return values[col - 1] if col and len(values) >= col else None
+            for _, values in idx.iter_rows():
+                status_raw = _v(values, status_col)
                 status = str(status_raw).strip().upper() if status_raw else ""
-                report = ws.cell(row=row, column=report_col).value
-                item = ws.cell(row=row, column=item_col).value
-                etd = ws.cell(row=row, column=etd_col).value if etd_col else ""
-                type_of = ws.cell(row=row, column=type_of_col).value if type_of_col else ""
-                log_date = ws.cell(row=row, column=test_date_col).value
+                report = _v(values, report_col)
+                item = _v(values, item_col)
+                etd = _v(values, etd_col) if etd_col else ""
+                type_of = _v(values, type_of_col) if type_of_col else ""
+                log_date = _v(values, test_date_col)
                 log_date_str = str(log_date).strip() if log_date else ""
                 if log_date_str: log_date_str = log_date_str.split()[0]
                 r_dict = {
@@ -718,14 +630,6 @@ def get_category_component_position(finishing_type, material_type):
             return "LINE TEST_METAL"
     return ""
 
-def _load_pending_locked():
-    with PENDING_LOCK:
-        return safe_read_json(TFR_LOG_FILE)
-
-def _write_pending_locked(data):
-    with PENDING_LOCK:
-        safe_write_json(TFR_LOG_FILE, data)
-
 # ==== Helpers nhóm test ====
 def _group_of(test_group: str) -> str:
     """
@@ -781,17 +685,16 @@ def _build_reportno_to_group_map():
     Dựa vào cột 'type of' mà approve_all_one() đã điền.
     """
     try:
-        wb = safe_load_excel(local_main)
-        ws = wb.active
-        col_report = get_col_idx(ws, "report#")
-        col_typeof = get_col_idx(ws, "type of")
+        idx = get_report_view(local_main)
+        col_report = idx.col("report#")
+        col_typeof = idx.col("type of")
         if not col_report or not col_typeof:
             return {}
 
         mapping = {}
-        for row in range(2, ws.max_row + 1):
-            rep = ws.cell(row=row, column=col_report).value
-            tp  = ws.cell(row=row, column=col_typeof).value
+        for _, values in idx.iter_rows():
+            rep = values[col_report - 1] if len(values) >= col_report else None
+            tp  = values[col_typeof - 1] if len(values) >= col_typeof else None
             rep_s = ("" if rep is None else str(rep)).strip()
             tp_s  = ("" if tp  is None else str(tp )).strip()
             if not rep_s:
@@ -805,65 +708,107 @@ def _build_reportno_to_group_map():
         return {}
 
 
-def calculate_default_etd(request_date: str, test_group: str, *, all_reqs=None) -> str:
-    """
-    ETD mặc định, tính từ request_date (tính CẢ ngày request).
-    TẢI TRONG NGÀY = Pending (chỉ Submitted) + Approved (Archive), loại bỏ Declined.
+# ==== LỊCH TẢI ETD (date x group) ====
+# approved: {"YYYY-MM-DD|GROUP": số request đã approve} — lưu ra ETD_CALENDAR_FILE,
+#   +1 mỗi lần approve (note_etd_approved), chỉ build lại từ archive + Excel khi archive bị sửa ngoài app.
+# submitted: đếm 1 lượt trên danh sách pending (không đọc file / Excel).
+_ETD_CAL = {"approved": None, "archive_stamp": None}
+_ETD_CAL_LOCK = Lock()
+ETD_KEEP_DAYS = 14   # cùng hạn giữ với archive_request
 
-    - CONSTRUCTION / TRANSIT: 3 ngày  -> base +2 ngày
-      * tải (trong cùng request_date), đếm THEO REQUEST:
-        - đã có ≥5  req  (đang là req #6..#10)  -> +1 ngày
-        - đã có ≥10 req (đang là req #11..#15) -> +2 ngày
+def _etd_key(request_date, group):
+    return f"{(request_date or '').strip()}|{_group_of(group)}"
 
-    - FINISHING / MATERIAL : 5 ngày  -> base +4 ngày
-      * tải:
-        - đã có ≥15 req (đang là #16..#30) -> +2 ngày
-        - đã có ≥30 req (đang là #31..#45) -> +4 ngày
-    """
-    if not request_date:
-        return ""
+def _prune_etd_counts(counts):
+    cutoff = (datetime.now() - timedelta(days=ETD_KEEP_DAYS)).strftime("%Y-%m-%d")
+    for k in [k for k in counts if k.split("|", 1)[0] < cutoff]:
+        counts.pop(k, None)
 
-    g = _group_of(test_group)
-    if g in ("CONSTRUCTION", "TRANSIT"):
-        base = 2   # 3 ngày tính cả ngày request => +2
-    elif g in ("FINISHING", "MATERIAL"):
-        base = 4   # 5 ngày tính cả ngày request => +4
-    else:
-        base = 2
+def _save_etd_calendar():
+    try:
+        safe_write_json(ETD_CALENDAR_FILE, {
+            "approved": _ETD_CAL["approved"],
+            "archive_stamp": _ETD_CAL["archive_stamp"],
+        })
+    except Exception as e:
+        print("Lưu lịch ETD lỗi:", e)
 
-    # GHÉP Pending (chỉ Submitted) + Archive để đếm tải theo ngày/type
+def rebuild_etd_calendar():
+    """Build lại số đã approve theo (ngày, nhóm) từ archive; nhóm lấy theo cột 'type of' trong Excel."""
+    stamp = get_archive_store().stamp()   # lấy trước khi đọc: có ghi chen vào thì stamp lệch -> lần sau build lại
     try:
-        archive_list = safe_read_json(ARCHIVE_LOG) or []
+        archive_list = get_archive_store().records()
     except Exception:
         archive_list = []
-
-    # Archive không có test_group, nên join qua Excel để gán group
     rep2grp = _build_reportno_to_group_map()
-    archive_mapped = []
+    approved = {}
     for a in archive_list:
         try:
-            # giữ các khóa cần cho _count_by_date_and_group
             req_date = (a.get("request_date") or "").strip()
-            rep_no   = (a.get("report_no") or "").strip()
-            grp      = rep2grp.get(rep_no, "")
+            grp      = rep2grp.get((a.get("report_no") or "").strip(), "")
             if not req_date or not grp:
                 continue
-            archive_mapped.append({
-                "request_date": req_date,
-                "test_group": grp,       # để _group_of hiểu
-                "status": "Approved",    # đánh dấu để lọc hợp lệ
-            })
+            key = _etd_key(req_date, grp)
+            approved[key] = approved.get(key, 0) + 1
         except Exception:
             continue
+    with _ETD_CAL_LOCK:
+        _ETD_CAL["approved"] = approved
+        _ETD_CAL["archive_stamp"] = stamp
+        _save_etd_calendar()
+    return approved
+
+def _etd_approved_counts():
+    stamp = get_archive_store().stamp()
+    with _ETD_CAL_LOCK:
+        if _ETD_CAL["approved"] is None:
+            saved = safe_read_json(ETD_CALENDAR_FILE, default={})
+            if isinstance(saved, dict) and isinstance(saved.get("approved"), dict):
+                _ETD_CAL["approved"] = saved["approved"]
+                _ETD_CAL["archive_stamp"] = saved.get("archive_stamp")
+        if _ETD_CAL["approved"] is not None and _ETD_CAL["archive_stamp"] == stamp:
+            return _ETD_CAL["approved"]
+    # archive bị sửa ngoài luồng approve (hoặc chưa có lịch) -> build lại
+    return rebuild_etd_calendar()
+
+def note_etd_approved(request_date, test_group, stamp_before, stamp_after):
+    """
+    Gọi trong archive_request() sau khi ghi: +1 tải cho (request_date, group), không đọc lại archive/Excel.
+    stamp_before/after: stamp archive ngay trước/sau lần ghi (giữ named_lock("tfr_archive")).
+    Lịch chỉ +1 khi đang đúng bằng archive trước lần ghi; lệch (có ghi khác chen vào / vừa build lại)
+    thì để nguyên stamp cũ -> lần đọc tới build lại từ archive (không sót, không đếm 2 lần).
+    """
+    if not request_date:
+        return
+    with _ETD_CAL_LOCK:
+        counts = _ETD_CAL["approved"]
+        if counts is None or _ETD_CAL["archive_stamp"] != stamp_before:
+            return
+        key = _etd_key(request_date, test_group)
+        counts[key] = counts.get(key, 0) + 1
+        _prune_etd_counts(counts)
+        _ETD_CAL["archive_stamp"] = stamp_after
+        _save_etd_calendar()
+
+def _etd_submitted_counts(all_reqs):
+    counts = {}
+    for r in (all_reqs or []):
+        try:
+            if (r.get("status") or "").strip() != "Submitted":
+                continue
+            key = _etd_key(r.get("request_date"), r.get("test_group") or r.get("type_of_test"))
+            counts[key] = counts.get(key, 0) + 1
+        except Exception:
+            continue
+    return counts
 
-    combined = []
-    # Pending (all_reqs) – chỉ muốn Submitted
-    if isinstance(all_reqs, list):
-        combined += [r for r in all_reqs if (r.get("status") or "").strip() == "Submitted"]
-    # Approved (archive đã map)
-    combined += archive_mapped
-
-    cnt = _count_by_date_and_group(combined, request_date, g)
+def _etd_from_load(request_date, g, cnt):
+    if g in ("CONSTRUCTION", "TRANSIT"):
+        base = 2   # 3 ngày tính cả ngày request => +2
+    elif g in ("FINISHING", "MATERIAL"):
+        base = 4   # 5 ngày tính cả ngày request => +4
+    else:
+        base = 2
 
     extra = 0
     if g in ("CONSTRUCTION", "TRANSIT"):
@@ -881,6 +826,33 @@ def calculate_default_etd(request_date: str, test_group: str, *, all_reqs=None)
     etd = d0 + timedelta(days=base + extra)
     return etd.strftime("%Y-%m-%d")
 
+def calculate_default_etd(request_date: str, test_group: str, *, all_reqs=None, submitted_counts=None) -> str:
+    """
+    ETD mặc định, tính từ request_date (tính CẢ ngày request).
+    TẢI TRONG NGÀY = Pending (chỉ Submitted) + Approved (lịch ETD), loại bỏ Declined.
+
+    - CONSTRUCTION / TRANSIT: 3 ngày  -> base +2 ngày
+      * tải (trong cùng request_date), đếm THEO REQUEST:
+        - đã có ≥5  req  (đang là req #6..#10)  -> +1 ngày
+        - đã có ≥10 req (đang là req #11..#15) -> +2 ngày
+
+    - FINISHING / MATERIAL : 5 ngày  -> base +4 ngày
+      * tải:
+        - đã có ≥15 req (đang là #16..#30) -> +2 ngày
+        - đã có ≥30 req (đang là #31..#45) -> +4 ngày
+
+    submitted_counts: kết quả _etd_submitted_counts(all_reqs) dùng lại khi tính cho nhiều request.
+    """
+    if not request_date:
+        return ""
+
+    g = _group_of(test_group)
+    key = _etd_key(request_date, g)
+    if submitted_counts is None:
+        submitted_counts = _etd_submitted_counts(all_reqs if isinstance(all_reqs, list) else [])
+    cnt = _etd_approved_counts().get(key, 0) + submitted_counts.get(key, 0)
+    return _etd_from_load(request_date, g, cnt)
+
 TFR_INIT_DIR = os.path.join('static', 'TFR_INIT')
 os.makedirs(TFR_INIT_DIR, exist_ok=True)
 
@@ -900,7 +872,8 @@ def _save_initial_img(file_storage, trq_id):
 
 @app.route("/tfr_request_form", methods=["GET", "POST"])
 def tfr_request_form():
-    tfr_requests = _load_pending_locked()
+    pending_rows_snap = pending_store.pending_rows()   # [(pid, record)]
+    tfr_requests = [r for _, r in pending_rows_snap]
     error = ""
     form_data = {}
     missing_fields = []
@@ -1119,16 +1092,19 @@ def tfr_request_form():
                 pass
 
         # ---- Ghi đè item cũ hoặc append mới ----
+        target_pid = None   # dòng pending sẽ bị ghi đè (None = thêm mới)
         if trq_id and edit_idx is not None:
             try:
                 _abs = int(edit_idx)
                 if 0 <= _abs < len(tfr_requests) and tfr_requests[_abs].get("trq_id") == trq_id:
                     tfr_requests[_abs] = new_request
+                    target_pid = pending_rows_snap[_abs][0]
                 else:
                     # Fallback theo ordinal trong nhóm cùng trq_id
                     matches = [i for i, req in enumerate(tfr_requests) if req.get("trq_id") == trq_id]
                     if len(matches) > _abs:
                         tfr_requests[matches[_abs]] = new_request
+                        target_pid = pending_rows_snap[matches[_abs]][0]
                     else:
                         tfr_requests.append(new_request)
             except Exception:
@@ -1148,7 +1124,7 @@ def tfr_request_form():
         old_initial_img = None
         old_initial_images = []
         if editing:
-            old_list = safe_read_json(TFR_LOG_FILE) or []
+            old_list = [r for _, r in pending_rows_snap]
             try:
                 idx_keep = int(form.get("edit_idx", "-1"))
                 if 0 <= idx_keep < len(old_list):
@@ -1196,9 +1172,10 @@ def tfr_request_form():
                     new_request["initial_images"] = []
                     new_request["initial_img"] = None
 
-        # Ghi log như cũ
-        safe_write_json(TFR_LOG_FILE, tfr_requests)
-        safe_append_backup_json(TFR_LOG_FILE, new_request)
+        # Chỉ ghi đúng 1 dòng pending (không ghi lại cả danh sách)
+        if target_pid is None or not pending_store.update_request(target_pid, new_request):
+            pending_store.insert_request(new_request)
+        journal_append(TFR_LOG_FILE, new_request)
 
         message = (
             f"📝 [TRF] Có yêu cầu Test Request mới!\n"
@@ -1246,70 +1223,8 @@ def tfr_request_form():
         edit_idx=edit_idx
     )
 
-PENDING_LOCK = Lock()
-CANCEL_FLAGS = {} 
-
 def _read_pending():
-    return safe_read_json(TFR_LOG_FILE)
-
-def _write_pending(new_list):
-    safe_write_json(TFR_LOG_FILE, new_list)
-
-def _merge_update_etd(updates):
-    """
-    Cập nhật ETD an toàn theo dữ liệu mới nhất trong file:
-    - Nếu update có cả idx & trq_id: ưu tiên khớp trq_id, rồi mới rơi về idx.
-    - Nếu chỉ có trq_id: dùng trq_id.
-    - Nếu chỉ có idx: dùng idx, nhưng vẫn check bounds.
-    """
-    with PENDING_LOCK:
-        cur = _read_pending()
-        # Tạo map {trq_id: index} trên dữ liệu MỚI NHẤT
-        id_to_idx = {}
-        for i, r in enumerate(cur):
-            tid = (r.get("trq_id") or "").strip()
-            if tid:
-                id_to_idx[tid] = i
-
-        changed = False
-        for u in updates:
-            tid = (u.get("trq_id") or "").strip()
-            etd = (u.get("etd") or "").strip()
-            idx = u.get("idx")
-
-            # Ưu tiên dùng trq_id
-            if tid and tid in id_to_idx:
-                cur[id_to_idx[tid]]["etd"] = etd
-                changed = True
-            # Fallback dùng idx nếu hợp lệ
-            elif isinstance(idx, int) and 0 <= idx < len(cur):
-                cur[idx]["etd"] = etd
-                changed = True
-
-        if changed:
-            _write_pending(cur)
-        return cur  # trả về snapshot mới nhất sau khi đã merge ETD
-
-def _remove_approved_from_file(approved_trq_ids):
-    """
-    Xóa các request đã Approved RA KHỎI FILE theo trq_id (merge an toàn):
-    - Luôn đọc file mới nhất
-    - Lọc bỏ các phần tử có trq_id thuộc tập approved_trq_ids
-    - Không đụng chạm các request mới phát sinh
-    """
-    if not approved_trq_ids:
-        return
-
-    with PENDING_LOCK:
-        cur = _read_pending()
-        keep = []
-        approved_set = {tid.strip() for tid in approved_trq_ids if tid}
-        for r in cur:
-            tid = (r.get("trq_id") or "").strip()
-            if tid and tid in approved_set:
-                continue  # bỏ các request vừa approve
-            keep.append(r)
-        _write_pending(keep)
+    return pending_store.pending_list()
 
 def make_id_index_map(pending_list):
     """
@@ -1328,11 +1243,70 @@ def make_id_index_map(pending_list):
     return mapping
 
 # --- HÀM DUYỆT 1 REQUEST (giữ nguyên nếu app bạn đang xài) ---
-def approve_all_one(req):
+def _approve_row_updates(view, req):
+    """
+    Các ô approve ghi thêm sau write_tfr_to_excel (item#, type of, QA comment, ETD, log in date...).
+    Trả về dict {col: (value, number_format|None)} để ghi chung 1 lần với build_tfr_row_updates().
+    """
+    updates = {}
+
+    def set_val(col_name, value, is_date_col=False):
+        col_idx = view.col(col_name)
+        if col_idx:
+            if is_date_col:
+                dt_val = try_parse_excel_date(value)
+                if dt_val:
+                    updates[col_idx] = (dt_val, 'dd-mmm')   # <- đổi d-mmm -> dd-mmm
+                else:
+                    updates[col_idx] = (value, None)
+            else:
+                updates[col_idx] = (value.upper() if isinstance(value, str) else value, None)
+
+    def clean_type_of(val):
+        return val[:-5].strip() if val and isinstance(val, str) and val.upper().endswith(" TEST") else val
+
+    set_val("item#", req.get("item_code", ""))
+    set_val("type of", clean_type_of(req.get("test_group", "")))
+    set_val("item name/ description", req.get("sample_description", ""))
+    set_val("furniture testing", req.get("furniture_testing", ""))
+    set_val("submiter in", req.get("requestor", ""))
+    set_val("submited", req.get("department", ""))
+    # QA comment: gộp Remark + Subcon (nếu có)
+    remark_val = (req.get("remark") or "").strip()
+    subcon_val = (req.get("subcon") or "").strip()
+
+    qa_comment = ""
+
+    if remark_val:
+        qa_comment = remark_val
+
+    if subcon_val and subcon_val.upper() != "N/A":
+        if qa_comment:
+            qa_comment = f"{qa_comment} | SUBCON: {subcon_val}"
+        else:
+            qa_comment = f"SUBCON: {subcon_val}"
+
+    set_val("qa comment", qa_comment)
+
+    etd_val = req.get("etd", "")
+    set_val("etd", etd_val, is_date_col=True)  # <-- bỏ format_excel_date_short
+
+    vn_tz = pytz.timezone("Asia/Ho_Chi_Minh")
+    req_login = (req.get("request_date") or "").strip()
+    val_for_excel = req_login if req_login else datetime.now(vn_tz).strftime("%Y-%m-%d")
+    set_val("log in date", val_for_excel, is_date_col=True)
+
+    finishing_type = req.get("finishing_type", "")
+    material_type  = req.get("material_type", "")
+    cat_comp_pos   = get_category_component_position(finishing_type, material_type)
+    set_val("category / component name / position", cat_comp_pos)
+    return updates
+
+def approve_all_one(req, batch=None):
     """
     Approve 1 request:
       - cấp report_no + tạo DOCX/PDF
-      - cập nhật Excel + TRF.xlsx
+      - cập nhật Excel + TRF.xlsx (có batch -> chỉ gom, batch.flush() mới ghi)
       - đẩy vào archive
       - trả về req đã cập nhật (status/report_no/pdf_path/docx_path)
     """
@@ -1340,18 +1314,14 @@ def approve_all_one(req):
     with report_lock():                              # ← THÊM DÒNG NÀY
         # (giữ thread-lock như cũ để an toàn trong cùng process)
         with REPORT_NO_LOCK:
-            current_list = safe_read_json(TFR_LOG_FILE)
+            current_list = _read_pending()
             pdf_path, report_no = allocate_unique_report_no(
                 approve_request_fill_docx_pdf, req, current_list
             )
 
-        req["status"] = "Approved"
-        req["decline_reason"] = ""
         req["report_no"] = report_no
-
-        output_folder = os.path.join('static', 'TFR')
-        output_docx = os.path.join(output_folder, f"{report_no}.docx")
-        output_pdf  = os.path.join(output_folder, f"{report_no}.pdf")
+        output_docx = os.path.join('static', 'TFR', f"{report_no}.docx")
+        output_pdf  = os.path.join('static', 'TFR', f"{report_no}.pdf")
 
         try:
             if not os.path.exists(output_pdf):
@@ -1359,236 +1329,406 @@ def approve_all_one(req):
         except Exception as _pdf_e:
             print("PDF convert failed, fallback to DOCX:", _pdf_e)
 
-        if os.path.exists(output_pdf):
-            req['pdf_path'] = f"TFR/{report_no}.pdf"
-            req['docx_path'] = None
-        else:
-            req['pdf_path'] = None
-            req['docx_path'] = f"TFR/{report_no}.docx"
-
-    # Ghi Excel & TRF.xlsx & archive (giữ nguyên như bạn đang có)
-        try:
-            write_tfr_to_excel(local_main, report_no, req)
-            wb = load_workbook(local_main)
-            ws = wb.active
-            report_col = get_col_idx(ws, "report#")
-            row_idx = None
-            for row in range(2, ws.max_row + 1):
-                v = ws.cell(row=row, column=report_col).value
-                if v and str(v).strip() == str(report_no):
-                    row_idx = row
-                    break
-            if row_idx:
-                def set_val(col_name, value, is_date_col=False):
-                    col_idx = get_col_idx(ws, col_name)
-                    if col_idx:
-                        cell = ws.cell(row=row_idx, column=col_idx)
-                        if is_date_col:
-                            dt_val = try_parse_excel_date(value)
-                            if dt_val:
-                                cell.value = dt_val
-                                cell.number_format = 'dd-mmm'   # <- đổi d-mmm -> dd-mmm
-                            else:
-                                cell.value = value
-                        else:
-                            cell.value = value.upper() if isinstance(value, str) else value
-
-                def clean_type_of(val):
-                    return val[:-5].strip() if val and isinstance(val, str) and val.upper().endswith(" TEST") else val
-
-                set_val("item#", req.get("item_code", ""))
-                set_val("type of", clean_type_of(req.get("test_group", "")))
-                set_val("item name/ description", req.get("sample_description", ""))
-                set_val("furniture testing", req.get("furniture_testing", ""))
-                set_val("submiter in", req.get("requestor", ""))
-                set_val("submited", req.get("department", ""))
-                # QA comment: gộp Remark + Subcon (nếu có)
-                remark_val = (req.get("remark") or "").strip()
-                subcon_val = (req.get("subcon") or "").strip()
-
-                qa_comment = ""
-
-                if remark_val:
-                    qa_comment = remark_val
-
-                if subcon_val and subcon_val.upper() != "N/A":
-                    if qa_comment:
-                        qa_comment = f"{qa_comment} | SUBCON: {subcon_val}"
-                    else:
-                        qa_comment = f"SUBCON: {subcon_val}"
+        _commit_approved(req, batch=batch)
+    return req
 
-                set_val("qa comment", qa_comment)
+def _commit_approved(req, batch=None):
+    """
+    Phần "ghi" của approve cho 1 request đã có report_no + DOCX/PDF:
+    status/pdf_path -> Excel (SQLite trước, exporter ghi file sau) -> TRF.xlsx -> archive.
+    Lỗi từng bước chỉ log (giống cũ), không chặn các bước sau.
+    """
+    report_no = req["report_no"]
+    req["status"] = "Approved"
+    req["decline_reason"] = ""
+
+    output_pdf = os.path.join('static', 'TFR', f"{report_no}.pdf")
+    if os.path.exists(output_pdf):
+        req['pdf_path'] = f"TFR/{report_no}.pdf"
+        req['docx_path'] = None
+    else:
+        req['pdf_path'] = None
+        req['docx_path'] = f"TFR/{report_no}.docx"
 
-                etd_val = req.get("etd", "")
-                set_val("etd", etd_val, is_date_col=True)  # <-- bỏ format_excel_date_short
+    try:
+        view = get_report_view(local_main)
+        row_idx = view.find_row(report_no)
+        if row_idx is None:
+            raise Exception(f"Không tìm thấy mã report {report_no} trong file excel!")
+        updates = build_tfr_row_updates(view.headers, req)
+        updates.update(_approve_row_updates(view, req))
+        commit_row_updates(local_main, report_no, row_idx, updates, batch=batch)
+        commit_report_no(report_no)
+    except Exception as e:
+        print("Ghi vào Excel bị lỗi:", e)
 
+    try:
+        queue_trf_row(report_no, local_main, "TRF.xlsx", trq_id=req.get("trq_id", ""), batch=batch)
+    except Exception as e:
+        print("Append TRF lỗi:", e)
 
-                vn_tz = pytz.timezone("Asia/Ho_Chi_Minh")
-                req_login = (req.get("request_date") or "").strip()
-                val_for_excel = req_login if req_login else datetime.now(vn_tz).strftime("%Y-%m-%d")
-                set_val("log in date", val_for_excel, is_date_col=True)
+    try:
+        vn_tz = pytz.timezone("Asia/Ho_Chi_Minh")
+        short_data = {
+            "trq_id": req.get("trq_id", ""),
+            "report_no": req.get("report_no", ""),
+            "requestor": req.get("requestor", ""),
+            "department": req.get("department", ""),
+            "request_date": req.get("request_date", ""),
+            "item_code": req.get("item_code", ""),
+            "status": req.get("status", ""),
+            "pdf_path": req.get("pdf_path"),
+            "docx_path": req.get("docx_path"),
+            "employee_id": req.get("employee_id", ""),
+            "approved_date": datetime.now(vn_tz).strftime("%Y-%m-%d"),
+            "test_group": req.get("test_group", ""),
+        }
+        archive_request(short_data)
+    except Exception as e:
+        print("Archive lỗi:", e)
+    return req
 
-                finishing_type = req.get("finishing_type", "")
-                material_type  = req.get("material_type", "")
-                cat_comp_pos   = get_category_component_position(finishing_type, material_type)
-                set_val("category / component name / position", cat_comp_pos)
-                wb.save(local_main)
-        except Exception as e:
-            print("Ghi vào Excel bị lỗi:", e)
+# ================== PIPELINE APPROVE NHIỀU REQUEST ==================
+def _render_stage(req, stop):
+    """
+    DOCX (process pool) -> PDF (thread pool giới hạn), nối bằng callback.
+    Trả về (future kết quả, future DOCX); pool DOCX không dùng được -> None (committer tự render).
+    """
+    out = Future()
+    try:
+        docx_fut = get_docx_pool().submit(render_request_docx, dict(req))
+    except Exception as e:
+        print("DOCX pool lỗi, render tuần tự:", e)
+        reset_docx_pool()
+        return None, None
 
+    def _pdf_done(pf):
         try:
-            append_row_to_trf(report_no, local_main, "TRF.xlsx", trq_id=req.get("trq_id", ""))
-        except Exception as e:
-            print("Append TRF lỗi:", e)
+            out.set_result(pf.result())
+        except BaseException as e:
+            out.set_exception(e)
 
+    def _docx_done(f):
         try:
-            vn_tz = pytz.timezone("Asia/Ho_Chi_Minh")
-            short_data = {
-                "trq_id": req.get("trq_id", ""),
-                "report_no": req.get("report_no", ""),
-                "requestor": req.get("requestor", ""),
-                "department": req.get("department", ""),
-                "request_date": req.get("request_date", ""),
-                "item_code": req.get("item_code", ""),
-                "status": req.get("status", ""),
-                "pdf_path": req.get("pdf_path"),
-                "docx_path": req.get("docx_path"),
-                "employee_id": req.get("employee_id", ""),
-                "approved_date": datetime.now(vn_tz).strftime("%Y-%m-%d"),
-                "test_group": req.get("test_group", ""),
-            }
-            archive_request(short_data)
-        except Exception as e:
-            print("Archive lỗi:", e)
+            report_no, _ = f.result()
+            if stop.is_set():
+                raise CancelledError()
+            get_pdf_pool().submit(export_trf_pdf, report_no).add_done_callback(_pdf_done)
+        except BaseException as e:
+            out.set_exception(e)
 
-    return req
+    docx_fut.add_done_callback(_docx_done)
+    return out, docx_fut
 
-# ================== ROUTE: APPROVE ALL (STREAM) — ĐÃ SỬA ==================
-@app.post("/approve_all_stream")
-def approve_all_stream():
+def _approve_pipeline(items, batch=None, owner_of=None):
     """
-    Sửa chính:
-      1) Cập nhật ETD theo file MỚI NHẤT (merge) => không đè mất request mới.
-      2) Sau MỖI request được approve, xóa request đó khỏi file bằng phép "lọc theo trq_id"
-         trên dữ liệu MỚI NHẤT => không bao giờ overwrite các request mới vừa được gửi.
-      3) Không còn final write "ghi đè cả file" theo snapshot cũ nữa.
+    Approve nhiều request theo pipeline; yield (key, req đã approve | Exception) đúng thứ tự items=[(key, req)].
+    owner_of(key, req): owner giữ chỗ report_no duy nhất cho từng bước (job) -> chạy lại dùng lại đúng số cũ.
+      (1) cấp report_no cho cả đợt ngay từ đầu (giữ chỗ trong report_slots)
+      (2) điền DOCX trong process pool
+      (3) convert PDF trong thread pool có giới hạn
+      (4) ghi Excel/TRF/archive tuần tự tại đây (1 committer)
+    Dừng giữa chừng (generator bị close) -> huỷ việc chưa chạy, trả lại các số chưa commit.
     """
-    def gen():
-        run_id = str(uuid4())
-        CANCEL_FLAGS[run_id] = False
+    stop = Event()
+    jobs = []   # [trq_id, req, future kết quả, future DOCX, trạng thái]
+
+    # (1) Cấp số: chỉ giữ report_lock trong lúc giữ chỗ, không giữ suốt lúc render
+    with report_lock():
+        for tid, item in items:
+            req = dict(item)
+            preset = str(req.get("report_no", "") or "").strip()
+            try:
+                if owner_of is not None:
+                    req["report_no"] = reserve_report_no(owner=owner_of(tid, req), preset=preset or None, reuse=True)
+                else:
+                    req["report_no"] = reserve_report_no(owner=req.get("trq_id", ""), preset=preset or None)
+                jobs.append([tid, req, None, None, "reserved"])
+            except Exception as e:
+                jobs.append([tid, req, e, None, "failed"])
 
-        # Nhận input
-        try:
-            data = request.get_json(silent=True) or {}
-            updates = data.get("updates", []) or []
-        except Exception as e:
-            yield json.dumps({"type": "error", "message": f"Parse JSON: {e}"}) + "\n"
-            CANCEL_FLAGS.pop(run_id, None)
-            return
+    # (2) + (3) Render song song
+    for job in jobs:
+        if job[4] == "reserved":
+            job[2], job[3] = _render_stage(job[1], stop)
+
+    # (4) Committer
+    try:
+        for job in jobs:
+            tid, req, fut = job[0], job[1], job[2]
+            if job[4] == "failed":
+                yield tid, fut
+                continue
+            report_no = req["report_no"]
+            try:
+                try:
+                    if fut is None:
+                        raise BrokenProcessPool("không có pool")
+                    fut.result()
+                except BrokenProcessPool as e:
+                    # worker chết / không tạo được process -> render ngay trong process này
+                    if fut is not None:
+                        print("DOCX pool hỏng, render tuần tự:", e)
+                        reset_docx_pool()
+                    render_request_docx(req)
+                    export_trf_pdf(report_no)
+                try:
+                    get_used_report_numbers().add(report_no, "files")
+                except Exception as e:
+                    print("UsedReportNumbers update lỗi:", e)
+                with report_lock():
+                    _commit_approved(req, batch=batch)
+                job[4] = "committed"
+                yield tid, req
+            except Exception as e:
+                release_report_no(report_no)
+                job[4] = "failed"
+                yield tid, e
+    finally:
+        # Bị dừng giữa chừng: huỷ việc chưa chạy, chờ việc đang chạy xong rồi mới trả số
+        stop.set()
+        left = [job for job in jobs if job[4] == "reserved"]
+        for job in left:
+            if job[3] is not None:
+                job[3].cancel()
+        futures_wait([job[2] for job in left if job[2] is not None])
+        for job in left:
+            try:
+                release_report_no(job[1]["report_no"])
+            except Exception as e:
+                print("Trả report_no lỗi:", e)
 
-        # (1) Merge cập nhật ETD vào file hiện tại (an toàn)
+# ================== JOB: APPROVE ALL (chạy nền, lưu tiến độ) ==================
+def _pick_approve_todo(updates, rows):
+    """
+    Chọn các request cần duyệt (Submitted + có ETD) từ updates [{"idx", "trq_id"}] trên rows [(pid, record)]
+    mới nhất; sắp theo request_date -> loại test -> TRQ-ID. Trả về [(pid, trq_id, item)].
+    """
+    pending_after_etd = [r for _, r in rows]
+    id_to_idx = make_id_index_map(pending_after_etd)
+    todo = []
+    for u in updates:
+        idx = u.get("idx")
+        tid = (u.get("trq_id") or "").strip()
+
+        # Ưu tiên idx nếu còn hợp lệ và khớp trq_id (nếu có)
+        picked = None
+        if isinstance(idx, int) and 0 <= idx < len(pending_after_etd):
+            item = pending_after_etd[idx]
+            if item and item.get("status") == "Submitted" and (item.get("etd") or "").strip():
+                if not tid or tid == (item.get("trq_id") or "").strip():
+                    picked = (rows[idx][0], (item.get("trq_id") or "").strip(), item)
+
+        # Fallback theo trq_id
+        if not picked and tid and tid in id_to_idx:
+            j = id_to_idx[tid]
+            item = pending_after_etd[j]
+            if item and item.get("status") == "Submitted" and (item.get("etd") or "").strip():
+                picked = (rows[j][0], tid, item)
+
+        if picked and all(picked[0] != p for p, _, _ in todo):
+            todo.append(picked)
+
+    def _parse_dt(s: str):
+        s = (s or "").strip()
+        for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+            try:
+                return datetime.strptime(s, fmt)
+            except Exception:
+                pass
+        return datetime.max
+
+    def _norm_type(rec: dict):
+        t = (rec.get("type_of_test") or rec.get("test_group") or "")
+        return t.replace(" TEST", "").strip().lower()
+
+    todo.sort(key=lambda x: (
+        _parse_dt(x[2].get("request_date")),
+        _norm_type(x[2]),
+        (x[2].get("trq_id") or "")
+    ))
+    return todo
+
+def _run_approve_job(ctx):
+    """
+    Job 'approve_all' (job_queue): payload {"updates": [...]}.
+      1) Lần chạy đầu: merge ETD, chốt danh sách todo [(pid, trq_id)] vào payload (resume dùng lại đúng danh sách).
+      2) Bỏ qua bước đã xong (job_steps) hoặc request không còn trong pending (đã approve + gỡ).
+      3) Duyệt theo pipeline (_approve_pipeline): cấp số cả đợt -> DOCX/PDF song song -> ghi tuần tự.
+         Thay đổi Excel/TRF gom vào batch, ghi 1 lần mỗi APPROVE_BATCH_FLUSH_EVERY request (và cuối đợt);
+         request chỉ được gỡ khỏi pending + đánh dấu xong sau khi batch chứa nó đã flush.
+      4) Idempotent khi chạy lại: số report giữ theo owner job:<run_id>:<pid> (cấp lại đúng số cũ),
+         archive bỏ qua record đã có.
+    Sự kiện giữ nguyên dạng NDJSON cũ: start / progress / error / cancelled / done.
+    """
+    payload = ctx.payload
+    if "todo" not in payload:
+        updates = payload.get("updates") or []
         try:
-            pending_after_etd = _merge_update_etd(updates)
+            pending_store.set_etd_bulk(updates)
         except Exception as e:
-            yield json.dumps({"type": "error", "message": f"Bulk ETD update: {e}"}) + "\n"
-            pending_after_etd = _read_pending()
-
-        # (2) Lập danh sách cần duyệt (submitted + có ETD)
-        id_to_idx = make_id_index_map(pending_after_etd)
-        todo = []
-        for u in updates:
-            idx = u.get("idx")
-            tid = (u.get("trq_id") or "").strip()
-
-            # Ưu tiên idx nếu còn hợp lệ và khớp trq_id (nếu có)
-            picked = None
-            if isinstance(idx, int) and 0 <= idx < len(pending_after_etd):
-                item = pending_after_etd[idx]
-                if item and item.get("status") == "Submitted" and (item.get("etd") or "").strip():
-                    if not tid or tid == (item.get("trq_id") or "").strip():
-                        picked = (idx, (item.get("trq_id") or "").strip(), item)
-
-            # Fallback theo trq_id
-            if not picked and tid and tid in id_to_idx:
-                j = id_to_idx[tid]
-                item = pending_after_etd[j]
-                if item and item.get("status") == "Submitted" and (item.get("etd") or "").strip():
-                    picked = (j, tid, item)
-
-            if picked:
-                todo.append(picked)
-        
-        def _parse_dt(s: str):
-            s = (s or "").strip()
-            for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
-                try:
-                    return datetime.strptime(s, fmt)
-                except Exception:
-                    pass
-            return datetime.max
+            ctx.emit({"type": "error", "message": f"Bulk ETD update: {e}"})
+        todo = _pick_approve_todo(updates, pending_store.pending_rows())
+        ctx.save_payload(todo=[[pid, tid] for pid, tid, _ in todo])
+
+    todo = payload["todo"]
+    total = len(todo)
+    finished = ctx.done_steps()
+    done = 0
+    items = []
+    for pid, tid in todo:
+        if str(pid) in finished:
+            done += 1
+            continue
+        item = pending_store.get_request(pid)
+        if item is None:
+            # đã gỡ khỏi pending (approve xong ở lần chạy trước / người khác đã xử lý)
+            ctx.mark_steps([pid])
+            done += 1
+            continue
+        items.append(((pid, tid), item))
 
-        def _norm_type(rec: dict):
-            t = (rec.get("type_of_test") or rec.get("test_group") or "")
-            return t.replace(" TEST", "").strip().lower()
+    ctx.progress(done=done, total=total)
+    ctx.emit({"type": "start", "total": total, "run_id": ctx.run_id, "done": done})
 
-        # todo là list (idx, trq_id, item)
-        todo.sort(key=lambda x: (
-            _parse_dt(x[2].get("request_date")),
-            _norm_type(x[2]),
-            (x[2].get("trq_id") or "")
-        ))
+    unflushed = []
 
-        yield json.dumps({"type": "start", "total": len(todo), "run_id": run_id}) + "\n"
+    def _flush_batch(batch):
+        # chỉ gỡ khỏi pending + đánh dấu xong khi đã ghi được; lỗi -> batch giữ lại dữ liệu, lần flush sau ghi lại
+        batch.flush()
+        _mark_flushed()
 
-        # (3) Duyệt từng request + mỗi lần xong thì gỡ khỏi file bằng merge-remove
-        done = 0
-        approved_tids = []
+    def _mark_flushed():
+        if unflushed:
+            pending_store.delete_requests(list(unflushed))
+            ctx.mark_steps(list(unflushed))
+            unflushed.clear()
 
-        for _, tid, item in todo:
-            try:
-                approved = approve_all_one(dict(item))  # dùng bản copy để tránh side-effect
-                report_no = (approved or {}).get("report_no") or item.get("report_no")
+    def _owner(key, req):
+        return f"job:{ctx.run_id}:{key[0]}"
+
+    with ExcelCommitBatch(local_main) as batch:
+        pipeline = _approve_pipeline(items, batch=batch, owner_of=_owner)
+        try:
+            for (pid, tid), approved in pipeline:
+                if isinstance(approved, Exception):
+                    ctx.emit({"type": "error", "message": str(approved), "trq_id": tid})
+                    continue
 
                 # Ghi nhận tiến độ
                 done += 1
-                approved_tids.append(tid)
-                yield json.dumps({
+                unflushed.append(pid)
+                ctx.progress(done=done)
+                ctx.emit({
                     "type": "progress",
                     "done": done,
-                    "total": len(todo),
+                    "total": total,
                     "trq_id": tid,
-                    "report_no": report_no
-                }) + "\n"
-
-                # Xóa request đã approve ra khỏi file (MERGE theo trạng thái file mới nhất)
-                _remove_approved_from_file([tid])
+                    "report_no": approved.get("report_no")
+                })
 
-                # Người dùng bấm Cancel -> dừng sau khi xong request hiện tại
-                if CANCEL_FLAGS.get(run_id):
-                    yield json.dumps({"type": "cancelled", "done": done, "total": len(todo)}) + "\n"
-                    CANCEL_FLAGS.pop(run_id, None)
-                    return
+                # Đủ N request -> ghi Excel + gỡ các request đó khỏi pending
+                if APPROVE_BATCH_FLUSH_EVERY and len(unflushed) >= APPROVE_BATCH_FLUSH_EVERY:
+                    try:
+                        _flush_batch(batch)
+                    except Exception as e:
+                        print("approve_all flush lỗi (thử lại ở lần flush sau):", e)
 
+                # Cancel -> dừng sau request vừa ghi; số của các request sau được trả lại
+                if ctx.cancelled():
+                    break
+        finally:
+            pipeline.close()
+            try:
+                _flush_batch(batch)
             except Exception as e:
-                yield json.dumps({"type": "error", "message": str(e), "trq_id": tid}) + "\n"
+                print("approve_all flush lỗi:", e)
+    # __exit__ của batch flush lại lần cuối (vẫn lỗi -> raise, request giữ nguyên trong pending để resume)
+    _mark_flushed()
+
+    if ctx.cancelled():
+        ctx.emit({"type": "cancelled", "done": done, "total": total})
+    else:
+        ctx.emit({"type": "done", "done": done, "total": total})
 
-        # (4) Kết thúc bình thường
-        yield json.dumps({"type": "done", "done": done, "total": len(todo)}) + "\n"
-        CANCEL_FLAGS.pop(run_id, None)
+register_handler("approve_all", _run_approve_job)
 
+def _job_stream(run_id, since=0):
+    """Stream NDJSON các sự kiện của job tới khi job kết thúc (client ngắt kết nối thì job vẫn chạy)."""
+    def gen():
+        for _, ev in iter_job_events(run_id, since=since):
+            yield json.dumps(ev, ensure_ascii=False) + "\n"
     return Response(stream_with_context(gen()), mimetype="application/json")
 
+# ================== ROUTE: APPROVE ALL (STREAM) ==================
+@app.post("/approve_all_stream")
+def approve_all_stream():
+    """
+    Tạo job 'approve_all' chạy nền rồi stream tiến độ (NDJSON như cũ).
+    Ngắt kết nối / reload trang không làm dừng job: xem lại qua /approve_jobs/<run_id>/events.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        updates = data.get("updates", []) or []
+    except Exception as e:
+        return Response(json.dumps({"type": "error", "message": f"Parse JSON: {e}"}) + "\n",
+                        mimetype="application/json")
+    run_id = create_job("approve_all", {"updates": updates, "by": session.get("staff_id", "")})
+    return _job_stream(run_id)
+
+@app.post("/approve_jobs")
+def approve_jobs_create():
+    """Tạo job approve_all, trả về run_id ngay (không giữ request thread); theo dõi bằng poll/subscribe."""
+    data = request.get_json(silent=True) or {}
+    run_id = create_job("approve_all", {"updates": data.get("updates", []) or [], "by": session.get("staff_id", "")})
+    return jsonify(success=True, run_id=run_id)
+
+@app.get("/approve_jobs")
+def approve_jobs_list():
+    jobs = list_jobs("approve_all", limit=int(request.args.get("limit", 20)))
+    for j in jobs:
+        j.pop("payload", None)
+    return jsonify(success=True, jobs=jobs)
+
+@app.get("/approve_jobs/<run_id>")
+def approve_job_status(run_id):
+    """Poll: trạng thái + các sự kiện sau ?since=<seq>."""
+    job = get_job(run_id)
+    if job is None:
+        return jsonify(success=False, message="Run ID không tồn tại"), 404
+    events = job_events(run_id, request.args.get("since", 0, type=int))
+    job.pop("payload", None)
+    return jsonify(success=True, job=job, events=[dict(ev, seq=seq) for seq, ev in events])
+
+@app.get("/approve_jobs/<run_id>/events")
+def approve_job_events(run_id):
+    """Subscribe: stream NDJSON từ sự kiện ?since=<seq> tới khi job kết thúc."""
+    if get_job(run_id) is None:
+        return jsonify(success=False, message="Run ID không tồn tại"), 404
+    return _job_stream(run_id, since=request.args.get("since", 0, type=int))
+
+@app.post("/approve_jobs/<run_id>/cancel")
+def approve_job_cancel(run_id):
+    if not cancel_job(run_id):
+        return jsonify(success=False, message="Run ID không tồn tại hoặc đã kết thúc"), 404
+    return jsonify(success=True)
+
+@app.post("/approve_jobs/<run_id>/resume")
+def approve_job_resume(run_id):
+    """Chạy tiếp job bị dừng (cancel / server restart / lỗi); các request đã duyệt không bị duyệt lại."""
+    if not resume_job(run_id):
+        return jsonify(success=False, message="Job không ở trạng thái resume được"), 409
+    return jsonify(success=True, run_id=run_id)
 
-# (tuỳ chọn) Route cancel giữ nguyên
+# Route cancel cũ: giữ cho client cũ
 @app.post("/approve_all_cancel")
 def approve_all_cancel():
     data = request.get_json(silent=True) or {}
     run_id = data.get("run_id")
     if not run_id:
         return jsonify(success=False, message="Thiếu run_id"), 400
-    if run_id not in CANCEL_FLAGS:
+    if not cancel_job(run_id):
         return jsonify(success=False, message="Run ID không tồn tại hoặc đã kết thúc"), 404
-    CANCEL_FLAGS[run_id] = True
     return jsonify(success=True)
 
 @app.route("/tfr_request_status", methods=["GET", "POST"])
@@ -1625,7 +1765,6 @@ def tfr_request_status():
         return redirect(url_for('tfr_request_status'))
 
     # ===== Load & quyền =====
-    tfr_requests = safe_read_json(TFR_LOG_FILE) or []
     is_admin = session.get("user_type") in ("stl", "superadmin")
 
     # ===== Lấy Staff ID & tách (ID - Tên) =====
@@ -1643,33 +1782,30 @@ def tfr_request_status():
 
     # ===== Lọc hiển thị: user thường chỉ thấy request của mình (Tên HOẶC Employee ID) =====
     if not is_admin and (viewer_name or viewer_emp_id):
-        tfr_requests = [
-            r for r in tfr_requests
-            if _eq(r.get("requestor"), viewer_name) or _eq(r.get("employee_id"), viewer_emp_id)
-        ]
+        tfr_requests = [r for _, r in pending_store.rows_of_owner(viewer_name, viewer_emp_id)]
+    else:
+        tfr_requests = pending_store.pending_list()
 
     # ===== POST actions =====
     if request.method == "POST":
         action = request.form.get("action")
-        current = safe_read_json(TFR_LOG_FILE) or []   # snapshot mới nhất
+        rows = pending_store.pending_rows()            # snapshot mới nhất [(pid, record)]
+        current = [r for _, r in rows]
 
         # ---------- APPROVE ALL ----------
         if is_admin and action == "approve_all":
             approved_count = 0
-            new_pending = []
-            for req in current:
+            for pid, req in rows:
                 if (req.get("status") == "Submitted") and (req.get("etd") or "").strip():
                     try:
                         # ✅ log_in_date = request_date
                         req["log_in_date"] = req.get("request_date")
                         approve_all_one(req)
+                        pending_store.delete_request(pid)
                         approved_count += 1
-                        continue
                     except Exception as e:
                         print("Approve one (approve_all) error:", e)
-                new_pending.append(req)
 
-            safe_write_json(TFR_LOG_FILE, new_pending)
             flash(f"Đã duyệt {approved_count} request!")
             return _redirect_back()
 
@@ -1693,8 +1829,7 @@ def tfr_request_status():
 
                 try:
                     approve_all_one(req)
-                    del current[idx]
-                    safe_write_json(TFR_LOG_FILE, current)
+                    pending_store.delete_request(rows[idx][0])
                 except Exception as e:
                     print("Approve one (single) error:", e)
                     flash("Có lỗi khi approve, vui lòng thử lại.")
@@ -1707,9 +1842,7 @@ def tfr_request_status():
             matches = [i for i, req in enumerate(current) if req.get("trq_id") == trq_id]
             idx = matches[0] if matches else None
             if idx is not None:
-                current[idx]["status"] = "Declined"
-                current[idx]["decline_reason"] = reason
-            safe_write_json(TFR_LOG_FILE, current)
+                pending_store.patch_request(rows[idx][0], {"status": "Declined", "decline_reason": reason})
             return _redirect_back()
 
         # ---------- DUPLICATE ----------
@@ -1733,9 +1866,7 @@ def tfr_request_status():
                 if is_admin:
                     # Admin: giữ nguyên TRQ-ID (hành vi cũ)
                     # -> vẫn chèn ngay sau bản gốc để tiện edit
-                    insert_pos = idx + 1
-                    current.insert(insert_pos, new_req)
-                    safe_write_json(TFR_LOG_FILE, current)
+                    pending_store.insert_request(new_req, after_pid=rows[idx][0])
                     # Admin vẫn quay về trang danh sách như cũ
                     return _redirect_back()
                 else:
@@ -1766,8 +1897,7 @@ def tfr_request_status():
 
                     # Chèn ngay sau bản gốc
                     insert_pos = idx + 1
-                    current.insert(insert_pos, new_req)
-                    safe_write_json(TFR_LOG_FILE, current)
+                    pending_store.insert_request(new_req, after_pid=rows[idx][0])
 
                     # 🔁 NEW: Sau khi Dup thành công, chuyển thẳng tới form edit của bản mới
                     return redirect(url_for(
@@ -1785,7 +1915,8 @@ def tfr_request_status():
             if edit_idx is not None:
                 try:
                     edit_idx = int(edit_idx)
-                    deleted_req = current.pop(edit_idx)
+                    pid, deleted_req = rows[edit_idx]
+                    pending_store.delete_request(pid)
                     send_teams_message(
                         TEAMS_WEBHOOK_URL_TRF,
                         f"🗑️ [TRF] Đã có yêu cầu bị xóa!\n- TRQ-ID: {deleted_req.get('trq_id')}\n- Người thao tác: {session.get('staff_id', 'Không rõ')}"
@@ -1793,15 +1924,14 @@ def tfr_request_status():
                 except Exception as e:
                     print("Xóa bị lỗi:", e)
             else:
-                for i, req in enumerate(current):
+                for pid, req in rows:
                     if req.get("trq_id") == trq_id:
-                        deleted_req = current.pop(i)
+                        pending_store.delete_request(pid)
                         send_teams_message(
                             TEAMS_WEBHOOK_URL_TRF,
-                            f"🗑️ [TRF] Đã có yêu cầu bị xóa!\n- TRQ-ID: {deleted_req.get('trq_id')}\n- Người thao tác: {session.get('staff_id', 'Không rõ')}"
+                            f"🗑️ [TRF] Đã có yêu cầu bị xóa!\n- TRQ-ID: {req.get('trq_id')}\n- Người thao tác: {session.get('staff_id', 'Không rõ')}"
                         )
                         break
-            safe_write_json(TFR_LOG_FILE, current)
             return _redirect_back()
 
     # ===== GET view (KHÔNG reload lại full list; dùng danh sách đã lọc) =====
@@ -1825,7 +1955,7 @@ def tfr_request_status():
     if is_admin:
         # 1) Seed bộ đếm từ archive theo (date, group) -> count TRQ DUY NHẤT
         try:
-            archive_all = safe_read_json(ARCHIVE_LOG) or []
+            archive_all = get_archive_store().records()
         except Exception:
             archive_all = []
 
@@ -1998,7 +2128,10 @@ def tfr_request_status():
         if not path:
             return None
         try:
-            df = pd.read_excel(path)
+            headers, _, rows = read_sheet_fast(path, skip_blank=False)
+            df = pd.DataFrame([v for _, v in rows], columns=[
+                (h if h not in (None, "") else f"Unnamed: {i}") for i, h in enumerate(headers)
+            ])
         except Exception:
             try:
                 df = pd.read_excel(path, engine="openpyxl")
@@ -2061,12 +2194,22 @@ def tfr_request_status():
 
 @app.route("/tfr_request_archive")
 def tfr_request_archive():
-    # 1) Đọc archive
-    archive = safe_read_json(ARCHIVE_LOG) or []
+    # 1) Đọc archive: lọc + phân trang phía server (archive_store), chỉ xử lý record của trang hiện tại
+    q = (request.args.get("q") or "").strip()
+    try:
+        page = max(1, int(request.args.get("page", 1)))
+    except ValueError:
+        page = 1
+    try:
+        per_page = min(500, max(10, int(request.args.get("per_page", 100))))
+    except ValueError:
+        per_page = 100
+    archive, total = get_archive_store().query(q=q, page=page, per_page=per_page)
+    pages = max(1, (total + per_page - 1) // per_page)
 
     # 2) Gom ảnh từ toàn bộ requests (giống Status)
     try:
-        tfr_all = safe_read_json(TFR_LOG_FILE) or []
+        tfr_all = pending_store.pending_list()
     except Exception:
         tfr_all = []
 
@@ -2156,13 +2299,13 @@ def tfr_request_archive():
     # 4) Đọc Excel -> tạo rating_map, status_map, etd_map
     rating_map, status_map, etd_map = {}, {}, {}
     try:
-        wb = safe_load_excel(local_main)  # dùng helper sẵn có
-        ws = wb.active
+        view = get_report_view(local_main)  # SQLite mirror / ReportIndex, không mở workbook
+        header_names = view.headers
 
         def find_col(*aliases):
             # thử alias trực tiếp
             for name in aliases:
-                c = get_col_idx(ws, name)
+                c = view.col(name)
                 if c:
                     return c
             # fallback: quét header gần-đúng
@@ -2180,8 +2323,7 @@ def tfr_request_archive():
                 "etd": {"etd", "expecteddate", "deliverydate", "expecteddelivery", "expectedfinish", "completeddate"},
                 "report": {"report#", "reportno", "report", "reportnumber"},
             }[want]
-            for col in range(1, ws.max_column + 1):
-                h = ws.cell(row=1, column=col).value
+            for col, h in enumerate(header_names, start=1):
                 if h is None:
                     continue
                 h_norm = norm(h)
@@ -2200,8 +2342,19 @@ def tfr_request_archive():
 
         if col_report:
 
-            for r in range(2, ws.max_row + 1):
-                key_raw = ws.cell(row=r, column=col_report).value
+            def _cell(values, col):
+                return values[col - 1] if len(values) >= col else None
+
+            # Chỉ tra các report của trang hiện tại (find_row có index), không quét cả sheet
+            page_rows = []
+            for rec in archive:
+                rep = str(rec.get("report_no", "") or "").strip()
+                r_idx = view.find_row(rep) if rep else None
+                if r_idx is not None:
+                    page_rows.append(view.row_values(r_idx) or ())
+
+            for row_values in page_rows:
+                key_raw = _cell(row_values, col_report)
                 if key_raw is None:
                     continue
                 key = str(key_raw).strip()
@@ -2210,7 +2363,7 @@ def tfr_request_archive():
 
                 # Rating / Result
                 if col_rating:
-                    vr = ws.cell(row=r, column=col_rating).value
+                    vr = _cell(row_values, col_rating)
                     vr_str = "" if vr is None else str(vr).strip()
                     if vr_str:
                         rating_map[key] = vr_str
@@ -2218,7 +2371,7 @@ def tfr_request_archive():
 
                 # Status -> status_display
                 if col_status:
-                    vs = ws.cell(row=r, column=col_status).value
+                    vs = _cell(row_values, col_status)
                     vs_str_orig = "" if vs is None else str(vs).strip()
                     vs_upper = vs_str_orig.upper()
                     if vs_upper in {"ACTIVE", "MUST", "DUE", "LATE"}:
@@ -2232,7 +2385,7 @@ def tfr_request_archive():
 
                 # ETD -> chuẩn hoá text
                 if col_etd:
-                    ev = ws.cell(row=r, column=col_etd).value
+                    ev = _cell(row_values, col_etd)
                     if isinstance(ev, (datetime, date)):
                         etd_text = ev.strftime("%Y-%m-%d")
                     else:
@@ -2265,14 +2418,7 @@ def tfr_request_archive():
             rec["etd"] = etd_map[rep]
         rec.setdefault("employee_id", rec.get("employee_id", "") or "")
 
-    # 6) Sắp xếp: Report No mới nằm trên
-    def report_sort_key(rec):
-        s = str(rec.get("report_no", "") or "")
-        nums = re.findall(r"\d+", s)
-        num = int(nums[-1]) if nums else -1
-        return (num, s)
-
-    archive.sort(key=report_sort_key, reverse=True)
+    # 6) Sắp xếp: Report No mới nằm trên (archive_store.query đã sắp xếp trước khi cắt trang)
 
     # đảm bảo mỗi record khi đưa sang template đều có item_code
     for rec in archive:
@@ -2280,7 +2426,8 @@ def tfr_request_archive():
         rec["item_code"] = rec.get("item_code") or rec.get("item") or ""
 
     # 7) Render
-    return render_template("tfr_request_archive.html", requests=archive)
+    return render_template("tfr_request_archive.html", requests=archive,
+                           q=q, page=page, pages=pages, per_page=per_page, total=total)
 
 @app.post("/save_etd")
 def save_etd():
@@ -2293,20 +2440,43 @@ def save_etd():
         return jsonify(success=False, message="Thiếu trq_id hoặc etd"), 400
 
     try:
-        current = _load_pending_locked()
-        found = False
-        for row in current:
-            if (row.get("trq_id") or "").strip() == trq_id:
-                row["etd"] = etd
-                found = True
-                break
-        if not found:
+        if not pending_store.patch_by_trq(trq_id, {"etd": etd}):
             return jsonify(success=False, message="Không tìm thấy TRQ-ID trong pending!"), 404
-        _write_pending_locked(current)
         return jsonify(success=True)
     except Exception as e:
         return jsonify(success=False, message="Lỗi: " + str(e)), 500
 
+@app.route("/api/default_etd", methods=["GET", "POST"])
+def api_default_etd():
+    """
+    ETD mặc định cho CẢ danh sách pending (Submitted) trong 1 lần gọi: {trq_id: etd}.
+    Mỗi request được tính như lúc submit: tải = approved trong ngày + các Submitted đứng trước nó.
+    POST {"trq_ids": [...]} để chỉ trả về 1 phần danh sách.
+    """
+    only = None
+    if request.is_json:
+        ids = (request.get_json(silent=True) or {}).get("trq_ids")
+        if isinstance(ids, list):
+            only = {str(x).strip() for x in ids}
+    try:
+        current = pending_store.pending_list(status="Submitted")
+        seen = {}   # tải Submitted đã tính tới thời điểm request này
+        etds = {}
+        for r in current:
+            req_date = (r.get("request_date") or "").strip()
+            grp = r.get("test_group") or r.get("type_of_test")
+            key = _etd_key(req_date, grp)
+            tid = (r.get("trq_id") or "").strip()
+            if req_date and (only is None or tid in only):
+                try:
+                    etds[tid] = calculate_default_etd(req_date, grp, submitted_counts=seen)
+                except ValueError:
+                    etds[tid] = ""
+            seen[key] = seen.get(key, 0) + 1
+        return jsonify(success=True, etds=etds)
+    except Exception as e:
+        return jsonify(success=False, message="Lỗi: " + str(e)), 500
+
 @app.route('/run_export_excel', methods=['POST'])
 def run_export_excel():
     if session.get('role') not in ['stl', 'superadmin']:
@@ -2333,11 +2503,56 @@ def go_report():
         return redirect(url_for("update", report=report))
     return redirect(url_for("home"))
 
+# ==== Ảnh upload: manifest + thumbnail/bản web (image_derivs) ====
+def _after_image_saved(path):
+    """Gọi sau mỗi lần lưu ảnh upload: cập nhật manifest + xếp hàng tạo thumbnail / bản web (chạy nền)."""
+    image_manifest.note_saved(path)
+    if allowed_file(os.path.basename(path)):
+        image_derivs.schedule(path)
+
+def _after_image_removed(path):
+    image_manifest.note_removed(path)
+    image_derivs.remove(path)
+
+def _save_uploads(files, folder, prefix):
+    """Lưu lô file upload hợp lệ thành <prefix><n>.<ext> (cấp số 1 lần cho cả lô qua image_seq); trả về list tên file."""
+    files = [f for f in files if f and allowed_file(f.filename)]
+    names = image_seq.reserve_names(folder, prefix, [f.filename.rsplit('.', 1)[-1].lower() for f in files])
+    for file, fname in zip(files, names):
+        path = os.path.join(folder, fname)
+        blob_store.save_upload(file, path)
+        _after_image_saved(path)
+    return names
+
+def _deriv_url(url, kind):
+    # chỉ ảnh upload (/images/...) mới có bản phái sinh; ảnh static giữ nguyên
+    return f"{url}?s={kind}" if isinstance(url, str) and url.startswith("/images/") else url
+
+@app.template_filter("img_thumb")
+def _img_thumb(url):
+    return _deriv_url(url, "thumb")
+
+@app.template_filter("img_web")
+def _img_web(url):
+    return _deriv_url(url, "web")
+
+def _send_image(folder, filename):
+    """?s=thumb|web -> bản phái sinh nếu đã có (chưa có thì trả ảnh gốc và xếp hàng tạo); không có s -> ảnh gốc."""
+    kind = request.args.get("s")
+    if kind in image_derivs.KINDS:
+        src = safe_join(folder, filename)
+        if src and os.path.isfile(src):
+            ready = image_derivs.ready_path(src, kind)
+            if ready:
+                return send_file(os.path.abspath(ready), max_age=86400)
+            image_derivs.schedule(src)
+    return send_from_directory(folder, filename)
+
 # Trả ảnh tổng quan/cân nặng
 @app.route('/images/<report>/<filename>')
 def serve_general_img(report, filename):
     folder = os.path.join(UPLOAD_FOLDER, report)
-    return send_from_directory(folder, filename)
+    return _send_image(folder, filename)
 
 @app.route("/delete_image/<report>/<imgfile>", methods=["POST"])
 def delete_image_main(report, imgfile):
@@ -2346,6 +2561,7 @@ def delete_image_main(report, imgfile):
     try:
         if os.path.exists(img_path):
             os.remove(img_path)
+            _after_image_removed(img_path)
     except Exception as e:
         print(f"Lỗi khi xóa ảnh: {img_path} - {e}")
     return redirect(url_for('update', report=report))
@@ -2356,6 +2572,7 @@ def delete_test_group_image(report, group, key, imgfile):
     try:
         if os.path.exists(img_path):
             os.remove(img_path)
+            _after_image_removed(img_path)
     except Exception as e:
         print(f"Lỗi khi xóa ảnh: {img_path} - {e}")
     return redirect(url_for("test_group_item_dynamic", report=report, group=group, test_key=key))
@@ -2429,29 +2646,29 @@ def update():
         with open(path, "w", encoding="utf-8") as f:
             f.writelines(new_lines)
 
-    # ==== đọc Excel, tìm dòng ====
+    # ==== đọc dữ liệu report (SQLite mirror / ReportIndex dùng chung) ====
     try:
-        wb = safe_load_excel(local_main)
-        ws = wb.active
-        report_col = get_col_idx(ws, "report#") or get_col_idx(ws, "report")
+        idx = get_report_view(local_main)
+        report_col = idx.col("report#") or idx.col("report")
         if report_col is None:
             return "❌ Không tìm thấy cột REPORT# hoặc REPORT trong file Excel!", 500
 
-        for row in range(2, ws.max_row + 1):
-            v = ws.cell(row=row, column=report_col).value
-            if v and str(v).strip() == str(report):
-                row_idx = row
-                break
+        row_idx = idx.find_row(report)
         if row_idx is None:
             return f"❌ Không tìm thấy mã report {report} trong file Excel!", 404
 
         valid = True
+        row_values = idx.row_values(row_idx) or ()
+        header_names = idx.headers
+
+        def _cell(col):
+            return row_values[col - 1] if col and len(row_values) >= col else None
 
         # --- lấy rating_value để kiểm soát UI ---
         rating_value = ""
-        rating_col_idx = get_col_idx(ws, "rating")
+        rating_col_idx = idx.col("rating")
         if rating_col_idx:
-            rv = ws.cell(row=row_idx, column=rating_col_idx).value
+            rv = _cell(rating_col_idx)
             rating_value = (str(rv).strip() if rv not in (None, "") else "")
 
         # --- build lines hiển thị ---
@@ -2468,14 +2685,14 @@ def update():
                 ('rating', 'RATING')
             ]
             for key, label in summary_keys:
-                idx_col = get_col_idx(ws, key)
-                value = ws.cell(row=row_idx, column=idx_col).value if idx_col else ""
+                idx_col = idx.col(key)
+                value = _cell(idx_col) if idx_col else ""
                 show_value = str(value).strip() if value not in ("", None) else ""
                 lines.append((label, show_value))
         else:
-            for col in range(1, ws.max_column):
-                label = ws.cell(row=1, column=col).value
-                value = ws.cell(row=row_idx, column=col).value
+            for col in range(1, len(header_names)):
+                label = header_names[col - 1]
+                value = _cell(col)
                 if label and value not in (None, ""):
                     lines.append((str(label).upper(), str(value)))
 
@@ -2571,7 +2788,8 @@ def update():
                 if file and allowed_file(file.filename):
                     ext = file.filename.rsplit('.', 1)[1].lower()
                     filename = f"overview_{int(datetime.now().timestamp())}_{i}.{ext}"
-                    file.save(os.path.join(folder, filename))
+                    blob_store.save_upload(file, os.path.join(folder, filename))
+                    _after_image_saved(os.path.join(folder, filename))
             return redirect(url_for("update", report=report))
 
         # --- Upload weight images ---
@@ -2583,7 +2801,8 @@ def update():
                 if file and allowed_file(file.filename):
                     ext = file.filename.rsplit('.', 1)[1].lower()
                     filename = f"weight_{int(datetime.now().timestamp())}_{i}.{ext}"
-                    file.save(os.path.join(folder, filename))
+                    blob_store.save_upload(file, os.path.join(folder, filename))
+                    _after_image_saved(os.path.join(folder, filename))
             return redirect(url_for("update", report=report))
 
         # --- LƯU SAMPLE INFO vào comment_{group}.txt (KHÔNG ghi Excel) ---
@@ -2617,29 +2836,25 @@ def update():
         
         # --- Đánh dấu "testing" ---
         elif valid and action == "testing":
-            wb = safe_load_excel(local_main)
-            ws = wb.active
-            test_date_col = get_col_idx(ws, "test date")
-            rating_col = get_col_idx(ws, "rating")
+            test_date_col = idx.col("test date")
+            rating_col = idx.col("rating")
             vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
             now = datetime.now(vn_tz).strftime("%d/%m/%Y %H:%M").upper()
+            updates = {}
             if test_date_col:
-                ws.cell(row=row_idx, column=test_date_col).value = now
+                updates[test_date_col] = (now, None)
             if rating_col:
-                ws.cell(row=row_idx, column=rating_col).value = "PENDING"
-            safe_save_excel(wb, local_main)
+                updates[rating_col] = ("PENDING", None)
+            commit_row_updates(local_main, report, row_idx, updates)
             message = f"Đã ghi thời gian kiểm tra và cập nhật trạng thái PENDING cho {report}!"
 
         # --- Đánh dấu "test_done" ---
         elif valid and action == "test_done":
-            wb = safe_load_excel(local_main)
-            ws = wb.active
-            complete_col = get_col_idx(ws, "complete date")
+            complete_col = idx.col("complete date")
             vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
             now = datetime.now(vn_tz).strftime("%d/%m/%Y %H:%M").upper()
             if complete_col:
-                ws.cell(row=row_idx, column=complete_col).value = now
-            safe_save_excel(wb, local_main)
+                commit_row_updates(local_main, report, row_idx, {complete_col: (now, None)})
             message = f"Đã ghi hoàn thành test cho {report}!"
 
         # --- Rating PASS/FAIL/DATA (ghi Excel như cũ) ---
@@ -2647,6 +2862,12 @@ def update():
             print("==> ĐANG XỬ LÝ RATING:", action, "CHO REPORT", report)
             value = action.replace("rating_", "").upper()
 
+            # Rating cần tô màu dòng + copy style sang completed -> ghi thẳng Excel,
+            # nên đẩy hết thay đổi đang chờ trong SQLite ra file trước.
+            try:
+                flush_exports()
+            except Exception as e:
+                print("flush report_db lỗi:", e)
             wb = safe_load_excel(local_main)
             ws = wb.active
 
@@ -2849,12 +3070,8 @@ def update():
 
     # === Kiểm tra đã có ảnh after chưa ===
     folder = os.path.join(UPLOAD_FOLDER, str(report))
-    imgs_after = []
     after_tag = "line_after"
-    if os.path.exists(folder):
-        for f in sorted(os.listdir(folder)):
-            if allowed_file(f) and f.startswith(after_tag):
-                imgs_after.append(f"/images/{report}/{f}")
+    imgs_after = image_manifest.folder_index(folder).image_urls(report, after_tag)
     has_after_img = len(imgs_after) > 0
 
     show_line_test_done_notice = show_line_test_done and not has_after_img
@@ -2883,54 +3100,44 @@ def update():
     )
 
 def _has_images(report_folder: str, group: str, key: str, is_hotcold_like: bool) -> bool:
-    if not os.path.exists(report_folder):
-        return False
-    try:
-        files = os.listdir(report_folder)
-    except Exception:
-        return False
-
+    idx = image_manifest.folder_index(report_folder)
     if is_hotcold_like:
         # chấp nhận tên có/không kèm group sau before/after
-        prefixes = (
-            f"{key}_before_{group}",
-            f"{key}_after_{group}",
-            f"{key}_before_",
-            f"{key}_after_",
-        )
-        return any(allowed_file(fn) and fn.startswith(prefixes) for fn in files)
+        return idx.has_prefix(f"{key}_before_{group}", f"{key}_after_{group}", f"{key}_before_", f"{key}_after_")
     else:
-        pref = f"test_{group}_{key}_"
-        return any(allowed_file(fn) and fn.startswith(pref) for fn in files)
+        return idx.has_prefix(f"test_{group}_{key}_")
 
+@app.route("/download_images")
 @app.route("/download_images/<report>")
-def download_all_images(report):
-    base_dir = os.path.join("images", report)
-
-    if not os.path.exists(base_dir):
-        return f"Không tìm thấy thư mục hình cho report {report}", 404
-
-    # Tạo ZIP trong RAM
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(base_dir):
-            for file in files:
-                if file.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
-                    full_path = os.path.join(root, file)
-
-                    # Đường dẫn bên trong ZIP giữ nguyên cấu trúc
-                    arcname = os.path.relpath(full_path, base_dir)
-
-                    zipf.write(full_path, arcname)
-
-    zip_buffer.seek(0)
-
-    return send_file(
-        zip_buffer,
-        as_attachment=True,
-        download_name=f"{report}_images.zip",
-        mimetype="application/zip"
-    )
+def download_all_images(report=None):
+    """ZIP ảnh report dạng stream; nhiều report: /download_images?reports=25-6501,25-6502"""
+    if report:
+        reports = [report]
+    else:
+        reports = [r for v in request.args.getlist("reports") for r in re.split(r"[\s,;]+", v) if r]
+        reports = list(OrderedDict.fromkeys(reports))
+    if not reports:
+        return "Thiếu danh sách report (?reports=...)", 400
+    if len(reports) > IMAGE_ZIP_MAX_REPORTS:
+        return f"Tối đa {IMAGE_ZIP_MAX_REPORTS} report mỗi lần tải", 400
+    bad = [r for r in reports if not image_zip.report_dir(r)]
+    if bad:
+        return f"Report không hợp lệ: {', '.join(bad)}", 400
+    missing = [r for r in reports if not os.path.isdir(image_zip.report_dir(r))]
+    if len(missing) == len(reports):
+        return f"Không tìm thấy thư mục hình cho report {', '.join(missing)}", 404
+
+    download_name = f"{reports[0]}_images.zip" if len(reports) == 1 else f"images_{len(reports)}_reports.zip"
+    files = image_zip.collect(reports)
+    key = image_zip.archive_key(files)
+    cached = image_zip.cached_archive(key)
+    if cached:
+        return send_file(os.path.abspath(cached), as_attachment=True, download_name=download_name,
+                         mimetype="application/zip")
+
+    resp = Response(stream_with_context(image_zip.iter_zip_cached(files, key)), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+    return resp
 # >>> ADD
 @app.get('/api/report/detect')
 def api_report_detect():
@@ -2989,6 +3196,37 @@ def api_report_create():
             download_name=f"{report_id or 'report'}_{rtype}_TEMPLATE.docx"
         )
 
+@app.route("/api/report/bulk", methods=["GET", "POST"])
+def api_report_bulk():
+    """
+    Tạo nhiều report 1 lần -> ZIP (stream, report nào xong trước ghi trước; lỗi nằm trong _errors.txt).
+      reports: "25-6501:25-6550, 25-6600, 25-6601=transit_2c_np"
+      type   : loại mặc định cho các report không ghi '=loại'
+    Workbook chính chỉ đọc 1 lần cho cả đợt.
+    """
+    src = request.get_json(silent=True) or request.values
+    spec = src.get("reports") or ""
+    rtype = (src.get("type") or "").strip().lower()
+    try:
+        items = expand_report_spec(spec, rtype)
+    except ValueError as ex:
+        return jsonify({"ok": False, "error": str(ex)}), 400
+    if not items:
+        return jsonify({"ok": False, "error": "missing reports"}), 400
+
+    excel_path = os.path.join(local_main, "ds san pham test voi qr.xlsx")
+    try:
+        rows, excel_cols = load_report_rows(excel_path)
+    except Exception as ex:
+        print("Bulk report: đọc Excel lỗi:", ex)
+        return jsonify({"ok": False, "error": str(ex)}), 500
+
+    generated_by = session.get('staff_id') or session.get('user_type') or "VFR User"
+    stream = iter_bulk_zip(render_bulk(items, rows, excel_cols, generated_by))
+    resp = Response(stream_with_context(stream), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = f'attachment; filename="reports_{datetime.now():%Y%m%d_%H%M%S}.zip"'
+    return resp
+
 # --- THAY THẾ HẲN hàm test_group_page ---
 @app.route("/test_group/<report>/<group>", methods=["GET", "POST"])
 def test_group_page(report, group):
@@ -3007,6 +3245,7 @@ def test_group_page(report, group):
     comment_file = os.path.join(report_folder, f"comment_{group}.txt")
     all_status   = load_group_notes(status_file)    # {key -> PASS/FAIL/N/A/DATA...}
     all_comment  = load_group_notes(comment_file)   # {key -> comment string}
+    idx = image_manifest.folder_index(report_folder)      # 1 lần quét cho mọi mục trong menu
 
     test_status = {}
 
@@ -3019,11 +3258,9 @@ def test_group_page(report, group):
         #    - Mới:  status_{group}_{key}.txt / comment_{group}_{key}.txt
         #    - Cũ:   {key}_{group}_status.txt / {key}_{group}_comment.txt
         if not st:
-            for st_path in [
-                os.path.join(report_folder, f"status_{group}_{key}.txt"),
-                os.path.join(report_folder, f"{key}_{group}_status.txt"),
-            ]:
-                if os.path.exists(st_path):
+            for st_name in [f"status_{group}_{key}.txt", f"{key}_{group}_status.txt"]:
+                st_path = idx.path(st_name)
+                if idx.has(st_name):
                     try:
                         v = (safe_read_text(st_path) or "").strip()
                         if v:
@@ -3033,11 +3270,9 @@ def test_group_page(report, group):
                         pass
 
         if not cm:
-            for cm_path in [
-                os.path.join(report_folder, f"comment_{group}_{key}.txt"),
-                os.path.join(report_folder, f"{key}_{group}_comment.txt"),
-            ]:
-                if os.path.exists(cm_path):
+            for cm_name in [f"comment_{group}_{key}.txt", f"{key}_{group}_comment.txt"]:
+                cm_path = idx.path(cm_name)
+                if idx.has(cm_name):
                     try:
                         v = (safe_read_text(cm_path) or "").strip()
                         if v:
@@ -3108,15 +3343,9 @@ def test_group_item_dynamic(report, group, test_key):
                 files = request.files.getlist(f'gt68_face_img_{zone}')
                 if files:
                     imgs[str(idx)] = []  # FIX: đồng bộ key "0".."5" để FE đọc data.imgs[zone]
-                    for file in files:
-                        if file and allowed_file(file.filename):
-                            ext = file.filename.rsplit('.', 1)[-1].lower()
-                            prefix = f"test_{group}_{test_key}_gt68_face_{zone}_"
-                            nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                            next_num = max(nums, default=0) + 1
-                            fname = f"{prefix}{next_num}.{ext}"
-                            file.save(os.path.join(report_folder, fname))
-                            imgs[str(idx)].append(f"/images/{report}/{fname}")
+                    prefix = f"test_{group}_{test_key}_gt68_face_{zone}_"
+                    for fname in _save_uploads(files, report_folder, prefix):
+                        imgs[str(idx)].append(f"/images/{report}/{fname}")
 
         # ========== RH Impact zones (tách ra ngoài nhánh GT68) ==========
         # FIX: các khối RH/Drop/Impact/Rot KHÔNG còn lồng trong nhánh GT68
@@ -3124,60 +3353,36 @@ def test_group_item_dynamic(report, group, test_key):
             files = request.files.getlist(f'rh_impact_img_{zone}')
             if files:
                 imgs.setdefault(zone, [])
-                for file in files:
-                    if file and allowed_file(file.filename):
-                        ext = file.filename.rsplit('.', 1)[-1].lower()
-                        prefix = f"test_{group}_{test_key}_{zone}_"
-                        nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                        next_num = max(nums, default=0) + 1
-                        fname = f"{prefix}{next_num}.{ext}"
-                        file.save(os.path.join(report_folder, fname))
-                        imgs[zone].append(f"/images/{report}/{fname}")
+                prefix = f"test_{group}_{test_key}_{zone}_"
+                for fname in _save_uploads(files, report_folder, prefix):
+                    imgs[zone].append(f"/images/{report}/{fname}")
 
         # ========== RH Vib zones ==========
         for zone, _ in rh_vib_zones:
             files = request.files.getlist(f'rh_vib_img_{zone}')
             if files:
                 imgs.setdefault(zone, [])
-                for file in files:
-                    if file and allowed_file(file.filename):
-                        ext = file.filename.rsplit('.', 1)[-1].lower()
-                        prefix = f"test_{group}_{test_key}_{zone}_"
-                        nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                        next_num = max(nums, default=0) + 1
-                        fname = f"{prefix}{next_num}.{ext}"
-                        file.save(os.path.join(report_folder, fname))
-                        imgs[zone].append(f"/images/{report}/{fname}")
+                prefix = f"test_{group}_{test_key}_{zone}_"
+                for fname in _save_uploads(files, report_folder, prefix):
+                    imgs[zone].append(f"/images/{report}/{fname}")
 
         # ========== RH Second impact zones ==========
         for zone, _ in rh_second_impact_zones:
             files = request.files.getlist(f'rh_second_impact_img_{zone}')
             if files:
                 imgs.setdefault(zone, [])
-                for file in files:
-                    if file and allowed_file(file.filename):
-                        ext = file.filename.rsplit('.', 1)[-1].lower()
-                        prefix = f"test_{group}_{test_key}_{zone}_"
-                        nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                        next_num = max(nums, default=0) + 1
-                        fname = f"{prefix}{next_num}.{ext}"
-                        file.save(os.path.join(report_folder, fname))
-                        imgs[zone].append(f"/images/{report}/{fname}")
+                prefix = f"test_{group}_{test_key}_{zone}_"
+                for fname in _save_uploads(files, report_folder, prefix):
+                    imgs[zone].append(f"/images/{report}/{fname}")
 
         # ========== RH step12 zones ==========
         for zone, _ in rh_step12_zones:
             files = request.files.getlist(f'rh_step12_img_{zone}')
             if files:
                 imgs.setdefault(zone, [])
-                for file in files:
-                    if file and allowed_file(file.filename):
-                        ext = file.filename.rsplit('.', 1)[-1].lower()
-                        prefix = f"test_{group}_{test_key}_{zone}_"
-                        nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                        next_num = max(nums, default=0) + 1
-                        fname = f"{prefix}{next_num}.{ext}"
-                        file.save(os.path.join(report_folder, fname))
-                        imgs[zone].append(f"/images/{report}/{fname}")
+                prefix = f"test_{group}_{test_key}_{zone}_"
+                for fname in _save_uploads(files, report_folder, prefix):
+                    imgs[zone].append(f"/images/{report}/{fname}")
 
         # ========== DROP, IMPACT, ROTATION (tách ra ngoài nhánh GT68) ==========
         # Drop
@@ -3186,15 +3391,9 @@ def test_group_item_dynamic(report, group, test_key):
                 files = request.files.getlist(f'drop_img_{zone}')
                 if files:
                     imgs.setdefault(idx, [])
-                    for file in files:
-                        if file and allowed_file(file.filename):
-                            ext = file.filename.rsplit('.', 1)[-1].lower()
-                            prefix = f"test_{group}_{test_key}_drop_{zone}_"
-                            nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                            next_num = max(nums, default=0) + 1
-                            fname = f"{prefix}{next_num}.{ext}"
-                            file.save(os.path.join(report_folder, fname))
-                            imgs[idx].append(f"/images/{report}/{fname}")
+                    prefix = f"test_{group}_{test_key}_drop_{zone}_"
+                    for fname in _save_uploads(files, report_folder, prefix):
+                        imgs[idx].append(f"/images/{report}/{fname}")
 
         # Impact
         if is_impact:
@@ -3202,15 +3401,9 @@ def test_group_item_dynamic(report, group, test_key):
                 files = request.files.getlist(f'impact_img_{zone}')
                 if files:
                     imgs.setdefault(idx, [])
-                    for file in files:
-                        if file and allowed_file(file.filename):
-                            ext = file.filename.rsplit('.', 1)[-1].lower()
-                            prefix = f"test_{group}_{test_key}_impact_{zone}_"
-                            nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                            next_num = max(nums, default=0) + 1
-                            fname = f"{prefix}{next_num}.{ext}"
-                            file.save(os.path.join(report_folder, fname))
-                            imgs[idx].append(f"/images/{report}/{fname}")
+                    prefix = f"test_{group}_{test_key}_impact_{zone}_"
+                    for fname in _save_uploads(files, report_folder, prefix):
+                        imgs[idx].append(f"/images/{report}/{fname}")
 
         # Rotation
         if is_rot:
@@ -3218,28 +3411,16 @@ def test_group_item_dynamic(report, group, test_key):
                 files = request.files.getlist(f'rot_img_{zone}')
                 if files:
                     imgs.setdefault(idx, [])
-                    for file in files:
-                        if file and allowed_file(file.filename):
-                            ext = file.filename.rsplit('.', 1)[-1].lower()
-                            prefix = f"test_{group}_{test_key}_rotation_{zone}_"
-                            nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                            next_num = max(nums, default=0) + 1
-                            fname = f"{prefix}{next_num}.{ext}"
-                            file.save(os.path.join(report_folder, fname))
-                            imgs[idx].append(f"/images/{report}/{fname}")
+                    prefix = f"test_{group}_{test_key}_rotation_{zone}_"
+                    for fname in _save_uploads(files, report_folder, prefix):
+                        imgs[idx].append(f"/images/{report}/{fname}")
 
         # THƯỜNG
         if request.files.getlist('test_imgs'):
             imgs['normal'] = []
-            for file in request.files.getlist('test_imgs'):
-                if file and allowed_file(file.filename):
-                    ext = file.filename.rsplit('.', 1)[-1].lower()
-                    prefix = f"test_{group}_{test_key}_"
-                    nums = [int(f[len(prefix):].split('.')[0]) for f in os.listdir(report_folder) if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()]
-                    next_num = max(nums, default=0) + 1
-                    fname = f"{prefix}{next_num}.{ext}"
-                    file.save(os.path.join(report_folder, fname))
-                    imgs['normal'].append(f"/images/{report}/{fname}")
+            prefix = f"test_{group}_{test_key}_"
+            for fname in _save_uploads(request.files.getlist('test_imgs'), report_folder, prefix):
+                imgs['normal'].append(f"/images/{report}/{fname}")
 
         # Xóa ảnh AJAX
         if 'delete_img' in request.form:
@@ -3248,6 +3429,7 @@ def test_group_item_dynamic(report, group, test_key):
             if os.path.exists(img_path):
                 try:
                     os.remove(img_path)
+                    _after_image_removed(img_path)
                 except Exception:
                     pass  # Đã bị xóa bởi thread khác
             # Trả lại danh sách ảnh còn lại
@@ -3265,32 +3447,21 @@ def test_group_item_dynamic(report, group, test_key):
                     elif kind == 'rot':
                         zone = ROT_ZONES[int(idx)]
                         prefix = f"test_{group}_{test_key}_rotation_{zone}_"
-                    imgs[int(idx)] = []
-                    for f in os.listdir(report_folder):
-                        if allowed_file(f) and f.startswith(prefix):
-                            imgs[int(idx)].append(f"/images/{report}/{f}")
+                    imgs[int(idx)] = image_manifest.folder_index(report_folder).image_urls(report, prefix)
                 elif kind == 'gt68_face' and group == "transit_181_gt68" and test_key == "step4":
                     idx = int(idx)
                     zone = GT68_FACE_ZONES[idx]
                     prefix = f"test_{group}_{test_key}_gt68_face_{zone}_"
-                    imgs[str(idx)] = []  # FIX: trả về key "0".."5" để khớp FE
-                    for f in os.listdir(report_folder):
-                        if allowed_file(f) and f.startswith(prefix):
-                            imgs[str(idx)].append(f"/images/{report}/{f}")
+                    # FIX: trả về key "0".."5" để khớp FE
+                    imgs[str(idx)] = image_manifest.folder_index(report_folder).image_urls(report, prefix)
                 else:
                     # RH zones
                     zone = idx
                     prefix = f"test_{group}_{test_key}_{zone}_"
-                    imgs[zone] = []
-                    for f in os.listdir(report_folder):
-                        if allowed_file(f) and f.startswith(prefix):
-                            imgs[zone].append(f"/images/{report}/{f}")
+                    imgs[zone] = image_manifest.folder_index(report_folder).image_urls(report, prefix)
             elif 'delete_img' in request.form:
                 # Ảnh thường
-                imgs['normal'] = []
-                for f in os.listdir(report_folder):
-                    if allowed_file(f) and f.startswith(f"test_{group}_{test_key}_"):
-                        imgs['normal'].append(f"/images/{report}/{f}")
+                imgs['normal'] = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{test_key}_")
 
         return jsonify(imgs=imgs)
 
@@ -3324,18 +3495,7 @@ def test_group_item_dynamic(report, group, test_key):
         # Chỉ upload ảnh loại thường (test_imgs)
         if 'test_imgs' in request.files:
             files = request.files.getlist('test_imgs')
-            for file in files:
-                if file and allowed_file(file.filename):
-                    ext = file.filename.rsplit('.', 1)[-1].lower()
-                    prefix = f"test_{group}_{test_key}_"
-                    current_nums = [
-                        int(f[len(prefix):].split('.')[0])
-                        for f in os.listdir(report_folder)
-                        if f.startswith(prefix) and f[len(prefix):].split('.')[0].isdigit()
-                    ]
-                    next_num = max(current_nums) + 1 if current_nums else 1
-                    new_fname = f"{prefix}{next_num}.{ext}"
-                    file.save(os.path.join(report_folder, new_fname))
+            _save_uploads(files, report_folder, f"test_{group}_{test_key}_")
         # Xóa ảnh thường
         if 'delete_img' in request.form:
             del_img = request.form['delete_img']
@@ -3343,6 +3503,7 @@ def test_group_item_dynamic(report, group, test_key):
             if os.path.exists(img_path):
                 try:
                     os.remove(img_path)
+                    _after_image_removed(img_path)
                 except Exception:
                     pass
         # Ghi status PASS/FAIL/N/A
@@ -3357,41 +3518,28 @@ def test_group_item_dynamic(report, group, test_key):
     # --- Chuẩn bị dữ liệu ảnh vùng RH (step3/4/5/12) ---
     zone_imgs = {}
     for zone, label in rh_impact_zones + rh_vib_zones + rh_second_impact_zones + rh_step12_zones:
-        imgs_zone = []
-        for f in os.listdir(report_folder):
-            if allowed_file(f) and f.startswith(f"test_{group}_{test_key}_{zone}_"):
-                imgs_zone.append(f"/images/{report}/{f}")
+        imgs_zone = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{test_key}_{zone}_")
         zone_imgs[zone] = imgs_zone
 
     # --- Chuẩn bị dữ liệu ảnh thường ---
-    imgs = []
-    for f in sorted(os.listdir(report_folder)):
-        # Chỉ lấy ảnh loại thường, không lấy ảnh vùng
-        if allowed_file(f) and f.startswith(f"test_{group}_{test_key}_") and all(not f.startswith(f"test_{group}_{test_key}_{zone}_") for zone, _ in rh_impact_zones + rh_vib_zones + rh_second_impact_zones + rh_step12_zones):
-            imgs.append(f"/images/{report}/{f}")
+    # Chỉ lấy ảnh loại thường, không lấy ảnh vùng
+    zone_prefixes = tuple(f"test_{group}_{test_key}_{zone}_" for zone, _ in rh_impact_zones + rh_vib_zones + rh_second_impact_zones + rh_step12_zones)
+    imgs = [f"/images/{report}/{f}" for f in image_manifest.folder_index(report_folder).with_prefix(f"test_{group}_{test_key}_")
+            if not f.startswith(zone_prefixes)]
 
     # --- Chuẩn bị ảnh drop, impact, rot nếu có ---
     drop_imgs, impact_imgs, rot_imgs = [], [], []
     if is_drop:
         for zone in DROP_ZONES:
-            di = []
-            for f in os.listdir(report_folder):
-                if allowed_file(f) and f.startswith(f"test_{group}_{test_key}_drop_{zone}_"):
-                    di.append(f"/images/{report}/{f}")
+            di = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{test_key}_drop_{zone}_")
             drop_imgs.append(di)
     if is_impact:
         for zone in IMPACT_ZONES:
-            ii = []
-            for f in os.listdir(report_folder):
-                if allowed_file(f) and f.startswith(f"test_{group}_{test_key}_impact_{zone}_"):
-                    ii.append(f"/images/{report}/{f}")
+            ii = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{test_key}_impact_{zone}_")
             impact_imgs.append(ii)
     if is_rot:
         for zone in ROT_ZONES:
-            ri = []
-            for f in os.listdir(report_folder):
-                if allowed_file(f) and f.startswith(f"test_{group}_{test_key}_rotation_{zone}_"):
-                    ri.append(f"/images/{report}/{f}")
+            ri = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{test_key}_rotation_{zone}_")
             rot_imgs.append(ri)
 
     # --- Trả về template ---
@@ -3417,11 +3565,7 @@ def render_test_group_item(report, group, key, group_titles, comment):
     # Xử lý ảnh vùng RH (zone_imgs)
     zone_imgs = {}
     for zone, label in rh_impact_zones + rh_vib_zones + rh_second_impact_zones:
-        imgs = []
-        if os.path.exists(report_folder):
-            for f in os.listdir(report_folder):
-                if allowed_file(f) and f.startswith(f"test_{group}_{key}_{zone}_"):
-                    imgs.append(f"/images/{report}/{f}")
+        imgs = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{key}_{zone}_")
         zone_imgs[zone] = imgs
 
     # Vùng Face cho transit_181_gt68 step4
@@ -3430,11 +3574,7 @@ def render_test_group_item(report, group, key, group_titles, comment):
         gt68_face_zones = GT68_FACE_ZONES
         gt68_face_labels = GT68_FACE_LABELS
         for zone in gt68_face_zones:
-            imgs = []
-            if os.path.exists(report_folder):
-                for f in os.listdir(report_folder):
-                    if allowed_file(f) and f.startswith(f"test_{group}_{key}_gt68_face_{zone}_"):
-                        imgs.append(f"/images/{report}/{f}")
+            imgs = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{key}_gt68_face_{zone}_")
             gt68_face_imgs.append(imgs)
 
     # Nhóm transit 2C logic
@@ -3451,39 +3591,23 @@ def render_test_group_item(report, group, key, group_titles, comment):
     drop_imgs = []
     if is_drop:
         for zone in DROP_ZONES:
-            imgs = []
-            if os.path.exists(report_folder):
-                for f in os.listdir(report_folder):
-                    if allowed_file(f) and f.startswith(f"test_{group}_{key}_drop_{zone}_"):
-                        imgs.append(f"/images/{report}/{f}")
+            imgs = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{key}_drop_{zone}_")
             drop_imgs.append(imgs)
 
     impact_imgs = []
     rot_imgs = []
     if is_impact:
         for zone in IMPACT_ZONES:
-            imgs = []
-            if os.path.exists(report_folder):
-                for f in os.listdir(report_folder):
-                    if allowed_file(f) and f.startswith(f"test_{group}_{key}_impact_{zone}_"):
-                        imgs.append(f"/images/{report}/{f}")
+            imgs = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{key}_impact_{zone}_")
             impact_imgs.append(imgs)
     if is_rot:
         for zone in ROT_ZONES:
-            imgs = []
-            if os.path.exists(report_folder):
-                for f in os.listdir(report_folder):
-                    if allowed_file(f) and f.startswith(f"test_{group}_{key}_rotation_{zone}_"):
-                        imgs.append(f"/images/{report}/{f}")
+            imgs = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{key}_rotation_{zone}_")
             rot_imgs.append(imgs)
     gt68_face_imgs = []
     if group == "transit_181_gt68" and key == "step4":
         for zone in GT68_FACE_ZONES:
-            imgs = []
-            if os.path.exists(report_folder):
-                for f in os.listdir(report_folder):
-                    if allowed_file(f) and f.startswith(f"test_{group}_{key}_gt68_face_{zone}_"):
-                        imgs.append(f"/images/{report}/{f}")
+            imgs = image_manifest.folder_index(report_folder).image_urls(report, f"test_{group}_{key}_gt68_face_{zone}_")
             gt68_face_imgs.append(imgs)
 
     # === Status/comment helper ===
@@ -3525,6 +3649,7 @@ def render_test_group_item(report, group, key, group_titles, comment):
             img_path = os.path.join(report_folder, del_img)
             if os.path.exists(img_path):
                 os.remove(img_path)
+                _after_image_removed(img_path)
         # Ghi status PASS/FAIL/N/A
         if 'status' in request.form:
             status = request.form['status']
@@ -3543,13 +3668,7 @@ def render_test_group_item(report, group, key, group_titles, comment):
     for k in group_titles:
         st = get_group_note_value(status_file, k) if not group.startswith("transit") else None
         cm = get_group_note_value(comment_file, k)
-        has_img = False
-        prefix = f"test_{group}_{k}_"
-        if os.path.exists(report_folder):
-            for fn in os.listdir(report_folder):
-                if allowed_file(fn) and fn.startswith(prefix):
-                    has_img = True
-                    break
+        has_img = image_manifest.folder_index(report_folder).has_prefix(f"test_{group}_{k}_")
         test_status[k] = {
             'status': st,
             'comment': cm,
@@ -3558,14 +3677,13 @@ def render_test_group_item(report, group, key, group_titles, comment):
 
     # === Lấy ảnh thường cho mục không phải drop/impact/rot/RH np ===
     imgs = []
-    if os.path.exists(report_folder) and not is_drop:
+    if not is_drop:
         prefix = f"test_{group}_{key}_"
-        for f in sorted(os.listdir(report_folder)):
-            if allowed_file(f) and f.startswith(prefix):
-                # Chỉ nhận file có số thứ tự ngay sau prefix (vd: ..._1.jpg, ..._2.png)
-                tail = f[len(prefix):].split('.')[0]
-                if tail.isdigit():
-                    imgs.append(f"/images/{report}/{f}")
+        for f in image_manifest.folder_index(report_folder).with_prefix(prefix):
+            # Chỉ nhận file có số thứ tự ngay sau prefix (vd: ..._1.jpg, ..._2.png)
+            tail = f[len(prefix):].split('.')[0]
+            if tail.isdigit():
+                imgs.append(f"/images/{report}/{f}")
 
     # === Chọn template (transit dùng test_transit_item.html) ===
     TRANSIT_GROUPS = (
@@ -3720,20 +3838,7 @@ def hot_cold_test(report, group, test_key):
             field_name = f"{tag}_imgs"
             if field_name in request.files:
                 files = request.files.getlist(field_name)
-                count = 0
-                for file in files:
-                    if file and allowed_file(file.filename):
-                        ext = file.filename.rsplit('.', 1)[-1].lower()
-                        prefix_img = f"{tag}_"
-                        nums = [
-                            int(fname[len(prefix_img):].split('.')[0])
-                            for fname in os.listdir(folder)
-                            if fname.startswith(prefix_img) and fname[len(prefix_img):].split('.')[0].isdigit()
-                        ]
-                        next_num = max(nums) + 1 if nums else 1
-                        new_fname = f"{tag}_{next_num}.{ext}"
-                        file.save(os.path.join(folder, new_fname))
-                        count += 1
+                count = len(_save_uploads(files, folder, f"{tag}_"))
                 if count > 0:
                     now = datetime.now(vn_tz).strftime("%d/%m/%Y %H:%M")
                     safe_write_text(time_file, now)
@@ -3745,16 +3850,17 @@ def hot_cold_test(report, group, test_key):
             if os.path.exists(img_path):
                 try:
                     os.remove(img_path)
+                    _after_image_removed(img_path)
                 except Exception:
                     pass
             # Nếu không còn ảnh before/after thì xoá file time tương ứng
             if img.startswith(before_tag):
-                still = [f for f in os.listdir(folder) if allowed_file(f) and f.startswith(before_tag)]
+                still = image_manifest.folder_index(folder).with_prefix(before_tag)
                 if not still and os.path.exists(before_time_file):
                     try: os.remove(before_time_file)
                     except Exception: pass
             if img.startswith(after_tag):
-                still = [f for f in os.listdir(folder) if allowed_file(f) and f.startswith(after_tag)]
+                still = image_manifest.folder_index(folder).with_prefix(after_tag)
                 if not still and os.path.exists(after_time_file):
                     try: os.remove(after_time_file)
                     except Exception: pass
@@ -3789,13 +3895,9 @@ def hot_cold_test(report, group, test_key):
         imgs_mo_ta = []
 
     # Danh sách ảnh before/after
-    imgs_before, imgs_after = [], []
-    for fname in sorted(os.listdir(folder)):
-        if allowed_file(fname):
-            if fname.startswith(before_tag):
-                imgs_before.append(f"/images/{report}/{fname}")
-            elif fname.startswith(after_tag):
-                imgs_after.append(f"/images/{report}/{fname}")
+    idx = image_manifest.folder_index(folder)
+    imgs_before = idx.image_urls(report, before_tag)
+    imgs_after = idx.image_urls(report, after_tag)
 
     # Thời gian upload
     before_upload_time = (safe_read_text(before_time_file) or "").strip() if os.path.exists(before_time_file) else None
@@ -3879,16 +3981,7 @@ def line_test(report):
         for tag, time_file in [(before_tag, files_map["before_time"]), (after_tag, files_map["after_time"])]:
             if f"{tag}_imgs" in request.files:
                 files = request.files.getlist(f"{tag}_imgs")
-                nums = [int(f[len(tag)+1:].split('.')[0]) for f in os.listdir(folder)
-                        if f.startswith(f"{tag}_") and f[len(tag)+1:].split('.')[0].isdigit()]
-                next_num = max(nums, default=0) + 1
-                count = 0
-                for file in files:
-                    if file and allowed_file(file.filename):
-                        ext = file.filename.rsplit('.', 1)[-1].lower()
-                        file.save(os.path.join(folder, f"{tag}_{next_num}.{ext}"))
-                        next_num += 1
-                        count += 1
+                count = len(_save_uploads(files, folder, f"{tag}_"))
                 if count:
                     vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
                     safe_write_text(time_file, datetime.now(vn_tz).strftime("%d/%m/%Y %H:%M"))
@@ -3896,10 +3989,12 @@ def line_test(report):
         if "delete_img" in request.form:
             img = request.form["delete_img"]
             img_path = os.path.join(folder, img)
-            if os.path.exists(img_path): os.remove(img_path)
+            if os.path.exists(img_path):
+                os.remove(img_path)
+                _after_image_removed(img_path)
             for tag, time_file in [(before_tag, files_map["before_time"]), (after_tag, files_map["after_time"])]:
                 if img.startswith(tag):
-                    if not any(allowed_file(f) and f.startswith(tag) for f in os.listdir(folder)):
+                    if not image_manifest.folder_index(folder).has_prefix(tag):
                         if os.path.exists(time_file): os.remove(time_file)
         set_last_test_type(report, "LINE TEST")
         return redirect(request.url)
@@ -3915,8 +4010,8 @@ def line_test(report):
                 fail_reason_other = r
                 all_reasons.remove(r)
         fail_reasons = all_reasons
-    imgs_before = [f"/images/{report}/{f}" for f in sorted(os.listdir(folder)) if allowed_file(f) and f.startswith(before_tag)]
-    imgs_after  = [f"/images/{report}/{f}" for f in sorted(os.listdir(folder)) if allowed_file(f) and f.startswith(after_tag)]
+    imgs_before = image_manifest.folder_index(folder).image_urls(report, before_tag)
+    imgs_after  = image_manifest.folder_index(folder).image_urls(report, after_tag)
     before_upload_time = safe_read_text(files_map["before_time"])
     after_upload_time  = safe_read_text(files_map["after_time"])
 
@@ -4351,7 +4446,7 @@ def serve_test_img(report, group, test_key, filename):
     if not os.path.exists(folder):
         # Báo lỗi rõ ràng hoặc trả về 404
         return "Không tìm thấy thư mục ảnh!", 404
-    return send_from_directory(folder, filename)
+    return _send_image(folder, filename)
 
 @app.route("/api/report_comment")
 def api_report_comment():
@@ -4399,6 +4494,18 @@ def api_report_comment():
 
     return jsonify({"comment": text})
 
+@app.route("/api/lock_stats")
+def api_lock_stats():
+    """Thống kê lock của process này (wait/hold, số lần tranh chấp) để xem nghẽn lúc approve hàng loạt."""
+    if request.args.get("reset") == "1" and session.get("auth_ok"):
+        reset_lock_stats()
+    return jsonify({"pid": os.getpid(), "locks": lock_stats()})
+
+@app.route("/api/pdf_stats")
+def api_pdf_stats():
+    """Thống kê dịch vụ convert PDF của process này: backend, độ sâu hàng đợi, số job, độ trễ (giây)."""
+    return jsonify({"pid": os.getpid(), "pdf": converter_stats()})
+
 @app.route("/view_counter_log")
 def view_counter_log():
 
@@ -4630,4 +4737,5 @@ def display_board():
     )
 
 if __name__ == "__main__":
+    warm_template_cache()   # parse sẵn TRF + template report (TEMPLATE_MAP) 1 lần
     app.run(host="0.0.0.0", port=8246,debug=True)
@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import threading
+from datetime import datetime, timedelta
+from config import ARCHIVE_DIR, ARCHIVE_KEEP_DAYS
+from lock_utils import named_lock
+
+# =====================================================
+# Archive TFR dạng append-only (thay cho ghi lại cả tfr_archive.json mỗi lần approve)
+# - Mỗi tháng (theo request_date) 1 segment: <ARCHIVE_DIR>/YYYY-MM.jsonl, mỗi dòng 1 record.
+# - Approve -> append 1 dòng; không đọc lại / ghi lại cả file.
+# - Index trong RAM: trq_id, report_no, approved_date; đọc tiếp phần đuôi segment khi file lớn lên.
+# - Hạn giữ: record quá ARCHIVE_KEEP_DAYS ngày (theo request_date) bị ẩn khi đọc;
+#   xoá vật lý cả segment khi toàn bộ tháng đã quá hạn.
+# =====================================================
+
+SEGMENT_RE = re.compile(r"^(\d{4})-(\d{2})\.jsonl$")
+
+
+def parse_request_date(s):
+    """'YYYY-MM-DD' hoặc 'DD/MM/YYYY' -> datetime (None nếu lỗi)."""
+    s = str(s or "").strip()
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(s, fmt)
+        except Exception:
+            pass
+    return None
+
+
+def _segment_of(rec):
+    d = parse_request_date(rec.get("request_date")) or datetime.now()
+    return d.strftime("%Y-%m") + ".jsonl"
+
+
+def _report_sort_key(rec):
+    s = str(rec.get("report_no", "") or "")
+    nums = re.findall(r"\d+", s)
+    return (int(nums[-1]) if nums else -1, s)
+
+
+class ArchiveStore:
+    def __init__(self, root=ARCHIVE_DIR, keep_days=ARCHIVE_KEEP_DAYS, legacy_json=None):
+        self.root = root
+        self.keep_days = keep_days
+        self.legacy_json = legacy_json
+        self._lock = threading.RLock()
+        self._offsets = {}      # segment -> số byte đã đọc
+        self._records = []
+        self._by_trq = {}
+        self._by_report = {}
+        self._by_approved = {}
+        self._migrated = False
+
+    # ---------- file ----------
+
+    def _segments(self):
+        try:
+            return sorted(n for n in os.listdir(self.root) if SEGMENT_RE.match(n))
+        except FileNotFoundError:
+            return []
+
+    def stamp(self):
+        """(segment, size) của các segment: đổi khi có append/xoá segment (kể cả từ process khác)."""
+        out = []
+        for name in self._segments():
+            try:
+                out.append([name, os.path.getsize(os.path.join(self.root, name))])
+            except OSError:
+                pass
+        return out
+
+    def _migrate_legacy(self):
+        """Lần đầu: chuyển tfr_archive.json cũ sang segment (chỉ khi chưa có segment nào)."""
+        self._migrated = True
+        if not self.legacy_json or not os.path.exists(self.legacy_json):
+            return
+        # kiểm tra "chưa có segment" + ghi trong cùng 1 lần giữ khoá (lock reentrant, _write_lines lấy lại được)
+        # -> 2 process khởi động cùng lúc không import trùng
+        with named_lock("tfr_archive"):
+            if self._segments():
+                return
+            try:
+                with open(self.legacy_json, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception as e:
+                print("Đọc archive cũ lỗi:", e)
+                return
+            if isinstance(data, list):
+                self._write_lines([r for r in data if isinstance(r, dict)])
+
+    def _write_lines(self, records):
+        os.makedirs(self.root, exist_ok=True)
+        groups = {}
+        for rec in records:
+            groups.setdefault(_segment_of(rec), []).append(rec)
+        with named_lock("tfr_archive"):
+            for seg, recs in groups.items():
+                with open(os.path.join(self.root, seg), "a", encoding="utf-8") as f:
+                    for rec in recs:
+                        f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                    f.flush()
+                    try:
+                        os.fsync(f.fileno())
+                    except Exception:
+                        pass
+
+    # ---------- index ----------
+
+    def _reset(self):
+        self._offsets = {}
+        self._records = []
+        self._by_trq, self._by_report, self._by_approved = {}, {}, {}
+
+    def _index(self, rec):
+        i = len(self._records)
+        self._records.append(rec)
+        trq = str(rec.get("trq_id") or "").strip().upper()
+        if trq:
+            self._by_trq.setdefault(trq, []).append(i)
+        rep = str(rec.get("report_no") or "").strip()
+        if rep:
+            self._by_report.setdefault(rep, []).append(i)
+        ad = str(rec.get("approved_date") or "").strip()
+        if ad:
+            self._by_approved.setdefault(ad, []).append(i)
+
+    def refresh(self):
+        """Đọc phần mới của các segment (tail); segment bị xoá/cắt ngắn -> build lại từ đầu."""
+        with self._lock:
+            if not self._migrated:
+                self._migrate_legacy()
+            segs = self._segments()
+            for seg, off in self._offsets.items():
+                path = os.path.join(self.root, seg)
+                if seg not in segs or os.path.getsize(path) < off:
+                    self._reset()
+                    break
+            for seg in segs:
+                path = os.path.join(self.root, seg)
+                off = self._offsets.get(seg, 0)
+                try:
+                    if os.path.getsize(path) == off:
+                        continue
+                    with open(path, "rb") as f:
+                        f.seek(off)
+                        chunk = f.read()
+                except OSError:
+                    continue
+                # chỉ nhận tới dòng hoàn chỉnh cuối cùng (process khác có thể đang ghi dở)
+                end = chunk.rfind(b"\n") + 1
+                for line in chunk[:end].splitlines():
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        rec = json.loads(line.decode("utf-8"))
+                    except Exception:
+                        continue
+                    if isinstance(rec, dict):
+                        self._index(rec)
+                self._offsets[seg] = off + end
+        return self
+
+    # ---------- ghi ----------
+
+    def append(self, rec):
+        """Append 1 record vào segment tháng của nó (1 dòng JSONL)."""
+        self.refresh()
+        self._write_lines([rec])
+        self.refresh()
+
+    def drop_expired(self, days=None):
+        """Xoá các segment mà cả tháng đã quá hạn giữ; trả về danh sách segment đã xoá."""
+        days = self.keep_days if days is None else days
+        cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m")
+        dropped = []
+        with named_lock("tfr_archive"):
+            for seg in self._segments():
+                if seg[:7] < cutoff:
+                    try:
+                        os.remove(os.path.join(self.root, seg))
+                        dropped.append(seg)
+                    except OSError as e:
+                        print("Xoá segment archive lỗi:", seg, e)
+        if dropped:
+            self.refresh()
+        return dropped
+
+    # ---------- đọc ----------
+
+    def _live(self, rec, now=None):
+        d = parse_request_date(rec.get("request_date"))
+        if d is None:
+            return False
+        return ((now or datetime.now()) - d).days < self.keep_days
+
+    def records(self, include_expired=False):
+        """Các record còn hạn (theo request_date), theo thứ tự ghi."""
+        self.refresh()
+        with self._lock:
+            recs = list(self._records)
+        if include_expired:
+            return recs
+        now = datetime.now()
+        return [r for r in recs if self._live(r, now)]
+
+    def _pick(self, idx_map, key):
+        self.refresh()
+        with self._lock:
+            return [self._records[i] for i in idx_map.get(key, [])]
+
+    def find_by_trq(self, trq_id):
+        return self._pick(self._by_trq, str(trq_id or "").strip().upper())
+
+    def find_by_report(self, report_no):
+        return self._pick(self._by_report, str(report_no or "").strip())
+
+    def find_by_approved_date(self, approved_date):
+        return self._pick(self._by_approved, str(approved_date or "").strip())
+
+    def report_nos(self):
+        return {str(r.get("report_no") or "").strip() for r in self.records()} - {""}
+
+    def query(self, q="", page=1, per_page=100, include_expired=False):
+        """
+        Lọc + phân trang phía server.
+        - q: chứa trong TRQ-ID / report_no / employee_id / requestor / item_code (không phân biệt hoa thường)
+        - Sắp xếp report_no mới nhất lên trên.
+        Trả về (items của trang, tổng số record khớp).
+        """
+        q = (q or "").strip().upper()
+        recs = self.records(include_expired=include_expired)
+        if q:
+            fields = ("trq_id", "report_no", "employee_id", "requestor", "item_code", "item")
+            recs = [r for r in recs if any(q in str(r.get(k) or "").upper() for k in fields)]
+        recs.sort(key=_report_sort_key, reverse=True)
+        total = len(recs)
+        per_page = max(1, int(per_page or 1))
+        page = max(1, int(page or 1))
+        start = (page - 1) * per_page
+        return [dict(r) for r in recs[start:start + per_page]], total
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_archive_store():
+    global _STORE
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                _STORE = ArchiveStore(legacy_json="tfr_archive.json")
+    return _STORE
@@ -0,0 +1,215 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import hashlib
+import tempfile
+from config import UPLOAD_FOLDER, BLOB_STORE_DIR, BLOB_STORE_ENABLED
+import image_manifest
+from image_manifest import IMAGE_EXTS
+
+# =====================================================
+# Lưu ảnh upload theo nội dung (chống trùng: điện thoại gửi lại cùng ảnh, 1 ảnh gắn nhiều mục test)
+# - Upload: đọc stream theo khúc, vừa ghi file tạm vừa băm BLAKE2b -> blob BLOB_STORE_DIR/<2 ký tự>/<hash>.
+#   Blob đã có thì bỏ file tạm; file trong images/<report>/ là hardlink tới blob
+#   -> mọi chỗ đọc ảnh (route, docx, zip...) giữ nguyên, không cần biết blob.
+# - BLOB_STORE_DIR phải cùng ổ đĩa với UPLOAD_FOLDER (hardlink); không link được -> lưu file thường.
+# - Hardlink dùng chung mtime với blob (bản upload đầu tiên) -> thứ tự "mới nhất" lấy theo thời điểm upload
+#   ghi trong image_manifest ('added'), không theo mtime file.
+# - Xoá ảnh = xoá link như cũ; blob không còn link nào (st_nlink == 1) được dọn bằng gc().
+# - Không ghi đè tại chỗ lên ảnh đã link (sẽ đổi luôn các bản khác): muốn sửa ảnh thì ghi file tạm + os.replace.
+# - Ảnh cũ: python blob_store.py backfill [--dry-run] [thư mục ...] -> báo số byte thu hồi được.
+# =====================================================
+
+CHUNK_SIZE = 256 * 1024
+_TMP_PREFIX = ".up_"
+_TMP_MAX_AGE = 3600      # file tạm .up_* cũ hơn 1 giờ mới coi là sót lại (upload đang chạy vẫn dùng file tạm)
+
+
+def _enabled():
+    return bool(BLOB_STORE_ENABLED and BLOB_STORE_DIR)
+
+
+def _hasher():
+    return hashlib.blake2b(digest_size=32)
+
+
+def blob_path(digest):
+    return os.path.join(BLOB_STORE_DIR, digest[:2], digest)
+
+
+def hash_file(path):
+    h = _hasher()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(CHUNK_SIZE)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def _link_into(blob, dst):
+    """dst -> hardlink tới blob (ghi đè dst nếu đã có, qua link tạm + os.replace)."""
+    tmp = os.path.join(os.path.dirname(dst) or ".", f".lnk_{uuid.uuid4().hex}")
+    os.link(blob, tmp)
+    try:
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _adopt(tmp, digest):
+    """Đưa file tạm vào kho blob (blob đã có thì giữ blob cũ). Trả về đường dẫn blob."""
+    blob = blob_path(digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(tmp, blob)
+    except FileExistsError:
+        pass
+    return blob
+
+
+def save_upload(file_storage, dst_path):
+    """
+    Thay cho file_storage.save(dst_path): lưu theo nội dung + hardlink về dst_path.
+    Trả về hash nội dung (None nếu tắt blob store / không hardlink được -> đã lưu file thường).
+    """
+    if not _enabled():
+        file_storage.save(dst_path)
+        return None
+    os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=BLOB_STORE_DIR)
+    try:
+        h = _hasher()
+        src = file_storage.stream
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                buf = src.read(CHUNK_SIZE)
+                if not buf:
+                    break
+                h.update(buf)
+                f.write(buf)
+        digest = h.hexdigest()
+        try:
+            _link_into(_adopt(tmp, digest), dst_path)
+        except OSError as e:
+            # ổ đĩa không hỗ trợ hardlink / khác ổ với images -> lưu file thường
+            print("Blob store: không hardlink được, lưu file thường:", e)
+            shutil.move(tmp, dst_path)
+            return None
+        return digest
+    finally:
+        if os.path.exists(tmp):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def dedup_file(path, seen=None, dry_run=False):
+    """
+    Đưa 1 ảnh có sẵn vào kho blob. Trả về (trạng thái, số byte thu hồi):
+      'linked'  - trùng nội dung blob có sẵn -> thay bằng hardlink
+      'new'     - nội dung mới -> ảnh thành blob (không copy)
+      'already' - đã là hardlink (st_nlink > 1), bỏ qua
+    seen: set hash đã gặp (dry-run vẫn đếm đúng các bản trùng nhau chưa có blob).
+    """
+    st = os.stat(path)
+    if st.st_nlink > 1:
+        return "already", 0
+    digest = hash_file(path)
+    blob = blob_path(digest)
+    dup = os.path.exists(blob) or (seen is not None and digest in seen)
+    if seen is not None:
+        seen.add(digest)
+    if dup:
+        if not dry_run:
+            _link_into(blob, path)
+        return "linked", st.st_size
+    if not dry_run:
+        _adopt(path, digest)
+    return "new", 0
+
+
+def backfill(roots=None, dry_run=False):
+    """Chống trùng các thư mục ảnh có sẵn (mặc định cả UPLOAD_FOLDER). Trả về dict thống kê."""
+    stats = {"files": 0, "linked": 0, "new": 0, "already": 0, "errors": 0, "bytes_reclaimed": 0}
+    seen = set()
+    for root in roots or [UPLOAD_FOLDER]:
+        for dirpath, dirs, names in os.walk(root):
+            dirs.sort()
+            if not dry_run:
+                # ghi nhận thời điểm upload vào manifest trước khi link (hardlink mang mtime của blob)
+                image_manifest.entries(dirpath)
+            for name in sorted(names):
+                if name.startswith(".") or not name.lower().endswith(IMAGE_EXTS):
+                    continue
+                path = os.path.join(dirpath, name)
+                stats["files"] += 1
+                try:
+                    state, reclaimed = dedup_file(path, seen, dry_run)
+                except OSError as e:
+                    print(f"Blob store: lỗi {path}:", e)
+                    stats["errors"] += 1
+                    continue
+                stats[state] += 1
+                stats["bytes_reclaimed"] += reclaimed
+    return stats
+
+
+def gc(dry_run=False):
+    """Xoá blob không còn ảnh nào link tới + file tạm sót lại (> 1 giờ). Trả về (số file, số byte)."""
+    removed = freed = 0
+    cutoff = time.time() - _TMP_MAX_AGE
+    if not os.path.isdir(BLOB_STORE_DIR):
+        return 0, 0
+    for dirpath, _, names in os.walk(BLOB_STORE_DIR):
+        for name in names:
+            fp = os.path.join(dirpath, name)
+            try:
+                st = os.stat(fp)
+            except OSError:
+                continue
+            if name.startswith(_TMP_PREFIX):
+                stale = st.st_mtime < cutoff
+            else:
+                stale = st.st_nlink <= 1
+            if stale:
+                if not dry_run:
+                    try:
+                        os.remove(fp)
+                    except OSError:
+                        continue
+                removed += 1
+                freed += st.st_size
+    return removed, freed
+
+
+def _mb(n):
+    return f"{n / (1024 * 1024):.1f} MB"
+
+
+if __name__ == "__main__":
+    # python blob_store.py backfill [--dry-run] [thư mục ...]
+    # python blob_store.py gc [--dry-run]
+    args = sys.argv[1:]
+    dry = "--dry-run" in args
+    args = [a for a in args if a != "--dry-run"]
+    cmd = args[0] if args else ""
+    if cmd == "backfill":
+        s = backfill(args[1:] or None, dry_run=dry)
+        print(f"{'[DRY-RUN] ' if dry else ''}{s['files']} ảnh: {s['linked']} trùng -> hardlink, "
+              f"{s['new']} blob mới, {s['already']} đã link, {s['errors']} lỗi")
+        print(f"Thu hồi: {_mb(s['bytes_reclaimed'])} ({s['bytes_reclaimed']} byte)")
+    elif cmd == "gc":
+        n, b = gc(dry_run=dry)
+        print(f"{'[DRY-RUN] ' if dry else ''}Dọn {n} blob không dùng, {_mb(b)}")
+    else:
+        print("Dùng: python blob_store.py backfill [--dry-run] [thư mục ...] | gc [--dry-run]")
+        sys.exit(2)
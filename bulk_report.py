@@ -0,0 +1,173 @@
+import os
+import re
+import sys
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from config import local_main, TEMPLATE_MAP, APPROVE_DOCX_WORKERS, BULK_REPORT_MAX_ITEMS
+from docx_utils import load_report_rows, fill_cover_from_row, get_docx_pool, reset_docx_pool, _template_path
+from zip_stream import ZipStream
+
+# =====================================================
+# Tạo nhiều report 1 lần (cuối tháng) từ 1 lần đọc workbook chính
+# - load_report_rows: pd.read_excel 1 lần -> {report_id: row}; mỗi report chỉ còn fill template
+# - Render song song trong pool process DOCX (get_docx_pool, cùng pool với approve all),
+#   giữ tối đa ~2 x số worker việc đang chạy -> RAM không tăng theo số report
+# - Kết quả ghi vào ZIP dạng stream theo thứ tự xong trước ghi trước; lỗi gom vào _errors.txt cuối ZIP
+# - Spec report: "25-6501:25-6550" (khoảng), "25-6600" (lẻ), "25-6601=transit_2c_np" (riêng loại),
+#   cách nhau bằng dấu phẩy / khoảng trắng / xuống dòng
+# =====================================================
+
+def _expand_range(a, b):
+    ma, mb = re.match(r"^(.*?)(\d+)$", a), re.match(r"^(.*?)(\d+)$", b)
+    if not ma or not mb or ma.group(1) != mb.group(1):
+        raise ValueError(f"Khoảng report không hợp lệ: {a}:{b}")
+    prefix, width = ma.group(1), len(ma.group(2))
+    lo, hi = int(ma.group(2)), int(mb.group(2))
+    if hi < lo:
+        lo, hi = hi, lo
+    if hi - lo + 1 > BULK_REPORT_MAX_ITEMS:
+        raise ValueError(f"Khoảng {a}:{b} vượt quá {BULK_REPORT_MAX_ITEMS} report")
+    return [f"{prefix}{n:0{width}d}" for n in range(lo, hi + 1)]
+
+
+def expand_report_spec(spec, default_type=None):
+    """'25-6501:25-6510, 25-6600=bed' -> [(report_id, template_key)] (bỏ trùng, giữ thứ tự)."""
+    items, seen = [], set()
+    parts = spec if isinstance(spec, (list, tuple)) else [spec]
+    tokens = [t for p in parts for t in re.split(r"[\s,;]+", str(p or "")) if t]
+    for tok in tokens:
+        part, _, rtype = tok.partition("=")
+        rtype = (rtype or default_type or "").strip().lower()
+        if rtype not in TEMPLATE_MAP:
+            raise ValueError(f"Loại report không hợp lệ cho '{tok}': {rtype or '(trống)'}")
+        ids = _expand_range(*[x.strip() for x in part.split(":", 1)]) if ":" in part else [part.strip()]
+        for rid in ids:
+            if (rid, rtype) not in seen:
+                seen.add((rid, rtype))
+                items.append((rid, rtype))
+    if len(items) > BULK_REPORT_MAX_ITEMS:
+        raise ValueError(f"Tối đa {BULK_REPORT_MAX_ITEMS} report mỗi lần (đang có {len(items)})")
+    return items
+
+
+def _render_one(template_path, row, excel_cols, report_id, template_key, generated_by):
+    """Chạy trong worker process -> bytes DOCX."""
+    return fill_cover_from_row(template_path, row, excel_cols, report_id, template_key, generated_by).getvalue()
+
+
+def render_bulk(items, rows, excel_cols, generated_by=None, pool=None):
+    """
+    items: [(report_id, template_key)]; rows/excel_cols: từ load_report_rows.
+    Yield (report_id, template_key, docx_bytes | None, error | None) theo thứ tự xong trước.
+    Pool hỏng (worker chết) -> các report còn lại render tuần tự trong process này (như approve all).
+    """
+    pool = pool or get_docx_pool()
+    window = max(2, 2 * APPROVE_DOCX_WORKERS)
+    pending = {}
+    todo = iter(items)
+
+    def _inline(rid, key, row):
+        try:
+            return rid, key, _render_one(_template_path(key), row, excel_cols, rid, key, generated_by), None
+        except Exception as e:
+            return rid, key, None, str(e)
+
+    def _broken(e):
+        nonlocal pool
+        if pool is not None:
+            print("DOCX pool hỏng, render tuần tự:", e)
+            pool = None
+            reset_docx_pool()
+
+    def _fill():
+        for rid, key in todo:
+            row = rows.get(str(rid).strip())
+            if row is None:
+                return rid, key, None, "Report # not found"
+            if pool is None:
+                return _inline(rid, key, row)
+            try:
+                fut = pool.submit(_render_one, _template_path(key), row, excel_cols, rid, key, generated_by)
+            except BrokenProcessPool as e:
+                _broken(e)
+                return _inline(rid, key, row)
+            except Exception as e:
+                return rid, key, None, str(e)
+            pending[fut] = (rid, key, row)
+            if len(pending) >= window:
+                break
+        return None
+
+    while True:
+        res = _fill()
+        if res:
+            yield res
+            continue
+        if not pending:
+            return
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for fut in done:
+            rid, key, row = pending.pop(fut)
+            try:
+                yield rid, key, fut.result(), None
+            except BrokenProcessPool as e:
+                _broken(e)
+                yield _inline(rid, key, row)
+            except Exception as e:
+                yield rid, key, None, str(e)
+
+
+def _safe_name(s):
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", str(s)).strip("_") or "report"
+
+
+def iter_bulk_zip(results, on_result=None):
+    """Ghi kết quả render_bulk thành ZIP dạng stream; yield từng khúc bytes."""
+    zs = ZipStream()
+    errors, ok = [], 0
+    for rid, key, data, err in results:
+        if on_result:
+            on_result(rid, key, err)
+        if err:
+            errors.append(f"{rid}\t{key}\t{err}")
+            continue
+        ok += 1
+        yield zs.add(f"{_safe_name(rid)}_{key}.docx", data)
+    if errors:
+        yield zs.add("_errors.txt", "\r\n".join(errors) + "\r\n")
+    yield zs.finish()
+    print(f"Bulk report: {ok} OK, {len(errors)} lỗi")
+
+
+def bulk_zip_to_file(out_path, items, excel_path_or_name=None, generated_by=None, on_result=None):
+    rows, cols = load_report_rows(excel_path_or_name or local_main)
+    tmp = out_path + ".part"
+    with open(tmp, "wb") as f:
+        for chunk in iter_bulk_zip(render_bulk(items, rows, cols, generated_by), on_result):
+            f.write(chunk)
+    os.replace(tmp, out_path)
+
+
+if __name__ == "__main__":
+    # python bulk_report.py out.zip bed 25-6501:25-6550 25-6600=transit_2c_np [--excel path.xlsx]
+    args = sys.argv[1:]
+    excel = None
+    if "--excel" in args:
+        i = args.index("--excel")
+        excel = args[i + 1] if i + 1 < len(args) else None
+        del args[i:i + 2]
+    if len(args) < 3:
+        print("Dùng: python bulk_report.py <out.zip> <loại mặc định> <spec report> [...] [--excel file.xlsx]")
+        sys.exit(2)
+    out, default_type, specs = args[0], args[1], args[2:]
+    jobs = expand_report_spec(specs, default_type)
+    t0 = time.monotonic()
+    n = [0]
+
+    def _log(rid, key, err):
+        n[0] += 1
+        print(f"[{n[0]}/{len(jobs)}]", "LỖI" if err else "OK ", rid, key, err or "")
+
+    bulk_zip_to_file(out, jobs, excel, on_result=_log)
+    print(f"{out}: {len(jobs)} report, {time.monotonic() - t0:.1f}s")
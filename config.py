@@ -60,3 +60,67 @@ TEMPLATE_MAP = {
     'transit_181_gt68': 'TRANSIT-181-GT68.docx',
     'transit_3b_pallet': 'TRANSIT-3B-PL.docx',
 }
+
+# >>> ADD: SQLite mirror cho file Excel chính (Excel chỉ là bản export)
+REPORT_DB = "report_store.db"
+USE_REPORT_DB = os.getenv("USE_REPORT_DB", "1") == "1"
+REPORT_DB_EXPORT_INTERVAL = 3  # giây: exporter gom thay đổi rồi ghi Excel 1 lần
+APPROVE_BATCH_FLUSH_EVERY = 10  # approve all: ghi Excel/TRF 1 lần mỗi N request (0 = chỉ cuối đợt)
+
+# >>> ADD: lịch tải ETD (ngày x nhóm -> số request đã approve), cập nhật dần khi approve
+ETD_CALENDAR_FILE = "etd_calendar.json"
+
+# >>> ADD: archive TFR dạng segment JSONL theo tháng (append-only)
+ARCHIVE_DIR = "tfr_archive"
+ARCHIVE_KEEP_DAYS = 14
+
+# >>> ADD: journal JSONL cho file backup (…_backup.jsonl, append-only)
+JOURNAL_MAX_BYTES = 8 * 1024 * 1024   # segment đang ghi vượt ngưỡng -> xoay sang segment mới
+JOURNAL_FSYNC_EVERY = 20              # fsync sau mỗi N record ...
+JOURNAL_FSYNC_INTERVAL = 2.0          # ... hoặc chậm nhất sau N giây
+JOURNAL_GZIP = True                   # nén gzip segment đã đóng
+
+# >>> ADD: approve all dạng pipeline (cấp số -> DOCX song song -> PDF song song -> 1 luồng ghi Excel)
+APPROVE_DOCX_WORKERS = int(os.getenv("APPROVE_DOCX_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+APPROVE_PDF_WORKERS = int(os.getenv("APPROVE_PDF_WORKERS", "2"))   # Word/LibreOffice tốn RAM -> giới hạn
+
+# >>> ADD: dịch vụ convert DOCX -> PDF (pdf_convert.py)
+PDF_CONVERTER = os.getenv("PDF_CONVERTER", "auto")          # auto | word | libreoffice | none
+SOFFICE_PATH = os.getenv("SOFFICE_PATH", "")                # để trống = tự tìm soffice
+PDF_CONVERT_WORKERS = int(os.getenv("PDF_CONVERT_WORKERS", "2"))   # số soffice chạy song song (Word luôn 1)
+PDF_CONVERT_TIMEOUT = float(os.getenv("PDF_CONVERT_TIMEOUT", "120"))  # giây / job
+PDF_CONVERT_BATCH_MAX = 8                                   # số file tối đa 1 lần gọi soffice
+
+# >>> ADD: job nền (job_queue.py) — approve all chạy nền, lưu tiến độ để resume
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))   # số job chạy đồng thời (approve all ghi Excel -> nên để 1)
+
+# >>> ADD: cache ảnh đã xoay EXIF + thu nhỏ để dán vào report (image_cache.py)
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join("cache", "images"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))  # 0 = tắt cache
+IMAGE_CACHE_DPI = int(os.getenv("IMAGE_CACHE_DPI", "96"))        # Word dùng ~96dpi
+IMAGE_CACHE_FORMAT = os.getenv("IMAGE_CACHE_FORMAT", "JPEG")     # JPEG | PNG (ảnh có nền trong suốt luôn PNG)
+IMAGE_CACHE_QUALITY = int(os.getenv("IMAGE_CACHE_QUALITY", "85"))
+IMAGE_CACHE_WORKERS = int(os.getenv("IMAGE_CACHE_WORKERS", "4"))  # số thread decode/resize song song
+
+# >>> ADD: manifest ảnh theo thư mục report (image_manifest.py)
+IMAGE_MANIFEST_DIR = os.getenv("IMAGE_MANIFEST_DIR", os.path.join("cache", "manifests"))
+IMAGE_MANIFEST_CACHE_SIZE = 256   # số thư mục giữ manifest trong RAM (LRU)
+
+# >>> ADD: tạo nhiều report 1 lần (bulk_report.py, /api/report/bulk)
+BULK_REPORT_MAX_ITEMS = int(os.getenv("BULK_REPORT_MAX_ITEMS", "1000"))   # số report tối đa / lần
+
+# >>> ADD: ảnh phái sinh cho gallery (image_derivs.py) — thumbnail + bản web, tạo nền sau upload
+IMAGE_DERIV_DIR = os.getenv("IMAGE_DERIV_DIR", "images_derived")   # thư mục anh em với UPLOAD_FOLDER
+IMAGE_DERIV_SIZES = {"thumb": 320, "web": 1600}                   # cạnh dài (px)
+IMAGE_DERIV_FORMAT = os.getenv("IMAGE_DERIV_FORMAT", "WEBP")      # WEBP | JPEG (Pillow không có WebP -> JPEG)
+IMAGE_DERIV_QUALITY = int(os.getenv("IMAGE_DERIV_QUALITY", "80"))
+IMAGE_DERIV_WORKERS = int(os.getenv("IMAGE_DERIV_WORKERS", "2"))
+
+# >>> ADD: tải ZIP ảnh report dạng stream (image_zip.py, /download_images)
+IMAGE_ZIP_MAX_REPORTS = int(os.getenv("IMAGE_ZIP_MAX_REPORTS", "200"))          # số report tối đa / lần tải
+IMAGE_ZIP_CACHE_DIR = os.getenv("IMAGE_ZIP_CACHE_DIR", os.path.join("cache", "zips"))
+IMAGE_ZIP_CACHE_MAX_BYTES = int(os.getenv("IMAGE_ZIP_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))  # 0 = không lưu ZIP dựng sẵn
+
+# >>> ADD: lưu ảnh upload theo nội dung, chống trùng bằng hardlink (blob_store.py)
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "images_blobs")      # phải cùng ổ đĩa với UPLOAD_FOLDER
+BLOB_STORE_ENABLED = os.getenv("BLOB_STORE_ENABLED", "1") == "1"
@@ -62,29 +62,34 @@ def log_report_complete(report_number, type_of, ca, employee_id=""):
         ws.append(["Ngày", "Ca", "Type of", "Report#", "ID"])
         wb.save(excel_path)
 
-    wb = load_workbook(excel_path)
-    ws = wb.active
-
-    # Tìm dòng đã có report_number VÀ cùng ngày, cùng ca
+    # Tìm dòng đã có report_number VÀ cùng ngày, cùng ca (đọc read_only, không load cả workbook)
+    from excel_utils import iter_sheet_fast
     found_row = None
-    for row in range(2, ws.max_row + 1):
-        day = ws.cell(row=row, column=1).value
-        ca_val = ws.cell(row=row, column=2).value
-        report_val = ws.cell(row=row, column=4).value
-        if (str(day) == date_str) and (str(ca_val) == ca) and (str(report_val).strip().upper() == str(report_number).strip().upper()):
+    last_row = 1
+    for row, values in iter_sheet_fast(excel_path):
+        if row == 1:
+            continue
+        values = tuple(values) + (None,) * (5 - len(values))
+        if any(v is not None for v in values):
+            last_row = row
+        day, ca_val, report_val = values[0], values[1], values[3]
+        if found_row is None and (str(day) == date_str) and (str(ca_val) == ca) and (str(report_val).strip().upper() == str(report_number).strip().upper()):
             found_row = row
-            break
 
-    # Nếu đã tồn tại report# (cùng ngày và ca) thì update lại dòng đó
-    if found_row:
-        ws.cell(row=found_row, column=1).value = date_str
-        ws.cell(row=found_row, column=2).value = ca
-        ws.cell(row=found_row, column=3).value = type_of
-        ws.cell(row=found_row, column=4).value = report_number
-        ws.cell(row=found_row, column=5).value = employee_id
-    else:
-        ws.append([date_str, ca, type_of, report_number, employee_id])
+    # Có rồi (cùng ngày và ca) thì update lại dòng đó, chưa có thì thêm dòng mới
+    target_row = found_row or (last_row + 1)
+    new_values = [date_str, ca, type_of, report_number, employee_id]
+    try:
+        from xlsx_patch import patch_xlsx_rows
+        patch_xlsx_rows(excel_path, {target_row: {c: (v, None) for c, v in enumerate(new_values, start=1)}})
+        return
+    except Exception as e:
+        print("XML patch counter log lỗi, ghi bằng openpyxl:", e)
 
+    wb = load_workbook(excel_path)
+    ws = wb.active
+    for c, v in enumerate(new_values, start=1):
+        ws.cell(row=target_row, column=c).value = v
     wb.save(excel_path)
 
 def check_and_reset_counter():
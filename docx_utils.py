@@ -5,23 +5,26 @@
 
 import os
 import re
-import time
 import uuid
-import tempfile
+import copy
 import unicodedata
+import threading
+import multiprocessing
 from io import BytesIO
-import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from PIL import Image, ExifTags
-from openpyxl import load_workbook
 from docx import Document
 from docx.shared import Inches, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.table import WD_ALIGN_VERTICAL
+from docx.table import _Cell
 from datetime import datetime
-from config import local_main, TEMPLATE_MAP
+from config import local_main, TEMPLATE_MAP, APPROVE_DOCX_WORKERS, APPROVE_PDF_WORKERS
 from test_logic import TEST_GROUP_TITLES
-from excel_utils import _find_report_col
+from lock_utils import report_file_lock
+from pdf_convert import convert_to_pdf
+import image_cache
+import image_manifest
 
 # Optional pandas dependency for cover fill from Excel
 try:
@@ -32,7 +35,6 @@ except Exception:
 WORD_TEMPLATE = "FORM-QAD-011-TEST REQUEST FORM (TRF).docx"
 PDF_OUTPUT_FOLDER = os.path.join("static", "TFR")
 BLANK_TOKENS = {"", "-", "—", "–"}
-_IMG_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
 
 __all__ = [
     "get_first_empty_report_all_blank",
@@ -40,6 +42,8 @@ __all__ = [
     "approve_request_fill_docx_pdf",
     "fill_bed_cover_from_excel",
     "fill_cover_from_excel_generic",
+    "fill_cover_from_row",
+    "load_report_rows",
     "create_report_for_type",
 ]
 
@@ -47,41 +51,18 @@ __all__ = [
 
 def _load_oriented_and_resized_image(path, width_in, height_in):
     """
-    Load ảnh, fix EXIF orientation, resize đúng kích thước (inch), 
-    trả về buffer BytesIO để add_picture()
+    Ảnh đã fix EXIF orientation + resize đúng kích thước (inch), lấy từ image_cache
+    (chỉ render lần đầu / khi ảnh gốc đổi). Trả về BytesIO để add_picture(), lỗi -> None.
     """
-    try:
-        img = Image.open(path)
-
-        # ---- FIX EXIF ORIENTATION ----
-        try:
-            exif = img._getexif()
-            if exif:
-                for tag, value in exif.items():
-                    if ExifTags.TAGS.get(tag) == "Orientation":
-                        if value == 3:
-                            img = img.rotate(180, expand=True)
-                        elif value == 6:
-                            img = img.rotate(270, expand=True)
-                        elif value == 8:
-                            img = img.rotate(90, expand=True)
-                        break
-        except Exception:
-            pass
+    return image_cache.load_resized(path, width_in, height_in)
 
-        # ---- RESIZE EXACT SIZE ----
-        DPI = 96   # Word dùng ~96dpi
-        new_w = int(width_in * DPI)
-        new_h = int(height_in * DPI)
-        img = img.resize((new_w, new_h))
-
-        # ---- SAVE TO BUFFER ----
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
-        return buf
-    except Exception:
-        return None
+def _add_picture(run, path, width_in, height_in):
+    """Dán ảnh (bản resize trong cache, lỗi thì ảnh gốc) với kích thước width_in x height_in inch."""
+    buf = _load_oriented_and_resized_image(path, width_in, height_in)
+    pic = run.add_picture(buf if buf else path)
+    pic.width = Inches(width_in)
+    pic.height = Inches(height_in)
+    return pic
 
 def _normalize_to_check_blank(v):
     if v is None:
@@ -115,9 +96,9 @@ def remove_diacritics(s: str) -> str:
 
     return no_marks
 
-def _fill_generated_by_fields(doc: Document, generated_by: str | None) -> bool:
+def _fill_generated_by_fields(doc: Document, tpl, generated_by: str | None) -> bool:
     """
-    Điền tên người xuất report vào:
+    Điền tên người xuất report vào (toạ độ ô tính sẵn trong tpl: CompiledTemplate):
       1) Cover table: label 'Generated by:' → ô kế bên
       2) Signature block: hàng header 'Tested by | Generated by | Reviewed by' → hàng tên ở dưới (cột 'Generated by')
     - Bỏ dấu nếu tên có dấu
@@ -134,33 +115,26 @@ def _fill_generated_by_fields(doc: Document, generated_by: str | None) -> bool:
         return False
 
     changed = False
+    tables = doc.tables
 
     # 1) Cover table: "Generated by:" (label bên trái)
-    for t in doc.tables:
-        for r in t.rows:
-            cells = r.cells
-            for j in range(len(cells) - 1):
-                left = (cells[j].text or "").strip()
-                if left == "Generated by:":
-                    right = cells[j + 1]
-                    cur = (right.text or "").strip()
-                    if _is_placeholder_dash(cur) or cur == "":
-                        _set_cell_text_with_style(right, cells[j], name)
-                        changed = True
-
-    # 2) Signature block: tìm hàng header có 'Tested by', 'Generated by', 'Reviewed by'
-    for t in doc.tables:
-        for i, r in enumerate(t.rows):
-            heads_norm = [_norm(c.text) for c in r.cells]
-            if "generated by" in heads_norm:
-                gen_idx = heads_norm.index("generated by")
-                if i + 1 < len(t.rows):
-                    cell_below = t.rows[i + 1].cells[gen_idx]
-                    cur = (cell_below.text or "").strip()
-                    if _is_placeholder_dash(cur) or cur == "":
-                        # Giữ style theo cell header tương ứng
-                        _set_cell_text_with_style(cell_below, r.cells[gen_idx], name, align_center=True)
-                        changed = True
+    for ti, i, j in tpl.generated_by:
+        cells = tables[ti].rows[i].cells
+        right = cells[j + 1]
+        cur = (right.text or "").strip()
+        if _is_placeholder_dash(cur) or cur == "":
+            _set_cell_text_with_style(right, cells[j], name)
+            changed = True
+
+    # 2) Signature block: hàng header có 'Tested by', 'Generated by', 'Reviewed by'
+    for ti, i, gen_idx in tpl.signature_gen:
+        rows = tables[ti].rows
+        cell_below = rows[i + 1].cells[gen_idx]
+        cur = (cell_below.text or "").strip()
+        if _is_placeholder_dash(cur) or cur == "":
+            # Giữ style theo cell header tương ứng
+            _set_cell_text_with_style(cell_below, rows[i].cells[gen_idx], name, align_center=True)
+            changed = True
     return changed
 
 def _is_placeholder_dash(txt: str) -> bool:
@@ -247,23 +221,33 @@ def _set_cell_text_with_style(dst_cell, src_label_cell, text, align_center=False
 # ============================ Excel (TRF) ============================
 
 def get_first_empty_report_all_blank(excel_path):
-    wb = load_workbook(excel_path, data_only=True)
-    ws = wb.active
-    report_col = _find_report_col(ws)
-
-    for row in range(2, ws.max_row + 1):
+    # Đọc qua SQLite mirror / ReportIndex (thấy cả thay đổi chưa export ra Excel),
+    # bỏ qua các report đang nằm trong 1 đợt approve chưa flush.
+    from report_db import get_report_view, enabled_for
+    from excel_utils import is_report_in_open_batch
+    if enabled_for(excel_path):
+        # Lấy số free nhỏ nhất từ bảng report_slots (không quét toàn bộ dòng)
+        try:
+            from report_alloc import peek_free_report_no
+            return peek_free_report_no()
+        except Exception as e:
+            print("report_alloc lỗi, quét dòng trống:", e)
+    view = get_report_view(excel_path)
+    report_col = view.report_col
+
+    for _, values in view.iter_rows():
         all_mid_empty = True
-        for col in range(3, 25):  # C..X
-            is_blank, _ = _normalize_to_check_blank(ws.cell(row=row, column=col).value)
+        for v in values[2:24]:  # C..X
+            is_blank, _ = _normalize_to_check_blank(v)
             if not is_blank:
                 all_mid_empty = False
                 break
         if all_mid_empty:
-            report_no = ws.cell(row=row, column=report_col).value
+            report_no = values[report_col - 1] if len(values) >= report_col else None
             if report_no is not None and str(report_no).strip():
-                wb.close()
+                if is_report_in_open_batch(report_no):
+                    continue
                 return str(report_no).strip()
-    wb.close()
     return None
 
 # ============================ Unicode checkboxes ============================
@@ -317,195 +301,380 @@ def build_label_value_map(data):
 
     return label_value_map
 
-def tick_unicode_checkbox_by_label(doc: Document, label_value_map):
-    """
-    Tick checkbox (☐/☑) theo nhãn nhưng:
-    - KHÔNG đổi font
-    - KHÔNG đổi run
-    - KHÔNG tick sai vào Accepted / Not accepted
-    - CHỈ tick nếu nhãn nằm cạnh checkbox và khớp nguyên chữ
-    """
+# ============================ PDF convert (pdf_convert: Word / LibreOffice) ============================
 
-    def safe_match(full_text, label):
-        # bắt buộc match nguyên từ
-        return re.search(rf"\b{re.escape(label)}\b", full_text, flags=re.IGNORECASE)
+def try_convert_to_pdf(docx_path, pdf_path):
+    """Convert qua dịch vụ pdf_convert (Word hoặc LibreOffice); lỗi chỉ log, trả về True nếu có PDF."""
+    try:
+        return convert_to_pdf(docx_path, pdf_path)
+    except Exception as e:
+        print("PDF convert failed:", e)
+        return False
 
-    def toggle_paragraph(p):
-        if not p.runs:
-            return
+# ============================ Atomic save ============================
 
-        full = "".join(r.text for r in p.runs)
-        if "☐" not in full and "☑" not in full:
-            return
+def _atomic_save_docx(doc: Document, out_path: str):
+    tmp = f"{out_path}.tmp-{uuid.uuid4().hex}"
+    doc.save(tmp)
+    os.replace(tmp, out_path)
 
-        # Bỏ qua khối Construction test
-        if "accepted" in full.lower() or "not accepted" in full.lower():
-            return
+# ============================ Template đã compile (cache) ============================
+# Mỗi template (.docx TRF + các file trong TEMPLATE_MAP) chỉ parse 1 lần / process:
+#   - giữ Document gốc, mỗi lần fill deepcopy ra bản mới (không đọc lại zip/XML từ đĩa)
+#   - tính sẵn: nhãn (đã chuẩn hoá) -> toạ độ ô (ti, i, j), vị trí checkbox (paragraph, run, offset)
+#     -> lúc fill chỉ đụng đúng các ô đích, không quét lại cả bảng + tính lại cell.text.lower() nhiều lần.
+# Template đổi trên đĩa (mtime/size) -> tự compile lại.
+
+# nhãn TRF -> field trong data
+_TRF_FIELD_MAP = {
+    "requestor": "requestor",
+    "department": "department",
+    "requested date": "request_date",
+    "lab test report no.": "report_no",
+    "sample description": "sample_description",
+    "item code": "item_code",
+    "quantity": "quantity",
+    "supplier": "supplier",
+    "subcon": "subcon",
+    "test group": "test_group",
+    "test status": "test_status",
+    "furniture testing": "furniture_testing",
+    "estimated completed date": "estimated_completion_date",
+}
+
+_HEADER_KEYS = ("REPORT NO.", "RECEIVED DATE", "REPORT DATE")
+
+_TPL_CACHE = {}
+_TPL_LOCK = threading.Lock()
+
+
+def _trf_label(text: str) -> str:
+    return (
+        (text or "").strip().lower()
+        .replace("(mã item)", "")
+        .replace("(mã material)", "")
+        .replace("*", "")
+    )
 
-        # mapping checkbox
-        spans = []
-        pos = 0
-        for r in p.runs:
-            t = r.text or ""
-            spans.append((r, pos, pos + len(t)))
-            pos += len(t)
-
-        # duyệt từng nhãn
-        for label, value in label_value_map.items():
-            if not safe_match(full, label):
-                continue
 
-            m = safe_match(full, label)
-            if not m:
-                continue
+def _iter_cells(tables):
+    """(ti, i, j, cell, nrows, ncols) theo đúng thứ tự duyệt table -> row -> row.cells."""
+    for ti, table in enumerate(tables):
+        nrows = len(table.rows)
+        ncols = len(table.columns)
+        for i, row in enumerate(table.rows):
+            for j, cell in enumerate(row.cells):
+                yield ti, i, j, cell, nrows, ncols
 
-            label_pos = m.start()
 
-            # tìm checkbox gần nhất trước nhãn
-            chk = full.rfind("☐", 0, label_pos)
-            if chk == -1:
-                chk = full.rfind("☑", 0, label_pos)
-            if chk == -1:
-                continue
+def _run_pos(runs, pos):
+    """Vị trí ký tự pos (trong text ghép các run) -> (run_idx, offset)."""
+    start = 0
+    for k, r in enumerate(runs):
+        t = r.text or ""
+        if start <= pos < start + len(t):
+            return k, pos - start
+        start += len(t)
+    return None
 
-            desired = "☑" if value else "☐"
 
-            for run, start, end in spans:
-                if start <= chk < end:
-                    idx = chk - start
-                    rt = run.text
-                    run.text = rt[:idx] + desired + rt[idx + 1:]
-                    return
+class CompiledTemplate:
+    """Template .docx đã parse + các map đích tính sẵn (dùng chung, KHÔNG sửa trực tiếp self.doc)."""
+
+    def __init__(self, path: str, stamp):
+        self.path = path
+        self.stamp = stamp
+        # bản gốc để deepcopy: KHÔNG truy cập .tables/.paragraphs/.sections trên bản này
+        # (python-docx cache wrapper trỏ vào phần tử con -> deepcopy sẽ tách rời khỏi cây XML)
+        self._pristine = Document(path)
+        self._lock = threading.Lock()  # lxml: không deepcopy cùng 1 cây từ nhiều thread
+        self.doc = Document(path)     # bản để compile (tính toạ độ)
+        tables = self.doc.tables
+        self.labels = {}            # nhãn chuẩn hoá (_norm) -> [(ti, i, j)]
+        for ti, i, j, cell, _, _ in _iter_cells(tables):
+            key = _norm(cell.text)
+            if key:
+                self.labels.setdefault(key, []).append((ti, i, j))
+        self._compile_trf(tables)
+        self._compile_cover(tables)
+        self._compile_header()
+
+    def new_document(self) -> Document:
+        with self._lock:
+            return copy.deepcopy(self._pristine)
+
+    # ---------- TRF ----------
+    def _compile_trf(self, tables):
+        # ô có nhãn TRF: (ti, i, j, nrows, ncols, label, is_remark, is_emp, [(map_label, key)])
+        self.trf_fields = []
+        self.requested_by = []      # [(ti, i, j)] ô 'Requested by' (ghi tên vào ô ngay dưới)
+        seen_rows = set()
+        for ti, i, j, cell, nrows, ncols in _iter_cells(tables):
+            text = cell.text or ""
+            label = _trf_label(text)
+            is_remark = "other tests/instructions" in label or "remark" in label
+            is_emp = "emp id" in label or "msnv" in label
+            keys = [(m, k) for m, k in _TRF_FIELD_MAP.items() if m in label]
+            if is_remark or is_emp or keys:
+                self.trf_fields.append((ti, i, j, nrows, ncols, label, is_remark, is_emp, keys))
+            if text.strip().lower() == "requested by" and (ti, i) not in seen_rows:
+                seen_rows.add((ti, i))
+                self.requested_by.append((ti, i, j))
+
+        # checkbox: mỗi paragraph có ☐/☑ -> (loc, label, run_idx, offset) của nhãn đầu tiên khớp
+        labels = list(build_label_value_map({}).keys())
+        self.checkboxes = []
+        for loc, p in self._iter_paragraphs(tables):
+            full = "".join(r.text for r in p.runs)
+            if "☐" not in full and "☑" not in full:
+                continue
+            if "accepted" in full.lower():
+                continue   # khối Accepted / Not accepted: giữ nguyên template
+            for label in labels:
+                m = re.search(rf"\b{re.escape(label)}\b", full, flags=re.IGNORECASE)
+                if not m:
+                    continue
+                chk = full.rfind("☐", 0, m.start())
+                if chk == -1:
+                    chk = full.rfind("☑", 0, m.start())
+                if chk == -1:
+                    continue
+                rp = _run_pos(p.runs, chk)
+                if rp:
+                    self.checkboxes.append((loc, label) + rp)
+                break
 
-    # áp dụng
-    for p in doc.paragraphs:
-        toggle_paragraph(p)
+        # Sample return: (loc, pos YES, pos NO) trong các ô có 'sample return'
+        self.sample_return = []
+        done = set()
+        for ti, i, j, cell, _, _ in _iter_cells(tables):
+            if cell._tc in done or "sample return" not in cell.text.lower():
+                continue
+            done.add(cell._tc)
+            for pi, p in enumerate(cell.paragraphs):
+                full = "".join(r.text for r in p.runs)
+                m_yes = re.search(r"(☐|☑)\s*yes", full, flags=re.IGNORECASE)
+                m_no = re.search(r"(☐|☑)\s*no(?!t accepted)", full, flags=re.IGNORECASE)
+                yes = _run_pos(p.runs, m_yes.start(1)) if m_yes else None
+                no = _run_pos(p.runs, m_no.start(1)) if m_no else None
+                if yes or no:
+                    self.sample_return.append((("cell", ti, i, j, pi), yes, no))
+
+    def _iter_paragraphs(self, tables):
+        """(loc, paragraph): paragraph thân bài rồi tới paragraph trong ô (mỗi ô 1 lần)."""
+        for pi, p in enumerate(self.doc.paragraphs):
+            yield ("body", pi), p
+        done = set()
+        for ti, i, j, cell, _, _ in _iter_cells(tables):
+            if cell._tc in done:
+                continue
+            done.add(cell._tc)
+            for pi, p in enumerate(cell.paragraphs):
+                yield ("cell", ti, i, j, pi), p
+
+    # ---------- cover (template report trong TEMPLATE_MAP) ----------
+    def _compile_cover(self, tables):
+        self.result_cells = []      # [(ti, i, j)] ô 'RESULT:' (ghi vào ô j+1)
+        self.generated_by = []      # [(ti, i, j)] ô 'Generated by:' (ghi vào ô j+1)
+        self.signature_gen = []     # [(ti, i, j)] header 'Generated by' của khối chữ ký (ghi vào ô hàng dưới)
+        for ti, table in enumerate(tables):
+            nrows = len(table.rows)
+            for i, row in enumerate(table.rows):
+                cells = row.cells
+                for j in range(len(cells) - 1):
+                    left = (cells[j].text or "").strip()
+                    if re.match(r"(?i)^RESULT\s*:\s*$", left):
+                        self.result_cells.append((ti, i, j))
+                    if left == "Generated by:":
+                        self.generated_by.append((ti, i, j))
+                heads = [_norm(c.text) for c in cells]
+                if "generated by" in heads and i + 1 < nrows:
+                    self.signature_gen.append((ti, i, heads.index("generated by")))
+
+        # bảng cover/RESULT: [(i, col nhãn, col giá trị, nhãn gốc, nhãn _norm)]
+        tbl = _find_result_table(self.doc)
+        self.cover_ti = None
+        self.cover_rows = []
+        if tbl is None:
+            return
+        self.cover_ti = next((ti for ti, t in enumerate(tables) if t._tbl is tbl._tbl), None)
+        for i, row in enumerate(tbl.rows):
+            cells = row.cells
+            for lc, vc in ((0, 1), (2, 3)):
+                if len(cells) < vc + 1:
+                    continue
+                raw = (cells[lc].text or "").strip()
+                if raw.endswith(":"):
+                    self.cover_rows.append((i, lc, vc, raw, _norm(re.sub(r"[:\uFF1A]+$", "", raw))))
+
+    # ---------- header: Report No. / Received Date / Report Date ----------
+    def _compile_header(self):
+        # [(section idx, thuộc tính header, đường dẫn bảng, i, ci, key)]
+        self.header_fields = []
+        for si, sec in enumerate(self.doc.sections):
+            for attr in ("header", "first_page_header", "even_page_header"):
+                hdr = getattr(sec, attr)
+                if hdr is None or hdr.is_linked_to_previous:
+                    continue   # không có header riêng (truy cập .tables sẽ tạo header rỗng)
+                for ti, tbl in enumerate(hdr.tables):
+                    if len(tbl.rows) < 2 or len(tbl.columns) < 2:
+                        continue
+                    self._compile_header_table(si, attr, (ti,), tbl)
+
+    def _compile_header_table(self, si, attr, path, tbl):
+        nested = set()
+        for i, row in enumerate(tbl.rows):
+            cells = row.cells
+            for ci, cell in enumerate(cells):
+                text = _normalize(cell.text)
+                for key in _HEADER_KEYS:
+                    if key in text and ci + 1 < len(cells):
+                        self.header_fields.append((si, attr, path, i, ci, key))
+                if cell._tc in nested:
+                    continue   # ô gộp lặp lại trong row.cells
+                nested.add(cell._tc)
+                for k, inner in enumerate(cell.tables):
+                    self._compile_header_table(si, attr, path + ((i, ci, k),), inner)
+
+
+def _template_stamp(path: str):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def get_compiled_template(path: str) -> CompiledTemplate:
+    """Template đã compile (cache theo đường dẫn tuyệt đối, compile lại khi file đổi)."""
+    key = os.path.abspath(path)
+    stamp = _template_stamp(key)
+    tpl = _TPL_CACHE.get(key)
+    if tpl is not None and tpl.stamp == stamp:
+        return tpl
+    with _TPL_LOCK:
+        tpl = _TPL_CACHE.get(key)
+        if tpl is None or tpl.stamp != stamp:
+            tpl = CompiledTemplate(key, stamp)
+            _TPL_CACHE[key] = tpl
+        return tpl
+
+
+def _template_path(template_key: str) -> str:
+    template_name = TEMPLATE_MAP.get(template_key)
+    if not template_name:
+        raise KeyError(f"Template not found for key: {template_key}")
+    return os.path.join(os.path.dirname(__file__), template_name)
 
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for p in cell.paragraphs:
-                    toggle_paragraph(p)
 
-# ============================ PDF convert (optional, Windows) ============================
+def warm_template_cache():
+    """Compile sẵn TRF + mọi template trong TEMPLATE_MAP (lúc khởi động / khởi tạo worker); thiếu file thì bỏ qua."""
+    paths = [WORD_TEMPLATE] + [_template_path(k) for k in TEMPLATE_MAP]
+    n = 0
+    for p in paths:
+        if not os.path.exists(p):
+            continue
+        try:
+            get_compiled_template(p)
+            n += 1
+        except Exception as e:
+            print(f"Compile template lỗi ({p}):", e)
+    return n
 
-def try_convert_to_pdf(docx_path, pdf_path):
-    try:
-        import pythoncom
-        pythoncom.CoInitialize()
-        from docx2pdf import convert
-        convert(docx_path, pdf_path)
-    except Exception as e:
-        import traceback
-        print("PDF convert failed:", e)
-        traceback.print_exc()
 
-# ============================ Atomic save ============================
+def _cell_at(tables, ti, i, j):
+    return tables[ti].rows[i].cells[j]
 
-def _lock_path_for(report_no: str) -> str:
-    return os.path.join(tempfile.gettempdir(), f"tfr_{report_no}.lock")
 
-def _acquire_lock(path: str, timeout=30):
-    t0 = time.time()
-    fd = None
-    while True:
-        try:
-            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
-            return fd
-        except FileExistsError:
-            if time.time() - t0 > timeout:
-                try:
-                    os.unlink(path)
-                except:
-                    pass
-            time.sleep(0.05)
-        except Exception:
-            time.sleep(0.05)
+def _paragraph_at(doc, tables, loc):
+    if loc[0] == "body":
+        return doc.paragraphs[loc[1]]
+    _, ti, i, j, pi = loc
+    return _cell_at(tables, ti, i, j).paragraphs[pi]
 
-def _release_lock(fd, path: str):
-    try:
-        os.close(fd)
-    except:
-        pass
-    try:
-        os.unlink(path)
-    except:
-        pass
 
-def _atomic_save_docx(doc: Document, out_path: str):
-    tmp = f"{out_path}.tmp-{uuid.uuid4().hex}"
-    doc.save(tmp)
-    os.replace(tmp, out_path)
+def _set_tick(p, pos, tick) -> bool:
+    """Đổi ký tự checkbox tại (run_idx, offset); bỏ qua nếu đích không còn là checkbox."""
+    if not pos:
+        return False
+    k, off = pos
+    runs = p.runs
+    if k >= len(runs):
+        return False
+    rt = runs[k].text or ""
+    if off >= len(rt) or rt[off] not in "☐☑":
+        return False
+    runs[k].text = rt[:off] + tick + rt[off + 1:]
+    return True
+
 
 # ============================ TRF: fill & export ============================
 
 def fill_docx_and_export_pdf(data, fixed_report_no=None):
     # report no
+    report_no = _pick_report_no(data, fixed_report_no)
+    # Giữ lock của report cả lúc convert PDF (convert chậm cũng không bị process khác ghi đè DOCX)
+    with report_file_lock(report_no):
+        output_docx = render_trf_docx(data, report_no)
+        output_pdf = export_trf_pdf(report_no)
+    try:
+        from report_alloc import note_report_used
+        note_report_used(report_no, "files")
+    except Exception as e:
+        print("UsedReportNumbers update lỗi:", e)
+    return output_docx, output_pdf, report_no
+
+
+def _pick_report_no(data, fixed_report_no=None):
     if fixed_report_no and str(fixed_report_no).strip():
         report_no = str(fixed_report_no).strip()
     else:
-        report_no = get_first_empty_report_all_blank(_smart_excel_path(local_main))
+        report_no = None
+        try:
+            # Giữ chỗ luôn để 2 request song song không nhận cùng 1 số
+            from report_alloc import reserve_report_no
+            report_no = reserve_report_no(owner=(data or {}).get("trq_id", ""))
+        except Exception as e:
+            print("report_alloc lỗi, quét dòng trống:", e)
+        if not report_no:
+            report_no = get_first_empty_report_all_blank(_smart_excel_path(local_main))
         if not report_no:
             raise Exception("No empty report number available in Excel.")
+    return report_no
 
+
+def render_trf_docx(data, report_no):
+    """Điền template TRF cho report_no rồi lưu static/TFR/<report_no>.docx; trả về đường dẫn DOCX."""
     data = dict(data or {})
     data["report_no"] = report_no
     template_key = (data.get("template_key") or "other")
 
-    doc = Document(WORD_TEMPLATE)
+    tpl = get_compiled_template(WORD_TEMPLATE)
+    doc = tpl.new_document()
+    tables = doc.tables
 
-    # basic field mapping
-    mapping = {
-        "requestor": "requestor",
-        "department": "department",
-        "requested date": "request_date",
-        "lab test report no.": "report_no",
-        "sample description": "sample_description",
-        "item code": "item_code",
-        "quantity": "quantity",
-        "supplier": "supplier",
-        "subcon": "subcon",
-        "test group": "test_group",
-        "test status": "test_status",
-        "furniture testing": "furniture_testing",
-        "estimated completed date": "estimated_completion_date",
-    }
+    # basic field mapping (ô nhãn tính sẵn trong tpl.trf_fields)
     remark = data.get("remark", "")
     remark_written = False
 
-    for table in doc.tables:
-        nrows = len(table.rows)
-        ncols = len(table.columns)
-        for i, row in enumerate(table.rows):
-            for j, cell in enumerate(row.cells):
-                label = (
-                    cell.text.strip().lower()
-                    .replace("(mã item)", "")
-                    .replace("(mã material)", "")
-                    .replace("*", "")
-                )
-                if not remark_written and ("other tests/instructions" in label or "remark" in label) and remark:
-                    if i + 1 < nrows:
-                        below_cell = table.rows[i + 1].cells[j]
-                        if not (below_cell.text or "").strip():
-                            below_cell.text = str(remark)
-                            remark_written = True
-                            continue
-                if ("emp id" in label or "msnv" in label) and data.get("employee_id", ""):
-                    if j + 1 < ncols:
-                        target_cell = row.cells[j + 1]
-                        if not (target_cell.text or "").strip():
-                            target_cell.text = str(data["employee_id"])
-                            continue
-                for map_label, key in mapping.items():
-                    if map_label in ["remark", "employee id"]:
-                        continue
-                    if map_label in label and key in data and str(data[key]).strip() != "":
-                        if j + 1 < ncols:
-                            target_cell = row.cells[j + 1]
-                            if (target_cell.text or "").strip() == "" or "lab test report no." in label:
-                                target_cell.text = str(data[key])
-    
+    for ti, i, j, nrows, ncols, label, is_remark, is_emp, keys in tpl.trf_fields:
+        if not remark_written and is_remark and remark:
+            if i + 1 < nrows:
+                below_cell = _cell_at(tables, ti, i + 1, j)
+                if not (below_cell.text or "").strip():
+                    below_cell.text = str(remark)
+                    remark_written = True
+                    continue
+        if is_emp and data.get("employee_id", ""):
+            if j + 1 < ncols:
+                target_cell = _cell_at(tables, ti, i, j + 1)
+                if not (target_cell.text or "").strip():
+                    target_cell.text = str(data["employee_id"])
+                    continue
+        for map_label, key in keys:
+            if key in data and str(data[key]).strip() != "":
+                if j + 1 < ncols:
+                    target_cell = _cell_at(tables, ti, i, j + 1)
+                    if (target_cell.text or "").strip() == "" or "lab test report no." in label:
+                        target_cell.text = str(data[key])
+
     def remove_accents(s):
         return ''.join(
             c for c in unicodedata.normalize('NFD', s)
@@ -516,129 +685,79 @@ def fill_docx_and_export_pdf(data, fixed_report_no=None):
     requester = remove_accents(requester_raw)
 
     if requester:
-        for table in doc.tables:
-            rows = table.rows
-            for i, row in enumerate(rows):
-                for j, cell in enumerate(row.cells):
-                    if (cell.text or "").strip().lower() == "requested by":
-                        if i + 1 < len(rows):
-                            below = rows[i + 1].cells[j]
-
-                            p = below.paragraphs[0]   # dùng đúng paragraph có sẵn
+        for ti, i, j in tpl.requested_by:
+            if i + 1 >= len(tables[ti].rows):
+                continue
+            below = _cell_at(tables, ti, i + 1, j)
 
-                            # xoá paragraph dư nếu có
-                            if len(below.paragraphs) > 1:
-                                for extra in below.paragraphs[1:]:
-                                    extra._element.getparent().remove(extra._element)
+            p = below.paragraphs[0]   # dùng đúng paragraph có sẵn
 
-                            # đảm bảo paragraph có run
-                            if not p.runs:
-                                p.add_run("")
+            # xoá paragraph dư nếu có
+            if len(below.paragraphs) > 1:
+                for extra in below.paragraphs[1:]:
+                    extra._element.getparent().remove(extra._element)
 
-                            run = p.runs[0]
-                            run.text = requester
-                            run.bold = False
-                            run.italic = True
-                            run.font.name = "Arial"
-                            run.font.size = Pt(16)
+            # đảm bảo paragraph có run
+            if not p.runs:
+                p.add_run("")
 
-                            p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            run = p.runs[0]
+            run.text = requester
+            run.bold = False
+            run.italic = True
+            run.font.name = "Arial"
+            run.font.size = Pt(16)
 
-                        break
+            p.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
-    # Tick boxes
+    # Tick boxes (vị trí checkbox tính sẵn; khối Accepted / Not accepted giữ nguyên template)
     label_value_map = build_label_value_map(data)
-    tick_unicode_checkbox_by_label(doc, label_value_map)
+    for loc, label, k, off in tpl.checkboxes:
+        _set_tick(_paragraph_at(doc, tables, loc), (k, off), "☑" if label_value_map.get(label) else "☐")
 
     # ---- Override Sample return: ONLY tick YES or NO, not both ----
     sample_return = (str(data.get("sample_return", "")).strip().lower())
-
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-
-                full_text = cell.text.lower()
-                if "sample return" not in full_text:
-                    continue
-
-                # duyệt từng paragraph trong cùng cell
-                for p in cell.paragraphs:
-                    full = "".join(r.text for r in p.runs)
-
-                    # tìm vị trí tick của Yes
-                    m_yes = re.search(r"(☐|☑)\s*yes", full, flags=re.IGNORECASE)
-                    # tìm tick của No
-                    m_no = re.search(r"(☐|☑)\s*no(?!t accepted)", full, flags=re.IGNORECASE)
-
-                    spans = []
-                    pos = 0
-                    for r in p.runs:
-                        t = r.text or ""
-                        spans.append((r, pos, pos + len(t)))
-                        pos += len(t)
-
-                    def replace_at(match, want_tick):
-                        if not match:
-                            return
-                        chk = match.start(1)
-                        for run, start, end in spans:
-                            if start <= chk < end:
-                                idx = chk - start
-                                old = run.text
-                                run.text = old[:idx] + want_tick + old[idx+1:]
-                                return
-
-                    # tick logic
-                    if sample_return == "yes":
-                        replace_at(m_yes, "☑")
-                        replace_at(m_no,  "☐")
-                    elif sample_return == "no":
-                        replace_at(m_yes, "☐")
-                        replace_at(m_no,  "☑")
-                    else:
-                        # không tick gì nếu không có input
-                        replace_at(m_yes, "☐")
-                        replace_at(m_no,  "☐")
-
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                t = (cell.text or "").lower()
-                if "accepted" in t or "not accepted" in t:
-                    # Bỏ tick theo template gốc
-                    for p in cell.paragraphs:
-                        for r in p.runs:
-                            if "☐" in r.text or "☑" in r.text:
-                                # KHÔNG thay đổi tick của template
-                                pass
+    want_yes = "☑" if sample_return == "yes" else "☐"
+    want_no = "☑" if sample_return == "no" else "☐"
+    for loc, yes, no in tpl.sample_return:
+        p = _paragraph_at(doc, tables, loc)
+        _set_tick(p, yes, want_yes)
+        _set_tick(p, no, want_no)
 
     # === NEW: auto fill Summary/Detail (status + comment + photo) for TRF too ===
-    _update_exec_summary_results_from_status(doc, report_no, template_key)
-    _update_detail_results_and_comments(doc, report_no, template_key)
-    _insert_transit_step_and_after_test_images(doc, report_no, template_key)
+    tables = DocTables(doc)
+    _update_exec_summary_results_from_status(tables, report_no, template_key)
+    _update_detail_results_and_comments(tables, report_no, template_key)
+    _insert_transit_step_and_after_test_images(tables, report_no, template_key)
 
     # save
     if not os.path.exists(PDF_OUTPUT_FOLDER):
-        os.makedirs(PDF_OUTPUT_FOLDER)
+        os.makedirs(PDF_OUTPUT_FOLDER, exist_ok=True)
     output_docx = os.path.join(PDF_OUTPUT_FOLDER, f"{report_no}.docx")
-    output_pdf  = os.path.join(PDF_OUTPUT_FOLDER, f"{report_no}.pdf")
-
-    lock_path = _lock_path_for(report_no)
-    fd = _acquire_lock(lock_path, timeout=30)
-    try:
+    with report_file_lock(report_no):
         _atomic_save_docx(doc, output_docx)
-    finally:
-        _release_lock(fd, lock_path)
+    return output_docx
 
-    try_convert_to_pdf(output_docx, output_pdf)
-    return output_docx, output_pdf, report_no
 
+def export_trf_pdf(report_no):
+    """Convert static/TFR/<report_no>.docx -> .pdf (giữ lock của report trong lúc convert)."""
+    output_docx = os.path.join(PDF_OUTPUT_FOLDER, f"{report_no}.docx")
+    output_pdf  = os.path.join(PDF_OUTPUT_FOLDER, f"{report_no}.pdf")
+    with report_file_lock(report_no):
+        try_convert_to_pdf(output_docx, output_pdf)
+    return output_pdf
 
-def approve_request_fill_docx_pdf(req):
-    fixed = (req.get("report_no") or "").strip()
+
+def _with_etd(req):
     if "etd" in req and not req.get("estimated_completion_date"):
         req = dict(req)
         req["estimated_completion_date"] = req.get("etd")
+    return req
+
+
+def approve_request_fill_docx_pdf(req):
+    fixed = (req.get("report_no") or "").strip()
+    req = _with_etd(req)
 
     if fixed:
         out_docx, out_pdf, report_no = fill_docx_and_export_pdf(req, fixed_report_no=fixed)
@@ -649,45 +768,271 @@ def approve_request_fill_docx_pdf(req):
         return out_pdf, report_no
     return out_docx, report_no
 
+def render_request_docx(req):
+    """
+    Worker cho pipeline approve (chạy trong process pool): chỉ điền DOCX, KHÔNG convert PDF.
+    req phải có sẵn report_no (đã giữ chỗ ở process chính). Trả về (report_no, đường dẫn DOCX).
+    """
+    report_no = str(req.get("report_no") or "").strip()
+    if not report_no:
+        raise ValueError("render_request_docx cần report_no đã cấp")
+    return report_no, render_trf_docx(_with_etd(req), report_no)
+
+
+# ============================ Pool cho pipeline approve ============================
+# - DOCX: process pool (python-docx tốn CPU, GIL) — context "spawn" giống Windows, an toàn khi app có nhiều thread.
+# - PDF : thread pool có giới hạn (convert là Word/LibreOffice bên ngoài, chủ yếu chờ I/O).
+
+_DOCX_POOL = None
+_PDF_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_docx_pool():
+    global _DOCX_POOL
+    with _POOL_LOCK:
+        if _DOCX_POOL is None:
+            _DOCX_POOL = ProcessPoolExecutor(max_workers=max(1, APPROVE_DOCX_WORKERS),
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=warm_template_cache)
+        return _DOCX_POOL
+
+
+def reset_docx_pool():
+    """Bỏ pool hỏng (worker chết) để lần sau tạo lại."""
+    global _DOCX_POOL
+    with _POOL_LOCK:
+        pool, _DOCX_POOL = _DOCX_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_pdf_pool():
+    global _PDF_POOL
+    with _POOL_LOCK:
+        if _PDF_POOL is None:
+            _PDF_POOL = ThreadPoolExecutor(max_workers=max(1, APPROVE_PDF_WORKERS), thread_name_prefix="tfr-pdf")
+        return _PDF_POOL
+
+# ======================= Duyệt bảng 1 lần (mức XML) + rule nhận diện bảng =======================
+# Mỗi lần fill chỉ duyệt doc.tables 1 lần ở mức XML (không qua row.cells / _tc_above / xpath của python-docx):
+#   - TableView.rows[i]  : tuple ô giống table.rows[i].cells (ô gộp ngang lặp lại, ô gộp dọc trỏ về ô gốc)
+#   - TableView.texts[i] : text từng ô (tính 1 lần cho mỗi ô gốc, giống cell.text)
+# Các bảng cần tìm (EXECUTIVE SUMMARY, bảng chi tiết, SAMPLE PICTURE, step Transit, AFTER TEST) là rule
+# đăng ký matcher bằng @_table_rule; DocTables chạy mọi matcher trên cùng lượt duyệt, lấy bảng ĐẦU TIÊN khớp.
+# Đọc text lúc đang ghi (ô vừa bị sửa) dùng _cell_text(cell) — đọc thẳng XML, nhanh hơn cell.text.
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_RUN_TEXT_TAGS = {_W + t for t in ("br", "cr", "noBreakHyphen", "ptab", "t", "tab")}
+
+
+def _xml_run_text(r) -> str:
+    return "".join(str(e) for e in r if e.tag in _RUN_TEXT_TAGS)
+
+
+def _xml_paragraph_text(p) -> str:
+    out = []
+    for e in p:
+        if e.tag == _W + "r":
+            out.append(_xml_run_text(e))
+        elif e.tag == _W + "hyperlink":
+            out.extend(_xml_run_text(r) for r in e if r.tag == _W + "r")
+    return "".join(out)
+
+
+def _xml_cell_text(tc) -> str:
+    """Giống _Cell.text: các paragraph con trực tiếp nối bằng '\\n'."""
+    return "\n".join(_xml_paragraph_text(p) for p in tc if p.tag == _W + "p")
+
+
+def _cell_text(cell) -> str:
+    return _xml_cell_text(cell._tc)
+
+
+_TABLE_RULES = []
+
+
+def _table_rule(name):
+    """Đăng ký matcher(view) cho bảng 'name'; kết quả truthy = bảng khớp (được lưu lại cho nơi dùng)."""
+    def deco(fn):
+        _TABLE_RULES.append((name, fn))
+        return fn
+    return deco
+
+
+class TableView:
+    """1 bảng đã duyệt: lưới ô + text; hits = {rule: kết quả matcher}."""
+
+    def __init__(self, table, norm_cache):
+        self.table = table
+        self._norm_cache = norm_cache
+        self._norm_rows = {}
+        self.rows = []
+        self.texts = []
+        self.scan()
+
+    def scan(self):
+        tbl = self.table._tbl
+        self.ncols = len(self.table.columns)
+        self.rows, self.texts, self._norm_rows = [], [], {}
+        above = {}   # grid offset -> (cell, text) của hàng trên (cho ô gộp dọc vMerge=continue)
+        for tr in tbl.tr_lst:
+            cells, texts, here = [], [], {}
+            off = tr.grid_before
+            for tc in tr.tc_lst:
+                span = tc.grid_span
+                if tc.vMerge == "continue" and off in above:
+                    cell, text = above[off]
+                else:
+                    cell, text = _Cell(tc, self.table), _xml_cell_text(tc)
+                for k in range(span):
+                    cells.append(cell)
+                    texts.append(text)
+                    here[off + k] = (cell, text)
+                off += span
+            self.rows.append(tuple(cells))
+            self.texts.append(tuple(texts))
+            above = here
+        self.hits = {name: fn(self) for name, fn in _TABLE_RULES}
+
+    def norm_row(self, i):
+        """_norm của các ô hàng i (cache; dùng cho matcher / header)."""
+        row = self._norm_rows.get(i)
+        if row is None:
+            cache = self._norm_cache
+            row = []
+            for t in self.texts[i]:
+                n = cache.get(t)
+                if n is None:
+                    n = cache[t] = _norm(t)
+                row.append(n)
+            row = self._norm_rows[i] = tuple(row)
+        return row
+
+
+class DocTables:
+    """Các bảng thân bài của 1 Document, duyệt 1 lần; get(rule) -> (view, kết quả matcher) của bảng đầu tiên khớp."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        norm_cache = {}
+        self.views = [TableView(t, norm_cache) for t in doc.tables]
+
+    def get(self, name):
+        for v in self.views:
+            hit = v.hits.get(name)
+            if hit:
+                return v, hit
+        return None, None
+
+    def view(self, name):
+        return self.get(name)[0]
+
+    def rescan(self, view):
+        """Duyệt lại 1 bảng sau khi đã sửa nội dung / thêm hàng (cho các rule chạy sau)."""
+        if view is not None:
+            view.scan()
+
+
+@_table_rule("exec_summary")
+def _match_exec_summary(view):
+    """
+    Bảng EXECUTIVE SUMMARY với các alias linh hoạt:
+      - Cột 1: "Clause" hoặc "Test property"
+      - Cột 2: "Description"
+      - Cột 3: "Result"
+      - Cột 4 (tuỳ chọn): "Comment(s)" / "*Comments"
+    """
+    for i, texts in enumerate(view.texts):
+        if len(texts) >= 3:
+            heads = view.norm_row(i)
+            if heads[0] in {"clause", "test property"} and heads[1] == "description" and heads[2] == "result":
+                return True
+    return False
+
+
+@_table_rule("detail")
+def _match_detail(view):
+    """
+    Bảng chi tiết:
+      - Cột 1: "Clause" hoặc "Test property"
+      - Cột 2: "Description"
+      - Cột 3: "Test Method/Requirement" hoặc "Criteria"
+      - Cột 4: "Result"
+      - Cột 5 (tuỳ chọn): "Photo reference"
+    """
+    req_aliases = {"test method requirement", "criteria", "test method", "requirement"}
+    for i, texts in enumerate(view.texts):
+        if len(texts) >= 4:
+            heads = view.norm_row(i)
+            if (heads[0] in {"clause", "test property"} and heads[1] == "description"
+                    and heads[2] in req_aliases and heads[3] == "result"):
+                return True
+    return False
+
+
+@_table_rule("sample_picture")
+def _match_sample_picture(view):
+    """Ô 'SAMPLE PICTURE' có hàng bên dưới -> (i+1,) = hàng chứa ô dán ảnh overview (ô đầu tiên)."""
+    n = len(view.rows)
+    for i in range(n):
+        if i + 1 < n and any("sample picture" in h for h in view.norm_row(i)):
+            return (i + 1,)
+    return None
+
+
+@_table_rule("transit_step")
+def _match_transit_step(view):
+    """
+    Bảng chứa các ô 'step4', 'step5', 'step6 machine', ... trong form Transit:
+      - Có ô 'SAMPLE PICTURE'
+      - Đồng thời có ít nhất một ô có chữ 'step' + số
+    """
+    has_sample = has_step = False
+    for i in range(len(view.rows)):
+        for h in view.norm_row(i):
+            if "sample picture" in h:
+                has_sample = True
+            if re.search(r"step\s*\d", h):
+                has_step = True
+    return has_sample and has_step
+
+
+@_table_rule("after_test")
+def _match_after_test(view):
+    """Bảng AFTER TEST (trang 7 trở đi): dòng đầu chỉ gồm ô 'AFTER TEST' / trống, ít nhất 1 ô 'AFTER TEST'."""
+    if not view.rows:
+        return False
+    headers = view.norm_row(0)
+    return bool(headers) and all(h in {"after test", ""} for h in headers) and any(h == "after test" for h in headers)
+
 # ======================= SAMPLE PICTURE =======================
 
-def _find_overview_images(report_id: str) -> list[str]:
-    roots = []
+def _report_image_dirs(report_id: str) -> list[str]:
+    """
+    Thư mục ảnh của report: images/<report>, report dods/<report>.
+    Chỉ khi report chưa có thư mục riêng mới dùng ảnh để phẳng ở gốc images/ và report dods/ (kiểu cũ).
+    """
     images_root = os.path.join(os.getcwd(), "images")
     report_dods_root = os.path.join(os.getcwd(), "report dods")
+    own = []
     if report_id:
-        roots.append(os.path.join(images_root, str(report_id)))
-        roots.append(os.path.join(report_dods_root, str(report_id)))
-    roots.append(report_dods_root)
-    roots.append(images_root)
-
-    found = []
-    seen = set()
-    for root in roots:
-        if not os.path.isdir(root):
-            continue
-        for name in os.listdir(root):
-            low = name.lower()
-            if any(low.endswith(ext) for ext in _IMG_EXTS) and "overview" in low:
-                p = os.path.join(root, name)
-                if p not in seen:
-                    seen.add(p)
-                    found.append(p)
-        if found:
-            break
+        own = [d for d in (os.path.join(images_root, str(report_id)), os.path.join(report_dods_root, str(report_id)))
+               if os.path.isdir(d)]
+    return own or [d for d in (report_dods_root, images_root) if os.path.isdir(d)]
 
-    found.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-    return found
+def _find_overview_images(report_id: str) -> list[str]:
+    for root in _report_image_dirs(report_id):
+        found = [p for p, e in image_manifest.image_paths(root) if "overview" in e["name"].lower()]
+        if found:
+            return found   # đã sắp mới nhất trước theo thời điểm upload trong manifest
+    return []
 
-def _find_sample_picture_target_cell(doc: Document):
-    for t in doc.tables:
-        rows = t.rows
-        for i, row in enumerate(rows):
-            for j, cell in enumerate(row.cells):
-                if "sample picture" in _norm(cell.text):
-                    if i + 1 < len(rows):
-                        return rows[i + 1].cells[0]
-    return None
+def _find_sample_picture_target_cell(tables: DocTables):
+    view, hit = tables.get("sample_picture")
+    if view is None:
+        return None
+    return view.rows[hit[0]][0]
 
 def _clear_cell_keep_one_paragraph(cell):
     try:
@@ -709,14 +1054,15 @@ def _clear_cell(cell):
     except Exception:
         pass
 
-def _insert_overview_images_into_sample_picture(doc: Document, report_id: str) -> bool:
+def _insert_overview_images_into_sample_picture(tables: DocTables, report_id: str) -> bool:
     img_paths = _find_overview_images(report_id)
     if not img_paths:
         return False
 
-    target_cell = _find_sample_picture_target_cell(doc)
+    target_cell = _find_sample_picture_target_cell(tables)
     if target_cell is None:
         return False
+    doc = tables.doc
 
     # gọi hàm mới: xóa hết paragraph trống
     _clear_cell(target_cell)
@@ -749,23 +1095,17 @@ def _insert_overview_images_into_sample_picture(doc: Document, report_id: str) -
         p = c.paragraphs[0] if c.paragraphs else c.add_paragraph("")
         p.alignment = WD_ALIGN_PARAGRAPH.CENTER
         run = p.add_run()
-        pic = run.add_picture(path)
-        pic.width  = Inches(3)     # ngang 3 inch
-        pic.height = Inches(2.5)
+        _add_picture(run, path, 3, 2.5)     # ngang 3 inch
 
+    # ô vừa dán ảnh có thể là ô step của Transit -> duyệt lại bảng cho các rule chạy sau
+    tables.rescan(tables.view("sample_picture"))
     return True
 
 # ======================= STATUS & COMMENT & PHOTO =======================
 
 def _find_status_file(report_id: str) -> str | None:
     def _candidates(root_dir):
-        if not os.path.isdir(root_dir):
-            return []
-        return [
-            os.path.join(root_dir, f)
-            for f in os.listdir(root_dir)
-            if f.lower().startswith("status") and f.lower().endswith(".txt")
-        ]
+        return image_manifest.folder_index(root_dir).status_paths()
 
     base_roots = [os.path.join(os.getcwd(), "images"), os.path.join(os.getcwd(), "report dods")]
     pri_roots = []
@@ -784,13 +1124,7 @@ def _find_status_file(report_id: str) -> str | None:
 
 def _find_comment_file(report_id: str) -> str | None:
     def _candidates(root_dir):
-        if not os.path.isdir(root_dir):
-            return []
-        return [
-            os.path.join(root_dir, f)
-            for f in os.listdir(root_dir)
-            if f.lower().startswith("comment") and f.lower().endswith(".txt")
-        ]
+        return image_manifest.folder_index(root_dir).comment_paths()
 
     base_roots = [os.path.join(os.getcwd(), "images"), os.path.join(os.getcwd(), "report dods")]
     pri_roots = []
@@ -957,75 +1291,14 @@ def _match_muc(desc: str, clause: str, muc_cands: dict) -> str | None:
             return muc
     return None
 
-# ======================= Table detection (with synonyms) =======================
-
-def _find_exec_summary_table(doc: Document):
-    """
-    Nhận diện bảng EXECUTIVE SUMMARY với các alias linh hoạt:
-      - Cột 1: "Clause" hoặc "Test property"
-      - Cột 2: "Description"
-      - Cột 3: "Result"
-      - Cột 4 (tuỳ chọn): "Comment(s)" / "*Comments"
-    """
-    clause_aliases = {"clause", "test property"}
-    desc_aliases = {"description"}
-    result_aliases = {"result"}
-    comment_aliases = {"comment", "comments", "*comments"}
-
-    for t in doc.tables:
-        for r in t.rows:
-            cells = r.cells
-            if len(cells) >= 3:
-                heads = [_norm(cells[i].text) for i in range(min(len(cells), 4))]
-                if (
-                    len(heads) > 2
-                    and heads[0] in clause_aliases
-                    and heads[1] in desc_aliases
-                    and heads[2] in result_aliases
-                ):
-                    return t
-    return None
-
-
-def _find_detail_table(doc: Document):
-    """
-    Nhận diện bảng chi tiết:
-      - Cột 1: "Clause" hoặc "Test property"
-      - Cột 2: "Description"
-      - Cột 3: "Test Method/Requirement" hoặc "Criteria"
-      - Cột 4: "Result"
-      - Cột 5 (tuỳ chọn): "Photo reference"
-    """
-    clause_aliases = {"clause", "test property"}
-    desc_aliases = {"description"}
-    req_aliases = {"test method requirement", "criteria", "test method", "requirement"}
-    result_aliases = {"result"}
-    photo_aliases = {"photo reference", "photo"}
-
-    for t in doc.tables:
-        for r in t.rows:
-            cells = r.cells
-            if len(cells) >= 4:
-                heads = [_norm(cells[i].text) for i in range(min(len(cells), 5))]
-                if (
-                    len(heads) > 3
-                    and heads[0] in clause_aliases
-                    and heads[1] in desc_aliases
-                    and heads[2] in req_aliases
-                    and heads[3] in result_aliases
-                ):
-                    return t
-    return None
-
 # ======================= Result/Photo style detection =======================
 
-def _detect_result_style(tbl):
-    for r in tbl.rows:
-        cells = r.cells
+def _detect_result_style(view):
+    for cells, texts in zip(view.rows, view.texts):
         if len(cells) < 3:
             continue
         c = cells[2]
-        t = (c.text or "").strip()
+        t = (texts[2] or "").strip()
         if t and not _is_placeholder_dash(t):
             fname, fsize, fbold, fitalic = _clone_first_run_style(c)
             try:
@@ -1035,13 +1308,12 @@ def _detect_result_style(tbl):
             return fname, fsize, fbold, fitalic, align
     return None, None, None, None, WD_ALIGN_PARAGRAPH.CENTER
 
-def _detect_result_style_detail(tbl):
-    for r in tbl.rows:
-        cells = r.cells
+def _detect_result_style_detail(view):
+    for cells, texts in zip(view.rows, view.texts):
         if len(cells) < 4:
             continue
         c = cells[3]
-        t = (c.text or "").strip()
+        t = (texts[3] or "").strip()
         if t and not _is_placeholder_dash(t):
             fname, fsize, fbold, fitalic = _clone_first_run_style(c)
             try:
@@ -1051,13 +1323,12 @@ def _detect_result_style_detail(tbl):
             return fname, fsize, fbold, fitalic, align
     return None, None, None, None, WD_ALIGN_PARAGRAPH.CENTER
 
-def _detect_photo_style_detail(tbl):
-    for r in tbl.rows:
-        cells = r.cells
+def _detect_photo_style_detail(view):
+    for cells, texts in zip(view.rows, view.texts):
         if len(cells) < 5:
             continue
         c = cells[4]
-        t = (c.text or "").strip()
+        t = (texts[4] or "").strip()
         if t and t.upper() not in {"-", "NO PHOTO"}:
             fname, fsize, fbold, fitalic = _clone_first_run_style(c)
             try:
@@ -1092,9 +1363,9 @@ def _is_exec_placeholder(text: str):
     t = (text or "").strip().upper()
     return t in {"", "-", "—", "–", "N/A", "N/T"}
 
-def _find_result_col(table):
+def _find_result_col(view):
     """Tự tìm cột chứa 'Result' (không phụ thuộc index cố định)."""
-    header = [c.text.strip().lower() for c in table.rows[0].cells]
+    header = [t.strip().lower() for t in view.texts[0]]
     for i, h in enumerate(header):
         if "result" in h:
             return i
@@ -1111,7 +1382,7 @@ def _aggregate_results(values):
         return "N/A"
     return "PASS"
 
-def _update_exec_summary_results_from_status(doc: Document, report_id: str, template_key: str) -> bool:
+def _update_exec_summary_results_from_status(tables: DocTables, report_id: str, template_key: str) -> bool:
     """
     MỚI: Điền EXECUTIVE SUMMARY theo ưu tiên:
       (1) Map Description của Summary với Description/Test property của bảng chi tiết
@@ -1121,8 +1392,8 @@ def _update_exec_summary_results_from_status(doc: Document, report_id: str, temp
     """
     changed = False
 
-    exec_tbl = _find_exec_summary_table(doc)
-    detail_tbl = _find_detail_table(doc)
+    exec_tbl = tables.view("exec_summary")
+    detail_tbl = tables.view("detail")
     if not exec_tbl or not detail_tbl:
         return False
 
@@ -1139,8 +1410,8 @@ def _update_exec_summary_results_from_status(doc: Document, report_id: str, temp
         return s in {"-", "—", "–"}  # chỉ ghi khi là các biến thể dấu gạch
 
     # --- xác định cột linh hoạt cho 2 bảng ---
-    def _hdr_idx(tbl, wanted):
-        hdr = [_norm(c.text) for c in tbl.rows[0].cells]
+    def _hdr_idx(view, wanted):
+        hdr = view.norm_row(0)
         for i, h in enumerate(hdr):
             if h in wanted:
                 return i
@@ -1169,13 +1440,13 @@ def _update_exec_summary_results_from_status(doc: Document, report_id: str, temp
     # --- index nhanh: description chi tiết -> (raw_desc, result) ---
     detail_desc_to_result = {}
     detail_rows = []
-    for r in detail_tbl.rows[1:]:
-        cells = r.cells
+    for cells in detail_tbl.rows[1:]:
         if len(cells) <= max(det_desc_idx, det_res_idx):
             continue
-        dprop = cells[det_prop_idx].text if det_prop_idx < len(cells) else ""
-        ddesc = cells[det_desc_idx].text if det_desc_idx < len(cells) else ""
-        dres  = cells[det_res_idx].text
+        # đọc trực tiếp (bảng chi tiết có thể vừa được điền Result)
+        dprop = _cell_text(cells[det_prop_idx]) if det_prop_idx < len(cells) else ""
+        ddesc = _cell_text(cells[det_desc_idx]) if det_desc_idx < len(cells) else ""
+        dres  = _cell_text(cells[det_res_idx])
         nd = _norm(ddesc)
         if nd:
             detail_desc_to_result.setdefault(nd, (ddesc, (dres or "").strip()))
@@ -1222,17 +1493,16 @@ def _update_exec_summary_results_from_status(doc: Document, report_id: str, temp
         major_to_results.setdefault(major, []).append(ru)
 
     # --- đi từng dòng summary ---
-    for row in exec_tbl.rows[1:]:
-        cells = row.cells
+    for cells in exec_tbl.rows[1:]:
         if len(cells) <= exec_res_idx:
             continue
 
-        prop_text = cells[exec_prop_idx].text if exec_prop_idx < len(cells) else ""
-        desc_text = cells[exec_desc_idx].text if exec_desc_idx < len(cells) else ""
+        prop_text = _cell_text(cells[exec_prop_idx]) if exec_prop_idx < len(cells) else ""
+        desc_text = _cell_text(cells[exec_desc_idx]) if exec_desc_idx < len(cells) else ""
         res_cell  = cells[exec_res_idx]
 
         # chỉ xử lý nếu ô hiện đang là dấu "-"
-        current_text = (res_cell.text or "").strip()
+        current_text = (_cell_text(res_cell) or "").strip()
         if not _is_dash_only(current_text):
             # đang là N/A, N/T, trống, hoặc đã có PASS/FAIL => bỏ qua, không ghi đè
             continue
@@ -1268,30 +1538,16 @@ def _update_exec_summary_results_from_status(doc: Document, report_id: str, temp
 
 # --------- Image helpers ---------
 
+def _candidate_image_entries(report_id: str) -> list[tuple[str, dict]]:
+    """[(path, entry manifest)] mọi ảnh của report, mới nhất trước."""
+    out = []
+    for root in _report_image_dirs(report_id):
+        out.extend(image_manifest.image_paths(root))
+    out.sort(key=lambda it: image_manifest.added_time(it[1]), reverse=True)
+    return out
+
 def _all_candidate_images(report_id: str):
-    roots = []
-    images_root = os.path.join(os.getcwd(), "images")
-    report_dods_root = os.path.join(os.getcwd(), "report dods")
-    if report_id:
-        roots.append(os.path.join(images_root, str(report_id)))
-        roots.append(os.path.join(report_dods_root, str(report_id)))
-    roots.append(report_dods_root)
-    roots.append(images_root)
-
-    files = []
-    seen = set()
-    for root in roots:
-        if not os.path.isdir(root):
-            continue
-        for name in os.listdir(root):
-            low = name.lower()
-            if any(low.endswith(ext) for ext in _IMG_EXTS):
-                p = os.path.join(root, name)
-                if p not in seen:
-                    seen.add(p)
-                    files.append(p)
-    files.sort(key=lambda p: os.path.getmtime(p), reverse=True)
-    return files
+    return [p for p, _ in _candidate_image_entries(report_id)]
 
 def _extract_muc_and_order_from_name(path: str, known_mucs: set[str] | None = None) -> tuple[str | None, int]:
     """
@@ -1329,33 +1585,22 @@ def _extract_muc_and_order_from_name(path: str, known_mucs: set[str] | None = No
 
     return None, 0
 
-_IMAGE_INDEX_CACHE: dict[tuple[str, tuple[str, ...]], dict[str, list[str]]] = {}
-
 def _index_images_by_muc(report_id: str, known_mucs: set[str]) -> dict[str, list[str]]:
     """
-    Lập chỉ mục {muc → [ảnh1, ảnh2,...]} (ảnh đã sort theo order).
+    Lập chỉ mục {muc → [ảnh1, ảnh2,...]} (ảnh đã sort theo order) từ manifest ảnh của report
+    (manifest tự làm mới khi có ảnh mới upload / bị xoá).
     """
-    cache_key = (str(report_id), tuple(sorted(known_mucs)))
-    if cache_key in _IMAGE_INDEX_CACHE:
-        return _IMAGE_INDEX_CACHE[cache_key]
-
-    paths = _all_candidate_images(report_id)
-    buckets: dict[str, list[tuple[int, str]]] = {}
-
-    for p in paths:
+    buckets: dict[str, list[tuple[int, float, str]]] = {}
+    for p, e in _candidate_image_entries(report_id):
         muc, order = _extract_muc_and_order_from_name(p, known_mucs)
         if not muc:
             continue
-        if muc not in buckets:
-            buckets[muc] = []
-        buckets[muc].append((order if order > 0 else 1, p))
+        buckets.setdefault(muc, []).append((order if order > 0 else 1, image_manifest.added_time(e), p))
 
     out: dict[str, list[str]] = {}
     for muc, items in buckets.items():
-        items.sort(key=lambda it: (it[0], os.path.getmtime(it[1])))
-        out[muc] = [path for _, path in items]
-
-    _IMAGE_INDEX_CACHE[cache_key] = out
+        items.sort(key=lambda it: (it[0], it[1]))
+        out[muc] = [path for _, _, path in items]
     return out
 
 def _insert_photo_references_stack(cell, image_paths: list[str], fname=None, fsize=None, fbold=None, fitalic=None, align=None):
@@ -1388,16 +1633,14 @@ def _insert_photo_references_stack(cell, image_paths: list[str], fname=None, fsi
         p.alignment = WD_ALIGN_PARAGRAPH.CENTER if align is None else align
         run = p.add_run()
         try:
-            pic = run.add_picture(path)
-            pic.width = Inches(2.0)
-            pic.height = Inches(2.0)
+            _add_picture(run, path, 2.0, 2.0)
         except Exception:
             continue
         pf = p.paragraph_format
         pf.space_before = Pt(0)
         pf.space_after  = Pt(0)
 
-def _update_detail_results_and_comments(doc: Document, report_id: str, template_key: str) -> bool:
+def _update_detail_results_and_comments(tables: DocTables, report_id: str, template_key: str) -> bool:
     status_map = _read_status_map(report_id)
     if not status_map:
         return False
@@ -1407,7 +1650,7 @@ def _update_detail_results_and_comments(doc: Document, report_id: str, template_
     if not muc_cands:
         return False
 
-    tbl = _find_detail_table(doc)
+    tbl = tables.view("detail")
     if tbl is None:
         return False
 
@@ -1418,15 +1661,14 @@ def _update_detail_results_and_comments(doc: Document, report_id: str, template_
     fname_p, fsize_p, fbold_p, fitalic_p, align_p = _detect_photo_style_detail(tbl)
 
     changed = False
-    for i, r in enumerate(tbl.rows):
+    for i, cells in enumerate(tbl.rows):
         if i == 0:
             continue
-        cells = r.cells
         if len(cells) < 5:
             continue
 
-        clause_text = cells[0].text or ""
-        desc_text = cells[1].text or ""
+        clause_text = _cell_text(cells[0]) or ""
+        desc_text = _cell_text(cells[1]) or ""
         result_cell = cells[3]
         photo_cell  = cells[4]
 
@@ -1434,7 +1676,7 @@ def _update_detail_results_and_comments(doc: Document, report_id: str, template_
 
         # Result
         if muc:
-            cur_val = (result_cell.text or "").strip()
+            cur_val = (_cell_text(result_cell) or "").strip()
             if _is_result_placeholder(cur_val):
                 val = status_map.get(muc)
                 if val:
@@ -1447,14 +1689,14 @@ def _update_detail_results_and_comments(doc: Document, report_id: str, template_
                     changed = True
 
         # Photo
-        cur_text = (photo_cell.text or "").strip().upper()
+        cur_text = (_cell_text(photo_cell) or "").strip().upper()
         if cur_text != "NO PHOTO" and (_is_result_placeholder(cur_text) or cur_text == ""):
             photos = img_index.get(muc or "", []) if muc else []
             _insert_photo_references_stack(photo_cell, photos, fname_p, fsize_p, fbold_p, fitalic_p, align_p)
             changed = True
 
         if not muc:
-            cur_text2 = (photo_cell.text or "").strip()
+            cur_text2 = (_cell_text(photo_cell) or "").strip()
             if _is_result_placeholder(cur_text2) or cur_text2 == "":
                 _insert_photo_references_stack(photo_cell, [], fname_p, fsize_p, fbold_p, fitalic_p, align_p)
                 changed = True
@@ -1520,48 +1762,26 @@ def _find_images_for_step_label(report_id: str, label: str) -> list[str]:
     return matched
 
 
-def _find_transit_step_table(doc: Document):
-    """
-    Tìm bảng chứa các ô 'step4', 'step5', 'step6 machine', v.v. trong form Transit.
-    Heuristic:
-      - Bảng có chứa 'SAMPLE PICTURE'
-      - Đồng thời có ít nhất một ô có chữ 'step' + số (step4, step5, step6, ...)
-    """
-    for t in doc.tables:
-        has_sample = False
-        has_step   = False
-        for r in t.rows:
-            for c in r.cells:
-                txt_norm = _norm(c.text)
-                if "sample picture" in txt_norm:
-                    has_sample = True
-                if re.search(r"step\s*\d", txt_norm):
-                    has_step = True
-        if has_sample and has_step:
-            return t
-    return None
-
-
-def _insert_transit_step_images(doc: Document, report_id: str) -> bool:
+def _insert_transit_step_images(tables: DocTables, report_id: str) -> bool:
     """
     Dán hình vào các ô 'step4', 'step5', 'step6 machine', 'step6 corner_235', ...
     - Mỗi ô step lấy ảnh theo rule _find_images_for_step_label.
     - Mặc định chỉ dán 1 ảnh/ô (ảnh đầu tiên).
     - Kích thước ảnh: vừa trong 1/3 chiều rộng vùng in (không làm nở cột).
     """
-    tbl = _find_transit_step_table(doc)
+    tbl = tables.view("transit_step")
     if not tbl:
         return False
 
-    sect = doc.sections[0]
+    sect = tables.doc.sections[0]
     avail_w = int((sect.page_width - sect.left_margin - sect.right_margin) * 0.97)
-    cols = max(1, len(tbl.columns))
+    cols = max(1, tbl.ncols)
     pic_w = int(avail_w / cols * 0.9)  # < chiều rộng cột 1 chút
 
     changed = False
-    for r in tbl.rows:
-        for c in r.cells:
-            raw = (c.text or "").strip()
+    for cells in tbl.rows:
+        for c in cells:
+            raw = (_cell_text(c) or "").strip()
             if not raw:
                 continue
             if "step" not in raw.lower():
@@ -1581,39 +1801,16 @@ def _insert_transit_step_images(doc: Document, report_id: str) -> bool:
             p.alignment = WD_ALIGN_PARAGRAPH.CENTER
             run = p.add_run()
             try:
-                buf = _load_oriented_and_resized_image(img_path, 3, 2.5)
-                if buf:
-                    pic = run.add_picture(buf)
-                    pic.width  = Inches(3)
-                    pic.height = Inches(2.5)
-                else:
-                    pic = run.add_picture(img_path)
-                    pic.width  = Inches(3)
-                    pic.height = Inches(2.5)
+                _add_picture(run, img_path, 3, 2.5)
             except Exception:
                 continue
             changed = True
+    if changed:
+        tables.rescan(tbl)
     return changed
 
 
-def _find_after_test_table(doc: Document):
-    """
-    Tìm bảng AFTER TEST (trang 7 trở đi).
-    - Dòng đầu tiên có các ô 'AFTER TEST'.
-    """
-    for t in doc.tables:
-        if not t.rows:
-            continue
-        first_row = t.rows[0]
-        headers = [_norm(c.text) for c in first_row.cells]
-        if headers and all(h in {"after test", ""} for h in headers):
-            # Ít nhất một ô thật sự là 'AFTER TEST'
-            if any(h == "after test" for h in headers):
-                return t
-    return None
-
-
-def _insert_after_test_step10_images(doc: Document, report_id: str) -> bool:
+def _insert_after_test_step10_images(tables: DocTables, report_id: str) -> bool:
     """
     Dán hình AFTER TEST (step10):
       - Lấy tất cả ảnh có 'step10' trong tên file.
@@ -1621,9 +1818,10 @@ def _insert_after_test_step10_images(doc: Document, report_id: str) -> bool:
       - Nếu > 12 ảnh (vượt số ô hiện tại), tự động add_row() thêm cho đủ,
         giữ đúng style 3 cột.
     """
-    tbl = _find_after_test_table(doc)
-    if not tbl:
+    view = tables.view("after_test")
+    if not view:
         return False
+    tbl = view.table
 
     # Lọc ảnh có chứa 'step10'
     candidates = _all_candidate_images(report_id)
@@ -1638,13 +1836,11 @@ def _insert_after_test_step10_images(doc: Document, report_id: str) -> bool:
         return False
 
     # Chuẩn bị danh sách ô (bỏ dòng header)
-    data_rows = list(tbl.rows)[1:]
     cells_seq = []
-    for row in data_rows:
-        for c in row.cells:
-            cells_seq.append(c)
+    for cells in view.rows[1:]:
+        cells_seq.extend(cells)
 
-    cols = max(1, len(tbl.columns))
+    cols = max(1, view.ncols)
     needed = max(0, len(step10_imgs) - len(cells_seq))
 
     # Nếu thiếu ô → thêm hàng mới với 3 cột, style giống hàng data cuối
@@ -1657,7 +1853,7 @@ def _insert_after_test_step10_images(doc: Document, report_id: str) -> bool:
             cells_seq.append(c)
         needed -= cols
 
-    sect = doc.sections[0]
+    sect = tables.doc.sections[0]
     avail_w = int((sect.page_width - sect.left_margin - sect.right_margin) * 0.97)
     pic_w = int(avail_w / cols * 0.9)
 
@@ -1669,23 +1865,16 @@ def _insert_after_test_step10_images(doc: Document, report_id: str) -> bool:
         p.alignment = WD_ALIGN_PARAGRAPH.CENTER
         run = p.add_run()
         try:
-            buf = _load_oriented_and_resized_image(img_path, 3, 2.5)
-            if buf:
-                pic = run.add_picture(buf)
-                pic.width  = Inches(3)
-                pic.height = Inches(2.5)
-            else:
-                pic = run.add_picture(img_path)
-                pic.width  = Inches(3)
-                pic.height = Inches(2.5)
+            _add_picture(run, img_path, 3, 2.5)
         except Exception:
             continue
         changed = True
 
+    tables.rescan(view)
     return changed
 
 
-def _insert_transit_step_and_after_test_images(doc: Document, report_id: str, template_key: str | None) -> bool:
+def _insert_transit_step_and_after_test_images(tables: DocTables, report_id: str, template_key: str | None) -> bool:
     """
     Hàm tổng cho Transit:
       - Chỉ chạy khi template_key là nhóm transit (transit_2c_np, transit_3b_np, ...).
@@ -1697,8 +1886,8 @@ def _insert_transit_step_and_after_test_images(doc: Document, report_id: str, te
     if "transit" not in key:
         return False
 
-    changed1 = _insert_transit_step_images(doc, report_id)
-    changed2 = _insert_after_test_step10_images(doc, report_id)
+    changed1 = _insert_transit_step_images(tables, report_id)
+    changed2 = _insert_after_test_step10_images(tables, report_id)
     return changed1 or changed2
 
 # ======================= Cover table (from Excel) =======================
@@ -1745,9 +1934,9 @@ def _set_result_inline_in_paragraph(paragraph, rating_text: str) -> bool:
 
     return True
 
-def _set_result_value(doc: Document, rating_text: str) -> bool:
+def _set_result_value(doc: Document, tpl, rating_text: str) -> bool:
     """
-    Đặt giá trị RESULT theo rating_text.
+    Đặt giá trị RESULT theo rating_text (ô 'RESULT:' tính sẵn trong tpl).
     - Với TABLE: ghi đè ô bên phải dù đang là '-', 'PASS', 'FAIL', 'DATA', 'N/A', ...
     - Với PARAGRAPH inline: luôn ghi đè phần sau 'RESULT:'.
     Trả về True nếu đã thay ở ít nhất một nơi.
@@ -1758,18 +1947,13 @@ def _set_result_value(doc: Document, rating_text: str) -> bool:
 
     replaced = False
 
-    # 1) Ưu tiên tìm theo TABLE có cột "RESULT:"
-    for t in doc.tables:
-        for r in t.rows:
-            cells = r.cells
-            # tìm ô có label "RESULT:" và ô giá trị bên phải
-            for j in range(len(cells) - 1):
-                left_txt = (cells[j].text or "").strip()
-                if re.match(r"(?i)^RESULT\s*:\s*$", left_txt):
-                    right_cell = cells[j + 1]
-                    # luôn ghi đè (kể cả đang PASS/FAIL/DATA hoặc '-')
-                    _set_cell_text_with_style(right_cell, cells[j], rating_text, align_center=True)
-                    replaced = True
+    # 1) Ưu tiên TABLE có ô "RESULT:" -> ô giá trị bên phải
+    tables = doc.tables
+    for ti, i, j in tpl.result_cells:
+        cells = tables[ti].rows[i].cells
+        # luôn ghi đè (kể cả đang PASS/FAIL/DATA hoặc '-')
+        _set_cell_text_with_style(cells[j + 1], cells[j], rating_text, align_center=True)
+        replaced = True
 
     if replaced:
         return True
@@ -1801,49 +1985,23 @@ def _replace_dash_runs(paragraphs, value: str) -> bool:
                 replaced = True
     return replaced
 
-def _process_table(tbl, mapping: dict, overwrite_any: bool) -> bool:
-    """
-    Duyệt một bảng (và các bảng con trong cell) để điền giá trị theo mapping.
-    mapping: keys UPPER như 'REPORT NO.', 'RECEIVED DATE', 'REPORT DATE'
-    overwrite_any hiện tại không dùng nữa, vì ta luôn muốn ghi 1 lần sạch sẽ.
-    """
-    changed = False
-    for row in tbl.rows:
-        cells = row.cells
-        n = len(cells)
-        for ci, cell in enumerate(cells):
-            left_text = _normalize(cell.text)
-            for key, val in mapping.items():
-                if key in left_text:
-                    # chọn ô bên phải ngay cạnh
-                    if ci + 1 < n:
-                        right = cells[ci + 1]
-
-                        # XÓA sạch nội dung ô phải rồi ghi lại 1 lần duy nhất
-                        try:
-                            right.text = ""
-                            while right.paragraphs:
-                                p = right.paragraphs[0]
-                                p._element.getparent().remove(p._element)
-                        except Exception:
-                            pass
-
-                        # dùng style của ô label bên trái (cell) để giữ font/size/bold
-                        _set_cell_text_with_style(right, cell, str(val))
-
-                        changed = True
-
-            # đệ quy các bảng con trong cell (nested tables)
-            for inner in cell.tables:
-                if _process_table(inner, mapping, overwrite_any):
-                    changed = True
-    return changed
+def _write_header_cell(cells, ci, val) -> None:
+    """XÓA sạch ô bên phải ô nhãn cells[ci] rồi ghi val 1 lần (giữ font/size/bold của ô nhãn)."""
+    right = cells[ci + 1]
+    try:
+        right.text = ""
+        while right.paragraphs:
+            p = right.paragraphs[0]
+            p._element.getparent().remove(p._element)
+    except Exception:
+        pass
+    _set_cell_text_with_style(right, cells[ci], str(val))
 
-def _fill_header_fields(doc: Document, data_row: dict, overwrite_any: bool = False) -> bool:
+def _fill_header_fields(doc: Document, tpl, data_row: dict) -> bool:
     """
-    Điền Report No., Received Date, Report Date vào các bảng lồng nhau trong HEADER.
-    - Chỉ ghi đè run dấu '-' để giữ style; fallback ghi thẳng nếu không tìm thấy run '-'.
-    - Duyệt cả primary/first/even headers để tránh miss khi template bật tùy chọn khác nhau.
+    Điền Report No., Received Date, Report Date vào các bảng (kể cả lồng nhau) trong HEADER.
+    - Ô đích tính sẵn trong tpl.header_fields (primary/first/even headers của mọi section).
+    - Xoá sạch ô bên phải nhãn rồi ghi 1 lần, giữ style của ô nhãn.
     Trả về True nếu có thay đổi.
     """
     # Lấy dữ liệu
@@ -1873,21 +2031,13 @@ def _fill_header_fields(doc: Document, data_row: dict, overwrite_any: bool = Fal
     }
 
     changed = False
-    # Duyệt tất cả section headers: primary, first-page, even-page
-    for sec in doc.sections:
-        for hdr in [sec.header, sec.first_page_header, sec.even_page_header]:
-            if hdr is None:
-                continue
-            for tbl in hdr.tables:
-                # Bỏ qua các bảng header nhỏ/dummy (thường chỉ có 1 hàng, 1 cột)
-                if len(tbl.rows) < 2:
-                    continue
-                if len(tbl.columns) < 2:
-                    continue
-
-                if _process_table(tbl, mapping, overwrite_any):
-                    changed = True
-
+    sections = doc.sections
+    for si, attr, path, i, ci, key in tpl.header_fields:
+        tbl = getattr(sections[si], attr).tables[path[0]]
+        for ri, rci, k in path[1:]:
+            tbl = tbl.rows[ri].cells[rci].tables[k]
+        _write_header_cell(tbl.rows[i].cells, ci, mapping[key])
+        changed = True
     return changed
 
 # ======================= Excel path resolution =======================
@@ -1951,6 +2101,47 @@ def _load_excel_df(excel_path_or_name: str):
 
 # ======================= Generic cover fill from Excel =======================
 
+def _prefetch_report_images(report_id: str, template_key: str | None):
+    """
+    Render trước (song song, qua image_cache) các ảnh sắp dán vào report:
+    overview (3 x 2.5 inch), ảnh mục cho cột Photo reference (2 x 2), ảnh step Transit (3 x 2.5).
+    Ảnh đã có trong cache thì bỏ qua -> tạo lại report gần như chỉ đọc bytes có sẵn.
+    """
+    items = [(p, 3, 2.5) for p in _find_overview_images(report_id)]
+    transit = "transit" in (template_key or "").lower()
+    for p in _all_candidate_images(report_id):
+        base = re.sub(r"[^a-z0-9]+", "", os.path.basename(p).lower())
+        if transit and "step" in base:
+            items.append((p, 3, 2.5))
+        elif _extract_muc_and_order_from_name(p)[0]:
+            items.append((p, 2.0, 2.0))
+    try:
+        image_cache.prefetch(items)
+    except Exception as e:
+        print("Prefetch ảnh report lỗi:", e)
+
+def _report_key_col(df) -> str:
+    for name in ["Report #", "Report#", "Report No", "Report no", "Report", "Report_No", "Report_Number"]:
+        if name in df.columns:
+            return name
+    for c in df.columns:
+        if "report" in c.lower():
+            return c
+    raise KeyError("Missing 'Report #' column (or variants) in Excel.")
+
+def load_report_rows(excel_path_or_name: str) -> tuple[dict, list]:
+    """
+    Đọc workbook chính 1 lần -> ({report_id: row}, excel_cols) cho chế độ tạo nhiều report.
+    Report # trùng thì giữ dòng ĐẦU TIÊN (giống fill_cover_from_excel_generic).
+    """
+    df = _load_excel_df(excel_path_or_name)
+    key_col = _report_key_col(df)
+    rows = {}
+    for idx, rid in df[key_col].astype(str).str.strip().items():
+        if rid not in rows:
+            rows[rid] = df.loc[idx]
+    return rows, list(df.columns)
+
 def fill_cover_from_excel_generic(
     template_docx_path: str,
     excel_path_or_name: str,
@@ -1962,25 +2153,25 @@ def fill_cover_from_excel_generic(
         raise FileNotFoundError(f"Template not found: {template_docx_path}")
 
     df = _load_excel_df(excel_path_or_name)
-
-    key_col = None
-    for name in ["Report #", "Report#", "Report No", "Report no", "Report", "Report_No", "Report_Number"]:
-        if name in df.columns:
-            key_col = name
-            break
-    if not key_col:
-        for c in df.columns:
-            if "report" in c.lower():
-                key_col = c
-                break
-    if not key_col:
-        raise KeyError("Missing 'Report #' column (or variants) in Excel.")
+    key_col = _report_key_col(df)
 
     row_df = df.loc[df[key_col].astype(str).str.strip() == str(report_id or "").strip()]
     if row_df.empty:
         raise ValueError(f"Report # not found: {report_id}")
-    row = row_df.iloc[0]
-    excel_cols = list(df.columns)
+    return fill_cover_from_row(template_docx_path, row_df.iloc[0], list(df.columns),
+                               report_id, template_key, generated_by)
+
+def fill_cover_from_row(
+    template_docx_path: str,
+    row,
+    excel_cols: list,
+    report_id: str,
+    template_key: str,
+    generated_by: str | None = None,
+) -> BytesIO:
+    """Fill template từ 1 dòng Excel đã đọc sẵn (dùng chung cho 1 report và chế độ tạo nhiều report)."""
+    if not os.path.exists(template_docx_path):
+        raise FileNotFoundError(f"Template not found: {template_docx_path}")
 
     preferred = {
         "Result:": ["rating", "Rating", "RATING"],
@@ -2053,90 +2244,66 @@ def fill_cover_from_excel_generic(
             return ""
         return str(v).strip()
 
-    doc = Document(template_docx_path)
+    tpl = get_compiled_template(template_docx_path)
+    doc = tpl.new_document()
 
     col_rating = next((c for c in excel_cols if _colnorm(c) == "rating"), "")
     if col_rating:
-        _set_result_value(doc, _val(row, col_rating))
+        _set_result_value(doc, tpl, _val(row, col_rating))
 
-    tbl = _find_result_table(doc)
-    if tbl is None:
+    if tpl.cover_ti is None:
         raise RuntimeError("Cover/RESULT table not found in template.")
+    tbl = doc.tables[tpl.cover_ti]
 
     # Đọc sample info từ comment file
     weight, size = _read_sample_info(report_id)
 
-    for r in tbl.rows:
-        cells = r.cells
-        if len(cells) >= 2:
-            l_label = (cells[0].text or "").strip()
-            if l_label.endswith(":"):
-                # --- CUSTOM: Sample Weight & Size ---
-                label_norm = _norm(re.sub(r"[:\uFF1A]+$", "", l_label))
-
-                if "sample weight" in label_norm:
-                    if weight:
-                        replaced = _replace_dash_runs(cells[1].paragraphs, weight)
-                        if not replaced and _is_placeholder_dash(cells[1].text):
-                            _set_cell_text_with_style(cells[1], cells[0], weight)
-                    continue
-
-                if "sample size" in label_norm:
-                    if size:
-                        replaced = _replace_dash_runs(cells[1].paragraphs, size)
-                        if not replaced and _is_placeholder_dash(cells[1].text):
-                            _set_cell_text_with_style(cells[1], cells[0], size)
-                    continue
+    # nhãn cover (cột 0 -> 1, cột 2 -> 3) tính sẵn trong tpl.cover_rows
+    done_left = set()
+    for i, lc, vc, label, label_norm in tpl.cover_rows:
+        cells = tbl.rows[i].cells
+        if lc == 2 and i in done_left:
+            continue   # giống luồng cũ: sample weight/size bên trái đã 'continue' cả hàng
+
+        # --- CUSTOM: Sample Weight & Size ---
+        if "sample weight" in label_norm or "sample size" in label_norm:
+            v = weight if "sample weight" in label_norm else size
+            if v:
+                replaced = _replace_dash_runs(cells[vc].paragraphs, v)
+                if not replaced and _is_placeholder_dash(cells[vc].text):
+                    _set_cell_text_with_style(cells[vc], cells[lc], v)
+            if lc == 0:
+                done_left.add(i)
+            continue
 
-                # --- Các field khác vẫn lấy từ Excel ---
-                cand = _pick_best_column(excel_cols, l_label, preferred_aliases=preferred.get(l_label))
-                if cand:
-                    cur = (cells[1].text or "").strip()
-                    val = _val(row, cand)
-                    if "generated by" in _norm(l_label):
-                        # Nếu có dạng "19797 - Nguyen Dinh Hoang" thì chỉ lấy phần sau dấu '-'
-                        if "-" in val:
-                            val = val.split("-", 1)[1].strip()
-                        val = remove_diacritics(val)
-                        val = remove_diacritics(val)
-                    _set_cell_text_with_style(cells[1], cells[0], val)
-        if len(cells) >= 4:
-            r_label = (cells[2].text or "").strip()
-            if r_label.endswith(":"):
-                # >>> THÊM KHỐI SAMPLE Ở BÊN PHẢI NGAY ĐÂY <<<
-                r_label_norm = _norm(re.sub(r"[:\uFF1A]+$", "", r_label))
-
-                if "sample weight" in r_label_norm:
-                    if weight:
-                        replaced = _replace_dash_runs(cells[3].paragraphs, weight)
-                        if not replaced and _is_placeholder_dash(cells[3].text):
-                            _set_cell_text_with_style(cells[3], cells[2], weight)
-                    continue  # Đừng rơi xuống Excel mapping
-
-                if "sample size" in r_label_norm:
-                    if size:
-                        replaced = _replace_dash_runs(cells[3].paragraphs, size)
-                        if not replaced and _is_placeholder_dash(cells[3].text):
-                            _set_cell_text_with_style(cells[3], cells[2], size)
-                    continue  # Đừng rơi xuống Excel mapping
-
-                # --- Các field KHÁC bên phải vẫn lấy từ Excel như cũ ---
-                cand = _pick_best_column(excel_cols, r_label, preferred_aliases=preferred.get(r_label))
-                if cand:
-                    cur = (cells[3].text or "").strip()
-                    if _is_placeholder_dash(cur):
-                        _set_cell_text_with_style(cells[3], cells[2], _val(row, cand))
-
-    _insert_overview_images_into_sample_picture(doc, report_id)
+        # --- Các field khác vẫn lấy từ Excel ---
+        cand = _pick_best_column(excel_cols, label, preferred_aliases=preferred.get(label))
+        if not cand:
+            continue
+        if lc == 0:
+            val = _val(row, cand)
+            if "generated by" in label_norm:
+                # Nếu có dạng "19797 - Nguyen Dinh Hoang" thì chỉ lấy phần sau dấu '-'
+                if "-" in val:
+                    val = val.split("-", 1)[1].strip()
+                val = remove_diacritics(val)
+            _set_cell_text_with_style(cells[vc], cells[lc], val)
+        elif _is_placeholder_dash((cells[vc].text or "").strip()):
+            _set_cell_text_with_style(cells[vc], cells[lc], _val(row, cand))
+
+    _prefetch_report_images(report_id, template_key)
+
+    tables = DocTables(doc)
+    _insert_overview_images_into_sample_picture(tables, report_id)
 
     # NEW: Transit – chèn hình step4/5/6 + AFTER TEST (step10)
-    _insert_transit_step_and_after_test_images(doc, report_id, template_key)
+    _insert_transit_step_and_after_test_images(tables, report_id, template_key)
 
-    _fill_header_fields(doc, row)
-    _fill_generated_by_fields(doc, generated_by)
+    _fill_header_fields(doc, tpl, row)
+    _fill_generated_by_fields(doc, tpl, generated_by)
 
-    _update_detail_results_and_comments(doc, report_id, template_key)
-    _update_exec_summary_results_from_status(doc, report_id, template_key)
+    _update_detail_results_and_comments(tables, report_id, template_key)
+    _update_exec_summary_results_from_status(tables, report_id, template_key)
 
     bio = BytesIO()
     doc.save(bio)
@@ -2159,10 +2326,7 @@ def create_report_for_type(report_id: str, template_key: str, excel_path_or_name
     Locate template by TEMPLATE_MAP[template_key] next to app.py, then fill.
     Excel path is flexible: file or directory (auto-pick latest).
     """
-    template_name = TEMPLATE_MAP.get(template_key)
-    if not template_name:
-        raise KeyError(f"Template not found for key: {template_key}")
-    template_path = os.path.join(os.path.dirname(__file__), template_name)
+    template_path = _template_path(template_key)
     return fill_cover_from_excel_generic(
         template_docx_path=template_path,
         excel_path_or_name=excel_path_or_name or local_main,
@@ -2,7 +2,9 @@ import pandas as pd
 import re
 import os
 import datetime
+import threading
 from config import local_main
+from lock_utils import workbook_lock
 from openpyxl import load_workbook, Workbook
 from copy import copy
 from openpyxl.utils import get_column_letter
@@ -97,19 +99,16 @@ def is_img_at_cell(img, row, col):
     return False
 
 # ==============
-# QAD dataframe
+# QAD item code
 # ==============
-try:
-    QAD_DF = pd.read_excel(local_main)
-    QAD_DF.columns = [clean_col(c) for c in QAD_DF.columns]
-except Exception:
-    QAD_DF = pd.DataFrame()
 
 def get_item_code(report):
-    row = QAD_DF.loc[QAD_DF['report#'] == str(report)] if 'report#' in QAD_DF.columns else pd.DataFrame()
-    if not row.empty and 'item#' in QAD_DF.columns:
-        return str(row.iloc[0]['item#'])
-    return ""
+    """Item# của report, đọc qua ReportIndex (luôn theo file mới nhất, không pandas)."""
+    try:
+        v = get_report_index(local_main).get_value(report, "item#")
+    except Exception:
+        return ""
+    return "" if v is None else str(v)
 
 # ==============================
 # Tìm đúng cột/row theo REPORT NO
@@ -177,6 +176,224 @@ def _build_headers_map(ws):
             headers[clean] = col
     return headers
 
+# ==========================================
+# ĐỌC NHANH (read_only + values_only)
+# ==========================================
+
+def _pick_sheet(wb, sheet_names=None):
+    for name in (sheet_names or ()):
+        if name in wb.sheetnames:
+            return wb[name]
+    return wb.active
+
+def iter_sheet_fast(path, sheet_names=None):
+    """
+    Đọc tuần tự 1 sheet ở chế độ read_only + values_only (nhanh nhất của openpyxl).
+    - Yield lần lượt (row_idx, values) với row_idx 1-based (row 1 = header).
+    - sheet_names: danh sách tên sheet ưu tiên, không có thì dùng sheet active.
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = _pick_sheet(wb, sheet_names)
+        for r_idx, values in enumerate(ws.iter_rows(values_only=True), start=1):
+            yield r_idx, values
+    finally:
+        wb.close()
+
+def header_map_from_list(header_names):
+    """{normalize_colname(header): col 1-based} (giữ cột đầu tiên nếu trùng) -> dùng như get_col_idx()."""
+    cols = {}
+    for c, name in enumerate(header_names, start=1):
+        if name:
+            cols.setdefault(normalize_colname(name), c)
+    return cols
+
+def read_sheet_fast(path, sheet_names=None, header_only=False, skip_blank=True):
+    """
+    Đọc cả sheet 1 lượt: trả về (headers, header_map, rows)
+    - headers: list header gốc (cột A = index 0)
+    - header_map: normalize_colname(header) -> col 1-based
+    - rows: list[(row_idx, tuple)] cắt/pad đúng số cột header (skip_blank: bỏ dòng trống hoàn toàn)
+    """
+    headers, rows = [], []
+    for r_idx, values in iter_sheet_fast(path, sheet_names):
+        if r_idx == 1:
+            headers = list(values)
+            if header_only:
+                break
+            continue
+        if skip_blank and not any(v is not None and v != "" for v in values):
+            continue
+        n = len(headers)
+        if len(values) != n:
+            values = tuple(values[:n]) + (None,) * (n - len(values))
+        rows.append((r_idx, values))
+    return headers, header_map_from_list(headers), rows
+
+# ==========================================
+# REPORT INDEX (cache trong RAM, theo mtime)
+# ==========================================
+
+class ReportIndex:
+    """
+    Index dùng chung cho file Excel chính:
+    - report# -> số dòng, giá trị cả dòng, header map.
+    - Build 1 lần (read_only + values_only), chỉ build lại khi mtime/size file thay đổi.
+    - Số dòng trả về khớp với ws.cell(row=...) khi mở file bằng openpyxl để ghi.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._headers = []        # header gốc theo cột (index 0 = cột A)
+        self._header_cols = {}    # normalize_colname(header) -> col (1-based, lấy cột đầu tiên)
+        self._rows = {}           # row_idx -> tuple giá trị
+        self._by_text = {}        # _norm_str(report) -> row_idx
+        self._by_num = {}         # _as_int_like(report) -> row_idx
+        self._report_col = 2
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _build(self, stamp):
+        headers, header_cols, rows, by_text, by_num = [], {}, {}, {}, {}
+        report_col = 2
+        if stamp is not None:
+            with workbook_lock(self.path, shared=True):
+                rows_iter = list(iter_sheet_fast(self.path))
+            for r_idx, values in rows_iter:
+                if r_idx == 1:
+                    headers = list(values)
+                    header_cols = header_map_from_list(headers)
+                    report_col = _report_col_from_headers(headers)
+                    continue
+                rows[r_idx] = values
+                v = values[report_col - 1] if len(values) >= report_col else None
+                if v is None:
+                    continue
+                txt = _norm_str(v)
+                if txt:
+                    by_text.setdefault(txt, r_idx)
+                num = _as_int_like(v)
+                if num is not None:
+                    by_num.setdefault(num, r_idx)
+        self._headers, self._header_cols = headers, header_cols
+        self._rows, self._by_text, self._by_num = rows, by_text, by_num
+        self._report_col = report_col
+        self._stamp = stamp
+
+    def refresh(self, force=False):
+        """Build lại nếu file đổi (mtime/size) hoặc force=True."""
+        stamp = self._file_stamp()
+        if not force and stamp == self._stamp and self._stamp is not None:
+            return self
+        with self._lock:
+            stamp = self._file_stamp()
+            if force or stamp != self._stamp or self._stamp is None:
+                self._build(stamp)
+        return self
+
+    def invalidate(self):
+        self._stamp = None
+
+    # ---- truy vấn ----
+    @property
+    def headers(self):
+        self.refresh()
+        return list(self._headers)
+
+    @property
+    def report_col(self):
+        self.refresh()
+        return self._report_col
+
+    def col(self, target):
+        """Cột (1-based) theo tên header, so khớp như get_col_idx()."""
+        self.refresh()
+        return self._header_cols.get(normalize_colname(target))
+
+    def find_row(self, report_no):
+        """Số dòng Excel của report (so khớp mạnh: text trước, số sau); None nếu không có."""
+        self.refresh()
+        if report_no is None:
+            return None
+        r = self._by_text.get(_norm_str(report_no))
+        if r is None:
+            num = _as_int_like(report_no)
+            if num is not None:
+                r = self._by_num.get(num)
+        return r
+
+    def row_values(self, row_idx):
+        self.refresh()
+        return self._rows.get(row_idx)
+
+    def get_value(self, report_no, target, default=None):
+        row_idx = self.find_row(report_no)
+        c = self.col(target)
+        if row_idx is None or c is None:
+            return default
+        values = self._rows.get(row_idx) or ()
+        return values[c - 1] if len(values) >= c else default
+
+    def get_row(self, report_no):
+        """Dict {header gốc: value} của dòng report; None nếu không có."""
+        row_idx = self.find_row(report_no)
+        if row_idx is None:
+            return None
+        return self.row_dict(row_idx)
+
+    def row_dict(self, row_idx):
+        values = self.row_values(row_idx) or ()
+        out = {}
+        for c, name in enumerate(self._headers):
+            if name and name not in out:
+                out[name] = values[c] if c < len(values) else None
+        return out
+
+    def iter_rows(self):
+        """Yield (row_idx, values) theo thứ tự dòng, bỏ header."""
+        self.refresh()
+        rows = self._rows
+        for r_idx in sorted(rows):
+            yield r_idx, rows[r_idx]
+
+
+def _report_col_from_headers(headers):
+    """Giống _find_report_col() nhưng chạy trên list header (fallback cột B)."""
+    candidates = {"report#", "reportno", "reportnumber", "report"}
+    for c, name in enumerate(headers, start=1):
+        if not name:
+            continue
+        n = re.sub(r'[^a-z0-9#]+', '', str(name).strip().lower())
+        if (
+            n in candidates
+            or n.startswith("report")
+            or ("report" in n and ("no" in n or "#" in n))
+        ):
+            return c
+    return 2
+
+_REPORT_INDEXES = {}
+_REPORT_INDEXES_LOCK = threading.Lock()
+
+def get_report_index(path=None):
+    """Lấy ReportIndex dùng chung toàn process cho file Excel (mặc định local_main)."""
+    key = os.path.abspath(path or local_main)
+    idx = _REPORT_INDEXES.get(key)
+    if idx is None:
+        with _REPORT_INDEXES_LOCK:
+            idx = _REPORT_INDEXES.get(key)
+            if idx is None:
+                idx = ReportIndex(key)
+                _REPORT_INDEXES[key] = idx
+    return idx.refresh()
+
 def _set_by_keywords(ws, row_idx, headers, keywords, value):
     """
     Ghi value vào cột có header thỏa mãn tất cả từ khóa (match mềm, lowercase, bỏ dấu câu).
@@ -239,28 +456,59 @@ def _set_date_by_keywords(ws, row_idx, headers, keywords, value, fmt='dd-mmm'):
 # GHI DỮ LIỆU VÀO ĐÚNG HÀNG
 # =========================
 
-def write_tfr_to_excel(excel_path, report_no, request):
-    """
-    Ghi dữ liệu vào **ĐÚNG HÀNG** có REPORT NO == report_no.
-    - KHÔNG tự +1.
-    - Tìm cột bằng header 'report' & 'no' (fallback B).
-    - Ghi theo 'match mềm' header (từ khoá).
-    - ĐẶC BIỆT:
-        * "Log in date" = request["log_in_date"] hoặc request["request_date"] (định dạng dd-mmm)
-        * ETD điền vào cột "ETD"/"Estimated Completion Date"/"Estimated Completed Date" (tùy header)
-    """
-    wb = load_workbook(excel_path, data_only=True)
-    ws = wb.active
+def _headers_map_from_list(header_names):
+    """Như _build_headers_map() nhưng chạy trên list header (ReportIndex.headers)."""
+    headers = {}
+    for col, name in enumerate(header_names, start=1):
+        if name:
+            clean = (
+                str(name)
+                .strip()
+                .replace('\n', ' ')
+                .replace('/', ' ')
+                .replace('.', '')
+                .replace('#', '')
+                .lower()
+            )
+            clean = " ".join(clean.split())
+            headers[clean] = col
+    return headers
 
-    # 1) Tìm cột REPORT NO và hàng tương ứng
-    report_col = _find_report_col(ws)
-    row_idx = _find_row_by_report(ws, report_no, report_col)
-    if row_idx is None:
-        wb.close()
-        raise Exception(f"Không tìm thấy mã report {report_no} trong file excel!")
+def _match_col(headers, keywords):
+    """Cột đầu tiên có header chứa đủ các từ khoá (giống _set_by_keywords)."""
+    kws = [w.lower() for w in keywords]
+    for h_clean, col_idx in headers.items():
+        if all(word in h_clean for word in kws):
+            return col_idx
+    return None
 
-    # 2) Chuẩn bị headers map
-    headers = _build_headers_map(ws)
+def _put_by_keywords(updates, headers, keywords, value, fmt=None):
+    """Bản 'gom thay đổi' của _set_by_keywords: ghi vào dict updates {col: (value, fmt)}."""
+    if value is None or value == "":
+        return False
+    col = _match_col(headers, keywords)
+    if col is None:
+        return False
+    updates[col] = (value, fmt)
+    return True
+
+def _put_date_by_keywords(updates, headers, keywords, value, fmt='dd-mmm'):
+    dt = _to_excel_date(value)
+    if dt is None:
+        return _put_by_keywords(updates, headers, keywords, value)
+    return _put_by_keywords(updates, headers, keywords, dt, fmt)
+
+def build_tfr_row_updates(header_names, request):
+    """
+    Tính các ô cần ghi cho 1 TFR (không mở workbook):
+    trả về dict {col: (value, number_format|None)} theo đúng luật match mềm của write_tfr_to_excel.
+    """
+    headers = _headers_map_from_list(header_names)
+    norm_cols = {}
+    for col, name in enumerate(header_names, start=1):
+        if name:
+            norm_cols.setdefault(normalize_colname(name), col)
+    updates = {}
 
     def to_upper(val):
         return val.upper() if isinstance(val, str) else val
@@ -272,17 +520,12 @@ def write_tfr_to_excel(excel_path, report_no, request):
     else:
         type_of_val = test_group_val
 
-    # 3) Ghi TRQ-ID nếu có cột tương ứng
-    trq_col = (
-        get_col_idx(ws, "trq-id")
-        or get_col_idx(ws, "trq_id")
-        or get_col_idx(ws, "trq id")
-        or get_col_idx(ws, "trqid")
-    )
+    # TRQ-ID nếu có cột tương ứng
+    trq_col = norm_cols.get("trqid")
     if trq_col:
-        ws.cell(row=row_idx, column=trq_col).value = request.get("trq_id", "")
+        updates[trq_col] = (request.get("trq_id", ""), None)
 
-    # 4) Ghi các trường mô tả chính theo match mềm
+    # Các trường mô tả chính theo match mềm
     fields_map = [
         (["item"], to_upper(request.get("item_code", ""))),
         (["type of"], to_upper(type_of_val)),
@@ -293,43 +536,260 @@ def write_tfr_to_excel(excel_path, report_no, request):
         (["remark"], to_upper(request.get("test_status", ""))),
     ]
     for keys, val in fields_map:
-        _set_by_keywords(ws, row_idx, headers, keys, val)
+        _put_by_keywords(updates, headers, keys, val)
 
-    # 5) Các cột tuỳ chọn: priority, ETD/Estimated, QR link (Y=25) nếu có
-    # 5.1 Priority (nếu có trong request)
+    # Priority (nếu có trong request)
     if "priority" in request:
-        _set_by_keywords(ws, row_idx, headers, ["priority"], to_upper(request.get("priority")))
+        _put_by_keywords(updates, headers, ["priority"], to_upper(request.get("priority")))
 
-    # 5.2 ETD / Estimated Completion/Completed Date
+    # ETD / Estimated Completion/Completed Date
     etd_val = request.get("etd") or request.get("estimated_completion_date")
-    wrote_etd = (
-        _set_by_keywords(ws, row_idx, headers, ["etd"], etd_val) or
-        _set_by_keywords(ws, row_idx, headers, ["estimated", "completion", "date"], etd_val) or
-        _set_by_keywords(ws, row_idx, headers, ["estimated", "completed", "date"], etd_val)
+    (
+        _put_by_keywords(updates, headers, ["etd"], etd_val) or
+        _put_by_keywords(updates, headers, ["estimated", "completion", "date"], etd_val) or
+        _put_by_keywords(updates, headers, ["estimated", "completed", "date"], etd_val)
     )
 
-    # 5.3 Log in date = request["log_in_date"] hoặc request["request_date"] => ghi với number_format dd-mmm
+    # Log in date = request["log_in_date"] hoặc request["request_date"] => number_format dd-mmm
     login_date_val = request.get("log_in_date") or request.get("request_date")
-    _set_date_by_keywords(ws, row_idx, headers, ["log", "in", "date"], login_date_val, fmt='dd-mmm') or \
-        _set_date_by_keywords(ws, row_idx, headers, ["login", "date"], login_date_val, fmt='dd-mmm')
+    _put_date_by_keywords(updates, headers, ["log", "in", "date"], login_date_val, fmt='dd-mmm') or \
+        _put_date_by_keywords(updates, headers, ["login", "date"], login_date_val, fmt='dd-mmm')
 
-    # 5.4 QR link (cột Y=25) nếu backend có set
+    # QR link (cột Y=25) nếu backend có set
     if "qr_link" in request:
-        ws.cell(row=row_idx, column=25).value = str(request["qr_link"])
+        updates[25] = (str(request["qr_link"]), None)
 
-    wb.save(excel_path)
-    wb.close()
+    return updates
 
-def append_row_to_trf(report_no, main_excel_path, trf_excel_path, trq_id=None):
-    wb_main = load_workbook(main_excel_path, data_only=True)
-    ws_main = wb_main.active
+def apply_row_updates(excel_path, row_updates):
+    """
+    Ghi nhiều dòng trong 1 lần mở/lưu workbook.
+    row_updates: {row_idx: {col: (value, number_format|None)}}
+    Dùng xlsx_patch (sửa XML) trước, layout lạ thì fallback openpyxl.
+    """
+    if not row_updates:
+        return
+    with workbook_lock(excel_path):
+        # Ưu tiên sửa thẳng XML các dòng cần ghi (không load/save cả workbook)
+        try:
+            from xlsx_patch import patch_xlsx_rows
+            patch_xlsx_rows(excel_path, row_updates)
+            get_report_index(excel_path).invalidate()
+            return
+        except Exception as e:
+            print("XML patch không dùng được, ghi bằng openpyxl:", e)
+        wb = load_workbook(excel_path)
+        try:
+            ws = wb.active
+            for row_idx, updates in row_updates.items():
+                for col, (value, fmt) in updates.items():
+                    cell = ws.cell(row=row_idx, column=col)
+                    cell.value = value
+                    if fmt:
+                        cell.number_format = fmt
+            wb.save(excel_path)
+        finally:
+            wb.close()
+    get_report_index(excel_path).invalidate()
+
+def _commit_rows(excel_path, rows):
+    """
+    rows: list[(report_no, row_idx, updates)]
+    - Có SQLite mirror (report_db) -> ghi SQLite trước (1 transaction), exporter ghi ra Excel sau.
+    - Không có -> ghi thẳng Excel (1 lần mở/lưu).
+    """
+    if not rows:
+        return
+    try:
+        import report_db
+        if report_db.enabled_for(excel_path):
+            report_db.upsert_rows(rows)
+            report_db.request_export()
+            return
+    except Exception as e:
+        print("report_db write lỗi, ghi thẳng Excel:", e)
+    row_updates = {}
+    for _, row_idx, updates in rows:
+        row_updates.setdefault(row_idx, {}).update(updates)
+    apply_row_updates(excel_path, row_updates)
+
+def commit_row_updates(excel_path, report_no, row_idx, updates, batch=None):
+    """
+    Điểm ghi chung cho 1 dòng report.
+    Nếu có batch (ExcelCommitBatch) thì chỉ gom lại, batch.flush() mới ghi.
+    """
+    if not updates:
+        return
+    if batch is not None:
+        batch.add_row(report_no, row_idx, updates)
+        return
+    _commit_rows(excel_path, [(report_no, row_idx, updates)])
 
-    # Tìm dòng theo REPORT NO (so khớp mạnh)
-    report_col = _find_report_col(ws_main)
-    row_idx = _find_row_by_report(ws_main, report_no, report_col)
+# ======================================
+# BATCH: gom thay đổi Excel của 1 đợt duyệt
+# ======================================
+
+_OPEN_BATCHES = set()
+_OPEN_BATCHES_LOCK = threading.Lock()
+
+class ExcelCommitBatch:
+    """
+    Gom mọi thay đổi Excel (local_main + TRF.xlsx) của 1 đợt approve, ghi 1 lần mỗi workbook
+    khi flush() (người gọi quyết định lúc nào flush).
+    Trong lúc chưa flush, report đã gom được coi là "đã dùng" (is_report_in_open_batch).
+    Ghi lỗi -> phần chưa ghi được trả lại batch (flush lần sau ghi lại), không bị mất.
+    """
+
+    def __init__(self, excel_path):
+        self.excel_path = excel_path
+        self._rows = {}          # row_idx -> [report_no, updates]
+        self._trf = []           # [(report_no, trf_path, trq_id)]
+        self._reports = set()    # _norm_str(report_no) đang chờ ghi
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with _OPEN_BATCHES_LOCK:
+            _OPEN_BATCHES.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.flush()
+        finally:
+            with _OPEN_BATCHES_LOCK:
+                _OPEN_BATCHES.discard(self)
+        return False
+
+    def add_row(self, report_no, row_idx, updates):
+        with self._lock:
+            entry = self._rows.setdefault(row_idx, [report_no, {}])
+            entry[1].update(updates)
+            self._reports.add(_norm_str(report_no))
+
+    def add_trf(self, report_no, trf_path, trq_id=None):
+        with self._lock:
+            self._trf.append((report_no, trf_path, trq_id))
+            self._reports.add(_norm_str(report_no))
+
+    def has_report(self, report_no):
+        return _norm_str(report_no) in self._reports
+
+    def _refresh_reports(self):
+        self._reports = {_norm_str(r) for r, _ in self._rows.values()} | {_norm_str(t[0]) for t in self._trf}
+
+    def _restore(self, rows, trf):
+        """Trả phần chưa ghi được về batch; update gom sau (mới hơn) được ưu tiên."""
+        with self._lock:
+            for rep, row_idx, upd in rows:
+                entry = self._rows.get(row_idx)
+                if entry is None:
+                    self._rows[row_idx] = [rep, dict(upd)]
+                else:
+                    merged = dict(upd)
+                    merged.update(entry[1])
+                    entry[1] = merged
+            self._trf = list(trf) + self._trf
+            self._refresh_reports()
+
+    def flush(self):
+        with self._lock:
+            rows = [(rep, row_idx, upd) for row_idx, (rep, upd) in self._rows.items()]
+            trf = list(self._trf)
+            self._rows, self._trf = {}, []
+        try:
+            _commit_rows(self.excel_path, rows)
+        except BaseException:
+            self._restore(rows, trf)
+            raise
+        committed = []
+        try:
+            _commit_trf_rows(self.excel_path, trf, committed)
+        except BaseException:
+            done_ids = {id(t) for t in committed}
+            self._restore([], [t for t in trf if id(t) not in done_ids])
+            raise
+        with self._lock:
+            self._refresh_reports()
+        return len(rows)
+
+def is_report_in_open_batch(report_no):
+    with _OPEN_BATCHES_LOCK:
+        return any(b.has_report(report_no) for b in _OPEN_BATCHES)
+
+def _commit_trf_rows(main_excel_path, items, committed=None):
+    """
+    items: [(report_no, trf_path, trq_id)] -> hàng đợi report_db hoặc append 1 lần mỗi file TRF.
+    committed: list (tuỳ chọn) nhận các item đã ghi xong -> lỗi giữa chừng biết phần nào cần ghi lại.
+    """
+    if not items:
+        return
+    if committed is None:
+        committed = []
+    try:
+        import report_db
+        if report_db.enabled_for(main_excel_path):
+            for item in items:
+                report_no, trf_path, trq_id = item
+                report_db.queue_trf_append(report_no, trf_path, trq_id=trq_id)
+                committed.append(item)
+            return
+    except Exception as e:
+        print("report_db queue TRF lỗi, ghi thẳng Excel:", e)
+    done_ids = {id(t) for t in committed}
+    by_path = {}
+    for item in items:
+        if id(item) not in done_ids:      # đã vào hàng đợi report_db -> không append lần nữa
+            by_path.setdefault(item[1], []).append(item)
+    for trf_path, group in by_path.items():
+        append_rows_to_trf([t[0] for t in group], main_excel_path, trf_path)
+        committed.extend(group)
+
+def queue_trf_row(report_no, main_excel_path, trf_excel_path, trq_id=None, batch=None):
+    """Append 1 dòng sang TRF.xlsx qua batch / report_db / ghi thẳng (tuỳ chế độ)."""
+    if batch is not None:
+        batch.add_trf(report_no, trf_excel_path, trq_id)
+        return
+    _commit_trf_rows(main_excel_path, [(report_no, trf_excel_path, trq_id)])
+
+def write_tfr_to_excel(excel_path, report_no, request):
+    """
+    Ghi dữ liệu vào **ĐÚNG HÀNG** có REPORT NO == report_no.
+    - KHÔNG tự +1.
+    - Tìm cột bằng header 'report' & 'no' (fallback B).
+    - Ghi theo 'match mềm' header (từ khoá).
+    - ĐẶC BIỆT:
+        * "Log in date" = request["log_in_date"] hoặc request["request_date"] (định dạng dd-mmm)
+        * ETD điền vào cột "ETD"/"Estimated Completion Date"/"Estimated Completed Date" (tùy header)
+    """
+    # 1) Tìm hàng tương ứng qua ReportIndex (không quét lại cả cột)
+    idx = get_report_index(excel_path)
+    row_idx = idx.find_row(report_no)
     if row_idx is None:
-        wb_main.close()
+        raise Exception(f"Không tìm thấy mã report {report_no} trong file excel!")
+
+    # 2) Tính các ô cần ghi rồi ghi qua điểm ghi chung
+    updates = build_tfr_row_updates(idx.headers, request)
+    commit_row_updates(excel_path, report_no, row_idx, updates)
+
+def append_row_to_trf(report_no, main_excel_path, trf_excel_path, trq_id=None):
+    append_rows_to_trf([report_no], main_excel_path, trf_excel_path)
+
+def append_rows_to_trf(report_nos, main_excel_path, trf_excel_path):
+    """
+    Copy (kèm style) các dòng report_nos từ file chính sang TRF.xlsx: mở/lưu mỗi file 1 lần.
+    Report đã có trong TRF.xlsx thì bỏ qua (resume job / exporter ghi lại sau khi chết giữa chừng).
+    """
+    # Tìm dòng theo REPORT NO (so khớp mạnh) qua ReportIndex, không có thì khỏi mở file
+    idx = get_report_index(main_excel_path)
+    row_idxs = [r for r in (idx.find_row(rep) for rep in report_nos) if r is not None]
+    if not row_idxs:
         return
+    with workbook_lock(main_excel_path, shared=True), workbook_lock(trf_excel_path):
+        _copy_rows_to_trf(main_excel_path, trf_excel_path, row_idxs)
+
+def _copy_rows_to_trf(main_excel_path, trf_excel_path, row_idxs):
+    wb_main = load_workbook(main_excel_path, data_only=True)
+    ws_main = wb_main.active
 
     # Nếu chưa có file TRF thì tạo mới, copy FULL header layout
     if not os.path.exists(trf_excel_path):
@@ -356,21 +816,38 @@ def append_row_to_trf(report_no, main_excel_path, trf_excel_path, trq_id=None):
     wb_trf = load_workbook(trf_excel_path)
     ws_trf = wb_trf.active
 
-    to_row = ws_trf.max_row + 1
-    for col in range(1, ws_main.max_column + 1):
-        c1 = ws_main.cell(row=row_idx, column=col)
-        c2 = ws_trf.cell(row=to_row, column=col)
-        c2.value = c1.value
-        if c1.has_style:
-            c2.font = copy(c1.font)
-            c2.border = copy(c1.border)
-            c2.fill = copy(c1.fill)
-            c2.number_format = c1.number_format
-            c2.protection = copy(c1.protection)
-            c2.alignment = copy(c1.alignment)
+    # report đã có trong TRF -> không append lần nữa
+    report_col = _find_report_col(ws_main)
+    existing = {_norm_str(v) for (v,) in ws_trf.iter_rows(min_row=2, min_col=report_col, max_col=report_col,
+                                                          values_only=True) if v not in (None, "")}
+    new_rows = []
+    for row_idx in row_idxs:
+        key = _norm_str(ws_main.cell(row=row_idx, column=report_col).value)
+        if key and key in existing:
+            continue
+        existing.add(key)
+        new_rows.append(row_idx)
+    if not new_rows:
+        wb_trf.close()
+        wb_main.close()
+        return
+
+    for row_idx in new_rows:
+        to_row = ws_trf.max_row + 1
+        for col in range(1, ws_main.max_column + 1):
+            c1 = ws_main.cell(row=row_idx, column=col)
+            c2 = ws_trf.cell(row=to_row, column=col)
+            c2.value = c1.value
+            if c1.has_style:
+                c2.font = copy(c1.font)
+                c2.border = copy(c1.border)
+                c2.fill = copy(c1.fill)
+                c2.number_format = c1.number_format
+                c2.protection = copy(c1.protection)
+                c2.alignment = copy(c1.alignment)
+        # Copy chiều cao cho chắc
+        ws_trf.row_dimensions[to_row].height = ws_main.row_dimensions[row_idx].height
 
-    # Copy chiều cao & width cho chắc
-    ws_trf.row_dimensions[to_row].height = ws_main.row_dimensions[row_idx].height
     for col in range(1, ws_main.max_column + 1):
         col_letter = get_column_letter(col)
         ws_trf.column_dimensions[col_letter].width = ws_main.column_dimensions[col_letter].width
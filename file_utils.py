@@ -1,6 +1,14 @@
 import json
 import os
+import gzip
+import time
+import atexit
+import shutil
+import threading
 import openpyxl
+from datetime import datetime
+from lock_utils import workbook_lock, named_lock
+from config import JOURNAL_MAX_BYTES, JOURNAL_FSYNC_EVERY, JOURNAL_FSYNC_INTERVAL, JOURNAL_GZIP
 
 # =========================
 # Internal helpers
@@ -67,26 +75,208 @@ def safe_write_json(path, data):
 
 def safe_append_backup_json(path, new_records):
     """
-    Append-only vào FILE BACKUP (…_backup.json) cạnh file chính.
-    - Không bao giờ xoá/sửa dữ liệu backup; chỉ nối thêm bản ghi mới.
+    Append-only vào journal backup (…_backup.jsonl) cạnh file chính.
+    - Giữ tên hàm cũ cho các chỗ đang gọi; thực chất là journal_append(path, new_records).
     - 'new_records' có thể là 1 dict hoặc list[dict].
-    - Nếu backup chưa tồn tại -> tạo mới dạng list.
     """
-    bak = _backup_path(path)
-    os.makedirs(os.path.dirname(bak) or ".", exist_ok=True)
+    journal_append(path, new_records)
 
-    cur = safe_read_json(bak, default=[])
-    if not isinstance(cur, list):
-        # Nếu file backup hiện tại không phải list (bị thay đổi từ trước),
-        # vẫn đảm bảo an toàn bằng cách chuyển về list.
-        cur = []
 
-    if isinstance(new_records, list):
-        cur.extend(new_records)
-    else:
-        cur.append(new_records)
+# =========================
+# Journal JSONL (append-only, thay cho đọc/ghi lại cả …_backup.json)
+# - Segment đang ghi: x_backup.jsonl, mỗi dòng 1 record; append O(1).
+# - fsync gom: sau JOURNAL_FSYNC_EVERY record hoặc chậm nhất JOURNAL_FSYNC_INTERVAL giây.
+# - Vượt JOURNAL_MAX_BYTES -> đổi tên thành x_backup.<thời điểm>.jsonl, nén .gz nếu JOURNAL_GZIP.
+# - x_backup.json cũ (dạng list) giữ nguyên, đọc lại như phần đầu lịch sử.
+# =========================
+
+_JOURNALS = {}
+_JOURNALS_LOCK = threading.Lock()
+
+
+def _journal_active(path: str) -> str:
+    return os.path.splitext(_backup_path(path))[0] + ".jsonl"
+
+
+def journal_segments(path):
+    """Các segment đã đóng (cũ -> mới), rồi tới segment đang ghi (nếu có)."""
+    active = _journal_active(path)
+    folder = os.path.dirname(active) or "."
+    prefix = os.path.basename(active)[:-len(".jsonl")] + "."
+    closed = []
+    try:
+        for name in os.listdir(folder):
+            if name == os.path.basename(active):
+                continue
+            if name.startswith(prefix) and (name.endswith(".jsonl") or name.endswith(".jsonl.gz")):
+                closed.append(os.path.join(folder, name))
+    except FileNotFoundError:
+        pass
+    closed.sort()
+    if os.path.exists(active):
+        closed.append(active)
+    return closed
+
+
+class _Journal:
+    def __init__(self, path):
+        self.active = _journal_active(path)
+        self.lock_name = "journal_" + os.path.basename(self.active)
+        self._lock = threading.Lock()
+        self._f = None
+        self._ino = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._timer = None
+
+    def _open(self):
+        # process khác có thể đã xoay segment -> mở lại file đang ghi
+        if self._f is not None:
+            try:
+                # nlink == 0: segment cũ đã bị nén + xoá (inode có thể bị file mới dùng lại)
+                if os.fstat(self._f.fileno()).st_nlink and os.stat(self.active).st_ino == self._ino:
+                    return self._f
+            except OSError:
+                pass
+            self._close()
+        os.makedirs(os.path.dirname(self.active) or ".", exist_ok=True)
+        self._f = open(self.active, "a", encoding="utf-8")
+        self._ino = os.fstat(self._f.fileno()).st_ino
+        return self._f
+
+    def _close(self):
+        if self._f is not None:
+            try:
+                self._sync()
+                self._f.close()
+            except Exception:
+                pass
+            self._f = None
+
+    def _sync(self):
+        if self._f is None or not self._unsynced:
+            return
+        try:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        except Exception:
+            pass
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _schedule_sync(self):
+        if self._timer is None:
+            self._timer = threading.Timer(JOURNAL_FSYNC_INTERVAL, self._timer_sync)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timer_sync(self):
+        with self._lock:
+            self._timer = None
+            self._sync()
+
+    def _rotate(self):
+        """Đóng segment đang ghi khi vượt ngưỡng; đổi tên (+ gzip)."""
+        self._close()
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        closed = self.active[:-len(".jsonl")] + f".{stamp}.jsonl"
+        try:
+            os.replace(self.active, closed)
+        except OSError as e:
+            # Windows: process khác còn mở file -> để lần sau
+            print("Xoay journal lỗi:", e)
+            return
+        if JOURNAL_GZIP:
+            try:
+                with open(closed, "rb") as src, gzip.open(closed + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(closed)
+            except Exception as e:
+                print("Nén journal lỗi:", e)
+
+    def append(self, records):
+        lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        if not lines:
+            return
+        with self._lock, named_lock(self.lock_name):
+            f = self._open()
+            f.write(lines)
+            f.flush()
+            self._unsynced += len(records)
+            if (self._unsynced >= JOURNAL_FSYNC_EVERY
+                    or time.monotonic() - self._last_sync >= JOURNAL_FSYNC_INTERVAL):
+                self._sync()
+            else:
+                self._schedule_sync()
+            if f.tell() >= JOURNAL_MAX_BYTES:
+                self._rotate()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+
+def _journal(path):
+    key = os.path.abspath(path)
+    with _JOURNALS_LOCK:
+        j = _JOURNALS.get(key)
+        if j is None:
+            j = _JOURNALS[key] = _Journal(path)
+        return j
+
+
+def journal_append(path, new_records):
+    """Append 1 dict hoặc list[dict] vào journal của 'path' (O(1), không đọc lại lịch sử)."""
+    records = new_records if isinstance(new_records, list) else [new_records]
+    _journal(path).append(records)
+
+
+def journal_sync(path=None):
+    """fsync ngay journal của 'path' (None = tất cả); tự gọi khi thoát process."""
+    with _JOURNALS_LOCK:
+        items = list(_JOURNALS.values()) if path is None else [_JOURNALS.get(os.path.abspath(path))]
+    for j in items:
+        if j is not None:
+            j.sync()
+
+
+atexit.register(journal_sync)
+
+
+def iter_journal(path, include_legacy=True):
+    """
+    Đọc lại toàn bộ lịch sử backup của 'path' theo dạng stream (không nạp hết vào RAM):
+    x_backup.json cũ (nếu có) -> các segment đã đóng (.jsonl / .jsonl.gz) -> segment đang ghi.
+    Dòng hỏng (ví dụ đang ghi dở) bị bỏ qua.
+    """
+    if include_legacy:
+        legacy = safe_read_json(_backup_path(path), default=[])
+        if isinstance(legacy, list):
+            for rec in legacy:
+                yield rec
+    for seg in journal_segments(path):
+        opener = gzip.open if seg.endswith(".gz") else open
+        try:
+            with opener(seg, "rt", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except OSError as e:
+            print("Đọc journal lỗi:", seg, e)
+
 
-    _atomic_write(bak, json.dumps(cur, ensure_ascii=False, indent=2))
+def replay_journal(path, apply, include_legacy=True):
+    """Gọi apply(record) cho từng record trong lịch sử; trả về số record đã replay."""
+    n = 0
+    for rec in iter_journal(path, include_legacy=include_legacy):
+        apply(rec)
+        n += 1
+    return n
 
 
 # =========================
@@ -128,5 +318,7 @@ def safe_save_excel(wb, path):
     """
     Lưu workbook Excel. Giữ nguyên hành vi mặc định (không backup) để tránh
     xung đột với openpyxl khi replace file đang mở bởi tiến trình khác.
+    Giữ workbook_lock (exclusive) trong lúc ghi.
     """
-    wb.save(path)
+    with workbook_lock(path):
+        wb.save(path)
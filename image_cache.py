@@ -0,0 +1,216 @@
+import os
+import hashlib
+import tempfile
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from config import (IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_DPI, IMAGE_CACHE_FORMAT,
+                    IMAGE_CACHE_QUALITY, IMAGE_CACHE_WORKERS)
+
+# =====================================================
+# Cache ảnh đã xoay EXIF + thu nhỏ để dán vào report (thay cho mở ảnh gốc + encode PNG mỗi lần tạo report)
+# - Key = (đường dẫn tuyệt đối, inode, mtime, size của ảnh gốc, kích thước inch, DPI, định dạng, quality)
+#   -> ảnh gốc đổi / cấu hình đổi thì tự ra key mới, không cần xoá cache
+#   (inode: ảnh là hardlink blob mang mtime cũ, đổi sang blob khác thì mtime có thể không tăng).
+# - Lưu ở IMAGE_CACHE_DIR/<2 ký tự đầu key>/<key>.img (JPEG; ảnh có nền trong suốt giữ PNG).
+# - Ghi file tạm rồi os.replace -> nhiều thread / process (pool DOCX) cùng ghi vẫn an toàn.
+# - LRU theo tổng dung lượng: hit thì "chạm" mtime file cache; vượt IMAGE_CACHE_MAX_BYTES thì xoá
+#   file lâu chưa dùng nhất tới còn ~90%.
+# - prefetch(): decode/resize các ảnh chưa có trong cache song song bằng thread pool.
+# =====================================================
+
+_VERSION = "1"     # đổi khi đổi cách render -> cache cũ tự bỏ qua
+_SUFFIX = ".img"
+
+_LOCK = threading.Lock()
+_TOTAL = None      # tổng byte trong cache (process này ước lượng; quét lại khi dọn)
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _enabled():
+    return bool(IMAGE_CACHE_DIR) and IMAGE_CACHE_MAX_BYTES > 0
+
+
+def _box_px(width_in, height_in, dpi):
+    return max(1, int(width_in * dpi)), max(1, int(height_in * dpi))
+
+
+def cache_key(path, width_in, height_in, dpi=None, fmt=None, quality=None):
+    """Key của ảnh đã resize; None nếu ảnh gốc không đọc được."""
+    dpi = dpi or IMAGE_CACHE_DPI
+    fmt = (fmt or IMAGE_CACHE_FORMAT).upper()
+    quality = quality or IMAGE_CACHE_QUALITY
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    raw = "|".join(str(x) for x in (
+        os.path.normcase(os.path.abspath(path)), st.st_ino, st.st_mtime_ns, st.st_size,
+        width_in, height_in, dpi, fmt, quality, _VERSION))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _cache_path(key):
+    return os.path.join(IMAGE_CACHE_DIR, key[:2], key + _SUFFIX)
+
+
+def _render(path, width_in, height_in, dpi, fmt, quality):
+    """Mở ảnh, xoay theo EXIF, resize đúng khung (inch x DPI) và encode -> bytes."""
+    w, h = _box_px(width_in, height_in, dpi)
+    with Image.open(path) as im:
+        # JPEG: decode thẳng ở độ phân giải nhỏ (nhanh hơn nhiều so với decode full rồi resize)
+        side = max(w, h)
+        try:
+            im.draft("RGB", (side, side))
+        except Exception:
+            pass
+        img = ImageOps.exif_transpose(im)
+        img = img.resize((w, h))
+
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    buf = BytesIO()
+    if fmt == "JPEG" and not has_alpha:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(buf, format="JPEG", quality=quality, optimize=True)
+    else:
+        img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def _read_hit(fp):
+    try:
+        with open(fp, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        os.utime(fp, None)     # LRU: đánh dấu vừa dùng
+    except OSError:
+        pass
+    return data or None
+
+
+def _store(key, data):
+    global _TOTAL
+    fp = _cache_path(key)
+    d = os.path.dirname(fp)
+    try:
+        os.makedirs(d, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=d)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, fp)
+    except OSError as e:
+        print("Ghi image cache lỗi:", e)
+        return
+    with _LOCK:
+        if _TOTAL is None:
+            _TOTAL = _scan_total()
+        else:
+            _TOTAL += len(data)
+        over = _TOTAL > IMAGE_CACHE_MAX_BYTES
+    if over:
+        evict()
+
+
+def _iter_entries():
+    """(path, size, mtime) của mọi file trong cache."""
+    if not os.path.isdir(IMAGE_CACHE_DIR):
+        return
+    for sub in os.listdir(IMAGE_CACHE_DIR):
+        sd = os.path.join(IMAGE_CACHE_DIR, sub)
+        if not os.path.isdir(sd):
+            continue
+        for name in os.listdir(sd):
+            if not name.endswith(_SUFFIX):
+                continue
+            fp = os.path.join(sd, name)
+            try:
+                st = os.stat(fp)
+            except OSError:
+                continue
+            yield fp, st.st_size, st.st_mtime
+
+
+def _scan_total():
+    return sum(size for _, size, _ in _iter_entries())
+
+
+def evict(max_bytes=None):
+    """Xoá file lâu chưa dùng nhất tới khi tổng <= 90% max_bytes. Trả về số file đã xoá."""
+    global _TOTAL
+    limit = IMAGE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _LOCK:
+        entries = sorted(_iter_entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(limit * 0.9)
+        removed = 0
+        for fp, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(fp)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        _TOTAL = total
+    return removed
+
+
+def get_resized_bytes(path, width_in, height_in, dpi=None, fmt=None, quality=None):
+    """Bytes ảnh đã xoay + resize (lấy cache nếu có, chưa có thì render rồi lưu). Lỗi -> None."""
+    dpi = dpi or IMAGE_CACHE_DPI
+    fmt = (fmt or IMAGE_CACHE_FORMAT).upper()
+    quality = quality or IMAGE_CACHE_QUALITY
+    key = cache_key(path, width_in, height_in, dpi, fmt, quality) if _enabled() else None
+    if key:
+        data = _read_hit(_cache_path(key))
+        if data:
+            return data
+    try:
+        data = _render(path, width_in, height_in, dpi, fmt, quality)
+    except Exception as e:
+        print(f"Resize ảnh lỗi ({path}):", e)
+        return None
+    if key:
+        _store(key, data)
+    return data
+
+
+def load_resized(path, width_in, height_in, **kw):
+    """Như get_resized_bytes nhưng trả BytesIO (dùng thẳng cho run.add_picture)."""
+    data = get_resized_bytes(path, width_in, height_in, **kw)
+    return BytesIO(data) if data else None
+
+
+def _pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPoolExecutor(max_workers=max(1, IMAGE_CACHE_WORKERS), thread_name_prefix="img-cache")
+        return _POOL
+
+
+def prefetch(items):
+    """
+    items: [(path, width_in, height_in)] -> render song song các ảnh chưa có trong cache.
+    Trả về số ảnh phải render mới.
+    """
+    if not _enabled():
+        return 0
+    todo, seen = [], set()
+    for path, w, h in items or []:
+        key = cache_key(path, w, h)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        if not os.path.exists(_cache_path(key)):
+            todo.append((path, w, h))
+    if not todo:
+        return 0
+    futs = [_pool().submit(get_resized_bytes, p, w, h) for p, w, h in todo]
+    return sum(1 for f in futs if f.result())
@@ -0,0 +1,147 @@
+import os
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps, features
+import image_manifest
+from config import (UPLOAD_FOLDER, IMAGE_DERIV_DIR, IMAGE_DERIV_SIZES, IMAGE_DERIV_FORMAT, IMAGE_DERIV_QUALITY,
+                    IMAGE_DERIV_WORKERS)
+
+# =====================================================
+# Ảnh phái sinh cho gallery (thumbnail + bản web) — tạo nền sau khi upload
+# - Ảnh gốc images/<report>/<file> -> IMAGE_DERIV_DIR/<report>/<kind>/<tên gốc>.webp (hoặc .jpg)
+#   kind: 'thumb' (lưới ảnh), 'web' (popup xem lớn); ảnh gốc giữ nguyên để tải về / làm report.
+# - Xoay theo EXIF, thu nhỏ giữ tỉ lệ (cạnh dài = IMAGE_DERIV_SIZES[kind]).
+# - schedule(path) chỉ đẩy việc vào thread pool -> request upload không phải chờ.
+# - Route serve ảnh: có bản phái sinh mới hơn ảnh gốc thì trả bản đó, chưa có thì trả ảnh gốc và
+#   schedule tạo (ảnh cũ trước khi có tính năng này cũng được bổ sung dần).
+#   "Mới hơn" so với max(mtime, lúc upload trong image_manifest): ảnh là hardlink blob (blob_store)
+#   mang mtime của bản upload đầu tiên -> tên file bị thay bằng blob cũ hơn vẫn phải tạo lại.
+# =====================================================
+
+KINDS = tuple(IMAGE_DERIV_SIZES)
+
+_FMT = IMAGE_DERIV_FORMAT.upper()
+if _FMT == "WEBP" and not features.check("webp"):
+    _FMT = "JPEG"
+_EXT = ".webp" if _FMT == "WEBP" else ".jpg"
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_INFLIGHT = set()
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def derivative_path(src_path, kind):
+    """Đường dẫn bản phái sinh của ảnh gốc (ảnh nằm ngoài UPLOAD_FOLDER -> None)."""
+    if kind not in IMAGE_DERIV_SIZES:
+        return None
+    rel = os.path.relpath(os.path.abspath(src_path), os.path.abspath(UPLOAD_FOLDER))
+    if rel.startswith(os.pardir):
+        return None
+    folder, name = os.path.split(rel)
+    return os.path.join(IMAGE_DERIV_DIR, folder, kind, name + _EXT)
+
+
+def _src_time(src_path):
+    """Lần cuối ảnh gốc đổi: mtime, hoặc lúc upload ghi trong manifest nếu muộn hơn."""
+    mtime = os.path.getmtime(src_path)
+    folder, name = os.path.split(src_path)
+    ent = image_manifest.entry(folder, name)
+    return max(mtime, image_manifest.added_time(ent)) if ent else mtime
+
+
+def _fresh(src_path, dst):
+    try:
+        return os.path.getmtime(dst) >= _src_time(src_path)
+    except OSError:
+        return False
+
+
+def ready_path(src_path, kind):
+    """Bản phái sinh đã tạo và còn mới so với ảnh gốc; chưa có -> None."""
+    dst = derivative_path(src_path, kind)
+    return dst if dst and _fresh(src_path, dst) else None
+
+
+def _write(img, dst):
+    d = os.path.dirname(dst)
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", suffix=_EXT, dir=d)
+    os.close(fd)
+    try:
+        if _FMT == "WEBP":
+            img.save(tmp, format="WEBP", quality=IMAGE_DERIV_QUALITY, method=4)
+        else:
+            img.save(tmp, format="JPEG", quality=IMAGE_DERIV_QUALITY, optimize=True)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def build(src_path):
+    """Tạo mọi bản phái sinh còn thiếu / cũ của 1 ảnh (decode ảnh gốc 1 lần). Trả về số bản đã tạo."""
+    todo = [(k, derivative_path(src_path, k)) for k in KINDS]
+    todo = [(k, dst) for k, dst in todo if dst and not _fresh(src_path, dst)]
+    if not todo or not os.path.exists(src_path):
+        return 0
+    biggest = max(IMAGE_DERIV_SIZES[k] for k, _ in todo)
+    with Image.open(src_path) as im:
+        try:
+            im.draft("RGB", (biggest, biggest))
+        except Exception:
+            pass
+        base = ImageOps.exif_transpose(im)
+        if base.mode not in ("RGB", "RGBA") or (_FMT == "JPEG" and base.mode != "RGB"):
+            base = base.convert("RGB")
+    n = 0
+    for kind, dst in sorted(todo, key=lambda t: -IMAGE_DERIV_SIZES[t[0]]):
+        img = base.copy()
+        img.thumbnail((IMAGE_DERIV_SIZES[kind], IMAGE_DERIV_SIZES[kind]))
+        _write(img, dst)
+        n += 1
+    return n
+
+
+def _run(src_path):
+    try:
+        build(src_path)
+    except Exception as e:
+        print(f"Tạo ảnh thumbnail/web lỗi ({src_path}):", e)
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.discard(src_path)
+
+
+def _pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPoolExecutor(max_workers=max(1, IMAGE_DERIV_WORKERS), thread_name_prefix="img-deriv")
+        return _POOL
+
+
+def schedule(src_path):
+    """Đưa ảnh vào hàng đợi tạo thumbnail / bản web (bỏ qua nếu đang xử lý)."""
+    src_path = os.path.abspath(src_path)
+    with _INFLIGHT_LOCK:
+        if src_path in _INFLIGHT:
+            return False
+        _INFLIGHT.add(src_path)
+    _pool().submit(_run, src_path)
+    return True
+
+
+def remove(src_path):
+    """Xoá các bản phái sinh khi ảnh gốc bị xoá."""
+    for kind in KINDS:
+        dst = derivative_path(src_path, kind)
+        if dst and os.path.exists(dst):
+            try:
+                os.remove(dst)
+            except OSError as e:
+                print("Xoá ảnh phái sinh lỗi:", e)
@@ -0,0 +1,323 @@
+import os
+import re
+import json
+import time
+import bisect
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from PIL import Image
+from config import TEST_GROUPS, ALLOWED_EXTENSIONS, IMAGE_MANIFEST_DIR, IMAGE_MANIFEST_CACHE_SIZE
+
+# =====================================================
+# Manifest / index file theo thư mục report (images/<report>, report dods/<report>)
+# - Mỗi thư mục 1 manifest: {name -> entry}; entry = name, mtime, size, width, height, added,
+#   tag / group / test_key / muc / order (tách từ tên file theo quy ước đặt tên lúc upload);
+#   kèm danh sách mọi file (đã sắp) để tra file status*.txt / comment*.txt.
+# - added = thời điểm upload (note_saved) / lần đầu thấy file; giữ nguyên khi file bị thay nội dung
+#   hoặc thành hardlink (blob_store: hardlink mang mtime của bản đầu tiên) -> sắp "mới nhất" theo added.
+# - Hợp lệ khi mtime của thư mục không đổi (thêm / xoá / đổi tên file đều đổi mtime thư mục);
+#   đổi -> quét lại bằng os.scandir, ảnh cũ (cùng mtime + size) dùng lại entry, không mở lại file.
+#   Thư mục đổi trong vòng _RACY_SECS trước lúc quét thì lần sau quét lại
+#   (mtime thư mục có thể chưa kịp nhảy khi 2 lần ghi rất sát nhau).
+# - Route upload / xoá gọi note_saved / note_removed -> cập nhật ngay (kể cả ghi đè cùng tên).
+# - Lưu JSON ở IMAGE_MANIFEST_DIR (không ghi vào thư mục ảnh để khỏi làm đổi mtime thư mục);
+#   bản trong RAM giữ LRU tối đa IMAGE_MANIFEST_CACHE_SIZE thư mục.
+# - Dùng chung cho docx_utils (tìm ảnh dán report, file status/comment) và các route / helper
+#   (folder_index(): tra ảnh theo prefix bằng bisect, kết quả giống sorted(listdir) + startswith).
+# =====================================================
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+_RACY_SECS = 1.0
+
+_LOCK = threading.Lock()
+_MEM = OrderedDict()     # folder key -> {"dir_mtime", "scanned_at", "entries": {name: entry}, "files": [name]}
+
+_GROUP_CODES = None
+
+
+def _group_codes():
+    """Mã nhóm test (dài trước để 'transit_2c_np' không bị khớp nhầm thành nhóm ngắn hơn)."""
+    global _GROUP_CODES
+    if _GROUP_CODES is None:
+        from test_logic import TEST_GROUP_TITLES   # import muộn: test_logic -> image_utils -> image_manifest
+        _GROUP_CODES = sorted({g for g, _ in TEST_GROUPS} | set(TEST_GROUP_TITLES), key=len, reverse=True)
+    return _GROUP_CODES
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTS)
+
+
+def parse_image_name(name):
+    """
+    Tách thông tin từ tên file ảnh:
+      - overview_<ts>_<i>.jpg        -> tag 'overview'
+      - test_<group>_<key>_<n>.jpg   -> tag 'test', group, test_key, order n
+      - ..._muc4.3_1.png             -> muc 'muc4.3', order 1
+    """
+    stem = re.sub(r"\.[A-Za-z0-9]+$", "", name)
+    low = stem.lower()
+    info = {"tag": low.split("_", 1)[0], "group": None, "test_key": None, "muc": None, "order": 0}
+
+    if low.startswith("test_"):
+        rest = stem[5:]
+        for g in _group_codes():
+            if rest.lower().startswith(g.lower() + "_"):
+                info["group"] = g
+                tail = rest[len(g) + 1:]
+                m = re.match(r"^(.*?)_(\d+)$", tail)
+                info["test_key"] = (m.group(1) if m else tail) or None
+                if m:
+                    info["order"] = int(m.group(2))
+                break
+
+    m = re.search(r"muc(\d+(?:\.\d+)*)(?:[ _\-]+(\d+))\b", low)
+    if m:
+        info["muc"], info["order"] = "muc" + m.group(1), int(m.group(2))
+    else:
+        m = re.search(r"muc(\d+(?:\.\d+)+)\b", low)
+        if m:
+            info["muc"], info["order"] = "muc" + m.group(1), 1
+    return info
+
+
+def _folder_key(folder):
+    return os.path.normcase(os.path.abspath(folder))
+
+
+def _disk_path(key):
+    return os.path.join(IMAGE_MANIFEST_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest()[:20] + ".json")
+
+
+def _dir_mtime(folder):
+    try:
+        return os.stat(folder).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _make_entry(name, st, path, added=None):
+    entry = {"name": name, "mtime": st.st_mtime, "size": st.st_size, "width": None, "height": None,
+             "added": st.st_mtime if added is None else added}
+    try:
+        with Image.open(path) as im:     # chỉ đọc header
+            entry["width"], entry["height"] = im.size
+    except Exception:
+        pass
+    entry.update(parse_image_name(name))
+    return entry
+
+
+def _scan(folder, old_entries):
+    """-> (entries ảnh, tên mọi file đã sắp)."""
+    entries, files = {}, []
+    try:
+        it = os.scandir(folder)
+    except OSError:
+        return entries, files
+    with it:
+        for de in it:
+            try:
+                if not de.is_file():
+                    continue
+                files.append(de.name)
+                if not is_image(de.name):
+                    continue
+                st = de.stat()
+            except OSError:
+                continue
+            old = old_entries.get(de.name)
+            if old and old.get("mtime") == st.st_mtime and old.get("size") == st.st_size:
+                entries[de.name] = old
+            else:
+                entries[de.name] = _make_entry(de.name, st, de.path, (old or {}).get("added"))
+    files.sort()
+    return entries, files
+
+
+def _load_disk(key):
+    try:
+        with open(_disk_path(key), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("folder") == key:
+            return data
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _save_disk(key, man):
+    try:
+        os.makedirs(IMAGE_MANIFEST_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=IMAGE_MANIFEST_DIR)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"folder": key, "dir_mtime": man["dir_mtime"], "scanned_at": man.get("scanned_at"),
+                       "entries": man["entries"], "files": man.get("files"),
+                       "saved_at": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp, _disk_path(key))
+    except OSError as e:
+        print("Ghi manifest ảnh lỗi:", e)
+
+
+def _remember(key, man):
+    _MEM[key] = man
+    _MEM.move_to_end(key)
+    while len(_MEM) > max(1, IMAGE_MANIFEST_CACHE_SIZE):
+        _MEM.popitem(last=False)
+
+
+def _fresh(man, cur):
+    """Manifest còn dùng được với mtime thư mục cur (quét xong đủ lâu sau lần đổi cuối)."""
+    return (man.get("dir_mtime") == cur and man.get("files") is not None
+            and (man.get("scanned_at") or 0) - cur / 1e9 > _RACY_SECS)
+
+
+def _get(folder):
+    """Manifest còn hợp lệ của thư mục (quét lại nếu mtime thư mục đã đổi)."""
+    key = _folder_key(folder)
+    cur = _dir_mtime(folder)
+    with _LOCK:
+        man = _MEM.get(key)
+        if man is None:
+            man = _load_disk(key) or {"dir_mtime": None, "entries": {}}
+        if cur is None:
+            man = {"dir_mtime": None, "entries": {}, "files": []}
+        elif not _fresh(man, cur):
+            scanned_at = time.time()
+            ents, files = _scan(folder, man.get("entries") or {})
+            man = {"dir_mtime": cur, "scanned_at": scanned_at, "entries": ents, "files": files}
+            _save_disk(key, man)
+        _remember(key, man)
+        return man
+
+
+def entries(folder):
+    """[entry] ảnh trong thư mục, sắp theo tên."""
+    ents = _get(folder)["entries"]
+    return [ents[n] for n in sorted(ents)]
+
+
+def image_names(folder):
+    """Tên file ảnh trong thư mục (sắp theo tên) — thay cho os.listdir + lọc đuôi ảnh."""
+    return sorted(_get(folder)["entries"])
+
+
+# ---------- tra cứu theo prefix / file status, comment ----------
+
+def _is_allowed(name):
+    return '.' in name and name.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def _prefix_slice(names, prefix):
+    i = bisect.bisect_left(names, prefix)
+    j = i
+    while j < len(names) and names[j].startswith(prefix):
+        j += 1
+    return names[i:j]
+
+
+class FolderIndex:
+    """Tra cứu trên manifest 1 thư mục (đọc 1 lần, mọi truy vấn chạy trên RAM)."""
+
+    def __init__(self, folder, man):
+        self.folder = folder
+        self.names = list(man.get("files") or [])
+        self._set = set(self.names)
+        self.images = [n for n in sorted(man["entries"]) if _is_allowed(n)]
+        low = [(n, n.lower()) for n in self.names]
+        self.status_files = [n for n, l in low if l.startswith("status") and l.endswith(".txt")]
+        self.comment_files = [n for n, l in low if l.startswith("comment") and l.endswith(".txt")]
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def has(self, name):
+        return name in self._set
+
+    def with_prefix(self, prefix, images_only=True):
+        """Tên file bắt đầu bằng prefix (mặc định chỉ ảnh), theo thứ tự tên."""
+        return _prefix_slice(self.images if images_only else self.names, prefix)
+
+    def has_prefix(self, *prefixes, images_only=True):
+        return any(self.with_prefix(p, images_only) for p in prefixes)
+
+    def image_urls(self, report, prefix=""):
+        return [f"/images/{report}/{n}" for n in self.with_prefix(prefix)]
+
+    def status_paths(self):
+        return [self.path(n) for n in self.status_files]
+
+    def comment_paths(self):
+        return [self.path(n) for n in self.comment_files]
+
+
+def folder_index(folder):
+    """FolderIndex của thư mục theo manifest hiện tại (dựng lại khi manifest đổi)."""
+    man = _get(folder)
+    idx = man.get("_index")
+    if idx is None:
+        idx = FolderIndex(folder, man)
+        man["_index"] = idx        # chỉ giữ trong RAM (_save_disk không ghi khoá này)
+    return idx
+
+
+def entry(folder, name):
+    """Entry của 1 ảnh trong thư mục (None nếu không có)."""
+    return _get(folder)["entries"].get(name)
+
+
+def added_time(entry):
+    """Thời điểm upload của ảnh (manifest cũ chưa có 'added' -> mtime)."""
+    return entry.get("added") or entry.get("mtime") or 0
+
+
+def image_paths(folder, newest_first=True):
+    """[(path, entry)] sắp theo thời điểm upload (mới nhất trước) mà không phải getmtime từng file."""
+    ents = entries(folder)
+    ents.sort(key=added_time, reverse=newest_first)
+    return [(os.path.join(folder, e["name"]), e) for e in ents]
+
+
+def note_saved(path):
+    """Gọi sau khi lưu / ghi đè 1 ảnh -> cập nhật entry ngay (ghi đè cùng tên không đổi mtime thư mục)."""
+    folder, name = os.path.split(path)
+    if not is_image(name):
+        return
+    key = _folder_key(folder)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    entry = _make_entry(name, st, path, added=time.time())
+    with _LOCK:
+        man = _MEM.get(key) or _load_disk(key)
+    if man is None:
+        man = _get(folder)      # chưa có manifest -> quét luôn để lưu được thời điểm upload
+    with _LOCK:
+        man["entries"][name] = entry
+        files = man.get("files")
+        if files is not None and name not in files:
+            bisect.insort(files, name)
+        man.pop("_index", None)
+        # các file khác có thể cũng vừa đổi -> để lần đọc tới so lại mtime thư mục (quét nhẹ, dùng lại entry)
+        man["dir_mtime"] = None
+        _remember(key, man)
+        _save_disk(key, man)
+
+
+def note_removed(path):
+    """Gọi sau khi xoá 1 ảnh / file trong thư mục report."""
+    folder, name = os.path.split(path)
+    key = _folder_key(folder)
+    with _LOCK:
+        man = _MEM.get(key)
+        if man is None:
+            return
+        man["entries"].pop(name, None)
+        if name in (man.get("files") or ()):
+            man["files"].remove(name)
+        man.pop("_index", None)
+        man["dir_mtime"] = None
+        _remember(key, man)
@@ -0,0 +1,93 @@
+import os
+import threading
+from report_db import get_conn
+
+# =====================================================
+# Cấp số thứ tự cho file ảnh upload (thay cho os.listdir + parse tên mỗi file upload)
+# - Bảng image_seq (cùng report_store.db, WAL): (thư mục, prefix) -> số kế tiếp.
+# - reserve(): cấp 1 khoảng số liên tiếp cho cả lô upload trong 1 transaction BEGIN IMMEDIATE
+#   -> nhiều request / process cùng upload vào 1 report không bị trùng tên.
+# - Lần đầu gặp (thư mục, prefix): quét thư mục 1 lần lấy số lớn nhất đang có (giữ đúng số cũ).
+# - Số đã cấp không dùng lại (xoá ảnh số lớn nhất không làm ảnh upload sau bị trùng tên cũ).
+# - Tên được cấp mà đã có file (copy tay vào thư mục...) -> quét lại và cấp tiếp từ số lớn nhất.
+# =====================================================
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_seq (
+    folder   TEXT,
+    prefix   TEXT,
+    next_num INTEGER,
+    PRIMARY KEY (folder, prefix)
+);
+"""
+
+_SCHEMA_DONE = set()
+_SCHEMA_LOCK = threading.Lock()
+
+
+def _conn():
+    conn = get_conn()
+    key = id(conn)
+    if key not in _SCHEMA_DONE:
+        with _SCHEMA_LOCK:
+            conn.executescript(_SCHEMA)
+            _SCHEMA_DONE.add(key)
+    return conn
+
+
+def _folder_key(folder):
+    return os.path.normcase(os.path.abspath(folder))
+
+
+def max_existing(folder, prefix):
+    """Số lớn nhất trong các file '<prefix><n>.<ext>' đang có trong thư mục (0 nếu chưa có)."""
+    n = 0
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return 0
+    for f in names:
+        if f.startswith(prefix):
+            num = f[len(prefix):].split('.')[0]
+            if num.isdigit():
+                n = max(n, int(num))
+    return n
+
+
+def reserve(folder, prefix, count=1, rescan=False):
+    """Giữ chỗ count số liên tiếp cho (thư mục, prefix); trả về số đầu tiên."""
+    count = max(1, int(count))
+    key = _folder_key(folder)
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT next_num FROM image_seq WHERE folder=? AND prefix=?", (key, prefix)).fetchone()
+        first = row[0] if row else 1
+        if row is None or rescan:
+            first = max(first, max_existing(folder, prefix) + 1)
+        conn.execute(
+            "INSERT INTO image_seq(folder, prefix, next_num) VALUES (?, ?, ?) "
+            "ON CONFLICT(folder, prefix) DO UPDATE SET next_num=excluded.next_num",
+            (key, prefix, first + count))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return first
+
+
+def reserve_names(folder, prefix, exts):
+    """
+    Tên file cho cả lô upload: exts = ['jpg', 'png', ...] -> ['<prefix>5.jpg', '<prefix>6.png', ...].
+    Cấp số 1 lần cho cả lô; nếu có tên trùng file đang có thì quét lại thư mục và cấp lại.
+    """
+    exts = list(exts)
+    if not exts:
+        return []
+    first = reserve(folder, prefix, len(exts))
+    names = [f"{prefix}{first + i}.{ext}" for i, ext in enumerate(exts)]
+    if any(os.path.exists(os.path.join(folder, n)) for n in names):
+        first = reserve(folder, prefix, len(exts), rescan=True)
+        names = [f"{prefix}{first + i}.{ext}" for i, ext in enumerate(exts)]
+    return names
+
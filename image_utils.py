@@ -2,6 +2,7 @@ import os
 import unicodedata
 import re
 from config import UPLOAD_FOLDER, ALLOWED_EXTENSIONS
+import image_manifest
 
 def safe_filename(filename):
     """
@@ -21,14 +22,6 @@ def get_img_urls(report, tag=None, upload_folder=UPLOAD_FOLDER):
     """
     Lấy danh sách url ảnh của report (có thể filter theo tag: vd "overview", "weight", ...)
     """
-    urls = []
     folder = os.path.join(upload_folder, str(report))
-    # Nếu chỉ đọc/xem thì không cần lock, chỉ lock khi xóa/upload
-    if not os.path.exists(folder): return urls
-    for fname in os.listdir(folder):
-        if tag and not fname.startswith(f"{tag}_"):
-            continue
-        # Kiểm tra file có đúng định dạng mở rộng cho phép
-        if fname.rsplit('.', 1)[-1].lower() in ALLOWED_EXTENSIONS:
-            urls.append(f"/images/{report}/{fname}")
-    return sorted(urls)
\ No newline at end of file
+    # Đọc từ index thư mục report (quét 1 lần, tự làm mới khi thư mục đổi)
+    return image_manifest.folder_index(folder).image_urls(report, f"{tag}_" if tag else "")
\ No newline at end of file
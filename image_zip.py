@@ -0,0 +1,166 @@
+import os
+import hashlib
+import tempfile
+import threading
+from config import UPLOAD_FOLDER, IMAGE_ZIP_CACHE_DIR, IMAGE_ZIP_CACHE_MAX_BYTES
+from zip_stream import ZipStream
+
+# =====================================================
+# Tải ảnh report dạng ZIP stream (thay cho dựng cả ZIP trong BytesIO rồi mới gửi)
+# - collect(): liệt kê ảnh của 1 hay nhiều report -> [(path, tên trong ZIP, size, mtime_ns, inode)]
+#   1 report: giữ cấu trúc thư mục như cũ; nhiều report: thêm thư mục <report>/ ở đầu.
+# - iter_zip(): ghi từng ảnh theo khúc ra response (ZIP_STORED cho JPEG/PNG/WebP) -> RAM cố định,
+#   byte đầu tiên đi ngay.
+# - ZIP dựng sẵn (tuỳ chọn, IMAGE_ZIP_CACHE_MAX_BYTES > 0): key = hash danh sách ảnh (tên, size, mtime, inode —
+#   hardlink blob mang mtime cũ); lần tải đầu vừa stream vừa ghi ra IMAGE_ZIP_CACHE_DIR, lần sau ảnh không đổi thì trả thẳng file.
+#   Ảnh thêm / xoá / sửa -> key đổi; file cũ bị dọn theo LRU khi vượt dung lượng.
+# =====================================================
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+
+_LOCK = threading.Lock()
+
+
+def report_dir(report):
+    """Thư mục ảnh của report; tên report không hợp lệ (có '/', '..') -> None."""
+    report = str(report or "").strip()
+    if not report or report in (".", "..") or any(c in report for c in "/\\:"):
+        return None
+    return os.path.join(UPLOAD_FOLDER, report)
+
+
+def collect(reports):
+    """[(path, arcname, size, mtime_ns, inode)] của ảnh trong các report (report không có thư mục thì bỏ qua)."""
+    multi = len(reports) > 1
+    files = []
+    for report in reports:
+        base_dir = report_dir(report)
+        if not base_dir or not os.path.isdir(base_dir):
+            continue
+        for root, dirs, names in os.walk(base_dir):
+            dirs.sort()
+            for name in sorted(names):
+                if not name.lower().endswith(IMAGE_EXTS):
+                    continue
+                full_path = os.path.join(root, name)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                arcname = os.path.relpath(full_path, base_dir).replace(os.sep, "/")
+                if multi:
+                    arcname = f"{report}/{arcname}"
+                files.append((full_path, arcname, st.st_size, st.st_mtime_ns, st.st_ino))
+    return files
+
+
+def archive_key(files):
+    """Hash danh sách ảnh (tên trong ZIP, size, mtime, inode) -> key ZIP dựng sẵn."""
+    h = hashlib.sha1()
+    for _, arcname, size, mtime_ns, ino in files:
+        h.update(f"{arcname}\0{size}\0{mtime_ns}\0{ino}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def iter_zip(files):
+    """Generator bytes ZIP; ảnh bị xoá giữa chừng thì bỏ qua."""
+    zs = ZipStream()
+    for path, arcname, *_ in files:
+        try:
+            yield from zs.add_file(arcname, path)
+        except FileNotFoundError:
+            continue
+    yield zs.finish()
+
+
+# ---------- ZIP dựng sẵn ----------
+
+def _cache_enabled():
+    return bool(IMAGE_ZIP_CACHE_DIR) and IMAGE_ZIP_CACHE_MAX_BYTES > 0
+
+
+def _cache_path(key):
+    return os.path.join(IMAGE_ZIP_CACHE_DIR, key + ".zip")
+
+
+def cached_archive(key):
+    """Đường dẫn ZIP dựng sẵn của key (đánh dấu vừa dùng); chưa có -> None."""
+    if not _cache_enabled():
+        return None
+    fp = _cache_path(key)
+    try:
+        os.utime(fp, None)
+    except OSError:
+        return None
+    return fp
+
+
+def evict(max_bytes=None):
+    """Xoá ZIP lâu chưa dùng nhất tới khi tổng <= max_bytes. Trả về số file đã xoá."""
+    limit = IMAGE_ZIP_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _LOCK:
+        entries = []
+        try:
+            names = os.listdir(IMAGE_ZIP_CACHE_DIR)
+        except OSError:
+            return 0
+        for name in names:
+            if not name.endswith(".zip"):
+                continue
+            fp = os.path.join(IMAGE_ZIP_CACHE_DIR, name)
+            try:
+                st = os.stat(fp)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fp))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, fp in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(fp)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+    return removed
+
+
+def _tee_to_cache(chunks, key):
+    """Stream chunks ra ngoài đồng thời ghi file tạm; chỉ giữ lại khi stream chạy hết (client không huỷ giữa chừng)."""
+    try:
+        os.makedirs(IMAGE_ZIP_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_", suffix=".part", dir=IMAGE_ZIP_CACHE_DIR)
+    except OSError as e:
+        print("Tạo ZIP dựng sẵn lỗi:", e)
+        yield from chunks
+        return
+    done = False
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        done = True
+    finally:
+        if done:
+            try:
+                os.replace(tmp, _cache_path(key))
+            except OSError as e:
+                print("Lưu ZIP dựng sẵn lỗi:", e)
+            evict()
+        else:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def iter_zip_cached(files, key=None):
+    """Như iter_zip, bật ZIP dựng sẵn thì lưu lại kết quả cho lần tải sau."""
+    chunks = iter_zip(files)
+    if not _cache_enabled():
+        return chunks
+    return _tee_to_cache(chunks, key or archive_key(files))
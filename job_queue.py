@@ -0,0 +1,335 @@
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from report_db import get_conn
+from lock_utils import _pid_alive
+from config import JOB_WORKERS
+
+# =====================================================
+# Job nền có lưu trạng thái (thay cho chạy approve trong generator HTTP + CANCEL_FLAGS trong RAM)
+# - jobs       : run_id, kind, state, payload, tiến độ, pid đang chạy
+# - job_events : sự kiện NDJSON của job (start/progress/error/cancelled/done), đọc lại theo seq
+# - job_steps  : bước đã xong (vd trq_id đã approve) -> chạy lại / resume thì bỏ qua (idempotent)
+# - Chạy trong thread pool nền (JOB_WORKERS); request HTTP chỉ tạo job rồi poll / subscribe.
+# - State: queued -> running -> done | failed | cancelled ; process chết giữa chừng -> interrupted.
+#   cancel: running -> cancelling (handler tự dừng ở bước an toàn); resume: interrupted/cancelled/failed -> queued.
+# - Khôi phục chạy ngay lần đầu module dùng DB (waitress import app, không qua __main__);
+#   get_job() gặp job running/cancelling mà pid chủ đã chết cũng chuyển luôn sang interrupted.
+# =====================================================
+
+TERMINAL = ("done", "failed", "cancelled", "interrupted")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    run_id      TEXT PRIMARY KEY,
+    kind        TEXT,
+    state       TEXT,
+    payload     TEXT,
+    total       INTEGER DEFAULT 0,
+    done        INTEGER DEFAULT 0,
+    error       TEXT,
+    owner_pid   INTEGER,
+    attempts    INTEGER DEFAULT 0,
+    created_at  REAL,
+    updated_at  REAL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_state ON jobs(state);
+CREATE TABLE IF NOT EXISTS job_events (
+    run_id  TEXT,
+    seq     INTEGER,
+    event   TEXT,
+    at      REAL,
+    PRIMARY KEY (run_id, seq)
+);
+CREATE TABLE IF NOT EXISTS job_steps (
+    run_id   TEXT,
+    step     TEXT,
+    result   TEXT,
+    at       REAL,
+    PRIMARY KEY (run_id, step)
+);
+"""
+
+_SCHEMA_DONE = set()
+_SCHEMA_LOCK = threading.Lock()
+_RECOVERED = False
+_HANDLERS = {}
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_WAKE = threading.Condition()     # báo cho subscriber trong cùng process là có event mới
+
+
+def _conn():
+    global _RECOVERED
+    conn = get_conn()
+    if id(conn) not in _SCHEMA_DONE:
+        with _SCHEMA_LOCK:
+            conn.executescript(_SCHEMA)
+            _SCHEMA_DONE.add(id(conn))
+    if not _RECOVERED:
+        with _SCHEMA_LOCK:
+            first, _RECOVERED = not _RECOVERED, True
+        if first:
+            try:
+                recover_jobs()
+            except Exception as e:
+                print("Khôi phục job lỗi:", e)
+    return conn
+
+
+def _tx(fn):
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        out = fn(conn)
+        conn.execute("COMMIT")
+        return out
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def register_handler(kind, fn):
+    """fn(ctx: JobContext) chạy job loại 'kind'; tự emit sự kiện và kiểm tra ctx.cancelled()."""
+    _HANDLERS[kind] = fn
+    # job loại này còn queued (process trước chết trước khi kịp nhận) -> nhận chạy
+    for (run_id,) in _conn().execute("SELECT run_id FROM jobs WHERE state='queued' AND kind=?", (kind,)).fetchall():
+        _submit(run_id)
+
+
+# ---------- đọc ----------
+
+def _row_to_job(row):
+    if not row:
+        return None
+    keys = ("run_id", "kind", "state", "payload", "total", "done", "error", "owner_pid", "attempts",
+            "created_at", "updated_at")
+    job = dict(zip(keys, row))
+    try:
+        job["payload"] = json.loads(job["payload"] or "{}")
+    except ValueError:
+        job["payload"] = {}
+    return job
+
+
+def _owner_dead(job):
+    pid = job.get("owner_pid")
+    return job["state"] in ("running", "cancelling") and pid != os.getpid() and not _pid_alive(pid)
+
+
+def _mark_interrupted(run_id):
+    if _set(run_id, only_from=("running", "cancelling"), state="interrupted"):
+        _emit(run_id, {"type": "interrupted", "message": "Server khởi động lại giữa chừng, có thể resume"})
+
+
+def get_job(run_id):
+    """Job theo run_id; đang running/cancelling mà process chạy nó đã chết -> interrupted."""
+    sql = ("SELECT run_id, kind, state, payload, total, done, error, owner_pid, attempts, created_at, updated_at "
+           "FROM jobs WHERE run_id=?")
+    job = _row_to_job(_conn().execute(sql, (str(run_id or ""),)).fetchone())
+    if job is not None and _owner_dead(job):
+        _mark_interrupted(job["run_id"])
+        job = _row_to_job(_conn().execute(sql, (job["run_id"],)).fetchone())
+    return job
+
+
+def list_jobs(kind=None, limit=20):
+    sql = ("SELECT run_id, kind, state, payload, total, done, error, owner_pid, attempts, created_at, updated_at "
+           "FROM jobs")
+    args = []
+    if kind:
+        sql += " WHERE kind=?"
+        args.append(kind)
+    sql += " ORDER BY created_at DESC LIMIT ?"
+    args.append(int(limit))
+    return [_row_to_job(r) for r in _conn().execute(sql, args)]
+
+
+def job_events(run_id, since=0):
+    """[(seq, event)] có seq > since."""
+    out = []
+    for seq, ev in _conn().execute("SELECT seq, event FROM job_events WHERE run_id=? AND seq>? ORDER BY seq",
+                                   (run_id, int(since or 0))):
+        try:
+            out.append((seq, json.loads(ev)))
+        except ValueError:
+            continue
+    return out
+
+
+def iter_job_events(run_id, since=0, poll=0.3, idle_timeout=None):
+    """
+    Subscribe: yield (seq, event) lần lượt tới khi job kết thúc và đã đọc hết event.
+    Cùng process thì được đánh thức ngay khi có event; process khác thì poll mỗi 'poll' giây.
+    """
+    last = int(since or 0)
+    idle_since = time.monotonic()
+    while True:
+        batch = job_events(run_id, last)
+        for seq, ev in batch:
+            last = seq
+            yield seq, ev
+        if batch:
+            idle_since = time.monotonic()
+            continue
+        job = get_job(run_id)
+        if job is None or job["state"] in TERMINAL:
+            # đọc nốt event ghi ngay trước khi đổi state
+            for seq, ev in job_events(run_id, last):
+                yield seq, ev
+            return
+        if idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+            return
+        with _WAKE:
+            _WAKE.wait(poll)
+
+
+# ---------- ghi ----------
+
+def _emit(run_id, event):
+    def fn(conn):
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM job_events WHERE run_id=?", (run_id,)).fetchone()[0]
+        conn.execute("INSERT INTO job_events(run_id, seq, event, at) VALUES (?, ?, ?, ?)",
+                     (run_id, seq, json.dumps(event, ensure_ascii=False), time.time()))
+        return seq
+    seq = _tx(fn)
+    with _WAKE:
+        _WAKE.notify_all()
+    return seq
+
+
+def _set(run_id, only_from=None, **fields):
+    fields["updated_at"] = time.time()
+    sql = "UPDATE jobs SET " + ", ".join(f"{k}=?" for k in fields) + " WHERE run_id=?"
+    args = list(fields.values()) + [run_id]
+    if only_from:
+        sql += " AND state IN (%s)" % ",".join("?" * len(only_from))
+        args += list(only_from)
+    n = _conn().execute(sql, args).rowcount
+    with _WAKE:
+        _WAKE.notify_all()
+    return n > 0
+
+
+def create_job(kind, payload, run_id=None):
+    """Tạo job (queued) và đưa vào thread pool; trả về run_id."""
+    run_id = run_id or str(uuid.uuid4())
+    now = time.time()
+    _conn().execute(
+        "INSERT INTO jobs(run_id, kind, state, payload, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+        (run_id, kind, json.dumps(payload or {}, ensure_ascii=False), now, now))
+    _submit(run_id)
+    return run_id
+
+
+def cancel_job(run_id):
+    """queued -> cancelled ngay; running -> cancelling (handler dừng sau bước hiện tại)."""
+    get_job(run_id)     # process chạy job đã chết -> interrupted, không kẹt ở cancelling
+    if _set(run_id, only_from=("queued",), state="cancelled"):
+        _emit(run_id, {"type": "cancelled", "done": (get_job(run_id) or {}).get("done", 0),
+                       "total": (get_job(run_id) or {}).get("total", 0)})
+        return True
+    return _set(run_id, only_from=("running",), state="cancelling")
+
+
+def resume_job(run_id):
+    """Chạy tiếp job đã dừng (interrupted / cancelled / failed); các bước đã xong được bỏ qua."""
+    get_job(run_id)     # running của process đã chết -> interrupted -> resume được
+    if not _set(run_id, only_from=("interrupted", "cancelled", "failed"), state="queued", error=None):
+        return False
+    _submit(run_id)
+    return True
+
+
+def recover_jobs():
+    """
+    Tự chạy lần đầu module dùng DB: job đang chạy của process đã chết -> interrupted (chờ resume);
+    job còn queued (chưa ai nhận) mà đã có handler -> nhận chạy luôn (chưa có thì register_handler nhận).
+    """
+    conn = _conn()
+    for run_id, pid in conn.execute(
+            "SELECT run_id, owner_pid FROM jobs WHERE state IN ('running', 'cancelling')").fetchall():
+        if pid != os.getpid() and not _pid_alive(pid):
+            _mark_interrupted(run_id)
+    for run_id, kind in conn.execute("SELECT run_id, kind FROM jobs WHERE state='queued'").fetchall():
+        if kind in _HANDLERS:
+            _submit(run_id)
+
+
+# ---------- chạy ----------
+
+class JobContext:
+    def __init__(self, job):
+        self.run_id = job["run_id"]
+        self.kind = job["kind"]
+        self.payload = job["payload"]
+        self.attempt = job["attempts"]
+        self._last_check = 0.0
+        self._cancelled = False
+
+    def emit(self, event):
+        return _emit(self.run_id, event)
+
+    def progress(self, done=None, total=None):
+        fields = {}
+        if done is not None:
+            fields["done"] = int(done)
+        if total is not None:
+            fields["total"] = int(total)
+        if fields:
+            _set(self.run_id, **fields)
+
+    def save_payload(self, **kv):
+        """Lưu thêm vào payload (vd danh sách việc cố định lúc chạy lần đầu) để resume dùng lại."""
+        self.payload.update(kv)
+        _set(self.run_id, payload=json.dumps(self.payload, ensure_ascii=False))
+
+    def cancelled(self):
+        if not self._cancelled:
+            row = _conn().execute("SELECT state FROM jobs WHERE run_id=?", (self.run_id,)).fetchone()
+            self._cancelled = bool(row) and row[0] == "cancelling"
+        return self._cancelled
+
+    def done_steps(self):
+        return {s for (s,) in _conn().execute("SELECT step FROM job_steps WHERE run_id=?", (self.run_id,))}
+
+    def mark_steps(self, steps, result=None):
+        now = time.time()
+        data = json.dumps(result, ensure_ascii=False) if result is not None else None
+        _tx(lambda conn: conn.executemany(
+            "INSERT OR REPLACE INTO job_steps(run_id, step, result, at) VALUES (?, ?, ?, ?)",
+            [(self.run_id, str(s), data, now) for s in steps]))
+
+
+def _execute(run_id):
+    claimed = _tx(lambda conn: conn.execute(
+        "UPDATE jobs SET state='running', owner_pid=?, attempts=attempts+1, updated_at=? "
+        "WHERE run_id=? AND state='queued'", (os.getpid(), time.time(), run_id)).rowcount)
+    if not claimed:
+        return
+    job = get_job(run_id)
+    handler = _HANDLERS.get(job["kind"])
+    ctx = JobContext(job)
+    try:
+        if handler is None:
+            raise RuntimeError(f"Không có handler cho job '{job['kind']}'")
+        handler(ctx)
+        if ctx.cancelled():
+            _set(run_id, state="cancelled")
+        else:
+            _set(run_id, only_from=("running", "cancelling"), state="done")
+    except Exception as e:
+        print(f"Job {run_id} lỗi:", e)
+        _emit(run_id, {"type": "error", "message": str(e)})
+        _set(run_id, state="failed", error=str(e))
+
+
+def _submit(run_id):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPoolExecutor(max_workers=max(1, JOB_WORKERS), thread_name_prefix="job")
+        _POOL.submit(_execute, run_id)
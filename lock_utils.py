@@ -0,0 +1,314 @@
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl            # Linux/macOS: flock (shared/exclusive)
+    msvcrt = None
+except ImportError:         # Windows: msvcrt.locking (chỉ có exclusive)
+    fcntl = None
+    import msvcrt
+
+# =====================================================
+# Lock liên process (thay cho spin-wait O_EXCL + xoá lock sau 30/60s)
+# - flock: chờ blocking (không đốt CPU), OS tự nhả khi process chết -> không cần xoá file lock.
+# - Reader/writer: shared=True cho đọc, mặc định exclusive cho ghi.
+# - Công bằng: cổng (gate) FIFO trong process + gate file liên process -> writer đang chờ
+#   chặn reader mới, không bị đói.
+# - Reentrant trong cùng thread (giữ exclusive rồi xin shared/exclusive tiếp vẫn được).
+# - Ghi pid chủ lock vào <name>.owner; lúc phải chờ thì kiểm tra pid còn sống không (stale).
+# - Thống kê wait/hold cho từng lock: lock_stats().
+# =====================================================
+
+LOCK_DIR = os.path.join(tempfile.gettempdir(), "vfr_locks")
+
+_local = threading.local()
+_GATES = {}
+_GATES_LOCK = threading.Lock()
+_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def _safe_name(name):
+    return re.sub(r"[^0-9A-Za-z_.-]+", "_", str(name))[:80] or "lock"
+
+
+def _lock_file(name, suffix=".lock"):
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    return os.path.join(LOCK_DIR, _safe_name(name) + suffix)
+
+
+# ---------- cổng FIFO trong process ----------
+
+class _Gate:
+    """Hàng đợi theo vé: thread nào đến trước được vào trước."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+        self.abandoned = set()
+
+    def enter(self, timeout=None):
+        with self.cond:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while ticket != self.serving:
+                remain = None if deadline is None else deadline - time.monotonic()
+                if remain is not None and remain <= 0:
+                    self.abandoned.add(ticket)
+                    return None
+                self.cond.wait(remain)
+            return ticket
+
+    def leave(self):
+        with self.cond:
+            self.serving += 1
+            while self.serving in self.abandoned:
+                self.abandoned.discard(self.serving)
+                self.serving += 1
+            self.cond.notify_all()
+
+
+def _gate(name):
+    with _GATES_LOCK:
+        g = _GATES.get(name)
+        if g is None:
+            g = _GATES[name] = _Gate()
+        return g
+
+
+# ---------- khoá file (OS) ----------
+
+def _os_try_lock(fd, shared):
+    try:
+        if fcntl:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        else:
+            os.lseek(fd, 0, 0)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        return True
+    except (BlockingIOError, PermissionError, OSError):
+        return False
+
+
+def _os_lock(fd, shared, deadline=None):
+    """Khoá blocking; có deadline thì poll với backoff ngắn."""
+    if fcntl and deadline is None:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        return True
+    delay = 0.005
+    while not _os_try_lock(fd, shared):
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return True
+
+
+def _os_unlock(fd):
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(fd, 0, 0)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    except OSError:
+        pass
+
+
+# ---------- chủ lock / stale ----------
+
+def _pid_alive(pid):
+    if not pid or pid <= 0:
+        return False
+    if os.name == "nt":
+        try:
+            import ctypes
+            h = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)  # QUERY_LIMITED_INFORMATION
+            if not h:
+                return False
+            ctypes.windll.kernel32.CloseHandle(h)
+            return True
+        except Exception:
+            return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _write_owner(name, shared):
+    if shared:
+        return
+    try:
+        with open(_lock_file(name, ".owner"), "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "thread": threading.current_thread().name,
+                       "since": time.time()}, f)
+    except OSError:
+        pass
+
+
+def read_owner(name):
+    """Thông tin chủ lock exclusive gần nhất: {"pid", "thread", "since", "alive"} hoặc None."""
+    try:
+        with open(_lock_file(name, ".owner"), encoding="utf-8") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    info["alive"] = _pid_alive(info.get("pid"))
+    return info
+
+
+def _check_stale(name):
+    info = read_owner(name)
+    if info and not info["alive"]:
+        # flock được OS nhả khi process chết; còn bị giữ nghĩa là fd đã bị kế thừa (fork/subprocess)
+        print(f"[lock] {name}: chủ lock pid={info.get('pid')} không còn chạy, lock có thể do process con giữ")
+        _stat(name, stale=1)
+
+
+# ---------- thống kê ----------
+
+def _stat(name, wait=None, hold=None, contended=0, stale=0, timeout=0):
+    with _STATS_LOCK:
+        s = _STATS.get(name)
+        if s is None:
+            s = _STATS[name] = {"acquired": 0, "contended": 0, "timeouts": 0, "stale_owner": 0,
+                                "wait_total": 0.0, "wait_max": 0.0, "hold_total": 0.0, "hold_max": 0.0,
+                                "holds": 0}
+        if wait is not None:
+            s["acquired"] += 1
+            s["wait_total"] += wait
+            s["wait_max"] = max(s["wait_max"], wait)
+        if hold is not None:
+            s["holds"] += 1
+            s["hold_total"] += hold
+            s["hold_max"] = max(s["hold_max"], hold)
+        s["contended"] += contended
+        s["stale_owner"] += stale
+        s["timeouts"] += timeout
+
+
+def lock_stats():
+    """{name: {acquired, contended, timeouts, stale_owner, wait_avg/max, hold_avg/max}} (giây)."""
+    out = {}
+    with _STATS_LOCK:
+        for name, s in _STATS.items():
+            out[name] = {
+                "acquired": s["acquired"],
+                "contended": s["contended"],
+                "timeouts": s["timeouts"],
+                "stale_owner": s["stale_owner"],
+                "wait_avg": round(s["wait_total"] / s["acquired"], 4) if s["acquired"] else 0.0,
+                "wait_max": round(s["wait_max"], 4),
+                "hold_avg": round(s["hold_total"] / s["holds"], 4) if s["holds"] else 0.0,
+                "hold_max": round(s["hold_max"], 4),
+            }
+    return out
+
+
+def reset_lock_stats():
+    with _STATS_LOCK:
+        _STATS.clear()
+
+
+# ---------- API ----------
+
+def _held():
+    # process con (fork) không được kế thừa các lock "đang giữ" của cha
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.held = {}
+    return _local.held
+
+
+@contextmanager
+def named_lock(name, shared=False, timeout=None):
+    """
+    Khoá liên process theo tên.
+    - shared=True: nhiều reader cùng giữ; False: exclusive (writer).
+    - timeout=None: chờ tới khi được; có timeout -> raise LockTimeout.
+    """
+    held = _held()
+    entry = held.get(name)
+    if entry is not None:
+        if entry["shared"] and not shared:
+            raise RuntimeError(f"Không nâng được lock '{name}' từ shared lên exclusive")
+        entry["count"] += 1
+        try:
+            yield
+        finally:
+            entry["count"] -= 1
+        return
+
+    t0 = time.monotonic()
+    deadline = None if timeout is None else t0 + timeout
+    gate = _gate(name)
+    if gate.enter(timeout) is None:
+        _stat(name, timeout=1)
+        raise LockTimeout(f"Hết thời gian chờ lock '{name}'")
+
+    fd = gate_fd = None
+    try:
+        # gate file: giữ trong lúc chờ lock chính -> reader mới phải xếp hàng sau writer
+        gate_fd = os.open(_lock_file(name, ".gate"), os.O_CREAT | os.O_RDWR)
+        fd = os.open(_lock_file(name), os.O_CREAT | os.O_RDWR)
+        contended = 0
+        for f, f_shared in ((gate_fd, False), (fd, shared)):
+            if _os_try_lock(f, f_shared):
+                continue
+            if not contended:
+                contended = 1
+                _check_stale(name)
+            if not _os_lock(f, f_shared, deadline):
+                _stat(name, contended=1, timeout=1)
+                raise LockTimeout(f"Hết thời gian chờ lock '{name}'")
+    except BaseException:
+        for f in (fd, gate_fd):
+            if f is not None:
+                _os_unlock(f)
+                os.close(f)
+        gate.leave()
+        raise
+
+    _os_unlock(gate_fd)
+    os.close(gate_fd)
+    gate.leave()
+
+    t1 = time.monotonic()
+    _stat(name, wait=t1 - t0, contended=contended)
+    _write_owner(name, shared)
+    held[name] = {"shared": shared, "count": 1}
+    try:
+        yield
+    finally:
+        held.pop(name, None)
+        _os_unlock(fd)
+        os.close(fd)
+        _stat(name, hold=time.monotonic() - t1)
+
+
+def workbook_lock(path, shared=False, timeout=None):
+    """Reader/writer lock cho 1 file Excel (theo đường dẫn tuyệt đối)."""
+    ap = os.path.abspath(path)
+    digest = hashlib.md5(ap.lower().encode("utf-8")).hexdigest()[:8]
+    return named_lock(f"wb_{os.path.basename(ap)}_{digest}", shared=shared, timeout=timeout)
+
+
+def report_file_lock(report_no, timeout=None):
+    """Lock riêng cho file DOCX/PDF đầu ra của 1 report."""
+    return named_lock(f"tfr_{report_no}", timeout=timeout)
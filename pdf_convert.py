@@ -0,0 +1,456 @@
+import os
+import sys
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import subprocess
+import importlib.util
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from config import PDF_CONVERTER, PDF_CONVERT_WORKERS, PDF_CONVERT_TIMEOUT, PDF_CONVERT_BATCH_MAX, SOFFICE_PATH
+from lock_utils import named_lock
+
+# =====================================================
+# Dịch vụ convert DOCX -> PDF (thay cho mỗi file 1 lần gọi docx2pdf)
+# - 1 hàng đợi job + N worker thread chạy suốt vòng đời process.
+# - Backend:
+#     word        : docx2pdf + pythoncom (Windows, như cũ) — luôn 1 worker + lock liên process
+#                   (docx2pdf mở Word.Application dùng chung rồi Quit() sau mỗi lần -> chạy song song sẽ tắt Word của nhau)
+#     libreoffice : soffice headless; có module uno -> giữ soffice chạy sẵn (warm) và convert qua UNO,
+#                   không có -> mỗi lô 1 lệnh "soffice --convert-to pdf a.docx b.docx ..." với profile riêng.
+#     none        : không convert (báo lỗi rõ ràng, caller dùng DOCX).
+#   PDF_CONVERTER=auto: Windows có Word -> word; có soffice -> libreoffice; còn lại none.
+# - Worker lấy 1 job rồi gom thêm các job đang chờ (tối đa PDF_CONVERT_BATCH_MAX) -> 1 lần gọi backend.
+# - Timeout từng job: caller chờ tối đa timeout; soffice quá hạn bị kill và khởi động lại.
+# - Thống kê: converter_stats() -> độ sâu hàng đợi, số job, độ trễ.
+# =====================================================
+
+_SOFFICE_CANDIDATES = (
+    "soffice", "libreoffice",
+    r"C:\Program Files\LibreOffice\program\soffice.exe",
+    r"C:\Program Files (x86)\LibreOffice\program\soffice.exe",
+    "/usr/lib/libreoffice/program/soffice",
+    "/Applications/LibreOffice.app/Contents/MacOS/soffice",
+)
+
+
+def find_soffice():
+    if SOFFICE_PATH:
+        return SOFFICE_PATH if (shutil.which(SOFFICE_PATH) or os.path.exists(SOFFICE_PATH)) else None
+    for c in _SOFFICE_CANDIDATES:
+        p = shutil.which(c) or (c if os.path.isabs(c) and os.path.exists(c) else None)
+        if p:
+            return p
+    return None
+
+
+def _has_module(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except Exception:
+        return False
+
+
+def pick_backend(name=PDF_CONVERTER):
+    name = (name or "auto").strip().lower()
+    if name != "auto":
+        return name
+    if os.name == "nt" and _has_module("docx2pdf") and _has_module("pythoncom"):
+        return "word"
+    if find_soffice():
+        return "libreoffice"
+    return "none"
+
+
+def _file_url(path):
+    path = os.path.abspath(path).replace("\\", "/")
+    return "file:///" + path.lstrip("/")
+
+
+class _Job:
+    __slots__ = ("docx", "pdf", "future", "submitted", "deadline")
+
+    def __init__(self, docx, pdf, timeout):
+        self.docx = os.path.abspath(docx)
+        self.pdf = os.path.abspath(pdf)
+        self.future = Future()
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + timeout
+
+
+# ---------- backend ----------
+
+class _NoneBackend:
+    name = "none"
+
+    def __init__(self, slot=None):
+        pass
+
+    def convert_batch(self, jobs):
+        for job in jobs:
+            job.future.set_exception(RuntimeError(
+                "Không có bộ convert PDF (cần Word+docx2pdf hoặc LibreOffice; đặt PDF_CONVERTER/SOFFICE_PATH)"))
+
+    def close(self):
+        pass
+
+
+class _WordBackend:
+    """docx2pdf (Word COM) — worker thread CoInitialize 1 lần; mỗi lúc chỉ 1 lần convert (cả các process)."""
+    name = "word"
+    max_workers = 1
+
+    def __init__(self, slot):
+        self._com_ready = False
+
+    def convert_batch(self, jobs):
+        for job in jobs:
+            try:
+                if not self._com_ready:
+                    import pythoncom
+                    pythoncom.CoInitialize()
+                    self._com_ready = True
+                from docx2pdf import convert
+                with named_lock("pdf_word"):
+                    convert(job.docx, job.pdf)
+                job.future.set_result(os.path.exists(job.pdf))
+            except Exception as e:
+                job.future.set_exception(e)
+
+    def close(self):
+        pass
+
+
+def _move_replace(src, dst):
+    """os.replace; khác ổ đĩa (EXDEV) thì copy ra file tạm cạnh đích rồi replace (vẫn ghi đè được)."""
+    try:
+        os.replace(src, dst)
+    except OSError:
+        tmp = dst + ".tmp"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+        os.remove(src)
+
+
+class _LibreOfficeBackend:
+    """
+    soffice headless, mỗi worker 1 profile riêng (2 instance không tranh profile).
+    - Có uno: giữ 1 soffice chạy sẵn, convert từng file qua UNO (không khởi động lại mỗi lần).
+    - Không có uno: 1 lệnh --convert-to cho cả lô, ra thư mục tạm rồi chuyển vào đúng chỗ.
+    """
+    name = "libreoffice"
+
+    def __init__(self, slot):
+        self.soffice = find_soffice()
+        if not self.soffice:
+            raise RuntimeError("Không tìm thấy soffice (LibreOffice); đặt SOFFICE_PATH")
+        self.slot = slot
+        self.profile = os.path.join(tempfile.gettempdir(), f"vfr_lo_profile_{os.getpid()}_{slot}")
+        self.pipe = f"vfr_lo_{os.getpid()}_{slot}"
+        self.use_uno = _has_module("uno")
+        self._proc = None
+        self._desktop = None
+
+    def _base_args(self):
+        return [self.soffice, "--headless", "--invisible", "--nologo", "--norestore",
+                "--nodefault", "--nolockcheck", f"-env:UserInstallation={_file_url(self.profile)}"]
+
+    # ----- UNO (warm) -----
+    def _ensure_uno(self, timeout=60):
+        if self._proc is not None and self._proc.poll() is None and self._desktop is not None:
+            return self._desktop
+        self._kill()
+        import uno
+        self._proc = subprocess.Popen(
+            self._base_args() + [f"--accept=pipe,name={self.pipe};urp;StarOffice.ComponentContext"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                ctx = resolver.resolve(f"uno:pipe,name={self.pipe};urp;StarOffice.ComponentContext")
+                self._desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+                return self._desktop
+            except Exception:
+                if self._proc.poll() is not None or time.monotonic() > deadline:
+                    self._kill()
+                    raise RuntimeError("Không khởi động được soffice (UNO)")
+                time.sleep(0.3)
+
+    def _convert_uno(self, job):
+        import uno
+        from com.sun.star.beans import PropertyValue
+
+        def prop(name, value):
+            p = PropertyValue()
+            p.Name, p.Value = name, value
+            return p
+
+        desktop = self._ensure_uno()
+        # quá hạn -> kill soffice, lệnh UNO đang chờ sẽ lỗi ngay
+        remain = max(1.0, job.deadline - time.monotonic())
+        watchdog = threading.Timer(remain, self._kill)
+        watchdog.daemon = True
+        watchdog.start()
+        tmp = job.pdf + ".tmp.pdf"
+        try:
+            doc = desktop.loadComponentFromURL(uno.systemPathToFileUrl(job.docx), "_blank", 0,
+                                               (prop("Hidden", True),))
+            try:
+                doc.storeToURL(uno.systemPathToFileUrl(tmp), (prop("FilterName", "writer_pdf_Export"),))
+            finally:
+                doc.close(True)
+            os.replace(tmp, job.pdf)
+        except Exception:
+            if not watchdog.is_alive():
+                raise TimeoutError(f"Convert PDF quá {PDF_CONVERT_TIMEOUT}s: {os.path.basename(job.docx)}")
+            self._desktop = None
+            raise
+        finally:
+            watchdog.cancel()
+            if os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    # ----- CLI theo lô -----
+    def _convert_cli(self, jobs):
+        # cùng tên file (khác thư mục) thì soffice ghi đè nhau -> tách lô
+        seen, batch, rest = set(), [], []
+        for job in jobs:
+            stem = os.path.splitext(os.path.basename(job.docx))[0].lower()
+            (rest if stem in seen else batch).append(job)
+            seen.add(stem)
+        # thư mục tạm cạnh file đích (cùng ổ đĩa -> os.replace không lỗi EXDEV khi %TEMP% / /tmp khác ổ)
+        outdir = tempfile.mkdtemp(prefix="vfr_pdf_", dir=os.path.dirname(os.path.abspath(batch[0].pdf)))
+        timeout = max(1.0, max(j.deadline for j in batch) - time.monotonic())
+        try:
+            timed_out, run_error = False, None
+            try:
+                subprocess.run(self._base_args() + ["--convert-to", "pdf", "--outdir", outdir]
+                               + [j.docx for j in batch],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+            except Exception as e:
+                run_error = e
+            for job in batch:
+                # từng job riêng: 1 file lỗi không kéo theo cả lô
+                try:
+                    out = os.path.join(outdir, os.path.splitext(os.path.basename(job.docx))[0] + ".pdf")
+                    if os.path.exists(out):
+                        _move_replace(out, job.pdf)
+                        job.future.set_result(True)
+                    elif timed_out:
+                        job.future.set_exception(TimeoutError(
+                            f"Convert PDF quá hạn: {os.path.basename(job.docx)}"))
+                    else:
+                        job.future.set_exception(run_error or RuntimeError(
+                            f"soffice không tạo được PDF: {os.path.basename(job.docx)}"))
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
+        if rest:
+            self._convert_cli(rest)
+
+    def convert_batch(self, jobs):
+        if not self.use_uno:
+            return self._convert_cli(jobs)
+        for job in jobs:
+            try:
+                self._convert_uno(job)
+                job.future.set_result(True)
+            except Exception as e:
+                job.future.set_exception(e)
+
+    def _kill(self):
+        proc, self._proc, self._desktop = self._proc, None, None
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.kill()
+                proc.wait(5)
+            except Exception:
+                pass
+
+    def close(self):
+        self._kill()
+
+
+_BACKENDS = {"none": _NoneBackend, "word": _WordBackend, "libreoffice": _LibreOfficeBackend}
+
+
+# ---------- service ----------
+
+class PdfConverter:
+    def __init__(self, backend=None, workers=PDF_CONVERT_WORKERS, batch_max=PDF_CONVERT_BATCH_MAX,
+                 timeout=PDF_CONVERT_TIMEOUT):
+        self.backend = backend or pick_backend()
+        if self.backend not in _BACKENDS:
+            raise ValueError(f"PDF_CONVERTER không hợp lệ: {self.backend}")
+        self.workers = max(1, int(workers or 1))
+        cap = getattr(_BACKENDS[self.backend], "max_workers", None)
+        if cap:
+            self.workers = min(self.workers, cap)
+        self.batch_max = max(1, int(batch_max or 1))
+        self.timeout = float(timeout)
+        self._q = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "done": 0, "failed": 0, "timeouts": 0, "batches": 0,
+                       "in_flight": 0, "latency_total": 0.0, "latency_max": 0.0}
+        self._recent = deque(maxlen=200)
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for slot in range(self.workers):
+                t = threading.Thread(target=self._worker, args=(slot,), name=f"pdf-convert-{slot}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def _worker(self, slot):
+        try:
+            backend = _BACKENDS[self.backend](slot)
+        except Exception as e:
+            print("Khởi tạo bộ convert PDF lỗi:", e)
+            backend = _NoneBackend()
+        while True:
+            jobs = [self._q.get()]
+            while len(jobs) < self.batch_max:
+                try:
+                    jobs.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            # job quá hạn khi còn nằm trong hàng đợi -> bỏ, không tốn công convert
+            now = time.monotonic()
+            live = []
+            for job in jobs:
+                if job.future.done():
+                    continue
+                if now >= job.deadline:
+                    job.future.set_exception(TimeoutError(f"Hết hạn khi chờ convert: {os.path.basename(job.docx)}"))
+                else:
+                    live.append(job)
+            if live:
+                with self._lock:
+                    self._stats["in_flight"] += len(live)
+                    self._stats["batches"] += 1
+                try:
+                    backend.convert_batch(live)
+                except Exception as e:
+                    for job in live:
+                        if not job.future.done():
+                            job.future.set_exception(e)
+                with self._lock:
+                    self._stats["in_flight"] -= len(live)
+            for _ in jobs:
+                self._q.task_done()
+
+    def _on_done(self, job):
+        def cb(f):
+            latency = time.monotonic() - job.submitted
+            with self._lock:
+                s = self._stats
+                try:
+                    ok = bool(f.result())
+                except TimeoutError:
+                    ok = False
+                    s["timeouts"] += 1
+                except BaseException:
+                    ok = False
+                s["done" if ok else "failed"] += 1
+                s["latency_total"] += latency
+                s["latency_max"] = max(s["latency_max"], latency)
+                self._recent.append(latency)
+        return cb
+
+    def submit(self, docx_path, pdf_path, timeout=None):
+        """Đưa 1 job vào hàng đợi; trả về Future[bool]."""
+        self._start()
+        job = _Job(docx_path, pdf_path, self.timeout if timeout is None else timeout)
+        job.future.add_done_callback(self._on_done(job))
+        with self._lock:
+            self._stats["submitted"] += 1
+        self._q.put(job)
+        return job.future
+
+    def _wait(self, fut, docx_path, timeout):
+        try:
+            return bool(fut.result(timeout=(self.timeout if timeout is None else timeout) + 5))
+        except FutureTimeout:
+            print("PDF convert quá hạn:", docx_path)
+        except Exception as e:
+            print("PDF convert failed:", e)
+        return False
+
+    def convert(self, docx_path, pdf_path, timeout=None):
+        """Convert 1 file, chờ kết quả; True nếu đã có PDF."""
+        return self._wait(self.submit(docx_path, pdf_path, timeout), docx_path, timeout)
+
+    def convert_many(self, pairs, timeout=None):
+        """Convert nhiều file trong 1 lượt (worker gom thành lô); trả về {docx_path: True/False}."""
+        futs = [(d, self.submit(d, p, timeout)) for d, p in pairs]
+        return {d: self._wait(f, d, timeout) for d, f in futs}
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            recent = sorted(self._recent)
+        finished = s["done"] + s["failed"]
+        return {
+            "backend": self.backend,
+            "workers": self.workers,
+            "queue_depth": self._q.qsize(),
+            "in_flight": s["in_flight"],
+            "submitted": s["submitted"],
+            "done": s["done"],
+            "failed": s["failed"],
+            "timeouts": s["timeouts"],
+            "batches": s["batches"],
+            "avg_batch": round((finished / s["batches"]), 2) if s["batches"] else 0.0,
+            "latency_avg": round(s["latency_total"] / finished, 3) if finished else 0.0,
+            "latency_p95": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 3) if recent else 0.0,
+            "latency_max": round(s["latency_max"], 3),
+        }
+
+
+_CONVERTER = None
+_CONVERTER_LOCK = threading.Lock()
+
+
+def get_pdf_converter():
+    global _CONVERTER
+    if _CONVERTER is None:
+        with _CONVERTER_LOCK:
+            if _CONVERTER is None:
+                _CONVERTER = PdfConverter()
+    return _CONVERTER
+
+
+def convert_to_pdf(docx_path, pdf_path, timeout=None):
+    return get_pdf_converter().convert(docx_path, pdf_path, timeout)
+
+
+def convert_many(pairs, timeout=None):
+    return get_pdf_converter().convert_many(pairs, timeout)
+
+
+def converter_stats():
+    return get_pdf_converter().stats()
+
+
+if __name__ == "__main__":
+    # python pdf_convert.py a.docx [b.docx ...]  -> PDF cạnh file DOCX
+    files = sys.argv[1:]
+    t0 = time.monotonic()
+    res = convert_many([(f, os.path.splitext(f)[0] + ".pdf") for f in files])
+    for f, ok in res.items():
+        print("OK " if ok else "LỖI", f)
+    print(converter_stats(), f"{time.monotonic() - t0:.2f}s")
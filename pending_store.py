@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from report_db import get_conn, _get_meta, _set_meta
+
+# =====================================================
+# Pending TFR (thay cho đọc/ghi lại cả tfr_requests.json)
+# - Bảng pending trong SQLite (cùng file report_store.db, WAL): mỗi request 1 dòng,
+#   thứ tự hiển thị theo cột pos (giữ đúng thứ tự list JSON cũ, chèn được "ngay sau bản gốc").
+# - Sửa / xoá theo pid (hoặc trq_id) trong 1 transaction BEGIN IMMEDIATE -> an toàn giữa các process.
+# - Index: trq_id, status, requestor, employee_id, request_date.
+# - Lần đầu chạy: import tfr_requests.json cũ (nếu có).
+# =====================================================
+
+LEGACY_JSON = "tfr_requests.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+    pid          INTEGER PRIMARY KEY AUTOINCREMENT,
+    pos          REAL,
+    trq_id       TEXT,
+    status       TEXT,
+    requestor    TEXT,
+    employee_id  TEXT,
+    request_date TEXT,
+    data_json    TEXT,
+    updated_at   REAL
+);
+CREATE INDEX IF NOT EXISTS ix_pending_pos    ON pending(pos);
+CREATE INDEX IF NOT EXISTS ix_pending_trq    ON pending(trq_id);
+CREATE INDEX IF NOT EXISTS ix_pending_status ON pending(status);
+CREATE INDEX IF NOT EXISTS ix_pending_req    ON pending(requestor);
+CREATE INDEX IF NOT EXISTS ix_pending_emp    ON pending(employee_id);
+CREATE INDEX IF NOT EXISTS ix_pending_date   ON pending(request_date);
+"""
+
+_SCHEMA_DONE = set()
+_SCHEMA_LOCK = threading.Lock()
+
+
+def _conn():
+    conn = get_conn()
+    key = id(conn)
+    if key not in _SCHEMA_DONE:
+        with _SCHEMA_LOCK:
+            conn.executescript(_SCHEMA)
+            _SCHEMA_DONE.add(key)
+            _migrate_legacy(conn)
+    return conn
+
+
+def _s(v):
+    return str(v or "").strip()
+
+
+def _cols(rec):
+    return (_s(rec.get("trq_id")), _s(rec.get("status")), _s(rec.get("requestor")).lower(),
+            _s(rec.get("employee_id")).lower(), _s(rec.get("request_date")),
+            json.dumps(rec, ensure_ascii=False), time.time())
+
+
+@contextmanager
+def transaction():
+    """BEGIN IMMEDIATE ... COMMIT: khoá ghi liên process trong lúc đọc-sửa-ghi."""
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        _bump_version(conn)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _bump_version(conn):
+    _set_meta(conn, "pending_version", str(int(_get_meta(conn, "pending_version", "0") or 0) + 1))
+
+
+def version():
+    """Đổi sau mỗi lần ghi (mọi process) -> dùng làm stamp cho cache."""
+    return _get_meta(_conn(), "pending_version", "0")
+
+
+def _migrate_legacy(conn):
+    if _get_meta(conn, "pending_migrated") == "1":
+        return
+    data = []
+    if os.path.exists(LEGACY_JSON):
+        try:
+            with open(LEGACY_JSON, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print("Đọc tfr_requests.json cũ lỗi:", e)
+            data = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if _get_meta(conn, "pending_migrated") != "1":
+            if isinstance(data, list):
+                conn.executemany(
+                    "INSERT INTO pending(pos, trq_id, status, requestor, employee_id, request_date, data_json, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(float(i + 1),) + _cols(r) for i, r in enumerate(data) if isinstance(r, dict)]
+                )
+            _set_meta(conn, "pending_migrated", "1")
+            _bump_version(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+# ---------- đọc ----------
+
+def pending_rows(status=None, requestor=None, employee_id=None, request_date=None, trq_id=None):
+    """[(pid, record)] theo thứ tự hiển thị; các filter dùng index (requestor/employee_id không phân biệt hoa thường)."""
+    sql = "SELECT pid, data_json FROM pending"
+    where, args = [], []
+    for col, val in (("status", status), ("requestor", requestor), ("employee_id", employee_id),
+                     ("request_date", request_date), ("trq_id", trq_id)):
+        if val is None:
+            continue
+        v = _s(val)
+        where.append(f"{col}=?")
+        args.append(v.lower() if col in ("requestor", "employee_id") else v)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY pos, pid"
+    out = []
+    for pid, data in _conn().execute(sql, args):
+        try:
+            out.append((pid, json.loads(data)))
+        except Exception:
+            continue
+    return out
+
+
+def rows_of_owner(requestor, employee_id):
+    """[(pid, record)] của 1 người: khớp requestor HOẶC employee_id (giống _eq: strip + lower)."""
+    sql = ("SELECT pid, data_json FROM pending WHERE requestor=? "
+           "UNION SELECT pid, data_json FROM pending WHERE employee_id=?")
+    rows = _conn().execute(
+        f"SELECT p.pid, p.data_json FROM pending p JOIN ({sql}) m ON m.pid=p.pid ORDER BY p.pos, p.pid",
+        (_s(requestor).lower(), _s(employee_id).lower())).fetchall()
+    out = []
+    for pid, data in rows:
+        try:
+            out.append((pid, json.loads(data)))
+        except Exception:
+            continue
+    return out
+
+
+def pending_list(**filters):
+    """Danh sách record (giống nội dung tfr_requests.json cũ)."""
+    return [r for _, r in pending_rows(**filters)]
+
+
+def get_request(pid):
+    row = _conn().execute("SELECT data_json FROM pending WHERE pid=?", (pid,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+# ---------- ghi ----------
+
+def _pos_after(conn, after_pid):
+    if after_pid is not None:
+        row = conn.execute("SELECT pos FROM pending WHERE pid=?", (after_pid,)).fetchone()
+        if row:
+            nxt = conn.execute("SELECT MIN(pos) FROM pending WHERE pos > ?", (row[0],)).fetchone()[0]
+            if nxt is None:
+                return row[0] + 1.0
+            if nxt - row[0] > 1e-6:
+                return (row[0] + nxt) / 2.0
+            # hết khe -> đánh lại pos rồi chèn
+            _renumber(conn)
+            return _pos_after(conn, after_pid)
+    top = conn.execute("SELECT MAX(pos) FROM pending").fetchone()[0]
+    return (top or 0.0) + 1.0
+
+
+def _renumber(conn):
+    pids = [p for (p,) in conn.execute("SELECT pid FROM pending ORDER BY pos, pid")]
+    conn.executemany("UPDATE pending SET pos=? WHERE pid=?", [(float(i + 1), p) for i, p in enumerate(pids)])
+
+
+def insert_request(rec, after_pid=None):
+    """Thêm 1 request (cuối danh sách, hoặc ngay sau after_pid). Trả về pid."""
+    with transaction() as conn:
+        pos = _pos_after(conn, after_pid)
+        cur = conn.execute(
+            "INSERT INTO pending(pos, trq_id, status, requestor, employee_id, request_date, data_json, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (pos,) + _cols(rec))
+        return cur.lastrowid
+
+
+def update_request(pid, rec):
+    """Ghi đè cả record của 1 dòng."""
+    with transaction() as conn:
+        return conn.execute(
+            "UPDATE pending SET trq_id=?, status=?, requestor=?, employee_id=?, request_date=?, data_json=?, updated_at=? "
+            "WHERE pid=?", _cols(rec) + (pid,)).rowcount > 0
+
+
+def patch_request(pid, fields):
+    """Sửa 1 vài field của 1 dòng (đọc-sửa-ghi trong cùng transaction)."""
+    with transaction() as conn:
+        return _patch(conn, pid, fields)
+
+
+def _patch(conn, pid, fields):
+    row = conn.execute("SELECT data_json FROM pending WHERE pid=?", (pid,)).fetchone()
+    if not row:
+        return False
+    rec = json.loads(row[0])
+    rec.update(fields)
+    conn.execute(
+        "UPDATE pending SET trq_id=?, status=?, requestor=?, employee_id=?, request_date=?, data_json=?, updated_at=? "
+        "WHERE pid=?", _cols(rec) + (pid,))
+    return True
+
+
+def patch_by_trq(trq_id, fields):
+    """Sửa field cho dòng ĐẦU TIÊN có trq_id; False nếu không có."""
+    with transaction() as conn:
+        row = conn.execute("SELECT pid FROM pending WHERE trq_id=? ORDER BY pos, pid LIMIT 1", (_s(trq_id),)).fetchone()
+        return bool(row) and _patch(conn, row[0], fields)
+
+
+def set_etd_bulk(updates):
+    """
+    updates: [{"trq_id", "idx", "etd"}] — ưu tiên khớp trq_id, fallback idx (vị trí trong danh sách).
+    Cùng logic _merge_update_etd cũ nhưng chỉ ghi các dòng đổi.
+    """
+    with transaction() as conn:
+        rows = [p for (p,) in conn.execute("SELECT pid FROM pending ORDER BY pos, pid")]
+        by_trq = {}
+        for pid, trq in conn.execute("SELECT pid, trq_id FROM pending ORDER BY pos, pid"):
+            if trq:
+                by_trq[trq] = pid   # giống map cũ: trq trùng -> lấy dòng cuối
+        changed = 0
+        for u in updates or []:
+            tid = _s(u.get("trq_id"))
+            etd = _s(u.get("etd"))
+            idx = u.get("idx")
+            pid = by_trq.get(tid) if tid else None
+            if pid is None and isinstance(idx, int) and 0 <= idx < len(rows):
+                pid = rows[idx]
+            if pid is not None and _patch(conn, pid, {"etd": etd}):
+                changed += 1
+        return changed
+
+
+def delete_request(pid):
+    with transaction() as conn:
+        return conn.execute("DELETE FROM pending WHERE pid=?", (pid,)).rowcount > 0
+
+
+def delete_requests(pids):
+    """Xoá nhiều dòng theo pid trong 1 transaction."""
+    pids = [p for p in (pids or []) if p is not None]
+    if not pids:
+        return 0
+    with transaction() as conn:
+        return conn.executemany("DELETE FROM pending WHERE pid=?", [(p,) for p in pids]).rowcount
+
+
+def delete_by_trq(trq_ids):
+    """Xoá mọi dòng có trq_id thuộc trq_ids (request đã approve)."""
+    ids = [_s(t) for t in (trq_ids or []) if _s(t)]
+    if not ids:
+        return 0
+    with transaction() as conn:
+        return conn.executemany("DELETE FROM pending WHERE trq_id=?", [(t,) for t in ids]).rowcount
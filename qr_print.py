@@ -13,8 +13,8 @@
 import io, os, re, unicodedata
 import datetime as dt
 from flask import Blueprint, request, send_file, render_template_string, session, current_app
-import openpyxl
 import qrcode
+from excel_utils import read_sheet_fast
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import mm
 from reportlab.lib.utils import ImageReader
@@ -129,16 +129,8 @@ def _safe_str(v, ascii_only=False):
 def _load_trf_table(xlsx_path):
     if not os.path.exists(xlsx_path):
         raise FileNotFoundError(f"Không thấy file TRF.xlsx tại: {xlsx_path}")
-    wb = openpyxl.load_workbook(xlsx_path, data_only=True)
-    ws = None
-    for name in ("TRF", "Sheet1"):
-        if name in wb.sheetnames:
-            ws = wb[name]
-            break
-    if ws is None:
-        ws = wb.active
-
-    headers = [cell.value for cell in ws[1]]
+    # Đọc 1 lượt ở chế độ read_only + values_only
+    headers, _, rows = read_sheet_fast(xlsx_path, sheet_names=("TRF", "Sheet1"), skip_blank=False)
     headers = [h if h is not None else "" for h in headers]
     norm_map = {_norm_header(str(h)): i for i, h in enumerate(headers)}
 
@@ -153,9 +145,7 @@ def _load_trf_table(xlsx_path):
             idx_typeof = norm_map[k]
             break
 
-    rows_values = []
-    for r in ws.iter_rows(min_row=2, values_only=True):
-        rows_values.append([r[i] if i < len(r) else None for i in range(len(headers))])
+    rows_values = [list(r) for _, r in rows]
 
     return headers, rows_values, idx_report, idx_typeof
 
@@ -0,0 +1,440 @@
+import os
+import sys
+import time
+import threading
+from excel_utils import _norm_str
+from report_db import get_conn, get_report_view, _excel_stamp, _get_meta, _set_meta
+from archive_store import get_archive_store
+import pending_store
+
+# =====================================================
+# Cấp REPORT NO từ các dòng đánh số sẵn còn trống (C..X trống)
+# - Bảng report_slots (SQLite, cùng file với report_db): free / reserved / committed.
+# - Lấy số: MIN(row_idx) WHERE state='free' qua index -> O(log n), không đụng Excel.
+# - Vòng đời: reserve -> (sinh DOCX/PDF, ghi Excel) -> commit; lỗi giữa chừng -> release.
+# - Chỉ đối chiếu lại với dữ liệu report (reconcile) khi file Excel đổi (mtime/size).
+# =====================================================
+
+RESERVE_TTL = 30 * 60   # giây: reserved mà dòng vẫn trống quá lâu -> trả lại free (committed không bao giờ hết hạn)
+BLANK_TOKENS = {"", "-", "—", "–"}
+
+# Nguồn "đã dùng" ngoài Excel (cùng giá trị với app.py)
+TFR_OUTPUT_FOLDER = os.path.join("static", "TFR")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_slots (
+    report_key TEXT PRIMARY KEY,
+    report_no  TEXT,
+    row_idx    INTEGER,
+    state      TEXT,
+    owner      TEXT,
+    changed_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_slots_free ON report_slots(state, row_idx);
+"""
+
+_SCHEMA_DONE = set()
+_SCHEMA_LOCK = threading.Lock()
+
+def _conn():
+    conn = get_conn()
+    key = id(conn)
+    if key not in _SCHEMA_DONE:
+        with _SCHEMA_LOCK:
+            conn.executescript(_SCHEMA)
+            _SCHEMA_DONE.add(key)
+    return conn
+
+def _is_blank(v):
+    if v is None:
+        return True
+    if isinstance(v, str):
+        s = (v.replace(" ", "").replace("​", "")
+               .replace("\r", "").replace("\n", "").replace("\t", "").strip())
+        return s in BLANK_TOKENS
+    return False
+
+def reconcile(force=False):
+    """
+    Đối chiếu report_slots với dữ liệu report (SQLite mirror / Excel):
+    - dòng có dữ liệu C..X -> committed
+    - dòng trống: committed giữ nguyên (dòng có thể còn nằm trong ExcelCommitBatch / hàng đợi export
+      sau 1 lần flush lỗi), reserved còn mới (< RESERVE_TTL) giữ nguyên, còn lại -> free
+    Chỉ chạy khi file Excel đổi hoặc force=True.
+    """
+    conn = _conn()
+    stamp = _excel_stamp()
+    if not force and stamp and _get_meta(conn, "slots_stamp") == stamp:
+        return False
+    view = get_report_view()
+    report_col = view.report_col
+    now = time.time()
+
+    current = {}
+    for key, state, owner, changed_at in conn.execute(
+            "SELECT report_key, state, owner, changed_at FROM report_slots"):
+        current[key] = (state, owner, changed_at)
+
+    rows = []
+    seen = set()
+    for row_idx, values in view.iter_rows():
+        rep = values[report_col - 1] if len(values) >= report_col else None
+        if rep is None or not str(rep).strip():
+            continue
+        key = _norm_str(rep)
+        if key in seen:
+            continue
+        seen.add(key)
+        filled = any(not _is_blank(v) for v in values[2:24])  # C..X
+        old_state, owner, changed_at = current.get(key, (None, "", now))
+        if filled:
+            state = "committed"
+            if old_state != "committed":
+                changed_at = now
+        elif old_state == "committed" or (old_state == "reserved" and now - (changed_at or 0) < RESERVE_TTL):
+            state = old_state
+        else:
+            state, owner, changed_at = "free", "", now
+        rows.append((key, str(rep).strip(), row_idx, state, owner or "", changed_at))
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM report_slots")
+        conn.executemany(
+            "INSERT INTO report_slots(report_key, report_no, row_idx, state, owner, changed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        _set_meta(conn, "slots_stamp", stamp)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if _USED is not None:
+        _USED.reload_source("excel")
+    return True
+
+def _ensure_fresh():
+    try:
+        reconcile()
+    except Exception as e:
+        print("report_alloc reconcile lỗi:", e)
+
+def reserve_report_no(owner="", preset=None, reuse=False):
+    """
+    Giữ chỗ 1 report_no (free -> reserved) trong 1 transaction.
+    - preset: giữ đúng số này (raise RuntimeError nếu số không còn trống).
+    - không preset: lấy dòng free có row_idx nhỏ nhất.
+    - Số đã dùng ở nguồn khác (đã có DOCX/PDF, đang pending, đã archive — UsedReportNumbers) thì bỏ qua
+      dù dòng Excel còn trống.
+    - reuse=True (owner phải duy nhất, vd job:<run_id>:<pid>): số đang reserved/committed của chính
+      owner đó được trả lại luôn -> chạy lại 1 bước không cấp thêm số mới.
+    """
+    _ensure_fresh()
+    used = _used_elsewhere()       # đọc trước transaction (có thể phải reconcile / load nguồn)
+    conn = _conn()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = None
+        if reuse and owner:
+            sql = "SELECT report_key, report_no, state FROM report_slots WHERE owner=? AND state IN ('reserved', 'committed')"
+            args = [owner]
+            if preset:
+                sql += " AND report_key=?"
+                args.append(_norm_str(preset))
+            row = conn.execute(sql + " ORDER BY row_idx LIMIT 1", args).fetchone()
+        if row is not None:
+            pass
+        elif preset:
+            row = conn.execute("SELECT report_key, report_no, state FROM report_slots WHERE report_key=?",
+                               (_norm_str(preset),)).fetchone()
+            if row is None or row[2] != "free" or row[0] in used:
+                raise RuntimeError(f"Mã report {preset} đã có dữ liệu, không thể ghi đè.")
+        else:
+            row, after = None, -1
+            while True:
+                r = conn.execute("SELECT report_key, report_no, state, row_idx FROM report_slots "
+                                 "WHERE state='free' AND row_idx>? ORDER BY row_idx LIMIT 1", (after,)).fetchone()
+                if r is None or r[0] not in used:
+                    row = r
+                    break
+                after = r[3]
+            if row is None:
+                raise RuntimeError("No empty report number available in Excel.")
+        conn.execute("UPDATE report_slots SET state='reserved', owner=?, changed_at=? WHERE report_key=?",
+                     (owner or "", now, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    _note_slot(row[1], free=False)
+    return row[1]
+
+def _used_elsewhere():
+    """report_key đã dùng ngoài report_slots (files / pending / archive); lỗi đọc index -> set rỗng."""
+    try:
+        return get_used_report_numbers().used_elsewhere()
+    except Exception as e:
+        print("UsedReportNumbers lỗi, cấp số chỉ theo Excel:", e)
+        return set()
+
+def _set_state(report_no, state, only_from=None):
+    conn = _conn()
+    sql = "UPDATE report_slots SET state=?, changed_at=?"
+    args = [state, time.time()]
+    if state == "free":
+        sql += ", owner=''"
+    sql += " WHERE report_key=?"
+    args.append(_norm_str(report_no))
+    if only_from:
+        sql += " AND state=?"
+        args.append(only_from)
+    return conn.execute(sql, args).rowcount > 0
+
+def commit_report_no(report_no):
+    """Đã ghi dữ liệu cho số này (reserved -> committed)."""
+    ok = _set_state(report_no, "committed")
+    if ok:
+        _note_slot(report_no, free=False)
+    return ok
+
+def release_report_no(report_no):
+    """Bỏ giữ chỗ (reserved -> free), ví dụ sinh DOCX lỗi."""
+    ok = _set_state(report_no, "free", only_from="reserved")
+    if ok:
+        _note_slot(report_no, free=True)
+    return ok
+
+def slot_state(report_no):
+    """'free' / 'reserved' / 'committed' hoặc None nếu số không có trong danh sách."""
+    _ensure_fresh()
+    row = _conn().execute("SELECT state FROM report_slots WHERE report_key=?",
+                          (_norm_str(report_no),)).fetchone()
+    return row[0] if row else None
+
+def is_report_no_used(report_no):
+    """Đã dùng = reserved/committed, hoặc không phải số đánh sẵn trong file (tránh ghi bậy)."""
+    return slot_state(report_no) != "free"
+
+def peek_free_report_no():
+    """Số free nhỏ nhất (không giữ chỗ)."""
+    _ensure_fresh()
+    row = _conn().execute("SELECT report_no FROM report_slots WHERE state='free' "
+                          "ORDER BY row_idx LIMIT 1").fetchone()
+    return row[0] if row else None
+
+def free_count():
+    _ensure_fresh()
+    return _conn().execute("SELECT COUNT(*) FROM report_slots WHERE state='free'").fetchone()[0]
+
+# =====================================================
+# UsedReportNumbers: tập report_no ĐÃ DÙNG (reserve_report_no bỏ qua các số này; report_no_exists)
+# Gộp 4 nguồn, load 1 lần rồi cập nhật dần:
+# - excel  : số không còn free trong report_slots (có dữ liệu / đang giữ chỗ / không có trong file)
+# - files  : static/TFR/<report_no>.pdf|.docx đã sinh
+# - pending: report_no trong pending_store (load lại khi version đổi)
+# - archive: report_no trong archive_store (add khi archive, load lại khi segment đổi)
+# =====================================================
+
+SOURCES = ("excel", "files", "pending", "archive")
+
+def _report_nos_in_pending():
+    out = set()
+    for r in pending_store.pending_list():
+        key = _norm_str(r.get("report_no") or "")
+        if key:
+            out.add(key)
+    return out
+
+def _report_nos_in_folder(folder):
+    out = set()
+    try:
+        with os.scandir(folder) as it:
+            for e in it:
+                stem, ext = os.path.splitext(e.name)
+                if ext.lower() in (".pdf", ".docx") and e.is_file():
+                    key = _norm_str(stem)
+                    if key:
+                        out.add(key)
+    except OSError:
+        pass
+    return out
+
+def _free_keys():
+    return {k for (k,) in _conn().execute("SELECT report_key FROM report_slots WHERE state='free'")}
+
+class UsedReportNumbers:
+    """
+    Kiểm tra "report_no đã dùng chưa" bằng tra set (không parse Excel / quét JSON mỗi lần).
+    - contains(report_no): True nếu đã dùng ở bất kỳ nguồn nào.
+    - add/discard(report_no, source): cập nhật dần khi approve / archive / sinh file.
+    - rebuild(): load lại cả 4 nguồn; check(): so index với nguồn thật.
+    """
+
+    def __init__(self, output_folder=TFR_OUTPUT_FOLDER):
+        self.output_folder = output_folder
+        self._lock = threading.RLock()
+        self._free = set()      # excel: số còn trống (không nằm trong đây = đã dùng)
+        self._sets = {"files": set(), "pending": set(), "archive": set()}
+        self._stamps = {}
+        self._loaded = False
+
+    def _read_source(self, source):
+        if source == "excel":
+            reconcile()
+            return _free_keys()
+        if source == "files":
+            return _report_nos_in_folder(self.output_folder)
+        if source == "pending":
+            return _report_nos_in_pending()
+        if source == "archive":
+            return {_norm_str(r) for r in get_archive_store().report_nos()} - {""}
+        raise ValueError(f"Nguồn không hợp lệ: {source}")
+
+    def reload_source(self, source):
+        with self._lock:
+            if not self._loaded and source != "excel":
+                return
+            if source == "excel":
+                self._free = _free_keys()
+                return
+            if source == "pending":
+                self._stamps["pending"] = pending_store.version()
+            elif source == "archive":
+                self._stamps["archive"] = get_archive_store().stamp()
+            self._sets[source] = self._read_source(source)
+
+    def rebuild(self):
+        with self._lock:
+            reconcile(force=True)
+            self._free = _free_keys()
+            self._stamps = {"pending": pending_store.version(),
+                            "archive": get_archive_store().stamp()}
+            for source in ("files", "pending", "archive"):
+                self._sets[source] = self._read_source(source)
+            self._loaded = True
+        return self
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.rebuild()
+            return
+        # Excel đổi (ghi ngoài app) -> reconcile sẽ gọi reload_source("excel")
+        _ensure_fresh()
+        # Chỉ đọc version pending / stat segment archive; đổi thì load lại nguồn đó
+        if pending_store.version() != self._stamps.get("pending"):
+            self.reload_source("pending")
+        if get_archive_store().stamp() != self._stamps.get("archive"):
+            self.reload_source("archive")
+
+    def sources_of(self, report_no):
+        """Các nguồn đang ghi nhận report_no đã dùng."""
+        key = _norm_str(report_no)
+        with self._lock:
+            self._ensure_loaded()
+            found = [] if key in self._free else ["excel"]
+            found += [s for s in ("files", "pending", "archive") if key in self._sets[s]]
+        return found
+
+    def contains(self, report_no):
+        key = _norm_str(report_no)
+        with self._lock:
+            self._ensure_loaded()
+            if key not in self._free:
+                return True
+            return any(key in self._sets[s] for s in ("files", "pending", "archive"))
+
+    __contains__ = contains
+
+    def used_elsewhere(self):
+        """Bản sao tập report_key đã dùng ở files / pending / archive (cho bộ cấp số)."""
+        with self._lock:
+            self._ensure_loaded()
+            return set().union(*(self._sets[s] for s in ("files", "pending", "archive")))
+
+    def add(self, report_no, source):
+        key = _norm_str(report_no)
+        if not key:
+            return
+        with self._lock:
+            if source == "excel":
+                self._free.discard(key)
+                return
+            self._sets[source].add(key)
+            # đã biết thay đổi của chính mình -> không cần load lại file
+            if source == "pending":
+                self._stamps[source] = pending_store.version()
+            elif source == "archive":
+                self._stamps[source] = get_archive_store().stamp()
+
+    def discard(self, report_no, source):
+        key = _norm_str(report_no)
+        with self._lock:
+            if source == "excel":
+                if key:
+                    self._free.add(key)
+                return
+            self._sets[source].discard(key)
+
+    def check(self):
+        """
+        So index với nguồn thật: {source: {"missing": [...], "extra": [...]}} (chỉ nguồn lệch).
+        - missing: nguồn có mà index chưa có; extra: index có mà nguồn không còn.
+        """
+        diffs = {}
+        with self._lock:
+            self._ensure_loaded()
+            for source in SOURCES:
+                actual = self._read_source(source)
+                have = self._free if source == "excel" else self._sets[source]
+                if source == "excel":
+                    # excel lưu số free: missing = đã dùng thật nhưng index còn free
+                    missing, extra = have - actual, actual - have
+                else:
+                    missing, extra = actual - have, have - actual
+                if missing or extra:
+                    diffs[source] = {"missing": sorted(missing), "extra": sorted(extra)}
+        return diffs
+
+_USED = None
+_USED_LOCK = threading.Lock()
+
+def get_used_report_numbers():
+    global _USED
+    if _USED is None:
+        with _USED_LOCK:
+            if _USED is None:
+                _USED = UsedReportNumbers()
+    return _USED
+
+def _note_slot(report_no, free):
+    if _USED is not None:
+        if free:
+            _USED.discard(report_no, "excel")
+        else:
+            _USED.add(report_no, "excel")
+
+def note_report_used(report_no, source):
+    """Hook cho approve / archive / sinh file: ghi nhận report_no đã dùng."""
+    if _USED is not None:
+        _USED.add(report_no, source)
+
+
+if __name__ == "__main__":
+    # python report_alloc.py rebuild  -> reconcile report_slots + load lại index
+    # python report_alloc.py check    -> in các chỗ index lệch nguồn thật
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "check"
+    used = get_used_report_numbers()
+    if cmd == "rebuild":
+        used.rebuild()
+        print("Free report_no:", len(used._free), {s: len(v) for s, v in used._sets.items()})
+    elif cmd == "check":
+        diffs = used.check()
+        if not diffs:
+            print("OK: index khớp với Excel / static/TFR / pending / archive")
+        for source, d in diffs.items():
+            print(f"{source}: thiếu {len(d['missing'])} {d['missing'][:20]}, thừa {len(d['extra'])} {d['extra'][:20]}")
+        sys.exit(1 if diffs else 0)
+    else:
+        print("Dùng: python report_alloc.py [rebuild|check]")
+        sys.exit(2)
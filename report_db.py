@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import datetime
+from config import local_main, REPORT_DB, USE_REPORT_DB, REPORT_DB_EXPORT_INTERVAL
+from lock_utils import named_lock
+from excel_utils import get_report_index, header_map_from_list, normalize_colname, _norm_str, _as_int_like, apply_row_updates, append_rows_to_trf
+
+# =====================================================
+# SQLite mirror của file Excel chính (WAL, khoá report#)
+# - Ghi: SQLite trước (nhanh, có transaction) + hàng đợi export.
+# - Exporter nền gom thay đổi, ghi local_main / TRF.xlsx 1 lần mỗi đợt.
+# - Đọc: home/update/dashboard lấy từ SQLite qua ReportStoreView.
+# =====================================================
+
+_local = threading.local()
+_INIT_LOCK = threading.Lock()
+_INITED = set()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS headers (
+    col  INTEGER PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS reports (
+    row_idx     INTEGER PRIMARY KEY,
+    report_no   TEXT,
+    report_key  TEXT,
+    report_num  INTEGER,
+    item        TEXT,
+    status      TEXT,
+    type_of     TEXT,
+    values_json TEXT,
+    updated_at  REAL
+);
+CREATE INDEX IF NOT EXISTS ix_reports_key    ON reports(report_key);
+CREATE INDEX IF NOT EXISTS ix_reports_num    ON reports(report_num);
+CREATE INDEX IF NOT EXISTS ix_reports_status ON reports(status);
+CREATE INDEX IF NOT EXISTS ix_reports_type   ON reports(type_of);
+CREATE INDEX IF NOT EXISTS ix_reports_item   ON reports(item);
+CREATE TABLE IF NOT EXISTS export_cells (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    row_idx    INTEGER,
+    col        INTEGER,
+    value_json TEXT,
+    fmt        TEXT
+);
+CREATE TABLE IF NOT EXISTS export_trf (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    report_no TEXT,
+    trf_path  TEXT,
+    trq_id    TEXT
+);
+"""
+
+def _db_path():
+    return os.path.abspath(REPORT_DB)
+
+def get_conn():
+    """Connection riêng cho mỗi thread (sqlite3 không chia sẻ được giữa thread)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(_db_path(), timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        _local.conn = conn
+    path = _db_path()
+    if path not in _INITED:
+        with _INIT_LOCK:
+            if path not in _INITED:
+                conn.executescript(_SCHEMA)
+                _INITED.add(path)
+    return conn
+
+def enabled_for(excel_path):
+    """Chỉ mirror file Excel chính (local_main)."""
+    return USE_REPORT_DB and os.path.abspath(excel_path) == os.path.abspath(local_main)
+
+# ---------- encode/decode giá trị ô ----------
+
+def _enc(v):
+    if isinstance(v, datetime.datetime):
+        return {"$dt": v.isoformat()}
+    if isinstance(v, datetime.date):
+        return {"$d": v.isoformat()}
+    if isinstance(v, datetime.time):
+        return v.isoformat()
+    if v is None or isinstance(v, (str, int, float, bool)):
+        return v
+    return str(v)
+
+def _dec(v):
+    if isinstance(v, dict):
+        if "$dt" in v:
+            return datetime.datetime.fromisoformat(v["$dt"])
+        if "$d" in v:
+            return datetime.date.fromisoformat(v["$d"])
+    return v
+
+def _dumps_values(values):
+    return json.dumps([_enc(v) for v in values], ensure_ascii=False)
+
+def _loads_values(s):
+    try:
+        return tuple(_dec(v) for v in json.loads(s or "[]"))
+    except Exception:
+        return ()
+
+# ---------- meta ----------
+
+def _get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+def _set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, value))
+
+def _excel_stamp(path=None):
+    try:
+        st = os.stat(path or local_main)
+        return f"{st.st_mtime_ns}:{st.st_size}"
+    except OSError:
+        return ""
+
+def _summary_cols(headers):
+    cols = header_map_from_list(headers)
+    return cols.get("item#"), cols.get("status"), cols.get("typeof")
+
+def _pick(values, col):
+    if not col or len(values) < col:
+        return ""
+    v = values[col - 1]
+    return "" if v is None else str(v).strip()
+
+def _row_record(row_idx, report_col, sum_cols, values):
+    item_col, status_col, type_col = sum_cols
+    rep = values[report_col - 1] if len(values) >= report_col else None
+    rep_s = "" if rep is None else str(rep).strip()
+    return (
+        row_idx, rep_s, _norm_str(rep) if rep_s else None, _as_int_like(rep) if rep_s else None,
+        _pick(values, item_col), _pick(values, status_col).upper(), _pick(values, type_col),
+        _dumps_values(values), time.time(),
+    )
+
+# ---------- đồng bộ Excel -> SQLite ----------
+
+def _pending_export_count(conn):
+    a = conn.execute("SELECT COUNT(*) FROM export_cells").fetchone()[0]
+    b = conn.execute("SELECT COUNT(*) FROM export_trf").fetchone()[0]
+    return a + b
+
+def sync_from_excel(force=False):
+    """
+    Nạp lại toàn bộ dòng từ Excel khi file bị sửa ngoài app (mtime/size đổi).
+    Nếu còn thay đổi chưa export thì chờ exporter ghi xong mới nạp (tránh đè dữ liệu mới).
+    """
+    conn = get_conn()
+    stamp = _excel_stamp()
+    if not stamp:
+        return False
+    if not force and _get_meta(conn, "excel_stamp") == stamp:
+        return False
+    if not force and _pending_export_count(conn):
+        return False
+    idx = get_report_index(local_main)
+    headers = idx.headers
+    report_col = idx.report_col
+    sum_cols = _summary_cols(headers)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM headers")
+        conn.executemany("INSERT INTO headers(col, name) VALUES (?, ?)",
+                         [(c, None if n is None else str(n)) for c, n in enumerate(headers, start=1)])
+        conn.execute("DELETE FROM reports")
+        conn.executemany(
+            "INSERT INTO reports(row_idx, report_no, report_key, report_num, item, status, type_of, values_json, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (_row_record(r, report_col, sum_cols, v) for r, v in idx.iter_rows())
+        )
+        _set_meta(conn, "excel_stamp", stamp)
+        _set_meta(conn, "report_col", str(report_col))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return True
+
+def _ensure_synced():
+    try:
+        sync_from_excel()
+    except Exception as e:
+        print("report_db sync lỗi:", e)
+
+# ---------- ghi ----------
+
+def upsert_row_cells(report_no, row_idx, updates):
+    """
+    Ghi các ô {col: (value, fmt)} của 1 dòng vào SQLite + đưa vào hàng đợi export (1 transaction).
+    """
+    upsert_rows([(report_no, row_idx, updates)])
+
+def upsert_rows(rows):
+    """rows: [(report_no, row_idx, updates)] -> ghi tất cả trong 1 transaction."""
+    _ensure_synced()
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        headers = [r[0] for r in conn.execute("SELECT name FROM headers ORDER BY col")]
+        report_col = int(_get_meta(conn, "report_col", "2") or 2)
+        sum_cols = _summary_cols(headers)
+        for report_no, row_idx, updates in rows:
+            row = conn.execute("SELECT values_json FROM reports WHERE row_idx=?", (row_idx,)).fetchone()
+            values = list(_loads_values(row[0])) if row else []
+            need = max([len(values), len(headers)] + list(updates.keys()))
+            values += [None] * (need - len(values))
+            if not row and report_no is not None and len(values) >= report_col:
+                values[report_col - 1] = values[report_col - 1] or report_no
+            for col, (value, fmt) in updates.items():
+                values[col - 1] = value
+            conn.execute(
+                "INSERT OR REPLACE INTO reports(row_idx, report_no, report_key, report_num, item, status, type_of, values_json, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", _row_record(row_idx, report_col, sum_cols, values)
+            )
+            conn.executemany(
+                "INSERT INTO export_cells(row_idx, col, value_json, fmt) VALUES (?, ?, ?, ?)",
+                [(row_idx, col, json.dumps(_enc(value), ensure_ascii=False), fmt) for col, (value, fmt) in updates.items()]
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def queue_trf_append(report_no, trf_excel_path, trq_id=None):
+    """Append dòng sang TRF.xlsx sau khi exporter đã ghi dòng đó ra Excel chính."""
+    conn = get_conn()
+    conn.execute("INSERT INTO export_trf(report_no, trf_path, trq_id) VALUES (?, ?, ?)",
+                 (str(report_no), trf_excel_path, trq_id or ""))
+    request_export()
+
+# ---------- exporter SQLite -> Excel ----------
+
+_EXPORT_EVENT = threading.Event()
+_EXPORT_LOCK = threading.Lock()
+_EXPORTER = None
+
+def request_export():
+    start_exporter()
+    _EXPORT_EVENT.set()
+
+def _read_exports(conn):
+    """Đọc hàng đợi (chưa xoá): chỉ xoá sau khi đã ghi ra Excel -> process chết giữa chừng thì lần sau ghi lại."""
+    cells = conn.execute("SELECT id, row_idx, col, value_json, fmt FROM export_cells ORDER BY id").fetchall()
+    trfs = conn.execute("SELECT id, report_no, trf_path, trq_id FROM export_trf ORDER BY id").fetchall()
+    return cells, trfs
+
+def _delete_exports(conn, sql, params):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(sql, params)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def flush_exports():
+    """
+    Ghi toàn bộ thay đổi đang chờ ra local_main (1 lần mở/lưu) rồi append TRF. Trả về số ô đã ghi.
+    - Giữ named_lock("report_db_export") suốt đọc hàng đợi -> ghi Excel -> xoá: nhiều process cùng chạy exporter
+      thì lần lượt từng process, ghi đúng thứ tự id (giá trị cũ không đè giá trị mới).
+    - Ghi lỗi / process chết trước khi xoá -> hàng đợi còn nguyên, lần sau ghi lại
+      (ghi ô là idempotent; append TRF bỏ qua report đã có trong TRF).
+    """
+    with _EXPORT_LOCK, named_lock("report_db_export"):
+        conn = get_conn()
+        cells, trfs = _read_exports(conn)
+        if not cells and not trfs:
+            return 0
+
+        if cells:
+            row_updates = {}
+            for _id, row_idx, col, value_json, fmt in cells:
+                row_updates.setdefault(row_idx, {})[col] = (_dec(json.loads(value_json)), fmt)
+            # Excel đang bị khoá (đang mở bằng Excel...) -> lỗi, hàng đợi giữ nguyên, lần sau ghi tiếp
+            apply_row_updates(local_main, row_updates)
+            _delete_exports(conn, "DELETE FROM export_cells WHERE id<=?", [(cells[-1][0],)])
+            _set_meta(conn, "excel_stamp", _excel_stamp())
+
+        by_path = {}
+        for t in trfs:
+            by_path.setdefault(t[2], []).append(t)
+        for trf_path, group in by_path.items():
+            try:
+                append_rows_to_trf([t[1] for t in group], local_main, trf_path)
+            except Exception as e:
+                # TRF.xlsx đang mở / bị khoá -> để nguyên trong hàng đợi như phần ô Excel
+                print("Append TRF lỗi:", e)
+                continue
+            _delete_exports(conn, "DELETE FROM export_trf WHERE id=?", [(t[0],) for t in group])
+        return len(cells)
+
+def _exporter_loop(interval):
+    while True:
+        _EXPORT_EVENT.wait(timeout=interval * 10)
+        # gom thêm thay đổi trong 'interval' giây rồi mới ghi 1 lần
+        time.sleep(interval)
+        _EXPORT_EVENT.clear()
+        try:
+            flush_exports()
+        except Exception as e:
+            print("report_db export lỗi:", e)
+
+def start_exporter(interval=REPORT_DB_EXPORT_INTERVAL):
+    global _EXPORTER
+    if not USE_REPORT_DB or (_EXPORTER is not None and _EXPORTER.is_alive()):
+        return
+    _ensure_synced()
+    _EXPORTER = threading.Thread(target=_exporter_loop, args=(interval,), name="report-db-exporter", daemon=True)
+    _EXPORTER.start()
+
+# ---------- đọc ----------
+
+class ReportStoreView:
+    """
+    Giao diện đọc giống ReportIndex (headers, col, find_row, row_values, iter_rows, get_row)
+    nhưng lấy dữ liệu từ SQLite -> thấy ngay cả thay đổi chưa export ra Excel.
+    """
+
+    def __init__(self):
+        conn = get_conn()
+        self._headers = [r[0] for r in conn.execute("SELECT name FROM headers ORDER BY col")]
+        self._cols = header_map_from_list(self._headers)
+        self.report_col = int(_get_meta(conn, "report_col", "2") or 2)
+
+    @property
+    def headers(self):
+        return list(self._headers)
+
+    def col(self, target):
+        return self._cols.get(normalize_colname(target))
+
+    def find_row(self, report_no):
+        if report_no is None:
+            return None
+        conn = get_conn()
+        row = conn.execute("SELECT row_idx FROM reports WHERE report_key=? ORDER BY row_idx LIMIT 1",
+                           (_norm_str(report_no),)).fetchone()
+        if row is None:
+            num = _as_int_like(report_no)
+            if num is not None:
+                row = conn.execute("SELECT row_idx FROM reports WHERE report_num=? ORDER BY row_idx LIMIT 1",
+                                   (num,)).fetchone()
+        return row[0] if row else None
+
+    def row_values(self, row_idx):
+        row = get_conn().execute("SELECT values_json FROM reports WHERE row_idx=?", (row_idx,)).fetchone()
+        return _loads_values(row[0]) if row else None
+
+    def get_row(self, report_no):
+        row_idx = self.find_row(report_no)
+        if row_idx is None:
+            return None
+        values = self.row_values(row_idx) or ()
+        out = {}
+        for c, name in enumerate(self._headers):
+            if name and name not in out:
+                out[name] = values[c] if c < len(values) else None
+        return out
+
+    def iter_rows(self, status_in=None, type_of=None, item_like=None):
+        """Yield (row_idx, values) theo thứ tự dòng; lọc bằng index SQL nếu có tham số."""
+        sql = "SELECT row_idx, values_json FROM reports"
+        where, args = [], []
+        if status_in:
+            where.append("status IN (%s)" % ",".join("?" * len(status_in)))
+            args += [str(s).upper() for s in status_in]
+        if type_of:
+            where.append("type_of=?")
+            args.append(type_of)
+        if item_like:
+            where.append("item LIKE ?")
+            args.append(f"%{item_like}%")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY row_idx"
+        for row_idx, values_json in get_conn().execute(sql, args):
+            yield row_idx, _loads_values(values_json)
+
+    def distinct(self, field):
+        """Giá trị khác nhau của item/status/type_of (dùng index, không quét dòng)."""
+        if field not in ("item", "status", "type_of"):
+            return []
+        return [r[0] for r in get_conn().execute(
+            f"SELECT DISTINCT {field} FROM reports WHERE {field}<>'' ORDER BY {field}")]
+
+def get_report_view(excel_path=None):
+    """
+    Nguồn đọc cho các route: SQLite mirror nếu bật, ngược lại ReportIndex trên Excel.
+    """
+    path = excel_path or local_main
+    if enabled_for(path):
+        try:
+            _ensure_synced()
+            return ReportStoreView()
+        except Exception as e:
+            print("report_db đọc lỗi, dùng Excel:", e)
+    return get_report_index(path)
@@ -1,7 +1,7 @@
 # test_logic.py
 import os, re
-from image_utils import allowed_file
 from config import UPLOAD_FOLDER
+import image_manifest
 
 def is_drop_test(title):
     return "drop test" in title['full'].lower() or "drop test" in title.get('short', '').lower()
@@ -39,22 +39,18 @@ def load_group_notes(path: str) -> dict:
 
 def get_group_test_status(report, group, test_key):
     report_folder = os.path.join(UPLOAD_FOLDER, str(report))
-    status_file = os.path.join(report_folder, f"status_{group}_{test_key}.txt")
-    comment_file = os.path.join(report_folder, f"comment_{group}_{test_key}.txt")
+    idx = image_manifest.folder_index(report_folder)
+    status_name = f"status_{group}_{test_key}.txt"
+    comment_name = f"comment_{group}_{test_key}.txt"
     status = comment = None
-    has_img = False
-    first_img = None
-    if os.path.exists(report_folder):
-        for f in sorted(os.listdir(report_folder)):
-            if allowed_file(f) and f.startswith(f"test_{group}_{test_key}_"):
-                has_img = True
-                first_img = f"/images/{report}/{f}"
-                break
-    if os.path.exists(status_file):
-        with open(status_file, 'r', encoding='utf-8') as f:
+    imgs = idx.image_urls(report, f"test_{group}_{test_key}_")
+    has_img = bool(imgs)
+    first_img = imgs[0] if imgs else None
+    if idx.has(status_name):
+        with open(idx.path(status_name), 'r', encoding='utf-8') as f:
             status = f.read().strip()
-    if os.path.exists(comment_file):
-        with open(comment_file, 'r', encoding='utf-8') as f:
+    if idx.has(comment_name):
+        with open(idx.path(comment_name), 'r', encoding='utf-8') as f:
             comment = f.read().strip()
     return {'status': status, 'comment': comment, 'has_img': has_img, 'first_img': first_img}
 
@@ -242,15 +242,49 @@ def _end_of_day(dt: datetime) -> datetime:
     return dt.replace(hour=23, minute=59, second=59, microsecond=999999)
 
 # --------------------- EXCEL LOAD ---------------------
+def _load_df_from_report_db():
+    """
+    Đọc từ SQLite mirror (report_db) nếu EXCEL_PATH là file chính -> không parse lại cả workbook.
+    Trả về None để fallback pd.read_excel.
+    """
+    try:
+        from report_db import get_report_view, ReportStoreView, enabled_for
+        if not enabled_for(EXCEL_PATH):
+            return None
+        view = get_report_view(EXCEL_PATH)
+        if not isinstance(view, ReportStoreView):
+            return None
+        # Đặt tên cột giống pandas: trống -> 'Unnamed: i', trùng -> 'name.1'
+        cols, seen = [], {}
+        for i, name in enumerate(view.headers):
+            name = f"Unnamed: {i}" if name is None or str(name).strip() == "" else str(name)
+            if name in seen:
+                seen[name] += 1
+                name = f"{name}.{seen[name]}"
+            else:
+                seen[name] = 0
+            cols.append(name)
+        n = len(cols)
+        data = []
+        for _, values in view.iter_rows():
+            values = list(values[:n]) + [None] * (n - len(values))
+            data.append(values)
+        return pd.DataFrame(data, columns=cols)
+    except Exception as e:
+        print("dashboard: đọc report_db lỗi, dùng Excel:", e)
+        return None
+
 def load_rows_from_excel():
     if not os.path.exists(EXCEL_PATH):
         raise FileNotFoundError(f"Excel not found: {EXCEL_PATH}")
 
-    sheet_to_read = 0 if SHEET_NAME_ENV is None else SHEET_NAME_ENV
-    df = pd.read_excel(EXCEL_PATH, sheet_name=sheet_to_read, engine="openpyxl")
-    if isinstance(df, dict):
-        first_key = list(df.keys())[0]
-        df = df[first_key]
+    df = _load_df_from_report_db() if SHEET_NAME_ENV is None else None
+    if df is None:
+        sheet_to_read = 0 if SHEET_NAME_ENV is None else SHEET_NAME_ENV
+        df = pd.read_excel(EXCEL_PATH, sheet_name=sheet_to_read, engine="openpyxl")
+        if isinstance(df, dict):
+            first_key = list(df.keys())[0]
+            df = df[first_key]
 
     df = df.dropna(how="all")
 
@@ -764,12 +798,11 @@ def audit_dashboard():
 @dashboard_bp.route("/dashboard/audit/headers")
 def audit_headers():
     try:
-        sheet_to_read = 0 if SHEET_NAME_ENV is None else SHEET_NAME_ENV
-        df = pd.read_excel(EXCEL_PATH, sheet_name=sheet_to_read, engine="openpyxl")
-        if isinstance(df, dict):
-            first_key = list(df.keys())[0]
-            df = df[first_key]
-        headers = list(df.columns)
+        # chỉ cần dòng header -> đọc read_only, dừng ngay sau dòng 1
+        from excel_utils import read_sheet_fast
+        sheet_names = None if SHEET_NAME_ENV is None else (SHEET_NAME_ENV,)
+        raw, _, _ = read_sheet_fast(EXCEL_PATH, sheet_names=sheet_names, header_only=True)
+        headers = [(h if h not in (None, "") else f"Unnamed: {i}") for i, h in enumerate(raw)]
         return jsonify({
             "headers_raw": headers,
             "headers_normalized": [{ "raw": h, "norm": _norm_header(h) } for h in headers]
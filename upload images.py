@@ -78,8 +78,8 @@ def clean_unlabeled_txt(root_folder: str, dry_run: bool = False, min_age_days: i
 # =============== IMAGE COMPRESS (IN-PLACE, IDEMPOTENT) ===============
 def compress_image_inplace(path, quality=80, max_side=2000):
     try:
-        with Image.open(path) as img:
-            img = ImageOps.exif_transpose(img)
+        with Image.open(path) as im:
+            img = ImageOps.exif_transpose(im)
             w, h = img.size
             m = max(w, h)
             if m > max_side:
@@ -87,7 +87,12 @@ def compress_image_inplace(path, quality=80, max_side=2000):
                 img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
             if img.mode in ("RGBA", "P"):
                 img = img.convert("RGB")
-            img.save(path, "JPEG", quality=quality, optimize=True)
+            img.load()
+        # ghi file tạm rồi thay (sau khi đã đóng ảnh gốc): ảnh có thể là hardlink dùng chung (blob_store)
+        # -> không ghi đè tại chỗ
+        tmp = path + ".tmp"
+        img.save(tmp, "JPEG", quality=quality, optimize=True)
+        os.replace(tmp, path)
     except Exception as e:
         print(f"[WARN] Lỗi nén ảnh {path}: {e}")
 
@@ -416,6 +421,14 @@ def process():
         clean_unlabeled_txt(folder, dry_run=False, min_age_days=0)
         compress_folder_inplace_smart(folder, quality=80, max_side=2000)
 
+    # 1b) Ảnh vừa nén là file mới -> gộp lại các bản trùng bằng hardlink (blob_store)
+    try:
+        import blob_store
+        s = blob_store.backfill(folders)
+        print(f"[INFO] Dedup ảnh: {s['linked']} file trùng, thu hồi {s['bytes_reclaimed']} byte")
+    except Exception as e:
+        print(f"[WARN] Dedup ảnh lỗi: {e}")
+
     # 2) Gom bucket theo THÁNG, nhưng tháng lấy từ day_label (của folder theo ảnh)
     month_buckets = {}  # { 'YYYYMM': [(folder_path, day_label)] }
     for folder in folders:
@@ -0,0 +1,352 @@
+import os
+import re
+import uuid
+import shutil
+import zipfile
+import datetime
+from xml.sax.saxutils import escape
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.styles.numbers import BUILTIN_FORMATS
+
+# =====================================================
+# Ghi trực tiếp XML trong file .xlsx cho vài dòng (không load cả workbook)
+# - Chỉ sửa <c> của các dòng cần ghi trong sheet XML (+ sharedStrings/styles nếu cần),
+#   các part khác copy nguyên.
+# - Giữ style/number_format sẵn có của ô; ngày có fmt (vd 'dd-mmm') sẽ dùng/thêm xf tương ứng.
+# - Gặp layout không chắc chắn (formula, sheet có prefix namespace, ô thiếu r=...) -> raise
+#   XlsxPatchUnsupported để caller fallback sang openpyxl.
+# =====================================================
+
+class XlsxPatchUnsupported(Exception):
+    pass
+
+_ILLEGAL_XML = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_CELL_RE = re.compile(r'<c\b([^>]*?)(/>|>(.*?)</c>)', re.S)
+_ROW_START_RE = re.compile(r'<row\b[^>]*?\br="(\d+)"[^>]*?(/?)>')
+
+def _attr(attrs, name):
+    m = re.search(r'(?:^|\s)%s="([^"]*)"' % re.escape(name), attrs)
+    return m.group(1) if m else None
+
+def _set_attr(tag_attrs, name, value):
+    """Đổi/thêm attribute trong chuỗi attrs (không gồm tên thẻ)."""
+    pat = re.compile(r'(\s%s=")[^"]*(")' % re.escape(name))
+    if pat.search(tag_attrs):
+        return pat.sub(lambda m: m.group(1) + value + m.group(2), tag_attrs, count=1)
+    return f'{tag_attrs} {name}="{value}"'
+
+def _resolve_target(base_dir, target):
+    if target.startswith("/"):
+        return target.lstrip("/")
+    parts = (base_dir + "/" + target).split("/")
+    out = []
+    for p in parts:
+        if p == "..":
+            if out:
+                out.pop()
+        elif p and p != ".":
+            out.append(p)
+    return "/".join(out)
+
+def _active_sheet_part(zin):
+    wb_xml = zin.read("xl/workbook.xml").decode("utf-8")
+    m = re.search(r'<(?:\w+:)?workbookView\b[^>]*\bactiveTab="(\d+)"', wb_xml)
+    active = int(m.group(1)) if m else 0
+    sheets = re.findall(r'<(?:\w+:)?sheet\b([^>]*?)/?>', wb_xml)
+    if not sheets:
+        raise XlsxPatchUnsupported("workbook.xml không có sheet")
+    attrs = sheets[active] if active < len(sheets) else sheets[0]
+    m = re.search(r'\b\w+:id="([^"]+)"', attrs)
+    if not m:
+        raise XlsxPatchUnsupported("sheet thiếu r:id")
+    rid = m.group(1)
+    rels = zin.read("xl/_rels/workbook.xml.rels").decode("utf-8")
+    for rel in re.findall(r'<(?:\w+:)?Relationship\b([^>]*?)/?>', rels):
+        if _attr(rel, "Id") == rid:
+            return _resolve_target("xl", _attr(rel, "Target") or "")
+    raise XlsxPatchUnsupported("không tìm thấy sheet part")
+
+def _find_part(zin, suffix):
+    for name in zin.namelist():
+        if name.lower().endswith(suffix):
+            return name
+    return None
+
+def _excel_serial(dt, date1904=False):
+    if isinstance(dt, datetime.date) and not isinstance(dt, datetime.datetime):
+        dt = datetime.datetime(dt.year, dt.month, dt.day)
+    if dt.tzinfo is not None:
+        dt = dt.replace(tzinfo=None)
+    epoch = datetime.datetime(1904, 1, 1) if date1904 else datetime.datetime(1899, 12, 30)
+    delta = dt - epoch
+    serial = delta.days + delta.seconds / 86400.0 + delta.microseconds / 86400e6
+    return int(serial) if serial == int(serial) else serial
+
+def _norm_fmt(code):
+    return (code or "").replace("\\", "").replace('"', "").strip().lower()
+
+class _Styles:
+    """Đọc/sửa cellXfs + numFmts trong styles.xml ở mức chuỗi."""
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.changed = False
+        m = re.search(r'<cellXfs\b([^>]*)>(.*?)</cellXfs>', xml, re.S)
+        if not m:
+            raise XlsxPatchUnsupported("styles.xml thiếu cellXfs")
+        self.xfs = re.findall(r'<xf\b[^>]*?(?:/>|>.*?</xf>)', m.group(2), re.S)
+        self.numfmts = {}
+        for nf in re.findall(r'<numFmt\b([^>]*?)/?>', xml):
+            try:
+                self.numfmts[int(_attr(nf, "numFmtId"))] = _attr(nf, "formatCode") or ""
+            except (TypeError, ValueError):
+                continue
+
+    def fmt_code(self, num_fmt_id):
+        if num_fmt_id in self.numfmts:
+            return self.numfmts[num_fmt_id]
+        return BUILTIN_FORMATS.get(num_fmt_id, "General")
+
+    def xf_numfmt(self, s_idx):
+        if s_idx >= len(self.xfs):
+            return 0
+        v = _attr(self.xfs[s_idx], "numFmtId")
+        return int(v) if v and v.isdigit() else 0
+
+    def _numfmt_id_for(self, fmt):
+        want = _norm_fmt(fmt)
+        for fid, code in BUILTIN_FORMATS.items():
+            if _norm_fmt(code) == want:
+                return fid
+        for fid, code in self.numfmts.items():
+            if _norm_fmt(code) == want:
+                return fid
+        new_id = max([163] + list(self.numfmts.keys())) + 1
+        node = f'<numFmt numFmtId="{new_id}" formatCode="{escape(fmt, {chr(34): "&quot;"})}"/>'
+        m = re.search(r'<numFmts\b([^>]*)>(.*?)</numFmts>', self.xml, re.S)
+        if m:
+            attrs = _set_attr(m.group(1), "count", str(len(self.numfmts) + 1))
+            self.xml = self.xml[:m.start()] + f'<numFmts{attrs}>{m.group(2)}{node}</numFmts>' + self.xml[m.end():]
+        else:
+            m = re.search(r'<styleSheet\b[^>]*>', self.xml)
+            if not m:
+                raise XlsxPatchUnsupported("styles.xml lạ")
+            self.xml = self.xml[:m.end()] + f'<numFmts count="1">{node}</numFmts>' + self.xml[m.end():]
+        self.numfmts[new_id] = fmt
+        self.changed = True
+        return new_id
+
+    def style_with_format(self, s_idx, fmt):
+        """Trả về index xf = xf hiện tại của ô nhưng numFmt = fmt (tái dùng nếu đã có)."""
+        if _norm_fmt(self.fmt_code(self.xf_numfmt(s_idx))) == _norm_fmt(fmt):
+            return s_idx
+        fid = self._numfmt_id_for(fmt)
+        base = self.xfs[s_idx] if s_idx < len(self.xfs) else '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        m = re.match(r'<xf\b([^>]*?)(/>|>)', base)
+        attrs = _set_attr(m.group(1), "numFmtId", str(fid))
+        attrs = _set_attr(attrs, "applyNumberFormat", "1")
+        new_xf = f'<xf{attrs}{m.group(2)}{base[m.end():]}'
+        if new_xf in self.xfs:
+            return self.xfs.index(new_xf)
+        self.xfs.append(new_xf)
+        m = re.search(r'<cellXfs\b([^>]*)>(.*?)</cellXfs>', self.xml, re.S)
+        attrs = _set_attr(m.group(1), "count", str(len(self.xfs)))
+        self.xml = self.xml[:m.start()] + f'<cellXfs{attrs}>{m.group(2)}{new_xf}</cellXfs>' + self.xml[m.end():]
+        self.changed = True
+        return len(self.xfs) - 1
+
+class _SharedStrings:
+    def __init__(self, xml):
+        self.xml = xml
+        self.added = []
+        self.uses = 0
+        m = re.search(r'<sst\b([^>]*)>', xml)
+        if not m or "</sst>" not in xml:
+            # sst rỗng dạng <sst .../> -> không append được an toàn
+            raise XlsxPatchUnsupported("sharedStrings lạ")
+        uc = _attr(m.group(1), "uniqueCount")
+        self.base = int(uc) if uc and uc.isdigit() else len(re.findall(r'<si\b', xml))
+
+    def add(self, text):
+        self.uses += 1
+        self.added.append(text)
+        return self.base + len(self.added) - 1
+
+    def render(self):
+        if not self.added:
+            return self.xml
+        items = []
+        for t in self.added:
+            sp = ' xml:space="preserve"' if t != t.strip() else ""
+            items.append(f'<si><t{sp}>{escape(t)}</t></si>')
+        xml = self.xml.replace("</sst>", "".join(items) + "</sst>", 1)
+        m = re.search(r'<sst\b([^>]*)>', xml)
+        attrs = _set_attr(m.group(1), "uniqueCount", str(self.base + len(self.added)))
+        cnt = _attr(m.group(1), "count")
+        if cnt and cnt.isdigit():
+            attrs = _set_attr(attrs, "count", str(int(cnt) + self.uses))
+        return xml[:m.start()] + f'<sst{attrs}>' + xml[m.end():]
+
+def _cell_xml(ref, s_attr, value, fmt, styles, sst, date1904):
+    s_idx = int(s_attr) if s_attr and s_attr.isdigit() else 0
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        if fmt:
+            s_idx = styles.style_with_format(s_idx, fmt)
+        elif not s_attr:
+            s_idx = styles.style_with_format(s_idx, "yyyy-mm-dd h:mm:ss" if isinstance(value, datetime.datetime) else "yyyy-mm-dd")
+        return f'<c r="{ref}" s="{s_idx}"><v>{_excel_serial(value, date1904)}</v></c>'
+    if fmt:
+        s_idx = styles.style_with_format(s_idx, fmt)
+    s_part = f' s="{s_idx}"' if (s_attr or fmt) else ""
+    if value is None or value == "":
+        return f'<c r="{ref}"{s_part}/>'
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{s_part} t="b"><v>{1 if value else 0}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"{s_part}><v>{repr(value) if isinstance(value, float) else value}</v></c>'
+    text = str(value)
+    if _ILLEGAL_XML.search(text):
+        raise XlsxPatchUnsupported("ký tự không hợp lệ trong XML")
+    if text.startswith("="):
+        raise XlsxPatchUnsupported("công thức")
+    if sst is not None:
+        return f'<c r="{ref}"{s_part} t="s"><v>{sst.add(text)}</v></c>'
+    sp = ' xml:space="preserve"' if text != text.strip() else ""
+    return f'<c r="{ref}"{s_part} t="inlineStr"><is><t{sp}>{escape(text)}</t></is></c>'
+
+def _patch_row(row_xml_open, body, row_idx, updates, styles, sst, date1904):
+    cells = []
+    for m in _CELL_RE.finditer(body):
+        attrs, inner = m.group(1), m.group(3) or ""
+        ref = _attr(attrs, "r")
+        if not ref:
+            raise XlsxPatchUnsupported("ô thiếu r=")
+        col = column_index_from_string(re.match(r'[A-Z]+', ref).group(0))
+        cells.append([col, m.group(0), attrs, inner])
+    by_col = {c[0]: c for c in cells}
+    for col, (value, fmt) in updates.items():
+        ref = f"{get_column_letter(col)}{row_idx}"
+        old = by_col.get(col)
+        if old is not None and "<f" in old[3]:
+            raise XlsxPatchUnsupported("ô đang có công thức")
+        s_attr = _attr(old[2], "s") if old is not None else None
+        new_xml = _cell_xml(ref, s_attr, value, fmt, styles, sst, date1904)
+        if old is not None:
+            old[1] = new_xml
+        else:
+            entry = [col, new_xml, "", ""]
+            cells.append(entry)
+            by_col[col] = entry
+    cells.sort(key=lambda c: c[0])
+    open_tag = row_xml_open
+    spans = re.search(r'\sspans="(\d+):(\d+)"', open_tag)
+    if spans and cells:
+        lo = min(int(spans.group(1)), cells[0][0])
+        hi = max(int(spans.group(2)), cells[-1][0])
+        open_tag = open_tag.replace(spans.group(0), f' spans="{lo}:{hi}"')
+    return open_tag + "".join(c[1] for c in cells) + "</row>"
+
+def _patch_sheet(xml, row_updates, styles, sst, date1904):
+    if "<sheetData" not in xml:
+        raise XlsxPatchUnsupported("sheet có prefix namespace / thiếu sheetData")
+    # sheetData rỗng dạng <sheetData/>
+    if re.search(r'<sheetData\s*/>', xml):
+        xml = re.sub(r'<sheetData\s*/>', '<sheetData></sheetData>', xml, count=1)
+    for row_idx in sorted(row_updates):
+        updates = row_updates[row_idx]
+        m = re.search(r'<row\b[^>]*?\br="%d"[^>]*?(/?)>' % row_idx, xml)
+        if m:
+            if m.group(1) == "/":
+                open_tag = m.group(0)[:-2].rstrip() + ">"
+                start, end, body = m.start(), m.end(), ""
+            else:
+                end_tag = xml.find("</row>", m.end())
+                if end_tag < 0:
+                    raise XlsxPatchUnsupported("row không đóng")
+                open_tag = m.group(0)
+                start, end, body = m.start(), end_tag + len("</row>"), xml[m.end():end_tag]
+            new_row = _patch_row(open_tag, body, row_idx, updates, styles, sst, date1904)
+            xml = xml[:start] + new_row + xml[end:]
+        else:
+            # chưa có dòng -> chèn đúng thứ tự
+            insert_at = None
+            for rm in _ROW_START_RE.finditer(xml):
+                if int(rm.group(1)) > row_idx:
+                    insert_at = rm.start()
+                    break
+            if insert_at is None:
+                insert_at = xml.find("</sheetData>")
+                if insert_at < 0:
+                    raise XlsxPatchUnsupported("thiếu </sheetData>")
+            new_row = _patch_row(f'<row r="{row_idx}">', "", row_idx, updates, styles, sst, date1904)
+            xml = xml[:insert_at] + new_row + xml[insert_at:]
+    return _grow_dimension(xml, row_updates)
+
+def _grow_dimension(xml, row_updates):
+    m = re.search(r'<dimension\b[^>]*\bref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"', xml)
+    if not m:
+        return xml
+    c1, r1 = column_index_from_string(m.group(1)), int(m.group(2))
+    c2 = column_index_from_string(m.group(3)) if m.group(3) else c1
+    r2 = int(m.group(4)) if m.group(4) else r1
+    max_row = max([r2] + list(row_updates.keys()))
+    max_col = max([c2] + [c for u in row_updates.values() for c in u.keys()])
+    if (max_row, max_col) == (r2, c2):
+        return xml
+    ref = f"{get_column_letter(c1)}{r1}:{get_column_letter(max_col)}{max_row}"
+    return xml[:m.start(1)] + ref + xml[m.end(m.lastindex):]
+
+def patch_xlsx_rows(path, row_updates):
+    """
+    Ghi {row_idx: {col: (value, number_format|None)}} vào sheet active của file .xlsx bằng cách sửa XML.
+    - Thành công: ghi file mới (tmp + os.replace) và trả True.
+    - Layout không hỗ trợ: raise XlsxPatchUnsupported (file gốc không bị đụng).
+    """
+    if not row_updates:
+        return True
+    if not path.lower().endswith((".xlsx", ".xlsm")):
+        raise XlsxPatchUnsupported("không phải xlsx")
+    with zipfile.ZipFile(path) as zin:
+        sheet_part = _active_sheet_part(zin)
+        wb_xml = zin.read("xl/workbook.xml").decode("utf-8")
+        date1904 = bool(re.search(r'date1904="(1|true)"', wb_xml))
+        styles_part = _find_part(zin, "xl/styles.xml")
+        if not styles_part:
+            raise XlsxPatchUnsupported("thiếu styles.xml")
+        styles = _Styles(zin.read(styles_part).decode("utf-8"))
+        sst_part = _find_part(zin, "xl/sharedstrings.xml")
+        sst = _SharedStrings(zin.read(sst_part).decode("utf-8")) if sst_part else None
+
+        sheet_xml = zin.read(sheet_part).decode("utf-8")
+        new_sheet = _patch_sheet(sheet_xml, row_updates, styles, sst, date1904)
+
+        patched = {sheet_part: new_sheet.encode("utf-8")}
+        if styles.changed:
+            patched[styles_part] = styles.xml.encode("utf-8")
+        if sst is not None and sst.added:
+            patched[sst_part] = sst.render().encode("utf-8")
+
+        folder = os.path.dirname(os.path.abspath(path))
+        tmp = os.path.join(folder, f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+        try:
+            with zipfile.ZipFile(tmp, "w") as zout:
+                for info in zin.infolist():
+                    if info.filename in patched:
+                        zout.writestr(info, patched[info.filename])
+                    else:
+                        # copy nguyên part không đổi (đọc/ghi theo khối, không giữ cả file trong RAM)
+                        with zin.open(info) as src, zout.open(info, "w") as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+                zout.comment = zin.comment
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+    try:
+        shutil.copymode(path, tmp)
+    except OSError:
+        pass
+    os.replace(tmp, path)
+    return True
@@ -0,0 +1,72 @@
+import time
+import zipfile
+
+# =====================================================
+# ZIP dạng stream: ghi entry nào lấy bytes ra ngay (không giữ cả archive trong RAM, không cần seek)
+# - zipfile tự dùng data descriptor khi file đích không seek được.
+# - Dùng: zs = ZipStream(); yield zs.add("a.docx", data); ...; yield zs.finish()
+# - add_file(): đọc file theo từng khúc CHUNK_SIZE -> RAM không phụ thuộc dung lượng file.
+# - File đã nén sẵn (ảnh JPEG/PNG/WebP, docx, pdf, zip) ghi ZIP_STORED; còn lại ZIP_DEFLATED.
+# =====================================================
+
+CHUNK_SIZE = 256 * 1024
+STORED_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".docx", ".xlsx", ".pdf", ".zip")
+
+
+def compress_type_for(name):
+    """Nén lại file đã nén sẵn chỉ tốn CPU -> STORED."""
+    return zipfile.ZIP_STORED if name.lower().endswith(STORED_EXTS) else zipfile.ZIP_DEFLATED
+
+
+class _Sink:
+    """File đích chỉ ghi (không tell/seek) -> gom bytes để lấy ra theo từng entry."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, b):
+        self._parts.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        out = b"".join(self._parts)
+        self._parts = []
+        return out
+
+
+class ZipStream:
+    def __init__(self, compression=zipfile.ZIP_STORED):
+        self._sink = _Sink()
+        self._zf = zipfile.ZipFile(self._sink, "w", compression=compression)
+
+    def add(self, name, data, compress_type=None):
+        """Ghi 1 entry từ bytes/str; trả về bytes ZIP vừa sinh ra."""
+        zi = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        zi.compress_type = self._zf.compression if compress_type is None else compress_type
+        self._zf.writestr(zi, data)
+        return self._sink.take()
+
+    def add_file(self, name, path, compress_type=None, chunk_size=CHUNK_SIZE):
+        """Ghi 1 entry từ file trên đĩa; generator yield bytes ZIP theo từng khúc đọc được."""
+        zi = zipfile.ZipInfo.from_file(path, name)
+        zi.compress_type = compress_type_for(name) if compress_type is None else compress_type
+        with open(path, "rb") as src, self._zf.open(zi, "w") as dst:
+            while True:
+                buf = src.read(chunk_size)
+                if not buf:
+                    break
+                dst.write(buf)
+                out = self._sink.take()
+                if out:
+                    yield out
+        out = self._sink.take()
+        if out:
+            yield out
+
+    def finish(self):
+        """Đóng archive (central directory); trả về phần bytes cuối."""
+        self._zf.close()
+        return self._sink.take()